@@ -2,7 +2,10 @@
 # Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
 
 """ In this module, the app is instantiated with a given server and cache config. Three global 
-variables shared across all user sessions are also instantiated: data, atlas and figures.
+variables shared across all user sessions are also instantiated: data, atlas and figures. They are
+initialized lazily (see modules/startup.py), in a background thread if the app has already been
+launched once, such that the server can answer requests while they are being loaded. The state of
+the initialization can be queried at /startup.
 """
 
 # ==================================================================================================
@@ -37,7 +40,15 @@ logging.info("Memory use after Figures import" + logmem())
 from modules.atlas import Atlas
 from modules.launch import Launch
 from modules.storage import Storage
-from modules.scRNAseq import ScRNAseq
+from modules.startup import Startup
+from modules.instrumentation import Instrumentation
+from modules.memory import MemoryAccountant
+from modules.shared_arrays import SharedArrayStore
+from modules.execution import return_execution_pool
+from modules.session_store import SessionStore
+from modules.export import ExportService, generate_lipid_images_table
+from modules.prefetch import SlicePrefetcher
+from modules.spatial_index import SpectralTileIndex
 
 # ==================================================================================================
 # --- App pre-computations
@@ -54,37 +65,77 @@ if SAMPLE_DATA:
     path_annotations = "data_sample/annotations/"
     path_db = "data_sample/app_data/data.db"
     cache_dir = "data_sample/cache/"
+    path_shared_arrays = "data_sample/app_data/shared_arrays/"
 else:
     path_data = "data/whole_dataset/"
     path_annotations = "data/annotations/"
     path_db = "data/app_data/data.db"
     cache_dir = "data/cache/"
+    path_shared_arrays = "data/app_data/shared_arrays/"
 
 # Load shelve database
 storage = Storage(path_db)
 
-# Load data
-data = MaldiData(path_data, sample_data=SAMPLE_DATA)
+# When the app is served by several workers (see gunicorn.conf.py), the large read-only arrays are
+# built once and attached as shared memory maps by every worker
+SHARED_ARRAYS = os.environ.get("LBAE_SHARED_ARRAYS", "0") == "1"
+shared_arrays = SharedArrayStore(
+    os.environ.get("LBAE_SHARED_ARRAYS_DIR", path_shared_arrays), enabled=SHARED_ARRAYS
+)
 
 # If True, only a small portions of the figures are precomputed (if precomputation has not already
 # been done). Used for debugging purposes.
 sample = False
 
-# Load Atlas and Figures objects. At first launch, many objects will be precomputed and shelved in
-# the classes Atlas and Figures.
-atlas = Atlas(data, storage, resolution=25, sample=sample)
-scRNAseq = ScRNAseq()
-figures = Figures(data, storage, atlas, scRNAseq, sample=sample)
-logging.info("Memory use after three main object have been instantiated" + logmem())
+# The main objects are registered as lazy components: they are only built on first access, or in a
+# background thread once the server is up (see the end of this file). At first launch, many objects
+# will be precomputed and shelved in the classes Atlas and Figures.
+startup = Startup()
+
+# Read ahead the files of the slices neighbouring the accessed ones, such that navigating through
+# the slices doesn't hit cold files
+prefetcher = SlicePrefetcher(path_data, n_ahead=int(os.environ.get("LBAE_PREFETCH_SLICES", 2)))
+data = startup.register(
+    "data",
+    lambda: MaldiData(
+        path_data, sample_data=SAMPLE_DATA, shared_arrays=shared_arrays, prefetcher=prefetcher
+    ),
+)
+atlas = startup.register(
+    "atlas",
+    lambda: Atlas(
+        data.resolve(), storage, resolution=25, sample=sample, shared_arrays=shared_arrays
+    ),
+)
+scRNAseq = startup.register("scRNAseq", lambda: ScRNAseq())
+figures = startup.register(
+    "figures",
+    lambda: Figures(data.resolve(), storage, atlas.resolve(), scRNAseq.resolve(), sample=sample),
+)
+
+# Precomputed spectra of tiles of pixels, used to sum the spectra of large hand-drawn regions
+spatial_index = SpectralTileIndex(data, storage)
+
+# Maximum memory used to sum the peaks of a selection of pixels at once. Larger selections (e.g.
+# large hand-drawn regions) are processed by blocks of rows, which is slower but doesn't crash
+SPECTRUM_MEMORY_LIMIT = int(os.environ.get("LBAE_SPECTRUM_MEMORY_LIMIT", 256 * 1024**2))
 
 
-# Compute and shelve potentially missing objects
-launch = Launch(data, atlas, figures, storage)
+def initialize_launch():
+    """Compute and shelve potentially missing objects, and compile the main functions. This can be
+    skipped to gain speed at startup... But lose security and speed during use."""
+    launch = Launch(data.resolve(), atlas.resolve(), figures.resolve(), storage, spatial_index)
+    launch.launch()
+    return launch
 
-# This line can be commented out to gain speed at startup... But lose security and speed during use
-launch.launch()
 
-logging.info("Memory use after main functions have been compiled" + logmem())
+launch = startup.register("launch", initialize_launch)
+
+# Initialize in the background only if everything has already been precomputed, as the first
+# launch might exit the app once done
+BACKGROUND_INITIALIZATION = os.environ.get(
+    "LBAE_BACKGROUND_INITIALIZATION", "1"
+) == "1" and storage.check_shelved_object("launch", "first_launch")
 
 # ==================================================================================================
 # --- Instantiate app and caching
@@ -129,10 +180,14 @@ if app.use_redis:
     }
 else:
     CACHE_CONFIG = {
-        # We use 'FileSystemCache' as we want the application to be lightweight in term of RAM
-        "CACHE_TYPE": "FileSystemCache",
-        "CACHE_DIR": cache_dir,
-        "CACHE_THRESHOLD": 200,
+        # We use a diskcache backend as we want the application to be lightweight in term of RAM,
+        # while sharing the memoized results between the workers and across restarts. Only a small
+        # budget of memory is used to keep the most valuable memoized results of each process
+        "CACHE_TYPE": "modules.cache_backend.TieredCache",
+        "CACHE_DIR": cache_dir + "flask/",
+        "CACHE_SIZE_LIMIT": int(os.environ.get("LBAE_CACHE_SIZE_LIMIT", 2 * 1024**3)),
+        "CACHE_MEMORY_LIMIT": int(os.environ.get("LBAE_CACHE_MEMORY_LIMIT", 256 * 1024**2)),
+        "CACHE_GROUP_BUDGETS": {"region_spectra": 128 * 1024**2},
     }
 
 # Initiate Cache
@@ -142,3 +197,109 @@ cache_flask.init_app(app.server, config=CACHE_CONFIG)  # Comment this line for a
 # Initiate the cache as unlocked
 cache_flask.set("locked-cleaning", False)
 cache_flask.set("locked-reading", False)
+
+# Keep the results computed for each user session (e.g. the spectra of the selected regions), such
+# that they're not recomputed or posted back by the browser
+session_store = SessionStore(
+    memory_limit=int(os.environ.get("LBAE_SESSION_STORE_MEMORY_LIMIT", 256 * 1024**2)),
+    default_ttl=int(os.environ.get("LBAE_SESSION_STORE_TTL", 1800)),
+)
+
+# Write the exports (e.g. spectra, lipid images) in the background, and stream them from
+# /export/<job_id>/download
+export_service = ExportService(cache_dir + "exports/")
+export_service.register_routes(server)
+
+
+@server.route("/export/lipid_images")
+def export_lipid_images():
+    """Submit the export of the images of the lipids (lipid_name arguments) of a slice, and return
+    the id of the export job. Invalid arguments are rejected before the job is submitted."""
+    format_export = flask.request.args.get("format", "npz")
+    if format_export not in export_service.return_formats():
+        flask.abort(400)
+    try:
+        slice_index = int(flask.request.args.get("slice_index", 1))
+    except ValueError:
+        flask.abort(400)
+    if slice_index not in data.get_slice_list():
+        flask.abort(400)
+
+    # Check the lipid names, as the job would only fail once running
+    l_lipid_names = flask.request.args.getlist("lipid_name")
+    try:
+        lipid_plasma_array = data.get_lipid_plasma_array(slice_index)
+    except IndexError:
+        # Lipid images are not available for all slices
+        flask.abort(400)
+    if len(l_lipid_names) == 0 or any(
+        f"{slice_index}_{lipid_name}" not in lipid_plasma_array for lipid_name in l_lipid_names
+    ):
+        flask.abort(400)
+
+    job_id = export_service.submit(
+        flask.request.args.get("session_id", None),
+        "lipid_images_slice_" + str(slice_index),
+        format_export,
+        generate_lipid_images_table,
+        data=data,
+        slice_index=slice_index,
+        l_lipid_names=l_lipid_names,
+    )
+    return flask.jsonify({"id": job_id})
+
+
+# Instrument all the callbacks registered from now on (i.e. in the pages), the metrics being
+# exposed at /metrics
+instrumentation = Instrumentation(cache_long_callback)
+instrumentation.instrument_app(app, cache_flask)
+
+# Expose the state of the queues of the pool running the CPU-bound computations off the event loop
+instrumentation.register_collector(lambda: return_execution_pool().return_metrics_lines())
+
+# Expose the hits, misses and size of the flask cache
+if not app.use_redis:
+    instrumentation.register_collector(cache_flask.cache.return_metrics_lines)
+
+# Expose the hits, misses and size of the session store
+instrumentation.register_collector(session_store.return_metrics_lines)
+
+# Expose the accesses to the slices and the page cache residency of their files
+instrumentation.register_collector(prefetcher.return_metrics_lines)
+
+
+# Expose the state and profile of the startup
+@server.route("/startup")
+def startup_report():
+    """Return the readiness of each global object, along with the time and memory taken to
+    initialize it."""
+    return flask.jsonify(startup.return_report())
+
+
+# Account for the memory held by the main objects
+memory_accountant = MemoryAccountant(
+    {"data": data, "atlas": atlas, "scRNAseq": scRNAseq, "figures": figures, "storage": storage}
+)
+
+
+@server.route("/admin/memory")
+def memory_report():
+    """Return the memory held by each main object (only to local clients). A new snapshot is taken
+    if the snapshot argument is set."""
+    if flask.request.remote_addr not in ["127.0.0.1", "::1"]:
+        flask.abort(403)
+    if flask.request.args.get("snapshot", "0") == "1":
+        memory_accountant.take_snapshot()
+    return flask.jsonify(memory_accountant.return_report())
+
+
+# Create the execution pool from the main thread, before the startup thread uses it. Under gevent,
+# the pool is bound to the hub of the thread creating it, and a pool bound to the startup thread
+# would run the tasks of the request greenlets inline
+return_execution_pool()
+
+# Initialize the main objects, in the background if possible such that the server can answer
+# requests (e.g. the home page) immediately
+startup.start(background=BACKGROUND_INITIALIZATION)
+if not BACKGROUND_INITIALIZATION:
+    logging.info("Memory use after main functions have been compiled" + logmem())
@@ -0,0 +1,716 @@
+# Copyright (c) 2022, Colas Droin. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
+
+""" This script runs a reproducible benchmark suite over the critical paths of the app, with fixed
+inputs, and records the timing distribution and the peak memory of each benchmark in a JSON results
+file. Two results files can then be compared, flagging the benchmarks that have regressed. The
+benchmarks requiring data which is not available (e.g. the MALDI data, which is not shipped in
+data_sample/) are skipped, and reported as such in the results file. Such data can be generated at
+any scale with benchmarks/generate_synthetic_dataset.py.
+
+It must be run from the root of the repository:
+
+`python -m benchmarks.benchmark run --output results.json`
+
+`python -m benchmarks.benchmark compare baseline.json results.json --threshold 0.1`
+"""
+
+# ==================================================================================================
+# --- Imports
+# ==================================================================================================
+
+# Standard modules
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import numba
+import psutil
+import tifffile
+
+# LBAE imports
+from modules.storage import Storage
+from modules.tools.image import convert_image_to_base64
+from modules.tools.spectra import (
+    compute_image_using_index_lookup,
+    compute_spectrum_per_row_selection,
+    compute_spectrum_per_row_selection_bounded,
+    reduce_resolution_sorted_array_spectra,
+    return_number_of_threads,
+    sample_rows_from_path,
+)
+from modules.tools.volume import fill_array_interpolation
+
+# ==================================================================================================
+# --- Fixed inputs
+# ==================================================================================================
+
+# Same inputs as the ones used to simulate user actions in Launch.run_compiled_functions()
+SLICE_INDEX = 1
+ARRAY_PATH = np.array(
+    [(53, 108), (54, 102), (59, 101), (58, 103), (56, 105), (53, 108)], dtype=np.int32
+)
+LOW_BOUND, HIGH_BOUND = 622.61, 622.62
+SET_ID_REGIONS = {1006}
+
+# Seed used for all the synthetic inputs
+SEED = 0
+
+# ==================================================================================================
+# --- Classes
+# ==================================================================================================
+
+
+class BenchmarkSkipped(Exception):
+    """Exception raised by the setup of a benchmark when the data it requires is not available."""
+
+    pass
+
+
+class BenchmarkContext:
+    """Class used to lazily build, and share between benchmarks, the objects of the app used as
+    inputs (data, storage, atlas, figures). Objects which cannot be built (e.g. because the data is
+    missing) make the benchmarks depending on them skip.
+
+    Attributes:
+        path_data (str): Path of the folder containing the MALDI data.
+        path_lipids (str): Path of the folder containing the lipid arrays.
+        path_lipizones (str): Path of the folder containing the lipizones data.
+        path_db (str): Path of the shelve database.
+        path_atlas (str): Path of the folder containing the sample Allen Brain Atlas.
+        sample_data (bool): If True, the MALDI data is loaded as a sampled dataset (i.e. from a
+            compressed pickle, without memory maps).
+        dic_objects (dict): Objects already built, indexed by name.
+        dic_errors (dict): Error messages of the objects which could not be built, indexed by name.
+
+    Methods:
+        __init__(path_data, path_lipids, path_lipizones, path_db, path_atlas, sample_data=False):
+            Initialize the BenchmarkContext class.
+        get(name): Return the object with the given name, building it if needed.
+    """
+
+    def __init__(
+        self, path_data, path_lipids, path_lipizones, path_db, path_atlas, sample_data=False
+    ):
+        """Initialize the class BenchmarkContext.
+
+        Args:
+            path_data (str): Path of the folder containing the MALDI data.
+            path_lipids (str): Path of the folder containing the lipid arrays.
+            path_lipizones (str): Path of the folder containing the lipizones data.
+            path_db (str): Path of the shelve database.
+            path_atlas (str): Path of the folder containing the sample Allen Brain Atlas.
+            sample_data (bool, optional): If True, the MALDI data is loaded as a sampled dataset.
+                Defaults to False.
+        """
+        self.path_data = path_data
+        self.path_lipids = path_lipids
+        self.path_lipizones = path_lipizones
+        self.path_db = path_db
+        self.path_atlas = path_atlas
+        self.sample_data = sample_data
+        self.dic_objects = {}
+        self.dic_errors = {}
+
+    def _build(self, name):
+        """This function builds the object with the given name.
+
+        Args:
+            name (str): Name of the object. Either "data", "storage", "atlas", "figures" or
+                "reference".
+
+        Returns:
+            (object): The object.
+        """
+        if name == "data":
+            from modules.maldi_data import MaldiData
+
+            if not os.path.exists(self.path_data + "light_arrays.pickle"):
+                raise BenchmarkSkipped("No MALDI data found in " + self.path_data)
+            return MaldiData(
+                self.path_data,
+                path_lipids=self.path_lipids,
+                path_lipizones=self.path_lipizones,
+                sample_data=self.sample_data,
+            )
+        elif name == "storage":
+            if not os.path.exists(os.path.dirname(self.path_db)):
+                raise BenchmarkSkipped("No shelve database found in " + self.path_db)
+            return Storage(self.path_db)
+        elif name == "atlas":
+            from modules.atlas import Atlas
+
+            return Atlas(self.get("data"), self.get("storage"), resolution=25)
+        elif name == "figures":
+            from modules.figures import Figures
+            from modules.scRNAseq import ScRNAseq
+
+            return Figures(self.get("data"), self.get("storage"), self.get("atlas"), ScRNAseq())
+        elif name == "reference":
+            path_reference = os.path.join(self.path_atlas, "reference.tiff")
+            if not os.path.exists(path_reference):
+                raise BenchmarkSkipped("No reference volume found in " + self.path_atlas)
+            return tifffile.imread(path_reference)
+        raise ValueError("Unknown object " + name)
+
+    def get(self, name):
+        """This function returns the object with the given name, building it the first time it is
+        requested. If the object could not be built, BenchmarkSkipped is raised, with the reason.
+
+        Args:
+            name (str): Name of the object.
+
+        Returns:
+            (object): The object.
+        """
+        if name in self.dic_errors:
+            raise BenchmarkSkipped(self.dic_errors[name])
+        if name not in self.dic_objects:
+            try:
+                self.dic_objects[name] = self._build(name)
+            except BenchmarkSkipped as e:
+                self.dic_errors[name] = str(e)
+                raise
+            except Exception as e:
+                self.dic_errors[name] = "Could not build " + name + ": " + repr(e)
+                raise BenchmarkSkipped(self.dic_errors[name])
+        return self.dic_objects[name]
+
+
+# ==================================================================================================
+# --- Benchmarks
+# ==================================================================================================
+
+# Each benchmark is defined by a setup function, taking the context and returning the function to
+# time (taking no argument). Setup is not timed.
+dic_benchmarks = {}
+
+
+def register_benchmark(name):
+    """Decorator used to register the setup function of a benchmark.
+
+    Args:
+        name (str): Name of the benchmark.
+
+    Returns:
+        (func): The decorator.
+    """
+
+    def decorator(setup_function):
+        dic_benchmarks[name] = setup_function
+        return setup_function
+
+    return decorator
+
+
+@register_benchmark("compute_image_using_index_lookup")
+def setup_compute_image_using_index_lookup(context):
+    """Benchmark of the computation of a lipid image from the lookup tables of slice 1."""
+    data = context.get("data")
+    l_args = [
+        LOW_BOUND,
+        HIGH_BOUND,
+        data.get_array_spectra(SLICE_INDEX),
+        data.get_array_lookup_pixels(SLICE_INDEX),
+        data.get_image_shape(SLICE_INDEX),
+        data.get_array_lookup_mz(SLICE_INDEX),
+        data.get_divider_lookup(SLICE_INDEX),
+        data.get_array_peaks_transformed_lipids(SLICE_INDEX),
+        data.get_array_corrective_factors(SLICE_INDEX).astype(np.float32),
+    ]
+    return lambda: compute_image_using_index_lookup(*l_args)
+
+
+@register_benchmark("compute_spectrum_per_row_selection")
+def setup_compute_spectrum_per_row_selection(context):
+    """Benchmark of the computation of the spectrum of a region drawn on slice 1."""
+    data = context.get("data")
+    list_index_bound_rows, list_index_bound_column_per_row = sample_rows_from_path(ARRAY_PATH)
+    l_args = [
+        list_index_bound_rows,
+        list_index_bound_column_per_row,
+        data.get_array_spectra(SLICE_INDEX),
+        data.get_array_lookup_pixels(SLICE_INDEX),
+        data.get_image_shape(SLICE_INDEX),
+        data.get_array_peaks_transformed_lipids(SLICE_INDEX),
+        data.get_array_corrective_factors(SLICE_INDEX).astype(np.float32),
+    ]
+    return lambda: compute_spectrum_per_row_selection(
+        *l_args, zeros_extend=False, apply_correction=False, n_threads=return_number_of_threads()
+    )
+
+
+def return_synthetic_selection(rng, image_shape=(64, 64), n_peaks_max=8):
+    """This function builds synthetic spectral data, along with a selection of rows of pixels whose
+    column intervals start and end on empty pixels, and some of which are entirely empty. Pixels
+    outside of the selection are not empty, such that reading past the boundaries of an interval
+    changes the result.
+
+    Args:
+        rng (np.random.Generator): Used to draw the peaks.
+        image_shape (int, int, optional): Shape of the synthetic slice. Defaults to (64, 64).
+        n_peaks_max (int, optional): Maximum number of peaks per pixel. Defaults to 8.
+
+    Returns:
+        (list): The arguments of compute_spectrum_per_row_selection().
+        (np.ndarray): The expected spectrum, computed pixel by pixel.
+    """
+    height, width = image_shape
+    list_index_bound_rows = np.array([8, height - 9], dtype=np.int32)
+    n_rows = list_index_bound_rows[1] - list_index_bound_rows[0] + 1
+    list_index_bound_column_per_row = np.zeros((n_rows, 4), dtype=np.int32)
+    array_empty = np.zeros(image_shape, dtype=bool)
+    for i, row in enumerate(range(list_index_bound_rows[0], list_index_bound_rows[1] + 1)):
+        column_1 = rng.integers(1, width // 2 - 4)
+        column_2 = rng.integers(width // 2 + 4, width - 1)
+        list_index_bound_column_per_row[i, :2] = (column_1, column_2)
+        array_empty[row, column_1 : column_1 + 2] = True
+        array_empty[row, column_2 - 1 : column_2 + 1] = True
+        # Second interval, entirely empty
+        list_index_bound_column_per_row[i, 2:] = (width // 2 - 2, width // 2 + 2)
+        array_empty[row, width // 2 - 2 : width // 2 + 3] = True
+
+    # Build the spectra, sorted by m/z within each pixel
+    l_spectra = []
+    array_pixel_indexes = np.full((height * width, 2), -1, dtype=np.int32)
+    n_peaks_total = 0
+    for idx_pix in range(height * width):
+        if array_empty.flat[idx_pix]:
+            continue
+        n_peaks = rng.integers(1, n_peaks_max + 1)
+        array_mz = np.sort(rng.choice(np.arange(400, 410, 0.001), n_peaks, replace=False))
+        l_spectra.append(np.array([array_mz, rng.random(n_peaks) + 0.1], dtype=np.float32))
+        array_pixel_indexes[idx_pix] = (n_peaks_total, n_peaks_total + n_peaks - 1)
+        n_peaks_total += n_peaks
+    array_spectra = np.concatenate(l_spectra, axis=1)
+
+    # Expected spectrum, pixel by pixel
+    l_selected = []
+    for i, row in enumerate(range(list_index_bound_rows[0], list_index_bound_rows[1] + 1)):
+        for column in range(
+            list_index_bound_column_per_row[i, 0], list_index_bound_column_per_row[i, 1] + 1
+        ):
+            idx_1, idx_2 = array_pixel_indexes[row * width + column]
+            if idx_1 != -1:
+                l_selected.append(array_spectra[:, idx_1 : idx_2 + 1])
+    array_expected = np.concatenate(l_selected, axis=1)
+    array_expected = array_expected[:, np.argsort(array_expected[0], kind="stable")]
+    array_expected = reduce_resolution_sorted_array_spectra(array_expected, resolution=10**-4)
+
+    l_args = [
+        list_index_bound_rows,
+        list_index_bound_column_per_row,
+        array_spectra,
+        array_pixel_indexes,
+        image_shape,
+        np.zeros((0, 4), dtype=np.float32),
+        np.zeros((0, height, width), dtype=np.float32),
+    ]
+    return l_args, array_expected
+
+
+@register_benchmark("compute_spectrum_per_row_selection_empty_bounds")
+def setup_compute_spectrum_per_row_selection_empty_bounds(context):
+    """Benchmark (and regression check) of the computation of the spectrum of a synthetic selection
+    whose row intervals start and end on empty pixels. The benchmark fails if the spectrum differs
+    from the one computed pixel by pixel."""
+    l_args, array_expected = return_synthetic_selection(np.random.default_rng(SEED))
+
+    def run_and_check():
+        array_spectrum = compute_spectrum_per_row_selection(
+            *l_args,
+            zeros_extend=False,
+            apply_correction=False,
+            n_threads=return_number_of_threads(),
+        )
+        if array_spectrum.shape != array_expected.shape or not np.allclose(
+            array_spectrum, array_expected, rtol=1e-5
+        ):
+            raise ValueError("The spectrum of the selection differs from the expected one")
+
+    return run_and_check
+
+
+@register_benchmark("compute_spectrum_per_row_selection_bounded_empty_bounds")
+def setup_compute_spectrum_per_row_selection_bounded_empty_bounds(context):
+    """Benchmark (and regression check) of the computation by blocks of rows of the spectrum of the
+    same synthetic selection, with a memory limit small enough to process a few rows per block. The
+    benchmark fails if the spectrum differs from the one computed pixel by pixel."""
+    l_args, array_expected = return_synthetic_selection(np.random.default_rng(SEED))
+
+    def run_and_check():
+        array_spectrum = compute_spectrum_per_row_selection_bounded(
+            *l_args, zeros_extend=False, apply_correction=False, memory_limit_bytes=2**12
+        )
+        if array_spectrum.shape != array_expected.shape or not np.allclose(
+            array_spectrum, array_expected, rtol=1e-5
+        ):
+            raise ValueError("The spectrum of the selection differs from the expected one")
+
+    return run_and_check
+
+
+@register_benchmark("compute_3D_volume_figure")
+def setup_compute_3D_volume_figure(context):
+    """Benchmark of the computation of the 3D volume figure of a lipid in a region."""
+    figures = context.get("figures")
+    data = context.get("data")
+    ll_t_bounds = [[None, None, None] for i in data.get_slice_list(indices="brain_1")]
+    ll_t_bounds[0] = [[(LOW_BOUND, HIGH_BOUND)], None, None]
+    return lambda: figures.compute_3D_volume_figure(
+        None, ll_t_bounds, set_id_regions=SET_ID_REGIONS
+    )
+
+
+@register_benchmark("convert_image_to_base64")
+def setup_convert_image_to_base64(context):
+    """Benchmark of the encoding of an image as a base64 PNG string."""
+    # Use the middle coronal section of the sample reference volume, scaled as a lipid image
+    array_reference = context.get("reference")
+    image = array_reference[array_reference.shape[0] // 2].astype(np.float32)
+    image = (255 * image / np.max(image)).astype(np.uint8)
+    image = np.kron(image, np.ones((4, 4), dtype=np.uint8))
+    return lambda: convert_image_to_base64(image, optimize=True, format="png")
+
+
+@register_benchmark("storage_return_shelved_object")
+def setup_storage_return_shelved_object(context):
+    """Benchmark of the loading of a shelved array (4MB) from the shelve database."""
+    # Use a temporary shelve database, such that the benchmark is independent of the app data
+    path_dir = tempfile.mkdtemp(prefix="lbae_benchmark_")
+    storage = Storage(os.path.join(path_dir, "data.db"))
+    rng = np.random.default_rng(SEED)
+    array_object = rng.random((1000, 1000), dtype=np.float32)
+    storage.return_shelved_object(
+        "benchmark", "array", force_update=True, compute_function=lambda: array_object
+    )
+    return lambda: storage.return_shelved_object(
+        "benchmark", "array", force_update=False, compute_function=lambda: array_object
+    )
+
+
+@register_benchmark("lipizones_getters")
+def setup_lipizones_getters(context):
+    """Benchmark of all the getters of the lipizones data, for slice 1."""
+    data = context.get("data")
+    df_lipizones = data._df_lipizones
+    section = df_lipizones["Section"].unique()[0]
+    division = df_lipizones["division"].unique()[0]
+    lipizone = data.get_lipizone_names()[0]
+
+    def run_getters():
+        data.get_lipizones_section_array(SLICE_INDEX)
+        data.get_lipizones_array(SLICE_INDEX)
+        data.get_lipid_green_array(SLICE_INDEX)
+        data.get_lipid_plasma_array(SLICE_INDEX)
+        data.get_lipizone_names()
+        data.get_lipizone_color(lipizone)
+        data.get_lipizones_divisions()
+        data.get_lipizones_coordinates(section)
+        data.get_lipizones_boundaries(section)
+        data.get_lipizones_division(division, section)
+        data.get_lipizones_centroids(0, None)
+
+    return run_getters
+
+
+@register_benchmark("fill_array_interpolation")
+def setup_fill_array_interpolation(context):
+    """Benchmark of the interpolation of the lipid expression between slices."""
+    # Build a pseudo-annotation from the sample reference volume (downsampled twice), by binning
+    # its intensities into structures, and a sparse lipid expression array with one slice out of 4
+    array_reference = context.get("reference")[::2, ::2, ::2].astype(np.float32)
+    array_inside = array_reference > np.percentile(array_reference, 30)
+    array_annotation = np.where(
+        array_inside,
+        np.digitize(array_reference, np.percentile(array_reference, np.arange(30, 100, 10))),
+        -1,
+    ).astype(np.float32)
+    rng = np.random.default_rng(SEED)
+    array_slices = np.where(array_inside, -0.01, -1.0).astype(np.float32)
+    array_slices[::4] = np.where(
+        array_inside[::4], rng.random(array_inside[::4].shape, dtype=np.float32), -1.0
+    )
+    return lambda: fill_array_interpolation(array_annotation, array_slices)
+
+
+# ==================================================================================================
+# --- Functions
+# ==================================================================================================
+
+
+def return_environment():
+    """This function returns a description of the environment in which the benchmarks are run, to
+    be stored along with the results.
+
+    Returns:
+        (dict): The description of the environment.
+    """
+    try:
+        commit = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except Exception:
+        commit = None
+    return {
+        "commit": commit,
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "numba": numba.__version__,
+        "platform": platform.platform(),
+        "n_cpus": psutil.cpu_count(),
+    }
+
+
+def compute_statistics(l_times):
+    """This function computes summary statistics over the timings of a benchmark.
+
+    Args:
+        l_times (list(float)): Timings of the repeats, in seconds.
+
+    Returns:
+        (dict): The minimum, median, mean, standard deviation, 95th percentile and maximum timings.
+    """
+    array_times = np.array(l_times)
+    return {
+        "min": float(np.min(array_times)),
+        "median": float(np.median(array_times)),
+        "mean": float(np.mean(array_times)),
+        "std": float(np.std(array_times)),
+        "p95": float(np.percentile(array_times, 95)),
+        "max": float(np.max(array_times)),
+    }
+
+
+def run_benchmark(function, n_repeats=10, n_warmup=1):
+    """This function times a benchmark, and measures its peak memory.
+
+    The first runs (warmup) are not timed, such that numba compilation and cold memory-mapped reads
+    are excluded. The peak memory is measured in a separate run, as tracing python allocations
+    slows the execution down. Since numba allocations are not traced, the increase of the process
+    resident memory during this run is also recorded.
+
+    Args:
+        function (func): Function taking no argument, executing the benchmarked code.
+        n_repeats (int, optional): Number of timed runs. Defaults to 10.
+        n_warmup (int, optional): Number of untimed runs. Defaults to 1.
+
+    Returns:
+        (dict): The timings of each run, their statistics, the traced peak memory and the increase
+            of resident memory, in bytes.
+    """
+    for _ in range(n_warmup):
+        function()
+
+    l_times = []
+    for _ in range(n_repeats):
+        time_start = time.perf_counter()
+        function()
+        l_times.append(time.perf_counter() - time_start)
+
+    process = psutil.Process()
+    rss_start = process.memory_info().rss
+    tracemalloc.start()
+    function()
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    rss_increase = max(0, process.memory_info().rss - rss_start)
+
+    return {
+        "status": "ok",
+        "times": l_times,
+        "statistics": compute_statistics(l_times),
+        "peak_memory": peak_memory,
+        "rss_increase": rss_increase,
+    }
+
+
+def run(context, l_names=None, n_repeats=10, n_warmup=1):
+    """This function runs the requested benchmarks.
+
+    Args:
+        context (BenchmarkContext): Used to build the inputs of the benchmarks.
+        l_names (list(str), optional): Names of the benchmarks to run. Defaults to None,
+            corresponding to all benchmarks.
+        n_repeats (int, optional): Number of timed runs per benchmark. Defaults to 10.
+        n_warmup (int, optional): Number of untimed runs per benchmark. Defaults to 1.
+
+    Returns:
+        (dict): The results, with the description of the environment and the result of each
+            benchmark.
+    """
+    dic_results = {
+        "environment": return_environment(),
+        "parameters": {"n_repeats": n_repeats, "n_warmup": n_warmup, "seed": SEED},
+        "benchmarks": {},
+    }
+    for name, setup_function in dic_benchmarks.items():
+        if l_names is not None and name not in l_names:
+            continue
+        try:
+            function = setup_function(context)
+        except BenchmarkSkipped as e:
+            logging.warning("Skipping benchmark " + name + ": " + str(e))
+            dic_results["benchmarks"][name] = {"status": "skipped", "reason": str(e)}
+            continue
+        try:
+            dic_results["benchmarks"][name] = run_benchmark(function, n_repeats, n_warmup)
+        except Exception as e:
+            logging.error("Benchmark " + name + " failed: " + repr(e))
+            dic_results["benchmarks"][name] = {"status": "failed", "reason": repr(e)}
+            continue
+        logging.info(
+            "Benchmark "
+            + name
+            + ": median "
+            + str(round(dic_results["benchmarks"][name]["statistics"]["median"] * 1000, 3))
+            + "ms"
+        )
+    return dic_results
+
+
+def compare(dic_baseline, dic_results, threshold=0.1):
+    """This function compares two benchmark results. A benchmark is flagged as regressed if its
+    median timing, or its peak memory, has increased by more than the given threshold compared to
+    the baseline.
+
+    Args:
+        dic_baseline (dict): Results used as reference.
+        dic_results (dict): Results to compare to the reference.
+        threshold (float, optional): Relative increase above which a benchmark is flagged.
+            Defaults to 0.1.
+
+    Returns:
+        (list(dict)): For each benchmark present in both results, the baseline and current median
+            timing and peak memory, their ratios, and whether it has regressed.
+    """
+    l_comparisons = []
+    for name, dic_current in dic_results["benchmarks"].items():
+        dic_reference = dic_baseline["benchmarks"].get(name, None)
+        if dic_reference is None or dic_reference["status"] != "ok":
+            continue
+        if dic_current["status"] != "ok":
+            continue
+        time_ratio = dic_current["statistics"]["median"] / dic_reference["statistics"]["median"]
+        memory_ratio = (dic_current["peak_memory"] + 1) / (dic_reference["peak_memory"] + 1)
+        l_comparisons.append(
+            {
+                "name": name,
+                "baseline_median": dic_reference["statistics"]["median"],
+                "median": dic_current["statistics"]["median"],
+                "time_ratio": time_ratio,
+                "baseline_peak_memory": dic_reference["peak_memory"],
+                "peak_memory": dic_current["peak_memory"],
+                "memory_ratio": memory_ratio,
+                "regressed": time_ratio > 1 + threshold or memory_ratio > 1 + threshold,
+            }
+        )
+    return l_comparisons
+
+
+def format_comparison(l_comparisons):
+    """This function returns a comparison as a human-readable table.
+
+    Args:
+        l_comparisons (list(dict)): The comparison, as returned by compare().
+
+    Returns:
+        (str): The table.
+    """
+    l_lines = [
+        "{:<36}{:>14}{:>14}{:>9}{:>14}{:>9}".format(
+            "benchmark", "baseline (ms)", "current (ms)", "ratio", "peak (MB)", "ratio"
+        )
+    ]
+    for dic_comparison in l_comparisons:
+        l_lines.append(
+            "{:<36}{:>14.3f}{:>14.3f}{:>9.2f}{:>14.1f}{:>9.2f}".format(
+                dic_comparison["name"],
+                dic_comparison["baseline_median"] * 1000,
+                dic_comparison["median"] * 1000,
+                dic_comparison["time_ratio"],
+                dic_comparison["peak_memory"] / 1024**2,
+                dic_comparison["memory_ratio"],
+            )
+            + (" REGRESSION" if dic_comparison["regressed"] else "")
+        )
+    return "\n".join(l_lines)
+
+
+# ==================================================================================================
+# --- Command line
+# ==================================================================================================
+
+
+def main(l_arguments=None):
+    """This function parses the command line arguments, and either runs the benchmarks or compares
+    two results files.
+
+    Args:
+        l_arguments (list(str), optional): Command line arguments. Defaults to None, corresponding
+            to sys.argv.
+
+    Returns:
+        (int): The exit code, 1 if a regression has been found, 0 otherwise.
+    """
+    parser = argparse.ArgumentParser(description="LBAE benchmark suite.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parser_run = subparsers.add_parser("run", help="Run the benchmarks.")
+    parser_run.add_argument("--output", default="benchmark_results.json")
+    parser_run.add_argument("--repeats", type=int, default=10)
+    parser_run.add_argument("--warmup", type=int, default=1)
+    parser_run.add_argument("--benchmarks", nargs="*", default=None, choices=list(dic_benchmarks))
+    parser_run.add_argument("--path-data", default="data_sample/whole_dataset/")
+    parser_run.add_argument("--path-lipids", default="data_sample/lipids/")
+    parser_run.add_argument("--path-lipizones", default="data_sample/lipizones/")
+    parser_run.add_argument("--path-db", default="data_sample/app_data/data.db")
+    parser_run.add_argument("--path-atlas", default="data_sample/atlas/allen_mouse_100um_v1.2/")
+    parser_run.add_argument("--sample-data", action="store_true")
+
+    parser_compare = subparsers.add_parser("compare", help="Compare two results files.")
+    parser_compare.add_argument("baseline")
+    parser_compare.add_argument("results")
+    parser_compare.add_argument("--threshold", type=float, default=0.1)
+
+    args = parser.parse_args(l_arguments)
+
+    if args.command == "run":
+        context = BenchmarkContext(
+            args.path_data,
+            args.path_lipids,
+            args.path_lipizones,
+            args.path_db,
+            args.path_atlas,
+            sample_data=args.sample_data,
+        )
+        dic_results = run(context, args.benchmarks, args.repeats, args.warmup)
+        with open(args.output, "w") as handle:
+            json.dump(dic_results, handle, indent=2)
+        logging.info("Results written to " + args.output)
+        return 0
+
+    with open(args.baseline) as handle:
+        dic_baseline = json.load(handle)
+    with open(args.results) as handle:
+        dic_results = json.load(handle)
+    l_comparisons = compare(dic_baseline, dic_results, args.threshold)
+    print(format_comparison(l_comparisons))
+    return 1 if any(x["regressed"] for x in l_comparisons) else 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s.%(msecs)03d %(levelname)s %(module)s - %(funcName)s: %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+    sys.exit(main())
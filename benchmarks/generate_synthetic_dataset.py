@@ -0,0 +1,654 @@
+# Copyright (c) 2022, Colas Droin. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
+
+""" This script generates a synthetic dataset at a configurable scale, in the exact on-disk formats
+loaded by the classes MaldiData and Atlas, such that every subsystem of the app can be tested for
+scaling offline, without access to the real data. It generates:
+
+- The MALDI data (whole_dataset/): for each slice, the lightweight arrays registered in
+    light_arrays.pickle, and the memory-mapped arrays (spectra, averaged spectra, lookup tables and
+    MAIA corrective factors). The lookup tables are built with the functions used for the real data
+    (see modules/tools/lookup_tables.py). With --sample-data, all the arrays are stored in a
+    compressed light_arrays.pickle instead, as in data_sample/.
+- The lipizones data (lipizones/): the lipizones dataframe (one row per point, with the expression
+    of 548 lipids, the ccfv3 coordinates, and the lipizone annotations and hierarchy), along with
+    the images of each lipizone and of each section.
+- The lipid images (lipids/), in green and plasma colormaps.
+- The registration data (tiff_files/): the coordinates of the warped and original acquisitions in
+    the ccfv3, the warped images and the original images.
+
+The annotation volume of the Allen Brain Atlas is not generated, as it is downloaded by BrainGlobe.
+Since the paths of the registration data are hardcoded in the app, the output folder should be
+data/ (or data_sample/ with --sample-data) to be used by the app directly. The lipids and lipizones
+data always come in 3 sections, as in MaldiData. It must be run from the root of the repository:
+
+`python -m benchmarks.generate_synthetic_dataset --output data/ --n-slices 32 --image-shape 160 228`
+"""
+
+# ==================================================================================================
+# --- Imports
+# ==================================================================================================
+
+# Standard modules
+import argparse
+import logging
+import lzma
+import os
+import pickle
+import time
+import numpy as np
+import pandas as pd
+import tifffile
+from matplotlib import cm
+
+# LBAE imports
+from modules.tools.lookup_tables import (
+    DIVIDER_LOOKUP,
+    build_index_lookup_table,
+    build_cumulated_image_lookup_table,
+    build_index_lookup_table_averaged_spectrum,
+)
+from modules.tools.spectra import add_zeros_to_spectrum
+from modules.tools.misc import logmem
+
+# ==================================================================================================
+# --- Constants
+# ==================================================================================================
+
+# Shape of the Allen Brain Atlas (in voxels) for each resolution (in um)
+dic_atlas_shape = {10: (1320, 800, 1140), 25: (528, 320, 456), 100: (132, 80, 114)}
+
+# Number of lipids in the lipizones dataframe, and number of sections, hardcoded in MaldiData
+N_LIPIDS_LIPIZONES = 548
+N_SECTIONS_LIPIZONES = 3
+
+# Shape of the full-size lipizones grid, and of the (downsampled) lipid and lipizone images
+LIPIZONES_GRID_SHAPE = (918, 1311)
+LIPIZONES_IMAGE_SHAPE = (459, 655)
+
+# Range of the m/z values of the spectra, and half-width of the annotation of a peak
+MZ_RANGE = (400, 1200)
+PEAK_HALF_WIDTH = 3 * 10**-4
+
+# Names of the arrays stored as memory maps for each slice
+l_memmap_arrays = [
+    "array_spectra",
+    "array_avg_spectrum",
+    "array_avg_spectrum_after_standardization",
+    "array_lookup_mz",
+    "array_cumulated_lookup_mz_image",
+    "array_corrective_factors",
+]
+
+# ==================================================================================================
+# --- Functions
+# ==================================================================================================
+
+
+def return_brain_mask(shape, margin=0.05):
+    """This function returns an elliptic mask, used as a synthetic brain section.
+
+    Args:
+        shape (tuple(int)): Shape of the mask.
+        margin (float, optional): Relative margin between the ellipse and the borders of the mask.
+            Defaults to 0.05.
+
+    Returns:
+        (np.ndarray): A boolean array of the requested shape, True inside the brain.
+    """
+    array_rows, array_columns = np.ogrid[: shape[0], : shape[1]]
+    array_distance = ((array_rows - shape[0] / 2) / ((0.5 - margin) * shape[0])) ** 2 + (
+        (array_columns - shape[1] / 2) / ((0.5 - margin) * shape[1])
+    ) ** 2
+    return array_distance < 1
+
+
+def compute_averaged_spectrum(array_mz, array_intensity, n_pixels, resolution):
+    """This function computes the spectrum averaged over all pixels, with the m/z values binned at
+    the given resolution, and pads it with zeros for display, as done for the real data.
+
+    Args:
+        array_mz (np.ndarray): m/z values of all the peaks of all the pixels.
+        array_intensity (np.ndarray): Corresponding intensities.
+        n_pixels (int): Total number of pixels of the slice.
+        resolution (float): Resolution of the m/z bins.
+
+    Returns:
+        (np.ndarray): An array of shape (2,n) containing the averaged spectrum.
+    """
+    array_bins = np.round(array_mz / resolution).astype(np.int64)
+    array_unique_bins, array_inverse = np.unique(array_bins, return_inverse=True)
+    array_avg_intensity = np.bincount(array_inverse, weights=array_intensity) / n_pixels
+    array_avg_spectrum = np.array(
+        [array_unique_bins * resolution, array_avg_intensity], dtype=np.float32
+    )
+    array_avg_spectrum, _ = add_zeros_to_spectrum(array_avg_spectrum, pad_individual_peaks=True)
+    return array_avg_spectrum
+
+
+def generate_maldi_slice(rng, image_shape, array_peaks_mz, n_peaks_per_pixel, n_lipids_transformed):
+    """This function generates the arrays of a synthetic MALDI acquisition, in the format produced
+    by the data processing pipeline (see modules/tools/maldi_conversion.py and
+    modules/tools/lookup_tables.py). Each pixel of the brain mask contains a random subset of the
+    peaks, TIC-normalized, with a spatial pattern specific to each peak.
+
+    Args:
+        rng (np.random.Generator): Random generator.
+        image_shape (tuple(int)): Shape of the acquisition.
+        array_peaks_mz (np.ndarray): Sorted m/z values of all the peaks of the dataset.
+        n_peaks_per_pixel (int): Average number of peaks per pixel.
+        n_lipids_transformed (int): Number of peaks annotated as MAIA-transformed lipids.
+
+    Returns:
+        (dict): A dictionnary containing the arrays of the slice, with the same keys as the ones
+            used in MaldiData.
+    """
+    n_peaks = array_peaks_mz.shape[0]
+    n_pixels = image_shape[0] * image_shape[1]
+    array_mask = return_brain_mask(image_shape).ravel()
+    array_pixels_brain = np.flatnonzero(array_mask)
+
+    # Draw the peaks of each pixel, sorted by pixel and m/z (i.e. peak index)
+    array_counts = np.clip(rng.poisson(n_peaks_per_pixel, array_pixels_brain.shape[0]), 1, n_peaks)
+    array_pixel = np.repeat(array_pixels_brain, array_counts).astype(np.int64)
+    array_peak = rng.integers(0, n_peaks, array_pixel.shape[0])
+    array_keys = np.unique(array_pixel * n_peaks + array_peak)
+    array_pixel = (array_keys // n_peaks).astype(np.int32)
+    array_peak = (array_keys % n_peaks).astype(np.int32)
+    del array_keys
+
+    # m/z values are jittered within the peak annotation
+    array_mz = array_peaks_mz[array_peak] + rng.integers(-2, 3, array_peak.shape[0]) * 10**-4
+
+    # Intensities follow a spatial gradient specific to each peak, and are TIC-normalized
+    array_abundance = rng.lognormal(0, 1, n_peaks)
+    array_angle = rng.uniform(0, 2 * np.pi, n_peaks)
+    array_rows, array_columns = np.divmod(array_pixel, image_shape[1])
+    array_gradient = 1 + 0.5 * np.sin(
+        2
+        * np.pi
+        * (
+            np.cos(array_angle[array_peak]) * array_rows / image_shape[0]
+            + np.sin(array_angle[array_peak]) * array_columns / image_shape[1]
+        )
+    )
+    array_intensity = (
+        array_abundance[array_peak] * array_gradient * rng.lognormal(0, 0.3, array_peak.shape[0])
+    )
+    array_TIC = np.bincount(array_pixel, weights=array_intensity, minlength=n_pixels)
+    array_intensity = array_intensity / array_TIC[array_pixel]
+    array_spectra = np.array([array_mz, array_intensity], dtype=np.float32)
+    del array_gradient, array_rows, array_columns
+
+    # Map each pixel to its boundaries in array_spectra (upper boundary included)
+    array_lookup_pixels = np.full((n_pixels, 2), -1, dtype=np.int32)
+    array_first = np.searchsorted(array_pixel, array_pixels_brain, side="left")
+    array_last = np.searchsorted(array_pixel, array_pixels_brain, side="right") - 1
+    array_lookup_pixels[array_pixels_brain, 0] = array_first
+    array_lookup_pixels[array_pixels_brain, 1] = array_last
+
+    # Annotate some of the peaks as MAIA-transformed lipids (min peak, max peak, number of pixels,
+    # estimated m/z), sorted by min_mz
+    array_idx_lipids = np.sort(rng.choice(n_peaks, n_lipids_transformed, replace=False))
+    array_n_pix = np.bincount(array_peak, minlength=n_peaks)[array_idx_lipids]
+    array_peaks_transformed_lipids = np.array(
+        [
+            array_peaks_mz[array_idx_lipids] - PEAK_HALF_WIDTH,
+            array_peaks_mz[array_idx_lipids] + PEAK_HALF_WIDTH,
+            array_n_pix,
+            array_peaks_mz[array_idx_lipids],
+        ],
+        dtype=np.float64,
+    ).T
+
+    # Smooth corrective factors around 1, and the corresponding standardized intensities
+    array_corrective_factors = np.ones(
+        (n_lipids_transformed, image_shape[0], image_shape[1]), dtype=np.float32
+    )
+    array_rows, array_columns = np.ogrid[: image_shape[0], : image_shape[1]]
+    for idx_lipid in range(n_lipids_transformed):
+        phase = rng.uniform(0, 2 * np.pi)
+        array_corrective_factors[idx_lipid] += 0.2 * np.sin(
+            phase + 4 * np.pi * array_rows / image_shape[0]
+        ) * np.cos(phase + 4 * np.pi * array_columns / image_shape[1])
+    array_idx_transformed = np.full(n_peaks, -1, dtype=np.int32)
+    array_idx_transformed[array_idx_lipids] = np.arange(n_lipids_transformed)
+    array_lipid = array_idx_transformed[array_peak]
+    array_is_lipid = array_lipid >= 0
+    array_intensity_standardized = np.array(array_intensity)
+    array_intensity_standardized[array_is_lipid] *= array_corrective_factors.reshape(
+        n_lipids_transformed, -1
+    )[array_lipid[array_is_lipid], array_pixel[array_is_lipid]]
+
+    # Averaged spectra, in low and high resolution, and the corresponding lookup table
+    array_avg_spectrum_downsampled = compute_averaged_spectrum(
+        array_mz, array_intensity, n_pixels, resolution=10**-2
+    )
+    array_avg_spectrum = compute_averaged_spectrum(
+        array_mz, array_intensity, n_pixels, resolution=10**-4
+    )
+    array_avg_spectrum_after_standardization = compute_averaged_spectrum(
+        array_mz, array_intensity_standardized, n_pixels, resolution=10**-4
+    )
+    array_lookup_mz_avg = build_index_lookup_table_averaged_spectrum(array_avg_spectrum[0, :])
+
+    # Lookup tables of the spectra of each pixel
+    array_image_shape = np.array(image_shape)
+    array_lookup_mz = build_index_lookup_table(array_spectra, array_lookup_pixels, DIVIDER_LOOKUP)
+    array_cumulated_lookup_mz_image = build_cumulated_image_lookup_table(
+        array_spectra, array_lookup_pixels, array_image_shape, DIVIDER_LOOKUP
+    )
+
+    return {
+        "image_shape": array_image_shape,
+        "divider_lookup": DIVIDER_LOOKUP,
+        "array_avg_spectrum_downsampled": array_avg_spectrum_downsampled,
+        "array_lookup_pixels": array_lookup_pixels,
+        "array_lookup_mz_avg": array_lookup_mz_avg,
+        "array_peaks_transformed_lipids": array_peaks_transformed_lipids,
+        "array_spectra": array_spectra,
+        "array_avg_spectrum": array_avg_spectrum,
+        "array_avg_spectrum_after_standardization": array_avg_spectrum_after_standardization,
+        "array_lookup_mz": array_lookup_mz,
+        "array_cumulated_lookup_mz_image": array_cumulated_lookup_mz_image,
+        "array_corrective_factors": array_corrective_factors,
+    }
+
+
+def generate_maldi_data(
+    path_output,
+    n_slices_brain_1,
+    n_slices_brain_2,
+    image_shape,
+    n_peaks,
+    n_peaks_per_pixel,
+    n_lipids_transformed,
+    seed=0,
+    sample_data=False,
+):
+    """This function generates the synthetic MALDI data of all slices, and saves it in the format
+    loaded by MaldiData.
+
+    Args:
+        path_output (str): Path of the folder in which the data is saved (e.g. whole_dataset/).
+        n_slices_brain_1 (int): Number of slices of brain 1.
+        n_slices_brain_2 (int): Number of slices of brain 2.
+        image_shape (tuple(int)): Shape of each acquisition.
+        n_peaks (int): Total number of distinct peaks in the dataset.
+        n_peaks_per_pixel (int): Average number of peaks per pixel.
+        n_lipids_transformed (int): Number of peaks annotated as MAIA-transformed lipids.
+        seed (int, optional): Seed of the random generator. Defaults to 0.
+        sample_data (bool, optional): If True, all the arrays are stored in a compressed pickle, as
+            in data_sample/. Else, the heavy arrays are stored as memory maps. Defaults to False.
+    """
+    os.makedirs(path_output, exist_ok=True)
+    rng = np.random.default_rng(seed)
+
+    # Peaks are shared by all slices, and spaced such that jittered m/z values don't overlap
+    spacing = (MZ_RANGE[1] - MZ_RANGE[0]) / n_peaks
+    array_peaks_mz = np.round(
+        np.linspace(MZ_RANGE[0], MZ_RANGE[1], n_peaks, endpoint=False)
+        + rng.uniform(0.1, 0.9, n_peaks) * spacing,
+        4,
+    )
+
+    dic_slices = {}
+    for slice_index in range(1, n_slices_brain_1 + n_slices_brain_2 + 1):
+        time_start = time.time()
+        dic_slice = generate_maldi_slice(
+            rng, image_shape, array_peaks_mz, n_peaks_per_pixel, n_lipids_transformed
+        )
+        dic_slice["is_brain_1"] = slice_index <= n_slices_brain_1
+
+        # Store the heavy arrays as memory maps, and register their shape
+        if not sample_data:
+            for array_name in l_memmap_arrays:
+                array = dic_slice.pop(array_name)
+                fp = np.memmap(
+                    path_output + array_name + "_" + str(slice_index) + ".mmap",
+                    dtype="float32" if array_name != "array_lookup_mz" else "int32",
+                    mode="w+",
+                    shape=array.shape,
+                )
+                fp[:] = array[:]
+                fp.flush()
+                dic_slice[array_name + "_shape"] = array.shape
+                del fp, array
+        dic_slices[slice_index] = dic_slice
+        logging.info(
+            "Slice "
+            + str(slice_index)
+            + " generated in "
+            + str(round(time.time() - time_start, 2))
+            + "s"
+            + logmem()
+        )
+
+    if sample_data:
+        with lzma.open(path_output + "light_arrays.pickle", "wb") as handle:
+            pickle.dump(dic_slices, handle)
+    else:
+        with open(path_output + "light_arrays.pickle", "wb") as handle:
+            pickle.dump(dic_slices, handle)
+
+
+def return_lipid_names(n_lipids=N_LIPIDS_LIPIZONES):
+    """This function returns unique synthetic lipid names (e.g. "PC 34:1").
+
+    Args:
+        n_lipids (int, optional): Number of lipid names. Defaults to N_LIPIDS_LIPIZONES.
+
+    Returns:
+        (list(str)): The lipid names.
+    """
+    l_classes = ["PC", "PE", "PS", "PI", "PG", "SM", "Cer", "HexCer", "LPC", "LPE", "TG", "DG"]
+    l_names = []
+    for i in range(n_lipids):
+        lipid_class = l_classes[i % len(l_classes)]
+        n_carbons = 30 + (i // len(l_classes)) % 14
+        n_double_bonds = (i // (len(l_classes) * 14)) % 7
+        l_names.append(lipid_class + " " + str(n_carbons) + ":" + str(n_double_bonds))
+    return l_names
+
+
+def generate_lipizones_data(path_output, n_points_per_section, n_levels, seed=0):
+    """This function generates the lipizones dataframe, in the format loaded by MaldiData. Each
+    section is split into lipizones (a Voronoi tessellation of the section), organized as a binary
+    hierarchy stored in the columns bottomup1 to bottomup<n_levels>. The expression of each lipid
+    in each point is drawn around the profile of its lipizone.
+
+    Args:
+        path_output (str): Path of the folder in which the dataframe is saved (e.g. lipizones/).
+        n_points_per_section (int): Number of points (i.e. rows) per section.
+        n_levels (int): Number of levels of the hierarchy, such that there are 2**n_levels
+            lipizones.
+        seed (int, optional): Seed of the random generator. Defaults to 0.
+
+    Returns:
+        (pd.DataFrame): The lipizones dataframe.
+    """
+    os.makedirs(path_output, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    n_lipizones = 2**n_levels
+    l_lipids = return_lipid_names()
+    l_lipizone_names = ["lipizone_" + str(i + 1) for i in range(n_lipizones)]
+    l_colors = [
+        "#{:02x}{:02x}{:02x}".format(*[int(255 * x) for x in cm.get_cmap("tab20")(i % 20)[:3]])
+        for i in range(n_lipizones)
+    ]
+    array_profiles = rng.lognormal(0, 0.5, (n_lipizones, N_LIPIDS_LIPIZONES))
+
+    l_df = []
+    array_mask = return_brain_mask(LIPIZONES_GRID_SHAPE)
+    array_points_brain = np.argwhere(array_mask)
+    for section in range(1, N_SECTIONS_LIPIZONES + 1):
+        # Draw points inside the section, and assign them to the closest lipizone center
+        array_points = array_points_brain[
+            rng.choice(array_points_brain.shape[0], n_points_per_section, replace=False)
+        ]
+        array_centers = array_points_brain[
+            rng.choice(array_points_brain.shape[0], n_lipizones, replace=False)
+        ]
+        array_distances = np.linalg.norm(
+            array_points[:, None, :].astype(np.float32) - array_centers[None, :, :], axis=2
+        )
+        array_sorted = np.sort(array_distances, axis=1)
+        array_lipizone = np.argmin(array_distances, axis=1)
+
+        df = pd.DataFrame(
+            (
+                array_profiles[array_lipizone]
+                * rng.lognormal(0, 0.2, (n_points_per_section, N_LIPIDS_LIPIZONES))
+            ).astype(np.float32),
+            columns=l_lipids,
+        )
+        df["Section"] = section
+        df["y_index"] = array_points[:, 0]
+        df["z_index"] = array_points[:, 1]
+        df["yccf"] = array_points[:, 0] * 0.01
+        df["zccf"] = array_points[:, 1] * 0.01
+        df["boundary"] = (array_sorted[:, 1] - array_sorted[:, 0] < 4).astype(np.int64)
+        df["lipizone_names"] = [l_lipizone_names[x] for x in array_lipizone]
+        df["lipizone_color"] = [l_colors[x] for x in array_lipizone]
+        df["division"] = ["division_" + str(x >> (n_levels - 1)) for x in array_lipizone]
+        for level in range(1, n_levels + 1):
+            df["bottomup" + str(level)] = array_lipizone >> (n_levels - level)
+        l_df.append(df)
+
+    df_lipizones = pd.concat(l_df, ignore_index=True)
+    df_lipizones.to_hdf(path_output + "datavignettes20240815.h5ad", key="table", mode="w")
+    return df_lipizones
+
+
+def compute_points_image(df, array_colors):
+    """This function draws the points of a dataframe on a downsampled lipizones grid.
+
+    Args:
+        df (pd.DataFrame): Dataframe containing the columns y_index and z_index.
+        array_colors (np.ndarray): Color of each point, of shape (n_points,) or (n_points, 4).
+
+    Returns:
+        (np.ndarray): The image, of shape LIPIZONES_IMAGE_SHAPE (+ the color channels).
+    """
+    image = np.zeros(LIPIZONES_IMAGE_SHAPE + array_colors.shape[1:], dtype=np.uint8)
+    image[df["y_index"].values // 2, df["z_index"].values // 2] = array_colors
+    return image
+
+
+def generate_lipizones_images(path_output, df_lipizones):
+    """This function generates the images of each lipizone and of each section, in the npz files
+    loaded by MaldiData.
+
+    Args:
+        path_output (str): Path of the folder in which the images are saved (e.g. lipizones/).
+        df_lipizones (pd.DataFrame): The lipizones dataframe.
+    """
+    dic_sections = {}
+    for section in range(1, N_SECTIONS_LIPIZONES + 1):
+        df_section = df_lipizones[df_lipizones["Section"] == section]
+        array_colors = np.array(
+            [
+                [int(color[i : i + 2], 16) for i in (1, 3, 5)] + [255]
+                for color in df_section["lipizone_color"]
+            ],
+            dtype=np.uint8,
+        )
+        dic_sections[str(section)] = compute_points_image(df_section, array_colors)
+
+        dic_lipizones = {}
+        for lipizone in df_section["lipizone_names"].unique():
+            array_is_lipizone = (df_section["lipizone_names"] == lipizone).values
+            dic_lipizones[lipizone] = compute_points_image(
+                df_section[array_is_lipizone], array_colors[array_is_lipizone]
+            )
+        np.savez(path_output + "small_lipizones_arrays_" + str(section) + ".npz", **dic_lipizones)
+    np.savez(path_output + "small_lipizones_sections_arrays.npz", **dic_sections)
+
+
+def generate_lipid_images(path_output, df_lipizones, n_lipid_images):
+    """This function generates the images of the lipids, in green (single channel) and plasma
+    (RGBA) colormaps, in the npz files loaded by MaldiData. Images are keyed by
+    "<section>_<lipid name>".
+
+    Args:
+        path_output (str): Path of the folder in which the images are saved (e.g. lipids/).
+        df_lipizones (pd.DataFrame): The lipizones dataframe.
+        n_lipid_images (int): Number of lipids (taken in the order of the dataframe columns) for
+            which images are generated.
+    """
+    os.makedirs(path_output, exist_ok=True)
+    l_lipids = df_lipizones.columns.tolist()[:N_LIPIDS_LIPIZONES][:n_lipid_images]
+    colormap = cm.get_cmap("plasma")
+    for section in range(1, N_SECTIONS_LIPIZONES + 1):
+        df_section = df_lipizones[df_lipizones["Section"] == section]
+        dic_green = {}
+        dic_plasma = {}
+        for lipid in l_lipids:
+            # Normalize the expression between the 2nd and 98th percentiles
+            array_values = df_section[lipid].values
+            low, high = np.percentile(array_values, [2, 98])
+            array_values = np.clip((array_values - low) / (high - low), 0, 1)
+            dic_green[str(section) + "_" + lipid] = compute_points_image(
+                df_section, (255 * array_values).astype(np.uint8)
+            )
+            dic_plasma[str(section) + "_" + lipid] = compute_points_image(
+                df_section, (255 * colormap(array_values)).astype(np.uint8)
+            )
+        np.savez(path_output + "small_lipids_green_arrays_" + str(section) + ".npz", **dic_green)
+        np.savez(path_output + "small_lipids_plasma_arrays_" + str(section) + ".npz", **dic_plasma)
+
+
+def generate_registration_data(
+    path_output, n_slices, image_shape, atlas_resolution=25, seed=0, sample_data=False
+):
+    """This function generates the registration data of the slices of brain 1, in the format loaded
+    by Atlas and Figures. Slices are coronal planes evenly spaced along the antero-posterior axis
+    of the atlas. Coordinates are in mm.
+
+    Args:
+        path_output (str): Path of the folder in which the data is saved (e.g. tiff_files/).
+        n_slices (int): Number of slices of brain 1.
+        image_shape (tuple(int)): Shape of each original acquisition.
+        atlas_resolution (int, optional): Resolution of the atlas (in um) used to define the shape
+            of the warped images. Defaults to 25.
+        seed (int, optional): Seed of the random generator. Defaults to 0.
+        sample_data (bool, optional): If True, the data is saved as npz/npy files, as in
+            data_sample/. Else, it is saved as tiff files. Defaults to False.
+    """
+    rng = np.random.default_rng(seed)
+    atlas_shape = dic_atlas_shape[atlas_resolution]
+    warped_shape = atlas_shape[1:]
+    resolution_mm = atlas_resolution / 1000
+    os.makedirs(path_output + "coordinates_original_data/", exist_ok=True)
+    os.makedirs(path_output + "original_data/", exist_ok=True)
+
+    array_x = np.linspace(0.2, 0.8, n_slices) * atlas_shape[0] * resolution_mm
+    array_rows, array_columns = np.mgrid[: warped_shape[0], : warped_shape[1]]
+    array_coordinates_warped_data = np.empty((n_slices,) + warped_shape + (3,), dtype=np.float32)
+    array_warped_data = np.zeros((n_slices,) + warped_shape, dtype=np.uint8)
+    array_mask_warped = return_brain_mask(warped_shape)
+    array_mask_original = return_brain_mask(image_shape)
+
+    # Original acquisitions cover the same field of view as the warped images
+    pixel_size_mm = (
+        warped_shape[0] * resolution_mm / image_shape[0],
+        warped_shape[1] * resolution_mm / image_shape[1],
+    )
+    array_rows_original, array_columns_original = np.mgrid[: image_shape[0], : image_shape[1]]
+    for i in range(n_slices):
+        array_coordinates_warped_data[i, :, :, 0] = array_x[i]
+        array_coordinates_warped_data[i, :, :, 1] = array_rows * resolution_mm
+        array_coordinates_warped_data[i, :, :, 2] = array_columns * resolution_mm
+        array_warped_data[i][array_mask_warped] = rng.integers(
+            50, 255, np.count_nonzero(array_mask_warped)
+        )
+
+        array_original_coor = np.empty(tuple(image_shape) + (3,), dtype=np.float32)
+        array_original_coor[:, :, 0] = array_x[i]
+        array_original_coor[:, :, 1] = array_rows_original * pixel_size_mm[0]
+        array_original_coor[:, :, 2] = array_columns_original * pixel_size_mm[1]
+        array_original_slice = np.zeros(image_shape, dtype=np.uint8)
+        array_original_slice[array_mask_original] = rng.integers(
+            50, 255, np.count_nonzero(array_mask_original)
+        )
+
+        # File names must be parsable by Atlas.compute_array_projection()
+        name = "slice_" + str(i + 1)
+        if sample_data:
+            np.save(
+                path_output + "coordinates_original_data/" + name + "-coords.npy",
+                array_original_coor,
+            )
+            tifffile.imwrite(path_output + "original_data/" + name + ".tiff", array_original_slice)
+        else:
+            tifffile.imwrite(
+                path_output + "coordinates_original_data/" + name + "-coords.tiff",
+                array_original_coor,
+            )
+            # The real acquisitions are stored as RGB, the last channel being used
+            tifffile.imwrite(
+                path_output + "original_data/" + name + ".tiff",
+                np.repeat(array_original_slice[:, :, None], 3, axis=2),
+            )
+
+    if sample_data:
+        np.savez(
+            path_output + "coordinates_warped_data.npz",
+            array_coordinates_warped_data=array_coordinates_warped_data,
+        )
+        np.savez(path_output + "warped_data.npz", array_warped_data=array_warped_data)
+    else:
+        tifffile.imwrite(path_output + "coordinates_warped_data.tif", array_coordinates_warped_data)
+        tifffile.imwrite(path_output + "warped_data.tif", array_warped_data)
+
+
+# ==================================================================================================
+# --- Command line
+# ==================================================================================================
+
+
+def main(l_arguments=None):
+    """This function parses the command line arguments and generates the synthetic dataset.
+
+    Args:
+        l_arguments (list(str), optional): Command line arguments. Defaults to None, corresponding
+            to sys.argv.
+    """
+    parser = argparse.ArgumentParser(description="Generate a synthetic LBAE dataset.")
+    parser.add_argument("--output", default="data_synthetic/")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--sample-data", action="store_true")
+    parser.add_argument("--n-slices", type=int, default=4, help="Number of slices of brain 1.")
+    parser.add_argument("--n-slices-brain-2", type=int, default=0)
+    parser.add_argument("--image-shape", type=int, nargs=2, default=[80, 114])
+    parser.add_argument("--n-peaks", type=int, default=2000)
+    parser.add_argument("--n-peaks-per-pixel", type=int, default=200)
+    parser.add_argument("--n-lipids-transformed", type=int, default=50)
+    parser.add_argument("--atlas-resolution", type=int, default=25, choices=list(dic_atlas_shape))
+    parser.add_argument("--n-points-per-section", type=int, default=5000)
+    parser.add_argument("--n-levels", type=int, default=5, help="There are 2**n_levels lipizones.")
+    parser.add_argument("--n-lipid-images", type=int, default=20)
+    args = parser.parse_args(l_arguments)
+
+    path_output = os.path.join(args.output, "")
+    image_shape = tuple(args.image_shape)
+
+    logging.info("Generating MALDI data" + logmem())
+    generate_maldi_data(
+        path_output + "whole_dataset/",
+        args.n_slices,
+        args.n_slices_brain_2,
+        image_shape,
+        args.n_peaks,
+        args.n_peaks_per_pixel,
+        args.n_lipids_transformed,
+        seed=args.seed,
+        sample_data=args.sample_data,
+    )
+
+    logging.info("Generating lipizones data" + logmem())
+    df_lipizones = generate_lipizones_data(
+        path_output + "lipizones/", args.n_points_per_section, args.n_levels, seed=args.seed
+    )
+    generate_lipizones_images(path_output + "lipizones/", df_lipizones)
+    generate_lipid_images(path_output + "lipids/", df_lipizones, args.n_lipid_images)
+
+    logging.info("Generating registration data" + logmem())
+    generate_registration_data(
+        path_output + "tiff_files/",
+        args.n_slices,
+        image_shape,
+        atlas_resolution=args.atlas_resolution,
+        seed=args.seed,
+        sample_data=args.sample_data,
+    )
+    logging.info("Synthetic dataset generated in " + path_output + logmem())
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s.%(msecs)03d %(levelname)s %(module)s - %(funcName)s: %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+    main()
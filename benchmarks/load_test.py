@@ -0,0 +1,932 @@
+# Copyright (c) 2022, Colas Droin. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
+
+""" This script runs a load test against a running instance of the app, by replaying realistic
+sequences of Dash callbacks (slice navigation, lipid selection, region drawing and spectrum
+computation, 3D volume computation) with several concurrent virtual users. Each virtual user behaves
+like a (simplified) Dash renderer: it fetches the layout and the callback graph of the app, keeps
+track of the value of every component property, fires the server-side callbacks whose inputs have
+changed (including the initial calls of the components added to the layout), and polls the long
+callbacks until they complete. Throughput, latency percentiles and error rates are reported per
+scenario, per user action and per callback, and recorded in a JSON results file.
+
+The server must be started beforehand (e.g. with `python main.py`), and the script must be run from
+the root of the repository:
+
+`python -m benchmarks.load_test --url http://127.0.0.1:8050 --users 8 --duration 120`
+"""
+
+# ==================================================================================================
+# --- Imports
+# ==================================================================================================
+
+# Standard modules
+import argparse
+import concurrent.futures
+import json
+import logging
+import random
+import sys
+import threading
+import time
+import uuid
+import numpy as np
+import requests
+
+# ==================================================================================================
+# --- Fixed inputs
+# ==================================================================================================
+
+# Region drawn on page 3, in the coordinates of the slice image (same path as the one used in
+# Launch.run_compiled_functions())
+L_PATH_REGION = [(53, 108), (54, 102), (59, 101), (58, 103), (56, 105), (53, 108)]
+
+# Prefix of the components created by Dash for each long callback
+PREFIX_LONG_CALLBACK = "_long_callback_"
+
+# ==================================================================================================
+# --- Classes
+# ==================================================================================================
+
+
+class CallbackGraph:
+    """Class used to represent the server-side callbacks of the app, as returned by the
+    /_dash-dependencies route of the server. It is shared (read-only) by all the virtual users.
+
+    Attributes:
+        l_callbacks (list(dict)): List of server-side callbacks, each with its output string, its
+            list of outputs, inputs and states (as (id, property) tuples), and whether its initial
+            call must be prevented.
+        dic_callbacks_per_input (dict): Dictionnary associating each (id, property) tuple to the
+            indices of the callbacks having it as input.
+
+    Methods:
+        __init__(l_dependencies): Initialize the CallbackGraph class.
+        parse_output(output): Parse the output string of a callback.
+        return_triggered_callbacks(set_changed_props): Return the callbacks triggered by a set of
+            property changes.
+    """
+
+    def __init__(self, l_dependencies):
+        """Initialize the class CallbackGraph.
+
+        Args:
+            l_dependencies (list(dict)): Callback graph, as returned by /_dash-dependencies.
+        """
+        self.l_callbacks = []
+        self.dic_callbacks_per_input = {}
+        for dependency in l_dependencies:
+            # Clientside callbacks are not replayed
+            if dependency.get("clientside_function") is not None:
+                continue
+            l_outputs, multi = self.parse_output(dependency["output"])
+            callback = {
+                "output": dependency["output"],
+                "l_outputs": l_outputs,
+                "multi": multi,
+                "l_inputs": [(x["id"], x["property"]) for x in dependency["inputs"]],
+                "l_states": [(x["id"], x["property"]) for x in dependency["state"]],
+                "prevent_initial_call": dependency.get("prevent_initial_call", False),
+            }
+            for prop in callback["l_inputs"]:
+                self.dic_callbacks_per_input.setdefault(prop, []).append(len(self.l_callbacks))
+            self.l_callbacks.append(callback)
+
+    @staticmethod
+    def parse_output(output):
+        """This function parses the output string of a callback, which is "id.property" for a single
+        output, and "..id_1.property_1...id_2.property_2.." for multiple outputs.
+
+        Args:
+            output (str): The output string.
+
+        Returns:
+            (list(tuple), bool): The list of (id, property) tuples, and whether the callback has
+                multiple outputs.
+        """
+        multi = output.startswith("..")
+        l_outputs = output[2:-2].split("...") if multi else [output]
+        return [tuple(x.rsplit(".", 1)) for x in l_outputs], multi
+
+    def return_triggered_callbacks(self, set_changed_props):
+        """This function returns the indices of the callbacks triggered by a set of property
+        changes, in the order in which they have been registered.
+
+        Args:
+            set_changed_props (set(tuple)): Set of (id, property) tuples that have changed.
+
+        Returns:
+            (list(int)): The indices of the triggered callbacks.
+        """
+        set_indices = set()
+        for prop in set_changed_props:
+            set_indices.update(self.dic_callbacks_per_input.get(prop, []))
+        return sorted(set_indices)
+
+
+class Recorder:
+    """Class used to record, in a thread-safe manner, the outcome of every request and every user
+    action performed during the load test.
+
+    Attributes:
+        l_records (list(dict)): List of records.
+        lock (threading.Lock): Lock used to append records from several threads.
+
+    Methods:
+        __init__(): Initialize the Recorder class.
+        record(kind, name, scenario, latency, error=None): Record a request or an action.
+        summarize(duration): Compute the statistics of the records.
+    """
+
+    def __init__(self):
+        """Initialize the class Recorder."""
+        self.l_records = []
+        self.lock = threading.Lock()
+
+    def record(self, kind, name, scenario, latency, error=None):
+        """Record a request or an action.
+
+        Args:
+            kind (str): Either "request" (a single HTTP request) or "action" (a user action,
+                i.e. all the requests it has triggered).
+            name (str): Name of the callback output or of the action.
+            scenario (str): Name of the scenario being run.
+            latency (float): Latency, in seconds.
+            error (str, optional): Error message if the request or action failed. Defaults to None.
+        """
+        with self.lock:
+            self.l_records.append(
+                {
+                    "kind": kind,
+                    "name": name,
+                    "scenario": scenario,
+                    "latency": latency,
+                    "error": error,
+                    "time": time.time(),
+                }
+            )
+
+    def summarize(self, duration):
+        """This function computes the throughput, latency percentiles and error rate of the
+        requests and actions recorded, overall, per scenario, per action and per callback.
+
+        Args:
+            duration (float): Wall time of the load test, in seconds.
+
+        Returns:
+            (dict): The statistics.
+        """
+        with self.lock:
+            l_records = list(self.l_records)
+
+        l_requests = [x for x in l_records if x["kind"] == "request"]
+        l_actions = [x for x in l_records if x["kind"] == "action"]
+        dic_summary = {
+            "requests": compute_statistics(l_requests, duration),
+            "actions": compute_statistics(l_actions, duration),
+            "per_scenario": {},
+            "per_action": {},
+            "per_callback": {},
+        }
+        for key, l_subset, field in [
+            ("per_scenario", l_actions, "scenario"),
+            ("per_action", l_actions, "name"),
+            ("per_callback", l_requests, "name"),
+        ]:
+            for name in sorted(set(x[field] for x in l_subset)):
+                dic_summary[key][name] = compute_statistics(
+                    [x for x in l_subset if x[field] == name], duration
+                )
+        dic_summary["errors"] = sorted(
+            set(x["name"] + ": " + x["error"] for x in l_records if x["error"] is not None)
+        )
+        return dic_summary
+
+
+class VirtualUser:
+    """Class used to simulate a user of the app. Like the Dash renderer, it keeps track of the value
+    of each component property, and sends the requests to the server-side callbacks triggered by
+    each user action, until no property changes anymore and all the long callbacks have completed.
+    Requests are sent sequentially, such that each virtual user has at most one pending request.
+
+    Attributes:
+        url (str): URL of the server.
+        graph (CallbackGraph): Callback graph of the app.
+        recorder (Recorder): Recorder of the requests and actions.
+        session (requests.Session): HTTP session of the user.
+        timeout (float): Timeout of each request, and of the polling of each long callback, in
+            seconds.
+        max_depth (int): Maximum number of successive rounds of callbacks triggered by an action.
+        rng (random.Random): Random generator of the user.
+        dic_props (dict): Value of each known component property, indexed by (id, property).
+        dic_children_ids (dict): Ids of the components contained in each children property, indexed
+            by (id, property), used to forget the components removed from the layout.
+        scenario (str): Name of the scenario being run.
+
+    Methods:
+        __init__(url, graph, recorder, timeout=60, max_depth=10, seed=0): Initialize the VirtualUser
+            class.
+        collect_props(tree): Record the properties of the components of a layout tree.
+        get_prop(id_component, prop, default=None): Return the value of a component property.
+        return_first_option(id_component): Return the first option of a dropdown.
+        call_callback(callback, set_changed_props): Send the request of a callback.
+        apply_response(dic_response): Update the component properties from a callback response.
+        propagate(set_changed_props, set_new_ids): Fire the callbacks triggered by some changes.
+        poll_long_callbacks(): Poll the long callbacks in progress.
+        interact(name, dic_changes): Perform a user action.
+        load_app(): Load the app layout.
+        navigate(pathname): Navigate to a page of the app.
+    """
+
+    def __init__(self, url, graph, recorder, timeout=60, max_depth=10, seed=0):
+        """Initialize the class VirtualUser.
+
+        Args:
+            url (str): URL of the server.
+            graph (CallbackGraph): Callback graph of the app.
+            recorder (Recorder): Recorder of the requests and actions.
+            timeout (float, optional): Timeout of each request, and of the polling of each long
+                callback, in seconds. Defaults to 60.
+            max_depth (int, optional): Maximum number of successive rounds of callbacks triggered by
+                an action. Defaults to 10.
+            seed (int, optional): Seed of the random generator of the user. Defaults to 0.
+        """
+        self.url = url.rstrip("/")
+        self.graph = graph
+        self.recorder = recorder
+        self.session = requests.Session()
+        self.timeout = timeout
+        self.max_depth = max_depth
+        self.rng = random.Random(seed)
+        self.dic_props = {}
+        self.dic_children_ids = {}
+        self.scenario = None
+
+    # ==============================================================================================
+    # --- Component properties
+    # ==============================================================================================
+
+    def collect_props(self, tree):
+        """This function walks a layout tree (as serialized by Dash), and records the properties of
+        the components having an id.
+
+        Args:
+            tree (dict, list, or object): The layout tree.
+
+        Returns:
+            (set(str)): The ids of the components found in the tree.
+        """
+        set_ids = set()
+        stack = [tree]
+        while len(stack) > 0:
+            node = stack.pop()
+            if isinstance(node, list):
+                stack.extend(node)
+            elif isinstance(node, dict) and "props" in node and "type" in node:
+                dic_node_props = node["props"]
+                id_component = dic_node_props.get("id", None)
+                if isinstance(id_component, str):
+                    set_ids.add(id_component)
+                for prop, value in dic_node_props.items():
+                    if isinstance(id_component, str):
+                        self.dic_props[(id_component, prop)] = value
+                    if isinstance(value, (dict, list)):
+                        stack.append(value)
+        return set_ids
+
+    def get_prop(self, id_component, prop, default=None):
+        """This function returns the current value of a component property.
+
+        Args:
+            id_component (str): Id of the component.
+            prop (str): Name of the property.
+            default (object, optional): Value returned if the property is unknown or None. Defaults
+                to None.
+
+        Returns:
+            (object): The value of the property.
+        """
+        value = self.dic_props.get((id_component, prop), None)
+        return default if value is None else value
+
+    def return_first_option(self, id_component):
+        """This function returns the value of the first option of a dropdown, whose options are
+        either strings or dictionnaries with a "value" key.
+
+        Args:
+            id_component (str): Id of the dropdown.
+
+        Returns:
+            (object): The value of the first option, or None if the dropdown has no option.
+        """
+        for prop in ["data", "options"]:
+            l_options = self.get_prop(id_component, prop, [])
+            if len(l_options) > 0:
+                option = l_options[0]
+                return option["value"] if isinstance(option, dict) else option
+        return None
+
+    # ==============================================================================================
+    # --- Requests
+    # ==============================================================================================
+
+    def call_callback(self, callback, set_changed_props):
+        """This function sends the request corresponding to a server-side callback, with the current
+        value of its inputs and states, and records its latency.
+
+        Args:
+            callback (dict): The callback, as stored in CallbackGraph.l_callbacks.
+            set_changed_props (set(tuple)): Properties that have changed. Empty for an initial
+                call.
+
+        Returns:
+            (dict): The properties updated by the callback, indexed by component id. Empty if the
+                callback did not update anything (or failed).
+        """
+
+        def serialize(id_component, prop):
+            dic_prop = {"id": id_component, "property": prop}
+            if (id_component, prop) in self.dic_props:
+                dic_prop["value"] = self.dic_props[(id_component, prop)]
+            return dic_prop
+
+        l_outputs = [{"id": x, "property": y} for x, y in callback["l_outputs"]]
+        body = {
+            "output": callback["output"],
+            "outputs": l_outputs if callback["multi"] else l_outputs[0],
+            "inputs": [serialize(x, y) for x, y in callback["l_inputs"]],
+            "state": [serialize(x, y) for x, y in callback["l_states"]],
+            "changedPropIds": [
+                x + "." + y for x, y in callback["l_inputs"] if (x, y) in set_changed_props
+            ],
+        }
+
+        time_start = time.perf_counter()
+        error = None
+        dic_response = {}
+        try:
+            response = self.session.post(
+                self.url + "/_dash-update-component", json=body, timeout=self.timeout
+            )
+            # 204 means that the update has been prevented
+            if response.status_code >= 400:
+                error = "HTTP " + str(response.status_code)
+            elif response.status_code != 204:
+                dic_response = response.json().get("response", {})
+        except (requests.RequestException, ValueError) as e:
+            error = type(e).__name__
+        self.recorder.record(
+            "request", callback["output"], self.scenario, time.perf_counter() - time_start, error
+        )
+        if error is not None:
+            raise RuntimeError(callback["output"] + " failed with " + error)
+        return dic_response
+
+    def apply_response(self, dic_response):
+        """This function updates the component properties from a callback response. When a children
+        property is updated, the components it previously contained are forgotten, and the new ones
+        are recorded.
+
+        Args:
+            dic_response (dict): The properties updated, indexed by component id.
+
+        Returns:
+            (set(tuple), set(str)): The (id, property) tuples whose value has changed, and the ids
+                of the components added to the layout.
+        """
+        set_changed_props = set()
+        set_new_ids = set()
+        for id_component, dic_updated_props in dic_response.items():
+            for prop, value in dic_updated_props.items():
+                key = (id_component, prop)
+                if key in self.dic_props and self.dic_props[key] == value:
+                    continue
+                self.dic_props[key] = value
+                set_changed_props.add(key)
+                if prop == "children":
+                    # Forget the components removed from the layout
+                    for id_removed in self.dic_children_ids.get(key, set()):
+                        for key_removed in [x for x in self.dic_props if x[0] == id_removed]:
+                            del self.dic_props[key_removed]
+                    set_ids = self.collect_props(value)
+                    self.dic_children_ids[key] = set_ids
+                    set_new_ids.update(set_ids)
+        return set_changed_props, set_new_ids
+
+    def propagate(self, set_changed_props, set_new_ids=None):
+        """This function fires, round after round, the callbacks triggered by some property changes
+        and the initial calls of the components added to the layout, until no property changes
+        anymore.
+
+        Args:
+            set_changed_props (set(tuple)): The (id, property) tuples whose value has changed.
+            set_new_ids (set(str), optional): The ids of the components added to the layout.
+                Defaults to None.
+
+        Returns:
+            (bool): True if at least one visible property (i.e. not internal to the long callbacks)
+                has been updated.
+        """
+        updated_visible = False
+        set_new_ids = set_new_ids if set_new_ids is not None else set()
+        for depth in range(self.max_depth):
+            l_indices = self.graph.return_triggered_callbacks(set_changed_props)
+            l_indices_initial = [
+                idx
+                for idx, callback in enumerate(self.graph.l_callbacks)
+                if not callback["prevent_initial_call"]
+                and idx not in l_indices
+                and any(x in set_new_ids for x, _ in callback["l_inputs"])
+            ]
+            set_next_changed_props = set()
+            set_next_new_ids = set()
+            for idx, changed in [(x, set_changed_props) for x in l_indices] + [
+                (x, set()) for x in l_indices_initial
+            ]:
+                callback = self.graph.l_callbacks[idx]
+                # Like the renderer, only fire callbacks whose inputs and outputs are in the layout
+                set_ids = set(x for x, _ in self.dic_props)
+                if not all(
+                    x in set_ids for x, _ in callback["l_inputs"] + callback["l_outputs"]
+                ):
+                    continue
+                dic_response = self.call_callback(callback, changed)
+                set_changed, set_new = self.apply_response(dic_response)
+                set_next_changed_props.update(set_changed)
+                set_next_new_ids.update(set_new)
+                updated_visible = updated_visible or any(
+                    not x.startswith(PREFIX_LONG_CALLBACK) for x, _ in set_changed
+                )
+            if len(set_next_changed_props) == 0 and len(set_next_new_ids) == 0:
+                break
+            set_changed_props, set_new_ids = set_next_changed_props, set_next_new_ids
+        else:
+            logging.warning("Maximum depth reached while propagating callbacks")
+        return updated_visible
+
+    def poll_long_callbacks(self):
+        """This function simulates the intervals created by Dash for each long callback: as long as
+        an interval is enabled, its n_intervals property is incremented at the interval period,
+        which makes the client poll the result of the long callback.
+
+        Returns:
+            (float): The time (from time.perf_counter()) at which a visible property was last
+                updated, or None if no visible property has been updated.
+        """
+        time_last_update = None
+        time_limit = time.perf_counter() + self.timeout
+        while True:
+            l_enabled = [
+                x
+                for (x, prop), value in self.dic_props.items()
+                if x.startswith(PREFIX_LONG_CALLBACK + "interval")
+                and prop == "disabled"
+                and value is False
+            ]
+            if len(l_enabled) == 0:
+                return time_last_update
+            if time.perf_counter() > time_limit:
+                raise RuntimeError("Long callback did not complete before timeout")
+            time.sleep(min(self.get_prop(x, "interval", 1000) for x in l_enabled) / 1000)
+            for id_interval in l_enabled:
+                n_intervals = self.get_prop(id_interval, "n_intervals", 0) + 1
+                self.dic_props[(id_interval, "n_intervals")] = n_intervals
+                if self.propagate({(id_interval, "n_intervals")}):
+                    time_last_update = time.perf_counter()
+
+    # ==============================================================================================
+    # --- User actions
+    # ==============================================================================================
+
+    def interact(self, name, dic_changes):
+        """This function performs a user action, i.e. changes some component properties, and
+        waits for all the callbacks triggered (including long callbacks) to complete. The latency of
+        the action is the time until the last visible update.
+
+        Args:
+            name (str): Name of the action.
+            dic_changes (dict): New value of the properties changed by the user, indexed by
+                (id, property).
+
+        Returns:
+            (bool): True if the action succeeded.
+        """
+        time_start = time.perf_counter()
+        error = None
+        try:
+            self.dic_props.update(dic_changes)
+            self.propagate(set(dic_changes))
+            time_end = time.perf_counter()
+            time_last_update = self.poll_long_callbacks()
+            if time_last_update is not None:
+                time_end = time_last_update
+        except RuntimeError as e:
+            error = str(e)
+            time_end = time.perf_counter()
+        self.recorder.record("action", name, self.scenario, time_end - time_start, error)
+        return error is None
+
+    def load_app(self):
+        """This function loads the app like a browser would: it fetches the layout, gives the user
+        its own session id, and fires the initial callbacks.
+
+        Returns:
+            (bool): True if the app has been loaded successfully.
+        """
+        time_start = time.perf_counter()
+        try:
+            response = self.session.get(self.url + "/_dash-layout", timeout=self.timeout)
+            response.raise_for_status()
+            layout = response.json()
+        except (requests.RequestException, ValueError) as e:
+            self.recorder.record(
+                "action", "load_app", self.scenario, time.perf_counter() - time_start, str(e)
+            )
+            return False
+
+        self.dic_props = {}
+        self.dic_children_ids = {}
+        set_ids = self.collect_props(layout)
+        self.dic_props[("session-id", "data")] = str(uuid.uuid4())
+        self.dic_props[("url", "pathname")] = "/"
+        error = None
+        try:
+            self.propagate(set(), set_ids)
+        except RuntimeError as e:
+            error = str(e)
+        self.recorder.record(
+            "action", "load_app", self.scenario, time.perf_counter() - time_start, error
+        )
+        return error is None
+
+    def navigate(self, pathname):
+        """This function navigates to a page of the app.
+
+        Args:
+            pathname (str): Path of the page.
+
+        Returns:
+            (bool): True if the navigation succeeded.
+        """
+        return self.interact("navigate " + pathname, {("url", "pathname"): pathname})
+
+
+# ==================================================================================================
+# --- Scenarios
+# ==================================================================================================
+
+# Dictionnary of scenarios, filled by the decorator below
+dic_scenarios = {}
+
+
+def register_scenario(name):
+    """This decorator registers a scenario under the provided name.
+
+    Args:
+        name (str): Name of the scenario.
+
+    Returns:
+        (func): The decorator.
+    """
+
+    def decorator(function):
+        dic_scenarios[name] = function
+        return function
+
+    return decorator
+
+
+@register_scenario("slice_navigation")
+def scenario_slice_navigation(user, n_steps=5):
+    """Navigate between random slices on the first page, hovering over the image and toggling the
+    annotations."""
+    if not user.navigate("/load-slice"):
+        return
+    slice_min = user.get_prop("main-slider-1", "min", 1)
+    slice_max = user.get_prop("main-slider-1", "max", 1)
+    for step in range(n_steps):
+        slice_index = user.rng.randint(slice_min, slice_max)
+        user.interact("change slice", {("main-slider-client", "data"): slice_index})
+        point = {"x": user.rng.randint(0, 100), "y": user.rng.randint(0, 100)}
+        user.interact(
+            "hover slice", {("page-1-graph-slice-selection", "hoverData"): {"points": [point]}}
+        )
+    checked = user.get_prop("page-1-toggle-annotations", "checked", False)
+    user.interact("toggle annotations", {("page-1-toggle-annotations", "checked"): not checked})
+
+
+@register_scenario("lipid_selection")
+def scenario_lipid_selection(user, n_steps=3):
+    """Select a lipid on the second page, display it as a colormap, then navigate between
+    slices."""
+    if not user.navigate("/lipid-selection"):
+        return
+    lipid_name = user.return_first_option("page-2-dropdown-lipids")
+    if lipid_name is None:
+        user.recorder.record("action", "select lipid", user.scenario, 0.0, "No lipid available")
+        return
+    user.interact("select lipid", {("page-2-dropdown-lipids", "value"): [lipid_name]})
+    n_clicks = user.get_prop("page-2-colormap-button", "n_clicks", 0) + 1
+    user.interact("display colormap", {("page-2-colormap-button", "n_clicks"): n_clicks})
+    slice_min = user.get_prop("main-slider-1", "min", 1)
+    slice_max = user.get_prop("main-slider-1", "max", 1)
+    for step in range(n_steps):
+        slice_index = user.rng.randint(slice_min, slice_max)
+        user.interact("change slice", {("main-slider-client", "data"): slice_index})
+
+
+@register_scenario("region_analysis")
+def scenario_region_analysis(user):
+    """Draw a region on the third page and compute its average spectrum and lipid expression."""
+    if not user.navigate("/region-analysis"):
+        return
+    path = "M" + "L".join(str(x) + "," + str(y) for x, y in L_PATH_REGION) + "Z"
+    relayout_data = {
+        "shapes": [
+            {
+                "editable": True,
+                "xref": "x",
+                "yref": "y",
+                "layer": "above",
+                "opacity": 0.7,
+                "line": {"color": "white", "width": 1, "dash": "solid"},
+                "fillcolor": "#C08261",
+                "fillrule": "evenodd",
+                "type": "path",
+                "path": path,
+            }
+        ]
+    }
+    user.interact("draw region", {("page-3-graph-heatmap-per-sel", "relayoutData"): relayout_data})
+    n_clicks = user.get_prop("page-3-button-compute-spectra", "n_clicks", 0) + 1
+    user.interact("compute spectra", {("page-3-button-compute-spectra", "n_clicks"): n_clicks})
+    n_clicks = user.get_prop("page-3-reset-button", "n_clicks", 0) + 1
+    user.interact("reset", {("page-3-reset-button", "n_clicks"): n_clicks})
+
+
+@register_scenario("volume_3D")
+def scenario_volume_3D(user):
+    """Select a structure and a lipid on the fourth page, and request the 3D volume figure (long
+    callback)."""
+    if not user.navigate("/3D-exploration"):
+        return
+    point = {"label": user.rng.choice(["Isocortex", "Hippocampal formation", "Thalamus"])}
+    user.interact(
+        "click structure", {("page-4-graph-region-selection", "clickData"): {"points": [point]}}
+    )
+    n_clicks = user.get_prop("page-4-add-structure-button", "n_clicks", 0) + 1
+    user.interact("add structure", {("page-4-add-structure-button", "n_clicks"): n_clicks})
+    for id_dropdown in [
+        "page-4-dropdown-lipid-names",
+        "page-4-dropdown-lipid-structures",
+        "page-4-dropdown-lipid-cations",
+    ]:
+        user.interact(
+            "choose lipid", {(id_dropdown, "value"): user.return_first_option(id_dropdown)}
+        )
+    n_clicks = user.get_prop("page-4-add-lipid-button", "n_clicks", 0) + 1
+    user.interact("add lipid", {("page-4-add-lipid-button", "n_clicks"): n_clicks})
+    n_clicks = user.get_prop("page-4-display-button", "n_clicks", 0) + 1
+    user.interact(
+        "compute volume",
+        {
+            ("page-4-display-button", "n_clicks"): n_clicks,
+            ("page-4-modal-volume", "is_open"): True,
+        },
+    )
+    user.interact("close volume", {("page-4-modal-volume", "is_open"): False})
+
+
+# ==================================================================================================
+# --- Functions
+# ==================================================================================================
+
+
+def compute_statistics(l_records, duration):
+    """This function computes the throughput, latency percentiles and error rate of a list of
+    records.
+
+    Args:
+        l_records (list(dict)): List of records, as stored by Recorder.
+        duration (float): Wall time of the load test, in seconds.
+
+    Returns:
+        (dict): The statistics, with latencies in seconds.
+    """
+    if len(l_records) == 0:
+        return {"count": 0}
+    array_latencies = np.array([x["latency"] for x in l_records if x["error"] is None])
+    n_errors = sum(1 for x in l_records if x["error"] is not None)
+    dic_statistics = {
+        "count": len(l_records),
+        "throughput": len(l_records) / duration if duration > 0 else None,
+        "error_rate": n_errors / len(l_records),
+    }
+    if len(array_latencies) > 0:
+        dic_statistics.update(
+            {
+                "mean": float(np.mean(array_latencies)),
+                "p50": float(np.percentile(array_latencies, 50)),
+                "p95": float(np.percentile(array_latencies, 95)),
+                "p99": float(np.percentile(array_latencies, 99)),
+                "max": float(np.max(array_latencies)),
+            }
+        )
+    return dic_statistics
+
+
+def fetch_callback_graph(url, timeout=60):
+    """This function fetches the callback graph of the app from the server.
+
+    Args:
+        url (str): URL of the server.
+        timeout (float, optional): Timeout of the request, in seconds. Defaults to 60.
+
+    Returns:
+        (CallbackGraph): The callback graph of the app.
+    """
+    response = requests.get(url.rstrip("/") + "/_dash-dependencies", timeout=timeout)
+    response.raise_for_status()
+    return CallbackGraph(response.json())
+
+
+def run_user(user, l_scenarios, time_limit, n_iterations):
+    """This function makes a virtual user load the app, and then run random scenarios until the
+    time limit or the number of iterations is reached.
+
+    Args:
+        user (VirtualUser): The virtual user.
+        l_scenarios (list(str)): Names of the scenarios to pick from.
+        time_limit (float): Time (from time.perf_counter()) after which no scenario is started.
+        n_iterations (int): Maximum number of scenarios run. None for no limit.
+    """
+    user.scenario = "load_app"
+    if not user.load_app():
+        return
+    iteration = 0
+    while time.perf_counter() < time_limit and (n_iterations is None or iteration < n_iterations):
+        user.scenario = user.rng.choice(l_scenarios)
+        dic_scenarios[user.scenario](user)
+        iteration += 1
+
+
+def run(
+    url,
+    n_users=4,
+    duration=60,
+    n_iterations=None,
+    l_scenarios=None,
+    ramp_up=0,
+    timeout=60,
+    seed=0,
+):
+    """This function runs the load test with several concurrent virtual users.
+
+    Args:
+        url (str): URL of the server.
+        n_users (int, optional): Number of concurrent virtual users. Defaults to 4.
+        duration (float, optional): Duration of the load test, in seconds. Scenarios already
+            started when it elapses are run until completion. Defaults to 60.
+        n_iterations (int, optional): Maximum number of scenarios run per user. Defaults to None.
+        l_scenarios (list(str), optional): Names of the scenarios to run. Defaults to None,
+            corresponding to all of them.
+        ramp_up (float, optional): Time over which the users are started, in seconds. Defaults to 0.
+        timeout (float, optional): Timeout of each request and long callback, in seconds. Defaults
+            to 60.
+        seed (int, optional): Seed of the random generators. Defaults to 0.
+
+    Returns:
+        (dict): The parameters of the load test and the statistics of the requests and actions.
+    """
+    if l_scenarios is None:
+        l_scenarios = list(dic_scenarios)
+    graph = fetch_callback_graph(url, timeout)
+    recorder = Recorder()
+    logging.info(
+        "Starting load test with "
+        + str(n_users)
+        + " users and "
+        + str(len(graph.l_callbacks))
+        + " server-side callbacks"
+    )
+
+    time_start = time.perf_counter()
+    time_limit = time_start + duration
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_users) as executor:
+        l_futures = []
+        for idx_user in range(n_users):
+            user = VirtualUser(url, graph, recorder, timeout=timeout, seed=seed + idx_user)
+            l_futures.append(
+                executor.submit(run_user, user, l_scenarios, time_limit, n_iterations)
+            )
+            if ramp_up > 0 and n_users > 1:
+                time.sleep(ramp_up / (n_users - 1))
+        for future in concurrent.futures.as_completed(l_futures):
+            # Exceptions are bugs of the harness, not errors of the server
+            future.result()
+    wall_time = time.perf_counter() - time_start
+    logging.info("Load test done in " + str(round(wall_time, 1)) + "s")
+
+    return {
+        "parameters": {
+            "url": url,
+            "n_users": n_users,
+            "duration": duration,
+            "n_iterations": n_iterations,
+            "scenarios": l_scenarios,
+            "ramp_up": ramp_up,
+            "timeout": timeout,
+            "seed": seed,
+            "wall_time": wall_time,
+        },
+        "results": recorder.summarize(wall_time),
+    }
+
+
+def format_summary(dic_summary):
+    """This function returns the statistics of the actions as a human-readable table, with
+    latencies in ms.
+
+    Args:
+        dic_summary (dict): The statistics, as returned by Recorder.summarize().
+
+    Returns:
+        (str): The table.
+    """
+    l_lines = [
+        "{:<24}{:>8}{:>10}{:>10}{:>10}{:>10}{:>8}".format(
+            "action", "count", "rps", "p50", "p95", "p99", "errors"
+        )
+    ]
+    for name, dic_statistics in [("all requests", dic_summary["requests"])] + list(
+        dic_summary["per_action"].items()
+    ):
+        l_lines.append(
+            "{:<24}{:>8}{:>10.2f}".format(
+                name[:23], dic_statistics["count"], dic_statistics["throughput"]
+            )
+            + "".join(
+                "{:>10.0f}".format(dic_statistics[x] * 1000) if x in dic_statistics else " " * 10
+                for x in ["p50", "p95", "p99"]
+            )
+            + "{:>7.1f}%".format(dic_statistics["error_rate"] * 100)
+        )
+    return "\n".join(l_lines)
+
+
+# ==================================================================================================
+# --- Command line
+# ==================================================================================================
+
+
+def main(l_arguments=None):
+    """This function parses the command line arguments, runs the load test and writes the results.
+
+    Args:
+        l_arguments (list(str), optional): Command line arguments. Defaults to None, corresponding
+            to sys.argv.
+
+    Returns:
+        (int): The exit code, 1 if the error rate of the requests is above the maximum error rate,
+            0 otherwise.
+    """
+    parser = argparse.ArgumentParser(description="LBAE load test.")
+    parser.add_argument("--url", default="http://127.0.0.1:8050")
+    parser.add_argument("--users", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=60)
+    parser.add_argument("--iterations", type=int, default=None)
+    parser.add_argument("--scenarios", nargs="*", default=None, choices=list(dic_scenarios))
+    parser.add_argument("--ramp-up", type=float, default=0)
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-error-rate", type=float, default=0.0)
+    parser.add_argument("--output", default="load_test_results.json")
+    args = parser.parse_args(l_arguments)
+
+    dic_results = run(
+        args.url,
+        n_users=args.users,
+        duration=args.duration,
+        n_iterations=args.iterations,
+        l_scenarios=args.scenarios,
+        ramp_up=args.ramp_up,
+        timeout=args.timeout,
+        seed=args.seed,
+    )
+    with open(args.output, "w") as handle:
+        json.dump(dic_results, handle, indent=2)
+    logging.info("Results written to " + args.output)
+    if dic_results["results"]["requests"]["count"] == 0:
+        logging.warning("No request could be sent to the server")
+        return 1
+    print(format_summary(dic_results["results"]))
+    return 1 if dic_results["results"]["requests"]["error_rate"] > args.max_error_rate else 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s.%(msecs)03d %(levelname)s %(module)s - %(funcName)s: %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+    sys.exit(main())
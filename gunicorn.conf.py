@@ -0,0 +1,91 @@
+# Copyright (c) 2022, Colas Droin. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
+
+""" This file contains the configuration of gunicorn, which is loaded automatically when gunicorn is
+run from the main lbae folder:
+
+`gunicorn main:server`
+
+The configuration can be adapted with the following environment variables:
+- LBAE_BIND: address the server is bound to. Defaults to 0.0.0.0:8050.
+- LBAE_WORKERS: number of worker processes. Defaults to 1.
+- LBAE_THREADS: number of threads (or greenlets) per worker. Defaults to 4.
+- LBAE_WORKER_CLASS: class of the workers. Defaults to gevent.
+- LBAE_TIMEOUT: time (in seconds) after which a silent worker is restarted. Defaults to 30.
+- LBAE_SHARED_ARRAYS: if "1", the large read-only arrays of the app are shared between the workers
+    (see modules/shared_arrays.py). Defaults to "1" if there are several workers, "0" otherwise.
+- LBAE_SHARED_ARRAYS_DIR: folder containing the shared arrays. Defaults to
+    data/app_data/shared_arrays/.
+- LBAE_PATH_DB: path of the shelve database. Defaults to data/app_data/data.db.
+
+The app is not preloaded in the master process: each worker initializes its own objects (in the
+background), the large arrays being attached from the shared folder instead of being duplicated.
+"""
+
+# ==================================================================================================
+# --- Imports
+# ==================================================================================================
+
+# Standard modules
+import dbm
+import logging
+import os
+import shelve
+
+# LBAE imports
+from modules.shared_arrays import SharedArrayStore
+
+# ==================================================================================================
+# --- Server settings
+# ==================================================================================================
+
+bind = os.environ.get("LBAE_BIND", "0.0.0.0:8050")
+workers = int(os.environ.get("LBAE_WORKERS", "1"))
+threads = int(os.environ.get("LBAE_THREADS", "4"))
+worker_class = os.environ.get("LBAE_WORKER_CLASS", "gevent")
+timeout = int(os.environ.get("LBAE_TIMEOUT", "30"))
+preload_app = False
+
+# The environment is inherited by the workers
+path_shared_arrays = os.environ.setdefault(
+    "LBAE_SHARED_ARRAYS_DIR", "data/app_data/shared_arrays/"
+)
+path_db = os.environ.get("LBAE_PATH_DB", "data/app_data/data.db")
+
+# ==================================================================================================
+# --- Server hooks
+# ==================================================================================================
+
+
+def check_first_launch(path_db):
+    """This function checks if the app has already been launched once, i.e. if all the
+    precomputations have been done and shelved.
+
+    Args:
+        path_db (str): Path of the shelve database.
+
+    Returns:
+        (bool): True if the app has already been launched once.
+    """
+    try:
+        with shelve.open(path_db, flag="r") as db:
+            return "launch/first_launch" in db
+    except dbm.error + (OSError,):
+        return False
+
+
+def on_starting(server):
+    """This hook is run in the master process, before the workers are spawned (such that they
+    inherit its environment). If the precomputations have not been done yet, a single worker is
+    spawned, as the shelve database would otherwise be filled by several workers at the same time.
+    Otherwise, the arrays are shared if there are several workers (the number of workers possibly
+    coming from the command line), and the shared folder is cleared, such that the arrays are
+    rebuilt from up-to-date data by the first worker needing them."""
+    if server.num_workers > 1 and not check_first_launch(path_db):
+        logging.warning(
+            "The app has never been launched: only one worker will be used for the precomputations"
+        )
+        server.num_workers = 1
+    os.environ.setdefault("LBAE_SHARED_ARRAYS", "1" if server.num_workers > 1 else "0")
+    if os.environ["LBAE_SHARED_ARRAYS"] == "1":
+        SharedArrayStore(path_shared_arrays).clear()
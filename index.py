@@ -20,7 +20,7 @@ import dash_mantine_components as dmc
 import dash
 
 # LBAE modules
-from app import app, data, atlas
+from app import app, data, atlas, startup
 from pages import (
     sidebar,
     home,
@@ -91,6 +91,7 @@ def return_main_content():
             dcc.Store(id="page-3-dcc-store-path-heatmap"),
             dcc.Store(id="page-3-dcc-store-basic-figure", data=True),
             # Record the computed spectra drawn in page 3
+            dcc.Store(id="page-3-dcc-store-spectra-computed"),
             dcc.Store(id="dcc-store-list-mz-spectra", data=[]),
             # Record the lipids expressed in the region in page 3
             dcc.Store(id="page-3-dcc-store-lipids-region", data=[]),
@@ -204,6 +205,50 @@ def return_main_content():
     return main_content
 
 
+def return_loading_content(dic_failure=None):
+    """This function computes a lightweight version of the app, displayed while the global objects
+    (data, atlas, figures) are still being initialized. It only contains the home page, and reloads
+    the app as soon as the initialization is complete (or has failed).
+
+    Args:
+        dic_failure (dict, optional): Name of the component whose initialization failed, along
+            with the corresponding error (see Startup.dic_failure). If provided, the error is
+            displayed instead of the loading message. Defaults to None.
+
+    Returns:
+        (html.Div): A div containing the corresponding elements.
+    """
+    if dic_failure is None:
+        alert = dmc.Alert(
+            title="The app is starting",
+            children="The data is being loaded, the app will be available in a moment...",
+            c="cyan",
+        )
+    else:
+        alert = dmc.Alert(
+            title="The app failed to start",
+            children="Component "
+            + str(dic_failure["component"])
+            + " could not be initialized ("
+            + str(dic_failure["error"])
+            + "). Please check the logs and restart the app.",
+            c="red",
+        )
+    return html.Div(
+        children=[
+            # Required by the home page callbacks
+            dcc.Store(id="main-slider", data=1),
+            # Check regularly if the app is ready, unless it has failed to start
+            dcc.Interval(id="startup-interval", interval=5000, disabled=dic_failure is not None),
+            home.layout,
+            dmc.Center(
+                alert,
+                style={"position": "fixed", "bottom": "1rem", "left": "7rem", "right": "1rem"},
+            ),
+        ],
+    )
+
+
 def return_validation_layout(main_content, initial_slice=1, brain="brain_1"):
     """This function compute the layout of the app, including the main container, the sidebar and
     the different pages.
@@ -233,6 +278,22 @@ def return_validation_layout(main_content, initial_slice=1, brain="brain_1"):
 # ==================================================================================================
 # --- App callbacks
 # ==================================================================================================
+app.clientside_callback(
+    """
+    function(n_intervals) {
+        fetch("/startup").then(response => response.json()).then(report => {
+            if (report.ready || report.failed) {
+                window.location.reload();
+            }
+        });
+        return window.dash_clientside.no_update;
+    }
+    """,
+    Output("startup-interval", "disabled"),
+    Input("startup-interval", "n_intervals"),
+)
+
+
 @app.callback(
     Output("content", "children"),
     Output("empty-content", "children"),
@@ -2,16 +2,24 @@
 # Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
 
 """ This script is used to run the app and setup logging settings. 
-To run the app with gunicorn, use the following command in the main lbae folder:
+To run the app with gunicorn (configured from gunicorn.conf.py), use the following command in the
+main lbae folder:
 
-`gunicorn main:server -b:8050 --worker-class gevent --threads 4 --workers=1`
+`gunicorn main:server`
 
 Or, to run the app ignoring hangup signals, i.e. not stopping when disconnecting from the server:
 
-`nohup gunicorn main:server -b:8050 --worker-class gevent --threads 4 --workers=1 &`
+`nohup gunicorn main:server &`
 
-The app will then run on http://cajal.epfl.ch:8050/ . Note that we only use one worker, as each
-additional worker will drastically increase the memory usage.
+The app will then run on http://cajal.epfl.ch:8050/ . By default, only one worker is used. Several
+workers can be used with, e.g.:
+
+`LBAE_WORKERS=4 gunicorn main:server`
+
+In this case, the large read-only arrays (MaldiData lightweight arrays, atlas volumes, warped
+coordinates and projection correspondence) are built once and attached as shared memory maps by
+every worker (see modules/shared_arrays.py), such that each additional worker only adds a small
+memory overhead. The first launch (precomputations) always uses a single worker.
 
 To kill gunicorn from a linux server (if it doesn't want to die, and respawn automatically), use the
 following command:
@@ -34,6 +42,7 @@ WARNING: because of a bug with the shelvedb, the app precomputations must be com
 import logging
 from modules.tools.misc import logmem  # To track memory usage
 import dash_mantine_components as dmc
+from dash import dcc, html
 import orjson  # Not needed, but is added to requirements.txt this way
 
 # ==================================================================================================
@@ -61,22 +70,55 @@ numba_logger.setLevel(logging.WARNING)
 # --- App and server initialization
 # ==================================================================================================
 logging.info("Starting import chain" + logmem())
-from app import app
-from index import return_main_content, return_validation_layout
-
-# Define app layout
-main_content = return_main_content()
-
-# Initialize app with main content and dark theme
-app.layout = dmc.MantineProvider(
+from app import app, startup
+from index import return_main_content, return_validation_layout, return_loading_content
+
+# The complete layout can only be computed once the global objects have been initialized
+dic_layout = {}
+
+
+def serve_layout():
+    """Return the complete layout of the app if the global objects have been initialized, or a
+    lightweight layout containing only the home page otherwise, along with the error if the
+    initialization failed."""
+    dic_failure = startup.return_failure()
+    if dic_failure is not None:
+        return dmc.MantineProvider(
+            theme={"colorScheme": "dark"},
+            children=[
+                return_loading_content(dic_failure),
+            ],
+        )
+    if not startup.is_ready():
+        return dic_layout["loading"]
+    if "main" not in dic_layout:
+        main_content = return_main_content()
+
+        # Give complete layout for callback validation, including the startup interval
+        app.validation_layout = html.Div(
+            [return_validation_layout(main_content), dcc.Interval(id="startup-interval")]
+        )
+
+        # Initialize app with main content and dark theme
+        dic_layout["main"] = dmc.MantineProvider(
+            theme={"colorScheme": "dark"},
+            children=[
+                main_content,
+            ],
+        )
+    return dic_layout["main"]
+
+
+dic_layout["loading"] = dmc.MantineProvider(
     theme={"colorScheme": "dark"},
     children=[
-        main_content,
+        return_loading_content(),
     ],
 )
 
-# Give complete layout for callback validation
-app.validation_layout = return_validation_layout(main_content)
+# Validation layout is completed once the complete layout has been computed
+app.validation_layout = dic_layout["loading"]
+app.layout = serve_layout
 
 # Server definition for gunicorn
 server = app.server
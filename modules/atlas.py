@@ -11,13 +11,9 @@ the Allen Brain Atlas, including the mapping with the Common Coordinate Framewor
 # Standard modules
 import numpy as np
 import os
-import matplotlib.pyplot as plt
 from bg_atlasapi import BrainGlobeAtlas
-from io import BytesIO
 import logging
-import io
 import skimage
-from imageio import imread
 import shutil
 
 # LBAE imports
@@ -29,8 +25,13 @@ from modules.tools.atlas import (
     compute_simplified_atlas_annotation,
     compute_array_images_atlas,
 )
-from modules.tools.spectra import compute_spectrum_per_row_selection, compute_thread_safe_function
+from modules.tools.spectra import (
+    compute_spectrum_per_row_selection_bounded,
+    compute_thread_safe_function,
+)
+from modules.tools.contours import compute_slice_contours, compute_contours_raster
 from modules.atlas_labels import Labels
+from modules.atlas_hierarchy import AtlasHierarchy
 from modules.tools.misc import logmem
 
 
@@ -48,10 +49,13 @@ class Atlas:
         resolution (int): Resolution of the atlas.
         data (MaldiData): Used to manipulate the raw MALDI data.
         storage (Storage): Used to access the shelve database.
+        shared_arrays (SharedArrayStore): Used to share the large read-only arrays between the
+            workers of the server. None if the arrays are not shared.
         bg_atlas (BrainGlobeAtlas): Used to query the Allen Brain Atlas.
         subsampling_block (int): Set the subsampling of the atlas in the longitudinal direction, to
             decrease the memory usage.
         labels (Labels): Used to load string annotation for contour plot, for each voxel.
+        hierarchy (AtlasHierarchy): Index of the hierarchy of structures of the Allen Brain atlas.
         dic_acronym_children_id (dict): Dictionnary that associates, to each structure (acronym),
             the set of ids (int) of all of its children.
         array_coordinates_warped_data (np.ndarray): An array that contains, for each slice and each
@@ -78,27 +82,38 @@ class Atlas:
             acquisition.
         list_projected_atlas_borders_arrays (list(np.ndarray)): A list of arrays, one per slice,
             which contains the atlas borders projected on our data.
+        list_projected_atlas_contours (list(dict)): A list of dictionnaries, one per slice, which
+            associate simplification tolerances to the polylines of the atlas borders projected on
+            our data.
 
 
     Methods:
-        __init__(maldi_data, resolution=25, sample=False): Initialize the Atlas class.
-        compute_dic_acronym_children_id(): Recursively compute a dictionnary that associates brain
-            structures to the set of their children.
-        compute_hierarchy_list(): Compute, for each children (node) structure, the corresponding
-            parent, to build a list associating child/parent for all structures, and also compute
-            dictionnaries that associate structure acronyms to their complete name in the process.
+        __init__(maldi_data, storage, resolution=25, sample=False, shared_arrays=None): Initialize
+            the Atlas class.
+        load_hierarchy(force_update=False): Load the index of the hierarchy of structures, and the
+            attributes derived from it.
+        compute_dic_acronym_children_id(): Return a dictionnary that associates brain structures to
+            the set of their children.
+        compute_hierarchy_list(): Return, for each children (node) structure, the corresponding
+            parent, along with the dictionnaries that associate structure acronyms to their
+            complete name.
         compute_array_projection(nearest_neighbour_correction=False, atlas_correction=False):
             Compute three arrays relating the original coordinates of our data to their projection
             in the CCFv3.
         compute_projection_parameters(): Compute the parameters used to map the 3D coordinates of
             the CCFv3 to the the 2D (tiled) slices.
+        compute_list_projected_atlas_contours(l_tolerances=(0.5, 1.0, 2.0)): Compute the polylines
+            of the projected atlas borders, for several simplification tolerances.
         compute_list_projected_atlas_borders_figures(): Compute an array of projected atlas borders.
+        get_projected_atlas_contours(slice_index, tolerance=1.0): Get the polylines of the projected
+            atlas borders of a slice, for a given simplification tolerance.
         prepare_and_compute_array_images_atlas(zero_out_of_annotation=False): Wrapper for
             compute_array_images_atlas.
         get_atlas_mask(structure): Compute a mask for the structure given as argument.
         compute_spectrum_data(slice_index, projected_mask=None, mask_name=None,
-            slice_coor_rescaled=None, MAIA_correction=False, cache_flask=None): Compute the averaged
-            spectral data for a given slice and a given mask.
+            slice_coor_rescaled=None, MAIA_correction=False, cache_flask=None,
+            memory_limit_bytes=2**28, set_progress=None): Compute the averaged spectral data for a
+            given slice and a given mask, with a bounded memory usage.
         save_all_projected_masks_and_spectra(force_update=False, cache_flask=None, sample=False):
             Save all the (2D) masks and corresponding averaged spectral data, for all the slices.
         get_projected_mask_and_spectrum(slice_index, mask_name, MAIA_correction=False): Get the
@@ -110,7 +125,7 @@ class Atlas:
     # --- Constructor
     # ==============================================================================================
 
-    def __init__(self, maldi_data, storage, resolution=25, sample=False):
+    def __init__(self, maldi_data, storage, resolution=25, sample=False, shared_arrays=None):
         """Initialize the class Atlas.
 
         Args:
@@ -119,6 +134,10 @@ class Atlas:
             resolution (int): Resolution of the atlas. Default to 25.
             sample (bool): If True, only a fraction of the precomputations are made (for debug).
                 Default to False.
+            shared_arrays (SharedArrayStore, optional): If provided and enabled, the large
+                read-only arrays (annotation and reference volumes, warped coordinates, projection
+                correspondence and original coordinates) are attached from this store, such that
+                they are shared between the workers of the server. Defaults to None.
         """
 
         logging.info("Initializing Atlas object" + logmem())
@@ -133,6 +152,7 @@ class Atlas:
         # Attribute to easily access the data and the shelve db
         self.data = maldi_data
         self.storage = storage
+        self.shared_arrays = shared_arrays
 
         # Correct atlas resolution to 100 if sampled app
         if maldi_data._sample_data:
@@ -166,75 +186,91 @@ class Atlas:
         # longitudinal direction, otherwise it's too heavy
         self.subsampling_block = 20
 
+        # BrainGlobeAtlas loads its volumes lazily in private attributes, which can therefore be
+        # replaced by shared arrays
+        if (
+            self.shared_arrays is not None
+            and self.shared_arrays.enabled
+            and hasattr(self.bg_atlas, "_annotation")
+        ):
+            for volume_name in ["annotation", "reference"]:
+                setattr(
+                    self.bg_atlas,
+                    "_" + volume_name,
+                    self.shared_arrays.return_shared_object(
+                        "atlas/" + volume_name + "_" + str(self.resolution),
+                        lambda volume_name=volume_name: getattr(self.bg_atlas, volume_name),
+                    ),
+                )
+
         # Load string annotation for contour plot, for each voxel.
         # These objects are heavy (~300mb) as they force the loading of annotations from the core
         # Atlas class. But they shouldn't be memory-mapped as they are called when hovering and
         # require very fast response from the server
         self.labels = Labels(self.bg_atlas, force_init=True)
 
-        # Compute a dictionnary that associates to each structure (acronym) the set of ids (int) of
-        # all of its children. Used only in page_4_plot_graph_volume, but it's very light (~3mb) so
-        # no problem using it as an attribute
-        self.dic_acronym_children_id = self.storage.return_shelved_object(
-            "atlas/atlas_objects",
-            "dic_acronym_children_id",
-            force_update=False,
-            compute_function=self.compute_dic_acronym_children_id,
-        )
+        # Index of the hierarchy of structures, from which are derived the dictionnary that
+        # associates to each structure (acronym) the set of ids (int) of all of its children, the
+        # graph of structures (l_nodes and l_parents) and the dictionnaries of names and acronyms.
+        # They are relatively lightweight and are used in many different places, so they shouldn't
+        # be used as properties
+        self.load_hierarchy()
 
         # Load array of coordinates for warped data (can't be loaded on the fly from shelve as used
         # with hovering). Weights ~225mb
         if maldi_data._sample_data:
-            with np.load("data_sample/tiff_files/coordinates_warped_data.npz") as handle:
-                self.array_coordinates_warped_data = handle["array_coordinates_warped_data"]
-
+            path_coordinates_warped_data = "data_sample/tiff_files/coordinates_warped_data.npz"
         else:
-            self.array_coordinates_warped_data = skimage.io.imread(
-                "data/tiff_files/coordinates_warped_data.tif"
+            path_coordinates_warped_data = "data/tiff_files/coordinates_warped_data.tif"
+
+        def load_coordinates_warped_data():
+            if maldi_data._sample_data:
+                with np.load(path_coordinates_warped_data) as handle:
+                    return handle["array_coordinates_warped_data"]
+            else:
+                return skimage.io.imread(path_coordinates_warped_data)
+
+        if self.shared_arrays is not None and self.shared_arrays.enabled:
+            self.array_coordinates_warped_data = self.shared_arrays.return_shared_object(
+                "atlas/array_coordinates_warped_data",
+                load_coordinates_warped_data,
+                version=str(os.path.getmtime(path_coordinates_warped_data)),
             )
+        else:
+            self.array_coordinates_warped_data = load_coordinates_warped_data()
 
         # Record shape of the warped data
         self.image_shape = list(self.array_coordinates_warped_data.shape[1:-1])
 
-        # Record dict that associate brain region (complete string) to specific id (short label),
-        # along with graph of structures (l_nodes and l_parents). Although the treemap graph is
-        # precomputed, the two dics of name and acronyms are relatively lightweight and are used in
-        # many different place, so they shouldn't be used a properties
-        (
-            self.l_nodes,
-            self.l_parents,
-            self.dic_name_acronym,
-            self.dic_acronym_name,
-        ) = self.storage.return_shelved_object(
-            "atlas/atlas_objects",
-            "hierarchy",
-            force_update=False,
-            compute_function=self.compute_hierarchy_list,
-        )
-
         # Array_projection_corrected is used a lot for lipid expression plots, as it encodes the
         # warping transformation of the data. Therefore it shouldn't be used a as a property.
         # Weights ~150mb
         # * The type is np.int16, and can't be reduced anymore as values are sometimes above 400
-        self.array_projection_correspondence_corrected = self.storage.return_shelved_object(
-            "atlas/atlas_objects",
-            "arrays_projection_corrected",
-            force_update=False,
-            compute_function=self.compute_array_projection,
-            nearest_neighbour_correction=True,
-            atlas_correction=True,
-        )[1]
+        # The arrays are loaded from the shelve database only once, as the entry is large.
+        def load_arrays_projection_corrected():
+            return self.storage.return_shelved_object(
+                "atlas/atlas_objects",
+                "arrays_projection_corrected",
+                force_update=False,
+                compute_function=self.compute_array_projection,
+                nearest_neighbour_correction=True,
+                atlas_correction=True,
+            )
+
+        if self.shared_arrays is not None and self.shared_arrays.enabled:
+            # Only the arrays used after initialization are shared
+            arrays_projection_corrected = self.shared_arrays.return_shared_object(
+                "atlas/arrays_projection_corrected",
+                lambda: (None,) + tuple(load_arrays_projection_corrected()[1:]),
+            )
+        else:
+            arrays_projection_corrected = load_arrays_projection_corrected()
+        self.array_projection_correspondence_corrected = arrays_projection_corrected[1]
 
         # Load arrays of original images coordinates. It is used everytime a 3D object is computed.
         # Weights ~50mb
-        self.l_original_coor = self.storage.return_shelved_object(
-            "atlas/atlas_objects",
-            "arrays_projection_corrected",
-            force_update=False,
-            compute_function=self.compute_array_projection,
-            nearest_neighbour_correction=True,
-            atlas_correction=True,
-        )[2]
+        self.l_original_coor = arrays_projection_corrected[2]
+        del arrays_projection_corrected
 
         # Dictionnary of existing masks per slice, which associates slice index (key) to a set of
         # masks acronyms
@@ -254,6 +290,7 @@ class Atlas:
         # precomputations
         self._array_projection_corrected = None
         self._list_projected_atlas_borders_arrays = None
+        self._list_projected_atlas_contours = None
 
         logging.info("Atlas object instantiated" + logmem())
 
@@ -309,53 +346,64 @@ class Atlas:
             )
         return self._list_projected_atlas_borders_arrays
 
+    @property
+    def list_projected_atlas_contours(self):
+        """Load the polylines of the projected atlas borders. It's a property to save memory as it
+        is only loaded when the atlas annotations are displayed.
+
+        Returns:
+            (list(dict)): A list of dictionnaries, one per slice, which associate simplification
+                tolerances to the polylines of the atlas borders projected on our data.
+        """
+        if self._list_projected_atlas_contours is None:
+            logging.info("list_projected_atlas_contours is being loaded." + logmem())
+            self._list_projected_atlas_contours = self.storage.return_shelved_object(
+                "atlas/atlas_objects",
+                "list_projected_atlas_contours",
+                force_update=False,
+                compute_function=self.compute_list_projected_atlas_contours,
+            )
+        return self._list_projected_atlas_contours
+
     # ==============================================================================================
     # --- Methods
     # ==============================================================================================
 
+    def load_hierarchy(self, force_update=False):
+        """Load the index of the hierarchy of structures (computing it if it doesn't exist for the
+        current version of the atlas), and the attributes derived from it.
+
+        Args:
+            force_update (bool, optional): If True, the index is recomputed. Defaults to False.
+        """
+        if force_update:
+            self.hierarchy.load(force_update=True)
+        else:
+            self.hierarchy = AtlasHierarchy(
+                self.bg_atlas, self.storage, sample=self.data._sample_data
+            )
+        self.dic_acronym_children_id = self.compute_dic_acronym_children_id()
+        (
+            self.l_nodes,
+            self.l_parents,
+            self.dic_name_acronym,
+            self.dic_acronym_name,
+        ) = self.compute_hierarchy_list()
+
     def compute_dic_acronym_children_id(self):
-        """Recursively compute a dictionnary that associates brain structures to the set of their
-            children.
+        """Return a dictionnary that associates brain structures to the set of their children,
+        from the index of the hierarchy.
 
         Returns:
             (dict): A dictionnary that associate to each structure (acronym) the set of ids (int) of
                 all of its children.
         """
-
-        # Recursive function to compute the parent of each structure
-        def fill_dic_acronym_children_id(dic_acronym_children_id, l_id_leaves):
-            older_leave_id = l_id_leaves[0]
-            acronym = self.bg_atlas.structures[older_leave_id]["acronym"]
-            for id_leave in l_id_leaves:
-                # Fill dic with current acronym and id
-                if acronym in dic_acronym_children_id:
-                    dic_acronym_children_id[acronym].add(id_leave)
-                else:
-                    dic_acronym_children_id[acronym] = set([id_leave])
-            # While root is not reached, climb back the ancestor tree
-            if len(self.bg_atlas.structures[older_leave_id]["structure_id_path"]) >= 2:
-                id_parent = self.bg_atlas.structures[older_leave_id]["structure_id_path"][-2]
-                dic_acronym_children_id = fill_dic_acronym_children_id(
-                    dic_acronym_children_id, [id_parent] + l_id_leaves
-                )
-            return dic_acronym_children_id
-
-        # Initialize dictionnary as empty
-        dic_acronym_children_id = {}
-
-        # Loop over each structure
-        for id in set(self.bg_atlas.annotation.flatten()):
-            if id != 0:
-                # Fill the dictionnary by climbing up the hierarchy structure
-                dic_acronym_children_id = fill_dic_acronym_children_id(
-                    dic_acronym_children_id, [id]
-                )
-        return dic_acronym_children_id
+        return self.hierarchy.dic_acronym_children_id
 
     def compute_hierarchy_list(self):
-        """Compute, for each children (node), the corresponding parent, to build a list associating
-        child/parent for all structures, and also compute dictionnaries that associate structure
-        acronyms to their complete name in the process.
+        """Return, for each children (node), the corresponding parent, to build a list associating
+        child/parent for all structures, along with the dictionnaries that associate structure
+        acronyms to their complete name, from the index of the hierarchy.
 
         Returns:
             (list(str)): List of children (node) names.
@@ -363,38 +411,8 @@ class Atlas:
             (dict): A dictionnary that associate structure name to its acronym.
             (dict): A dictionnary that associate structure acronym to its name.
         """
-
-        # Create a list of parents for all ancestors
-        l_nodes = []
-        l_parents = []
-        dic_name_acronym = {}
-        dic_acronym_name = {}
-        idx = 0
-
-        # Loop over each structure
-        for x, v in self.bg_atlas.structures.items():
-            # Keep only a very restrained amount of structures if sample data
-            if (
-                self.data._sample_data
-                and len(self.bg_atlas.get_structure_ancestors(v["acronym"])) > 1
-            ):
-                continue
-
-            if len(self.bg_atlas.get_structure_ancestors(v["acronym"])) > 0:
-                ancestor_acronym = self.bg_atlas.get_structure_ancestors(v["acronym"])[-1]
-                ancestor_name = self.bg_atlas.structures[ancestor_acronym]["name"]
-            else:
-                ancestor_name = ""
-            current_name = self.bg_atlas.structures[x]["name"]
-
-            l_nodes.append(current_name)
-            l_parents.append(ancestor_name)
-
-            # Register the name/acronym association for each structure
-            dic_name_acronym[current_name] = v["acronym"]
-            dic_acronym_name[v["acronym"]] = current_name
-
-        return l_nodes, l_parents, dic_name_acronym, dic_acronym_name
+        l_nodes, l_parents = self.hierarchy.return_treemap_inputs()
+        return l_nodes, l_parents, self.hierarchy.dic_name_acronym, self.hierarchy.dic_acronym_name
 
     def compute_array_projection(self, nearest_neighbour_correction=False, atlas_correction=False):
         """Compute three arrays relating the original coordinates of our data to their projection in
@@ -504,15 +522,18 @@ class Atlas:
             l_transform_parameters.append((a_atlas, u_atlas, v_atlas))
         return l_transform_parameters
 
-    def compute_list_projected_atlas_borders_figures(self):
-        """Compute an array of projected atlas borders (i.e. image of atlas annotations).
+    def compute_list_projected_atlas_contours(self, l_tolerances=(0.5, 1.0, 2.0)):
+        """Compute the polylines of the projected atlas borders (i.e. boundaries of the atlas
+        annotations), for several simplification tolerances.
+
+        Args:
+            l_tolerances (tuple(float), optional): Maximum distance (in pixels) between the
+                simplified polylines and the original boundaries. Defaults to (0.5, 1.0, 2.0).
 
         Returns:
-            (list(np.ndarray)): A list of arrays, one per slice, which contains the atlas
-                borders projected on our data.
+            (list(dict)): A list of dictionnaries, one per slice, which associate simplification
+                tolerances to the polylines of the atlas borders projected on our data.
         """
-
-        l_array_images = []
         # Load array of atlas images corresponding to our data and how it is projected
         (
             array_projected_images_atlas,
@@ -525,36 +546,41 @@ class Atlas:
             zero_out_of_annotation=True,
         )
 
-        # Loop over slice, compute image every time
-        for slice_index in range(array_projected_simplified_id.shape[0]):
-            contours = (
-                array_projected_simplified_id[slice_index, 1:, 1:]
-                - array_projected_simplified_id[slice_index, :-1, :-1]
+        return [
+            compute_slice_contours(
+                array_projected_simplified_id[slice_index], l_tolerances=l_tolerances
             )
-            contours = np.clip(contours**2, 0, 1)
-            contours = np.pad(contours, ((1, 0), (1, 0)))
-
-            # Do some cleaning on the sides
-            contours[:, :10] = 0
-            contours[:, -10:] = 0
-            contours[:10, :] = 0
-            contours[-10:, :] = 0
-
-            # Compute a matplolib figure and export it as image (it's a hack but it does the job)
-            fig = plt.figure(frameon=False)
-            dpi = 100
-            fig.set_size_inches(contours.shape[1] / dpi, contours.shape[0] / dpi)
-            ax = fig.add_axes([0, 0, 1, 1])
-            ax.axis("off")
-            prefix = "data:image/png;base64,"
-            plt.contour(contours, colors="orange", antialiased=True, linewidths=0.2, origin="image")
-            with BytesIO() as stream:
-                plt.savefig(stream, format="png", dpi=dpi)
-                plt.close()
-                img = imread(io.BytesIO(stream.getvalue()))
-                l_array_images.append(img)
-
-        return l_array_images
+            for slice_index in range(array_projected_simplified_id.shape[0])
+        ]
+
+    def compute_list_projected_atlas_borders_figures(self):
+        """Compute an array of projected atlas borders (i.e. image of atlas annotations), by
+        rasterizing the finest polylines of the projected atlas borders.
+
+        Returns:
+            (list(np.ndarray)): A list of arrays, one per slice, which contains the atlas
+                borders projected on our data.
+        """
+        return [
+            compute_contours_raster(dic_contours[min(dic_contours)], self.image_shape)
+            for dic_contours in self.list_projected_atlas_contours
+        ]
+
+    def get_projected_atlas_contours(self, slice_index, tolerance=1.0):
+        """Get the polylines of the projected atlas borders of a slice, simplified with the
+        precomputed tolerance closest to the requested one.
+
+        Args:
+            slice_index (int): Index of the slice.
+            tolerance (float, optional): Maximum distance (in pixels) between the simplified
+                polylines and the original boundaries. Defaults to 1.0.
+
+        Returns:
+            (list(np.ndarray)): A list of polylines, each being an array of shape (n,2) containing
+                the (row, column) coordinates of its vertices.
+        """
+        dic_contours = self.list_projected_atlas_contours[slice_index]
+        return dic_contours[min(dic_contours, key=lambda x: abs(x - tolerance))]
 
     # * This is quite long to execute (~10mn)
     def prepare_and_compute_array_images_atlas(self, zero_out_of_annotation=False):
@@ -626,11 +652,15 @@ class Atlas:
         slice_coor_rescaled=None,
         MAIA_correction=False,
         cache_flask=None,
+        memory_limit_bytes=2**28,
+        set_progress=None,
     ):
         """This function computes the averaged spectral data for a given slice and a given mask, the
         latter being provided either as a mask name, either as an array (at least one of the two
         must not be None). If the mask is provided as an array, the corresponding array of slice
-        coordinates (slice_coor_rescaled) must be provided.
+        coordinates (slice_coor_rescaled) must be provided. The rows of the mask are processed by
+        blocks, such that the memory used doesn't exceed memory_limit_bytes, even for the largest
+        structures.
 
         Args:
             slice_index (int): Index of the requested slice.
@@ -644,6 +674,10 @@ class Atlas:
             cache_flask (flask_caching.Cache, optional): Cache of the Flask database. If set to
                 None, the reading of memory-mapped data will not be multithreads-safe. Defaults to
                 None.
+            memory_limit_bytes (int, optional): Maximum memory used to process a block of rows of
+                the mask, in bytes. Defaults to 256MB.
+            set_progress: Used as part of the Plotly long callbacks, to indicate the progress of the
+                computation in the corresponding progress bar. Defaults to None.
 
         Returns:
             (np.ndarray): A 2D numpy array containing the averaged spectral data of the pixels in the
@@ -684,38 +718,47 @@ class Atlas:
             print("No selection could be found for current mask")
             grah_scattergl_data = None
         else:
-            # Do the average
+            # Do the average, loading only the spectra of the rows of the current block
             grah_scattergl_data = compute_thread_safe_function(
-                compute_spectrum_per_row_selection,
+                compute_spectrum_per_row_selection_bounded,
                 cache_flask,
                 self.data,
                 slice_index + 1,
                 list_index_bound_rows,
                 list_index_bound_column_per_row,
-                self.data.get_array_spectra(slice_index + 1),
+                None,
                 self.data.get_array_lookup_pixels(slice_index + 1),
                 original_shape,
                 self.data.get_array_peaks_transformed_lipids(slice_index + 1),
                 self.data.get_array_corrective_factors(slice_index + 1).astype(np.float32),
                 zeros_extend=False,
                 apply_correction=MAIA_correction,
+                memory_limit_bytes=memory_limit_bytes,
+                set_progress=set_progress,
+                return_array_spectra_rows=lambda row_1, row_2: self.data.get_array_spectra_rows(
+                    slice_index + 1, row_1, row_2
+                ),
+                task_class="heavy",
             )
         return grah_scattergl_data
 
     def save_all_projected_masks_and_spectra(
-        self, force_update=False, cache_flask=None, sample=False
+        self, force_update=False, cache_flask=None, sample=False, l_slice_indices=None
     ):
         """This function saves all the (2D) masks and corresponding averaged spectral data, for all
         the slices.
 
         Args:
-            force_update (bool, optional): If True, the function will not overwrite existing files.
+            force_update (bool, optional): If True, the function will overwrite existing files.
                 Defaults to False.
             cache_flask (flask_caching.Cache, optional): Cache of the Flask database. If set to
                 None, the reading of memory-mapped data will not be multithreads-safe. Defaults to
                 None.
             sample (bool, optional): If True, only a tiny sample of the masks will be processed (for
                 debug). Defaults to False.
+            l_slice_indices (list(int), optional): If provided, only the masks of the given slices
+                (indexed from 0) are processed, and the masks of the other slices are kept as they
+                are. Defaults to None.
         """
 
         # Path atlas for shelving
@@ -725,8 +768,16 @@ class Atlas:
         if sample:
             logging.warning("Only a sample of the masks and spectra will be computed!")
 
-        # Define a dictionnary that contains all the masks that exist for every slice
-        dic_existing_masks = {}
+        # Define a dictionnary that contains all the masks that exist for every slice. If only some
+        # slices are processed, start from the existing masks of the other slices.
+        if l_slice_indices is not None and self.storage.check_shelved_object(
+            path_atlas, "dic_existing_masks"
+        ):
+            dic_existing_masks = self.storage.load_shelved_object(path_atlas, "dic_existing_masks")
+        else:
+            dic_existing_masks = {}
+        if l_slice_indices is None:
+            l_slice_indices = range(self.data.get_slice_number())
 
         # Define a dictionnary to save the result of the function slice by slice
         if self.storage.check_shelved_object(path_atlas, "dic_processed_temp"):
@@ -737,7 +788,7 @@ class Atlas:
         else:
             dic_processed_temp = {}
 
-        for slice_index in range(self.data.get_slice_number()):
+        for slice_index in l_slice_indices:
             # Break the loop after the first slice if sample is True
             if sample and slice_index > 1:
                 break
@@ -753,7 +804,7 @@ class Atlas:
             dic_existing_masks[slice_index] = set([])
 
             # Check if the slice has already been processed
-            if slice_index not in dic_processed_temp:
+            if slice_index not in dic_processed_temp or force_update:
                 dic_processed_temp[slice_index] = set([])
 
             # Get hierarchical tree of brain structures
@@ -0,0 +1,215 @@
+# Copyright (c) 2022, Colas Droin. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
+
+""" This class is used to index the hierarchy of structures of the Allen Brain Atlas. The ancestors,
+descendants, names and acronyms of all structures, along with the inputs of the treemap, are
+computed in a single pass over the structure table of BrainGlobe, and shelved with a version key
+such that the index is recomputed whenever its format or the atlas version changes.
+"""
+
+# ==================================================================================================
+# --- Imports
+# ==================================================================================================
+
+# Standard modules
+import logging
+import numpy as np
+
+# LBAE imports
+from modules.tools.misc import logmem
+
+# ==================================================================================================
+# --- Class
+# ==================================================================================================
+
+
+class AtlasHierarchy:
+    """Class used to build, shelve and query an index of the hierarchy of structures of the Allen
+    Brain Atlas.
+
+    Attributes:
+        bg_atlas (BrainGlobeAtlas): Used to query the structure table and the annotations.
+        storage (Storage): Used to access the shelve database.
+        sample (bool): If True, only the first two levels of the hierarchy are kept in the treemap.
+        version (str): Version key of the index, made of the format version of the index and the
+            version of the atlas.
+        dic_id_acronym (dict): A dictionnary that associates each structure id to its acronym.
+        dic_acronym_id (dict): A dictionnary that associates each structure acronym to its id.
+        dic_name_acronym (dict): A dictionnary that associates each structure name to its acronym.
+        dic_acronym_name (dict): A dictionnary that associates each structure acronym to its name.
+        dic_id_ancestors (dict): A dictionnary that associates each structure id to the list of the
+            ids of its ancestors, from the root to its parent.
+        dic_id_descendants (dict): A dictionnary that associates each structure id to the list of
+            the ids of all its descendants.
+        dic_acronym_children_id (dict): A dictionnary that associates each structure (acronym) to
+            the set of ids of its annotated children, and of the structures in between.
+        l_nodes (list(str)): Names of the structures in the treemap.
+        l_parents (list(str)): Names of the parent of each structure in l_nodes.
+
+    Methods:
+        __init__(bg_atlas, storage, sample=False): Initialize the AtlasHierarchy class.
+        compute_hierarchy_index(version): Compute the index of the hierarchy of structures.
+        load(force_update=False): Load the index from the shelve database, computing it if needed.
+        get_ancestors(acronym): Return the acronyms of the ancestors of a structure.
+        get_descendants(acronym): Return the acronyms of the descendants of a structure.
+        return_treemap_inputs(): Return the lists of nodes and parents used to build the treemap.
+    """
+
+    # Version of the format of the index, to increment whenever compute_hierarchy_index() changes
+    format_version = 1
+
+    # ==============================================================================================
+    # --- Constructor
+    # ==============================================================================================
+
+    def __init__(self, bg_atlas, storage, sample=False):
+        """Initialize the class AtlasHierarchy.
+
+        Args:
+            bg_atlas (BrainGlobeAtlas): Used to query the structure table and the annotations.
+            storage (Storage): Used to access the shelve database.
+            sample (bool, optional): If True, only the first two levels of the hierarchy are kept
+                in the treemap. Defaults to False.
+        """
+        self.bg_atlas = bg_atlas
+        self.storage = storage
+        self.sample = sample
+        self.version = (
+            str(self.format_version)
+            + "_"
+            + str(self.bg_atlas.metadata["version"])
+            + ("_sample" if sample else "")
+        )
+        self.load()
+
+    # ==============================================================================================
+    # --- Methods
+    # ==============================================================================================
+
+    def compute_hierarchy_index(self, version):
+        """This function computes the index of the hierarchy of structures, in a single pass over
+        the structure table.
+
+        Args:
+            version (str): Version key of the index, stored along with it.
+
+        Returns:
+            (dict): The index, whose keys are the names of the corresponding attributes of the
+                class, along with the version key.
+        """
+        logging.info("Computing the hierarchy index " + version + logmem())
+        dic_id_acronym = {}
+        dic_acronym_id = {}
+        dic_name_acronym = {}
+        dic_acronym_name = {}
+        dic_id_ancestors = {}
+        dic_id_descendants = {}
+        dic_id_name = {}
+
+        # Loop over each structure, registering it as a descendant of all its ancestors
+        for id_structure, structure in self.bg_atlas.structures.items():
+            dic_id_acronym[id_structure] = structure["acronym"]
+            dic_acronym_id[structure["acronym"]] = id_structure
+            dic_name_acronym[structure["name"]] = structure["acronym"]
+            dic_acronym_name[structure["acronym"]] = structure["name"]
+            dic_id_name[id_structure] = structure["name"]
+            dic_id_ancestors[id_structure] = list(structure["structure_id_path"][:-1])
+            dic_id_descendants.setdefault(id_structure, [])
+            for id_ancestor in dic_id_ancestors[id_structure]:
+                dic_id_descendants.setdefault(id_ancestor, []).append(id_structure)
+
+        # Treemap inputs, keeping only the first two levels of the hierarchy if sample data
+        l_nodes = []
+        l_parents = []
+        for id_structure, l_ancestors in dic_id_ancestors.items():
+            if self.sample and len(l_ancestors) > 1:
+                continue
+            l_nodes.append(dic_id_name[id_structure])
+            l_parents.append(dic_id_name[l_ancestors[-1]] if len(l_ancestors) > 0 else "")
+
+        # Associate each structure to its annotated children, and to the structures in between
+        dic_acronym_children_id = {}
+        for id_annotation in np.unique(self.bg_atlas.annotation).tolist():
+            if id_annotation == 0:
+                continue
+            l_path = dic_id_ancestors[id_annotation] + [id_annotation]
+            for idx, id_structure in enumerate(l_path):
+                dic_acronym_children_id.setdefault(dic_id_acronym[id_structure], set()).update(
+                    l_path[idx:]
+                )
+
+        logging.info("Hierarchy index computed" + logmem())
+        return {
+            "version": version,
+            "dic_id_acronym": dic_id_acronym,
+            "dic_acronym_id": dic_acronym_id,
+            "dic_name_acronym": dic_name_acronym,
+            "dic_acronym_name": dic_acronym_name,
+            "dic_id_ancestors": dic_id_ancestors,
+            "dic_id_descendants": dic_id_descendants,
+            "dic_acronym_children_id": dic_acronym_children_id,
+            "l_nodes": l_nodes,
+            "l_parents": l_parents,
+        }
+
+    def load(self, force_update=False):
+        """This function loads the index from the shelve database, computing and shelving it if it
+        doesn't exist for the current version key, and sets the corresponding attributes.
+
+        Args:
+            force_update (bool, optional): If True, the index is recomputed. Defaults to False.
+        """
+        dic_index = self.storage.return_shelved_object(
+            "atlas/atlas_objects",
+            "hierarchy_index",
+            force_update=force_update,
+            compute_function=self.compute_hierarchy_index,
+            version=self.version,
+        )
+        self.dic_id_acronym = dic_index["dic_id_acronym"]
+        self.dic_acronym_id = dic_index["dic_acronym_id"]
+        self.dic_name_acronym = dic_index["dic_name_acronym"]
+        self.dic_acronym_name = dic_index["dic_acronym_name"]
+        self.dic_id_ancestors = dic_index["dic_id_ancestors"]
+        self.dic_id_descendants = dic_index["dic_id_descendants"]
+        self.dic_acronym_children_id = dic_index["dic_acronym_children_id"]
+        self.l_nodes = dic_index["l_nodes"]
+        self.l_parents = dic_index["l_parents"]
+
+    def get_ancestors(self, acronym):
+        """This function returns the acronyms of the ancestors of a structure.
+
+        Args:
+            acronym (str): Acronym of the structure.
+
+        Returns:
+            (list(str)): Acronyms of the ancestors, from the root to the parent of the structure.
+        """
+        return [
+            self.dic_id_acronym[id_ancestor]
+            for id_ancestor in self.dic_id_ancestors[self.dic_acronym_id[acronym]]
+        ]
+
+    def get_descendants(self, acronym):
+        """This function returns the acronyms of all the descendants of a structure.
+
+        Args:
+            acronym (str): Acronym of the structure.
+
+        Returns:
+            (list(str)): Acronyms of the descendants, in the order of the structure table.
+        """
+        return [
+            self.dic_id_acronym[id_descendant]
+            for id_descendant in self.dic_id_descendants[self.dic_acronym_id[acronym]]
+        ]
+
+    def return_treemap_inputs(self):
+        """This function returns the lists of nodes and parents used to build the treemap of the
+        hierarchy.
+
+        Returns:
+            (list(str)): List of children (node) names.
+            (list(str)): List of parent names.
+        """
+        return self.l_nodes, self.l_parents
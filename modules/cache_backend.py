@@ -0,0 +1,721 @@
+# Copyright (c) 2022, Colas Droin. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
+
+""" This class is a Flask-Caching backend relying on diskcache, used as a local stand-in for Redis.
+The cache is stored in a SQLite database (with the values in files when they are large), which can
+be accessed concurrently by several threads and processes, such that the memoized results are
+shared by all the workers of the server, and survive restarts. Contrarily to the FileSystemCache
+backend, which is limited to a number of entries and must list its folder to prune it, the cache
+is bounded by a size in bytes, the entries being evicted according to a given policy (e.g. least
+recently used). Hits, misses and size are exposed with the other metrics of the app, at /metrics.
+
+The TieredCache backend adds a small in-memory tier, private to each process, on top of the disk
+tier. Only the memoized results of the functions decorated with cache_group() (e.g. figures) are
+kept in memory, each group having its own budget in bytes. Admission and eviction in the memory
+tier depend on the size of the entries and on the time taken to compute them (GreedyDual-Size
+policy), such that large and expensive results are not evicted by many small and cheap ones.
+
+The backend is selected in app.py with:
+
+`"CACHE_TYPE": "modules.cache_backend.TieredCache"`
+"""
+
+# ==================================================================================================
+# --- Imports
+# ==================================================================================================
+
+# Standard modules
+import contextvars
+import functools
+import logging
+import pickle
+import threading
+import time
+from collections import OrderedDict
+import diskcache
+from flask_caching.backends.base import BaseCache
+
+# ==================================================================================================
+# --- Functions
+# ==================================================================================================
+
+# Name of the group of the function being executed, along with the key of its memoized result, used
+# to attribute the cached results
+_current_cache_group = contextvars.ContextVar("cache_group", default=None)
+
+
+def cache_group(name):
+    """This decorator assigns the results cached during the execution of a function to a group,
+    such that they can be kept in the memory tier of the TieredCache, within the budget of the
+    group. It must be placed above the memoize decorator:
+
+    @cache_group("region_spectra")
+    @cache_flask.memoize()
+    def function(...):
+
+    Args:
+        name (str): Name of the group.
+
+    Returns:
+        (func): The decorator.
+    """
+
+    def decorator(function):
+        @functools.wraps(function)
+        def grouped_function(*args, **kwargs):
+            # Key of the memoized result, computed as in the memoize decorator. It's the only key
+            # admitted in the memory tier, the other entries read or written by the function (e.g.
+            # the locks shared between the processes) always going to the disk tier
+            key = None
+            if hasattr(function, "make_cache_key") and hasattr(function, "uncached"):
+                try:
+                    key = function.make_cache_key(function.uncached, *args, **kwargs)
+                except Exception:
+                    logging.warning("The cache key of " + function.__name__ + " can't be computed")
+            token = _current_cache_group.set((name, key))
+            try:
+                return function(*args, **kwargs)
+            finally:
+                _current_cache_group.reset(token)
+
+        return grouped_function
+
+    return decorator
+
+
+# ==================================================================================================
+# --- Classes
+# ==================================================================================================
+
+
+class DiskCache(BaseCache):
+    """Flask-Caching backend storing the entries in a diskcache.Cache.
+
+    Attributes:
+        cache (diskcache.Cache): The underlying cache.
+        default_timeout (int): Default timeout of the entries, in seconds (0 means that the entries
+            never expire).
+
+    Methods:
+        factory(app, config, args, kwargs): Build the backend from the Flask-Caching config.
+        __init__(directory, size_limit=2**30, eviction_policy="least-recently-used",
+            default_timeout=300): Initialize the DiskCache class.
+        return_expire(timeout): Convert a Flask-Caching timeout into a diskcache expiration.
+        get(key): Return an entry.
+        set(key, value, timeout=None): Set an entry.
+        add(key, value, timeout=None): Set an entry only if it doesn't exist.
+        delete(key): Delete an entry.
+        has(key): Check if an entry exists.
+        clear(): Delete all the entries.
+        inc(key, delta=1): Atomically increment an entry.
+        dec(key, delta=1): Atomically decrement an entry.
+        return_statistics(): Return the statistics of the cache.
+        return_metrics_lines(): Return the statistics in the Prometheus text format.
+    """
+
+    @classmethod
+    def factory(cls, app, config, args, kwargs):
+        """This function builds the backend from the Flask-Caching config. It is called by
+        Flask-Caching when CACHE_TYPE is set to this class.
+
+        Args:
+            app (flask.Flask): The server.
+            config (dict): The Flask-Caching config, with the keys CACHE_DIR, and optionally
+                CACHE_SIZE_LIMIT (in bytes) and CACHE_EVICTION_POLICY.
+            args (list): Positional arguments of the backend.
+            kwargs (dict): Named arguments of the backend (e.g. default_timeout).
+
+        Returns:
+            (DiskCache): The backend.
+        """
+        kwargs.update(
+            dict(
+                size_limit=config.get("CACHE_SIZE_LIMIT", 2**30),
+                eviction_policy=config.get("CACHE_EVICTION_POLICY", "least-recently-used"),
+            )
+        )
+        return cls(config["CACHE_DIR"], *args, **kwargs)
+
+    def __init__(
+        self,
+        directory,
+        size_limit=2**30,
+        eviction_policy="least-recently-used",
+        default_timeout=300,
+    ):
+        """Initialize the class DiskCache.
+
+        Args:
+            directory (str): Folder of the cache.
+            size_limit (int, optional): Maximum size of the cache, in bytes. Defaults to 1GB.
+            eviction_policy (str, optional): Policy used to evict entries once the size limit is
+                reached, among the diskcache policies (e.g. "least-recently-stored", which is
+                cheaper as it doesn't update the entries when they are read). Defaults to
+                "least-recently-used".
+            default_timeout (int, optional): Default timeout of the entries, in seconds. Defaults to
+                300.
+        """
+        super().__init__(default_timeout=default_timeout)
+        self.cache = diskcache.Cache(
+            directory, size_limit=size_limit, eviction_policy=eviction_policy
+        )
+
+        # Statistics are stored in the cache database, hence shared by all the processes
+        self.cache.stats(enable=True)
+        logging.info(
+            "Flask cache stored in "
+            + directory
+            + " with a size limit of "
+            + str(round(size_limit / 1024**2))
+            + "MB"
+        )
+
+    # ==============================================================================================
+    # --- Methods
+    # ==============================================================================================
+
+    def return_expire(self, timeout):
+        """This function converts a Flask-Caching timeout into a diskcache expiration.
+
+        Args:
+            timeout (int): Timeout in seconds, None for the default timeout, and 0 for no timeout.
+
+        Returns:
+            (int): Expiration in seconds, or None if the entry never expires.
+        """
+        timeout = self._normalize_timeout(timeout)
+        return None if timeout == 0 else timeout
+
+    def get(self, key):
+        """Return an entry, or None if it doesn't exist.
+
+        Args:
+            key (str): Key of the entry.
+
+        Returns:
+            The value of the entry.
+        """
+        return self.cache.get(key, default=None)
+
+    def set(self, key, value, timeout=None):
+        """Set an entry.
+
+        Args:
+            key (str): Key of the entry.
+            value (object): Value of the entry (must be picklable).
+            timeout (int, optional): Timeout of the entry. Defaults to None, corresponding to the
+                default timeout.
+
+        Returns:
+            (bool): True if the entry has been set.
+        """
+        return self.cache.set(key, value, expire=self.return_expire(timeout))
+
+    def add(self, key, value, timeout=None):
+        """Set an entry only if it doesn't exist already.
+
+        Args:
+            key (str): Key of the entry.
+            value (object): Value of the entry (must be picklable).
+            timeout (int, optional): Timeout of the entry. Defaults to None, corresponding to the
+                default timeout.
+
+        Returns:
+            (bool): True if the entry has been added.
+        """
+        return self.cache.add(key, value, expire=self.return_expire(timeout))
+
+    def delete(self, key):
+        """Delete an entry.
+
+        Args:
+            key (str): Key of the entry.
+
+        Returns:
+            (bool): True if the entry existed.
+        """
+        return self.cache.delete(key)
+
+    def has(self, key):
+        """Check if an entry exists (and has not expired).
+
+        Args:
+            key (str): Key of the entry.
+
+        Returns:
+            (bool): True if the entry exists.
+        """
+        return key in self.cache
+
+    def clear(self):
+        """Delete all the entries.
+
+        Returns:
+            (bool): True once the cache has been cleared.
+        """
+        self.cache.clear()
+        return True
+
+    def inc(self, key, delta=1):
+        """Atomically increment an entry, initialized to 0 if it doesn't exist.
+
+        Args:
+            key (str): Key of the entry.
+            delta (int, optional): Increment. Defaults to 1.
+
+        Returns:
+            (int): The new value of the entry.
+        """
+        return self.cache.incr(key, delta, default=0)
+
+    def dec(self, key, delta=1):
+        """Atomically decrement an entry, initialized to 0 if it doesn't exist.
+
+        Args:
+            key (str): Key of the entry.
+            delta (int, optional): Decrement. Defaults to 1.
+
+        Returns:
+            (int): The new value of the entry.
+        """
+        return self.cache.decr(key, delta, default=0)
+
+    def return_statistics(self):
+        """This function returns the statistics of the cache, aggregated over all the processes.
+
+        Returns:
+            (dict): The number of hits, misses and entries, and the size (in bytes) of the cache
+                along with its limit.
+        """
+        hits, misses = self.cache.stats()
+        return {
+            "hits": hits,
+            "misses": misses,
+            "entries": len(self.cache),
+            "size_bytes": self.cache.volume(),
+            "size_limit_bytes": self.cache.size_limit,
+        }
+
+    def return_metrics_lines(self):
+        """This function returns the statistics of the cache in the Prometheus text format.
+
+        Returns:
+            (list(str)): The lines of the metrics.
+        """
+        dic_statistics = self.return_statistics()
+        return [
+            "# TYPE lbae_flask_cache_hits_total counter",
+            "lbae_flask_cache_hits_total " + str(dic_statistics["hits"]),
+            "# TYPE lbae_flask_cache_misses_total counter",
+            "lbae_flask_cache_misses_total " + str(dic_statistics["misses"]),
+            "# TYPE lbae_flask_cache_entries gauge",
+            "lbae_flask_cache_entries " + str(dic_statistics["entries"]),
+            "# TYPE lbae_flask_cache_size_bytes gauge",
+            "lbae_flask_cache_size_bytes " + str(dic_statistics["size_bytes"]),
+            "# TYPE lbae_flask_cache_size_limit_bytes gauge",
+            "lbae_flask_cache_size_limit_bytes " + str(dic_statistics["size_limit_bytes"]),
+        ]
+
+
+class TieredCache(DiskCache):
+    """Flask-Caching backend made of a small in-memory tier, private to each process, on top of the
+    disk tier of DiskCache.
+
+    Only the memoized results of the functions decorated with cache_group() are kept in memory
+    (serialized, such that the callers can't modify the cached objects), the other entries (e.g.
+    the locks shared between the processes, even when set by a grouped function) always going to
+    the disk tier. Each memory entry
+    has a priority L + cost / size, where cost is the time taken to compute it (measured between
+    the miss and the set) and L is the priority of the last evicted entry (GreedyDual-Size).
+    When space is needed, the entries of lowest priority are evicted, unless one of them has a
+    higher priority than the new entry, in which case the new entry is only stored on disk.
+
+    Attributes:
+        memory_limit (int): Maximum size of the memory tier, in bytes.
+        max_item_fraction (float): Maximum size of a memory entry, as a fraction of the budget.
+        dic_group_budgets (dict): Maximum size of the memory entries of each group, in bytes.
+        _dic_memory (OrderedDict): Memory entries, as (data, size, group, expiration, priority,
+            cost) tuples.
+        _dic_pending (dict): Time of the misses of the keys being computed.
+        _memory_size (int): Size of the memory tier, in bytes.
+        _priority_floor (float): Priority of the last evicted entry (L).
+        _dic_statistics (dict): Statistics of the memory tier, globally and per group.
+        _lock (threading.Lock): Lock protecting the memory tier.
+
+    Methods:
+        factory(app, config, args, kwargs): Build the backend from the Flask-Caching config.
+        __init__(directory, memory_limit=2**28, max_item_fraction=0.25, dic_group_budgets=None,
+            **kwargs): Initialize the TieredCache class.
+        return_group_statistics(group): Return the statistics of a group.
+        return_memory_group(key): Return the group of an entry admitted in the memory tier.
+        remove_memory_entry(key): Remove an entry from the memory tier.
+        admit_memory_entry(key, data, group, timeout, cost): Add an entry to the memory tier.
+        get(key): Return an entry.
+        set(key, value, timeout=None): Set an entry.
+        add(key, value, timeout=None): Set an entry only if it doesn't exist.
+        delete(key): Delete an entry.
+        has(key): Check if an entry exists.
+        clear(): Delete all the entries.
+        return_statistics(): Return the statistics of both tiers.
+        return_metrics_lines(): Return the statistics in the Prometheus text format.
+    """
+
+    @classmethod
+    def factory(cls, app, config, args, kwargs):
+        """This function builds the backend from the Flask-Caching config.
+
+        Args:
+            app (flask.Flask): The server.
+            config (dict): The Flask-Caching config, with the keys of DiskCache, and optionally
+                CACHE_MEMORY_LIMIT (in bytes), CACHE_MAX_ITEM_FRACTION and CACHE_GROUP_BUDGETS (a
+                dictionnary of budgets in bytes, indexed by group).
+            args (list): Positional arguments of the backend.
+            kwargs (dict): Named arguments of the backend.
+
+        Returns:
+            (TieredCache): The backend.
+        """
+        kwargs.update(
+            dict(
+                memory_limit=config.get("CACHE_MEMORY_LIMIT", 2**28),
+                max_item_fraction=config.get("CACHE_MAX_ITEM_FRACTION", 0.25),
+                dic_group_budgets=config.get("CACHE_GROUP_BUDGETS", None),
+            )
+        )
+        return super().factory(app, config, args, kwargs)
+
+    def __init__(
+        self,
+        directory,
+        memory_limit=2**28,
+        max_item_fraction=0.25,
+        dic_group_budgets=None,
+        **kwargs,
+    ):
+        """Initialize the class TieredCache.
+
+        Args:
+            directory (str): Folder of the disk tier.
+            memory_limit (int, optional): Maximum size of the memory tier, in bytes. Defaults to
+                256MB.
+            max_item_fraction (float, optional): Maximum size of a memory entry, as a fraction of
+                the budget of its group (or of memory_limit). Larger entries are only stored on
+                disk. Defaults to 0.25.
+            dic_group_budgets (dict, optional): Maximum size of the memory entries of each group,
+                in bytes. Groups without budget are only bounded by memory_limit. Defaults to None.
+            **kwargs: Named arguments of DiskCache.
+        """
+        super().__init__(directory, **kwargs)
+        self.memory_limit = memory_limit
+        self.max_item_fraction = max_item_fraction
+        self.dic_group_budgets = dic_group_budgets if dic_group_budgets is not None else {}
+        self._dic_memory = OrderedDict()
+        self._dic_pending = {}
+        self._memory_size = 0
+        self._priority_floor = 0.0
+        self._dic_statistics = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "admissions": 0,
+            "rejections": 0,
+            "evictions": 0,
+            "groups": {},
+        }
+        self._lock = threading.Lock()
+
+    # ==============================================================================================
+    # --- Methods
+    # ==============================================================================================
+
+    def return_group_statistics(self, group):
+        """This function returns the statistics of a group, creating them if needed. Must be
+        called with the lock held.
+
+        Args:
+            group (str): Name of the group.
+
+        Returns:
+            (dict): The statistics of the group.
+        """
+        if group not in self._dic_statistics["groups"]:
+            self._dic_statistics["groups"][group] = {
+                "memory_hits": 0,
+                "disk_hits": 0,
+                "misses": 0,
+                "entries": 0,
+                "size_bytes": 0,
+            }
+        return self._dic_statistics["groups"][group]
+
+    def return_memory_group(self, key):
+        """This function returns the group of an entry if it goes through the memory tier, i.e. if
+        it is the memoized result of the function decorated with cache_group() being executed.
+
+        Args:
+            key (str): Key of the entry.
+
+        Returns:
+            (str): The group of the entry, or None if the entry only goes to the disk tier.
+        """
+        t_group = _current_cache_group.get()
+        if t_group is None or key.startswith("locked-") or key.endswith("_memver"):
+            return None
+        group, key_result = t_group
+        return group if key == key_result else None
+
+    def remove_memory_entry(self, key):
+        """This function removes an entry from the memory tier, if present. Must be called with the
+        lock held.
+
+        Args:
+            key (str): Key of the entry.
+
+        Returns:
+            (tuple): The removed entry, or None if it was not in the memory tier.
+        """
+        entry = self._dic_memory.pop(key, None)
+        if entry is not None:
+            self._memory_size -= entry[1]
+            dic_group = self.return_group_statistics(entry[2])
+            dic_group["entries"] -= 1
+            dic_group["size_bytes"] -= entry[1]
+        return entry
+
+    def admit_memory_entry(self, key, data, group, timeout, cost):
+        """This function adds an entry to the memory tier if its size fits in the budget of its
+        group, evicting the entries of lowest priority if needed. The entry is rejected if it would
+        evict an entry of higher priority. Must be called with the lock held.
+
+        Args:
+            key (str): Key of the entry.
+            data (bytes): Serialized value of the entry.
+            group (str): Group of the entry.
+            timeout (int): Timeout of the entry, as returned by return_expire().
+            cost (float): Time taken to compute the entry, in seconds.
+
+        Returns:
+            (bool): True if the entry has been admitted.
+        """
+        self.remove_memory_entry(key)
+        size = len(data)
+        budget = min(self.dic_group_budgets.get(group, self.memory_limit), self.memory_limit)
+        if size > self.max_item_fraction * budget:
+            self._dic_statistics["rejections"] += 1
+            return False
+
+        # Select the victims, by increasing priority, until both budgets are respected
+        priority = self._priority_floor + cost / size
+        dic_group = self.return_group_statistics(group)
+        memory_size = self._memory_size
+        group_size = dic_group["size_bytes"]
+        l_victims = []
+        for key_victim, entry in sorted(self._dic_memory.items(), key=lambda x: x[1][4]):
+            if memory_size + size <= self.memory_limit and group_size + size <= budget:
+                break
+            # Only the entries of the group free space in the group budget
+            if memory_size + size <= self.memory_limit and entry[2] != group:
+                continue
+            # The new entry is the one of lowest priority, hence evicted right away
+            if entry[4] > priority:
+                self._priority_floor = priority
+                self._dic_statistics["rejections"] += 1
+                return False
+            l_victims.append(key_victim)
+            memory_size -= entry[1]
+            if entry[2] == group:
+                group_size -= entry[1]
+
+        for key_victim in l_victims:
+            entry = self.remove_memory_entry(key_victim)
+            self._priority_floor = max(self._priority_floor, entry[4])
+            self._dic_statistics["evictions"] += 1
+
+        expiration = time.time() + timeout if timeout is not None else None
+        self._dic_memory[key] = (data, size, group, expiration, priority, cost)
+        self._memory_size += size
+        dic_group["entries"] += 1
+        dic_group["size_bytes"] += size
+        self._dic_statistics["admissions"] += 1
+        return True
+
+    def get(self, key):
+        """Return an entry, from the memory tier if possible, or None if it doesn't exist.
+
+        Args:
+            key (str): Key of the entry.
+
+        Returns:
+            The value of the entry.
+        """
+        group = self.return_memory_group(key)
+        if group is None:
+            return super().get(key)
+
+        with self._lock:
+            dic_group = self.return_group_statistics(group)
+            entry = self._dic_memory.get(key, None)
+            if entry is not None and (entry[3] is None or entry[3] > time.time()):
+                # Refresh the priority of the entry
+                priority = self._priority_floor + entry[5] / entry[1]
+                self._dic_memory[key] = entry[:4] + (priority, entry[5])
+                self._dic_memory.move_to_end(key)
+                self._dic_statistics["memory_hits"] += 1
+                dic_group["memory_hits"] += 1
+                data = entry[0]
+            else:
+                if entry is not None:
+                    self.remove_memory_entry(key)
+                data = None
+
+        if data is not None:
+            return pickle.loads(data)
+
+        value = super().get(key)
+        with self._lock:
+            if value is None:
+                self._dic_statistics["misses"] += 1
+                dic_group["misses"] += 1
+                # The time of the miss is used to estimate the cost of the entry once set
+                if len(self._dic_pending) > 1024:
+                    self._dic_pending.clear()
+                self._dic_pending[key] = time.perf_counter()
+            else:
+                self._dic_statistics["disk_hits"] += 1
+                dic_group["disk_hits"] += 1
+        return value
+
+    def set(self, key, value, timeout=None):
+        """Set an entry in the disk tier, and in the memory tier if it is the memoized result of a
+        group.
+
+        Args:
+            key (str): Key of the entry.
+            value (object): Value of the entry (must be picklable).
+            timeout (int, optional): Timeout of the entry. Defaults to None, corresponding to the
+                default timeout.
+
+        Returns:
+            (bool): True if the entry has been set.
+        """
+        group = self.return_memory_group(key)
+        if group is not None:
+            data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            with self._lock:
+                time_miss = self._dic_pending.pop(key, None)
+                cost = time.perf_counter() - time_miss if time_miss is not None else 0.0
+                self.admit_memory_entry(key, data, group, self.return_expire(timeout), cost)
+        else:
+            with self._lock:
+                self.remove_memory_entry(key)
+        return super().set(key, value, timeout=timeout)
+
+    def add(self, key, value, timeout=None):
+        """Set an entry only if it doesn't exist already. Only the disk tier is used, as it is
+        shared by all the processes.
+
+        Args:
+            key (str): Key of the entry.
+            value (object): Value of the entry (must be picklable).
+            timeout (int, optional): Timeout of the entry. Defaults to None, corresponding to the
+                default timeout.
+
+        Returns:
+            (bool): True if the entry has been added.
+        """
+        return super().add(key, value, timeout=timeout)
+
+    def delete(self, key):
+        """Delete an entry from both tiers. The memory tiers of the other processes are not
+        affected.
+
+        Args:
+            key (str): Key of the entry.
+
+        Returns:
+            (bool): True if the entry existed.
+        """
+        with self._lock:
+            entry = self.remove_memory_entry(key)
+        return super().delete(key) or entry is not None
+
+    def has(self, key):
+        """Check if an entry exists (and has not expired) in one of the tiers.
+
+        Args:
+            key (str): Key of the entry.
+
+        Returns:
+            (bool): True if the entry exists.
+        """
+        with self._lock:
+            entry = self._dic_memory.get(key, None)
+            if entry is not None and (entry[3] is None or entry[3] > time.time()):
+                return True
+        return super().has(key)
+
+    def clear(self):
+        """Delete all the entries of both tiers.
+
+        Returns:
+            (bool): True once the cache has been cleared.
+        """
+        with self._lock:
+            for key in list(self._dic_memory.keys()):
+                self.remove_memory_entry(key)
+            self._dic_pending.clear()
+        return super().clear()
+
+    def return_statistics(self):
+        """This function returns the statistics of the disk tier, shared by all the processes,
+        along with the statistics of the memory tier of the current process.
+
+        Returns:
+            (dict): The statistics, the ones of the memory tier being under the key "memory".
+        """
+        dic_statistics = super().return_statistics()
+        with self._lock:
+            dic_statistics["memory"] = {
+                key: value for key, value in self._dic_statistics.items() if key != "groups"
+            }
+            dic_statistics["memory"]["size_bytes"] = self._memory_size
+            dic_statistics["memory"]["size_limit_bytes"] = self.memory_limit
+            dic_statistics["memory"]["groups"] = {
+                group: dict(dic) for group, dic in self._dic_statistics["groups"].items()
+            }
+        return dic_statistics
+
+    def return_metrics_lines(self):
+        """This function returns the statistics of both tiers in the Prometheus text format.
+
+        Returns:
+            (list(str)): The lines of the metrics.
+        """
+        l_lines = super().return_metrics_lines()
+        dic_memory = self.return_statistics()["memory"]
+        for key, type_metric in [
+            ("memory_hits", "counter"),
+            ("disk_hits", "counter"),
+            ("misses", "counter"),
+            ("admissions", "counter"),
+            ("rejections", "counter"),
+            ("evictions", "counter"),
+            ("size_bytes", "gauge"),
+            ("size_limit_bytes", "gauge"),
+        ]:
+            metric = "lbae_tiered_cache_" + key + ("_total" if type_metric == "counter" else "")
+            l_lines.append("# TYPE " + metric + " " + type_metric)
+            l_lines.append(metric + " " + str(dic_memory[key]))
+        for key, type_metric in [
+            ("memory_hits", "counter"),
+            ("disk_hits", "counter"),
+            ("misses", "counter"),
+            ("entries", "gauge"),
+            ("size_bytes", "gauge"),
+        ]:
+            metric = "lbae_tiered_cache_group_" + key
+            metric += "_total" if type_metric == "counter" else ""
+            l_lines.append("# TYPE " + metric + " " + type_metric)
+            for group, dic in dic_memory["groups"].items():
+                l_lines.append(metric + '{group="' + group + '"} ' + str(dic[key]))
+        return l_lines
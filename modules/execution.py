@@ -0,0 +1,250 @@
+# Copyright (c) 2022, Colas Droin. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
+
+""" This class is used to execute the CPU-bound work of the callbacks (mostly numba kernels) off the
+event loop. When the app is served by gevent workers, a numba kernel never yields, such that a
+single heavy computation (e.g. the average spectrum of a large region) freezes every other request
+of the worker. Here, the computations are dispatched to a bounded pool of native threads, the
+kernels releasing the GIL (nogil=True), while the calling greenlet simply waits for the result.
+Outside of gevent, the computations are run in the calling thread, the pool only bounding their
+concurrency.
+
+Each computation belongs to a task class (interactive, heavy or background), with its own priority,
+maximum number of running tasks and maximum queue length, such that light interactive computations
+(e.g. lipid images) are always served before heavy ones, and heavy ones can't use all the threads.
+The state of the queues is exposed with the other metrics of the app, at /metrics.
+"""
+
+# ==================================================================================================
+# --- Imports
+# ==================================================================================================
+
+# Standard modules
+import itertools
+import logging
+import os
+import threading
+import time
+
+# ==================================================================================================
+# --- Classes
+# ==================================================================================================
+
+
+class ExecutionQueueFull(Exception):
+    """Exception raised when a task is submitted while the queue of its class is full."""
+
+
+class ExecutionPool:
+    """Class used to run CPU-bound tasks on a bounded pool of native threads, with per-class
+    queues and priorities.
+
+    Attributes:
+        n_threads (int): Maximum number of tasks running at the same time.
+        pid (int): Identifier of the process in which the pool has been created.
+        dic_classes (dict): Configuration of each task class, with its priority (lower is served
+            first), its maximum number of running tasks and its maximum queue length.
+        threadpool (gevent.threadpool.ThreadPool): Pool of native threads, used only if the
+            threading module has been patched by gevent. None otherwise.
+        dic_metrics (dict): Metrics of each task class.
+        _l_waiting (list): Tickets of the tasks waiting to be run, as (priority, sequence number,
+            task class) tuples.
+        _counter (itertools.count): Counter used to serve the tasks of same priority in order.
+        _condition (threading.Condition): Condition used to wake up the waiting tasks.
+
+    Methods:
+        __init__(n_threads=None, dic_classes=None): Initialize the ExecutionPool class.
+        return_next_ticket(): Return the ticket of the next task to run.
+        run(task_class, function, *args, **kwargs): Run a task and return its result.
+        return_metrics(): Return the metrics of each task class.
+        return_metrics_lines(): Return the metrics in the Prometheus text format.
+    """
+
+    def __init__(self, n_threads=None, dic_classes=None):
+        """Initialize the class ExecutionPool.
+
+        Args:
+            n_threads (int, optional): Maximum number of tasks running at the same time. Defaults
+                to None, corresponding to the number of cores.
+            dic_classes (dict, optional): Configuration of each task class. Defaults to None,
+                corresponding to interactive (highest priority, all threads), heavy (at most half
+                of the threads) and background (a single thread) classes.
+        """
+        self.n_threads = n_threads if n_threads is not None else (os.cpu_count() or 1)
+        self.pid = os.getpid()
+        if dic_classes is None:
+            dic_classes = {
+                "interactive": {"priority": 0, "max_running": self.n_threads, "max_queued": 64},
+                "heavy": {
+                    "priority": 1,
+                    "max_running": max(1, self.n_threads // 2),
+                    "max_queued": 16,
+                },
+                "background": {"priority": 2, "max_running": 1, "max_queued": 1024},
+            }
+        self.dic_classes = dic_classes
+
+        # Native threads are only needed if the threads have been replaced by greenlets
+        self.threadpool = None
+        try:
+            import gevent.monkey
+
+            if gevent.monkey.is_module_patched("threading"):
+                import gevent.threadpool
+
+                self.threadpool = gevent.threadpool.ThreadPool(self.n_threads)
+        except ImportError:
+            pass
+
+        self.dic_metrics = {
+            task_class: {
+                "running": 0,
+                "queued": 0,
+                "max_queued_observed": 0,
+                "submitted": 0,
+                "completed": 0,
+                "failed": 0,
+                "rejected": 0,
+                "wait_seconds": 0.0,
+                "run_seconds": 0.0,
+            }
+            for task_class in self.dic_classes
+        }
+        self._l_waiting = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+
+        logging.info(
+            "Execution pool initialized with "
+            + str(self.n_threads)
+            + (" native threads" if self.threadpool is not None else " slots")
+        )
+
+    # ==============================================================================================
+    # --- Methods
+    # ==============================================================================================
+
+    def return_next_ticket(self):
+        """This function returns the ticket of the next task to run, i.e. the waiting task of
+        highest priority whose class has not reached its maximum number of running tasks. Must be
+        called with the condition held.
+
+        Returns:
+            (tuple): The ticket, or None if no task can be run now.
+        """
+        n_running = sum(dic["running"] for dic in self.dic_metrics.values())
+        if n_running >= self.n_threads:
+            return None
+        for ticket in sorted(self._l_waiting):
+            max_running = self.dic_classes[ticket[2]]["max_running"]
+            if self.dic_metrics[ticket[2]]["running"] < max_running:
+                return ticket
+        return None
+
+    def run(self, task_class, function, *args, **kwargs):
+        """This function runs a task once a thread is available for its class, and returns its
+        result. The calling thread (or greenlet) waits in the meantime.
+
+        Args:
+            task_class (str): Class of the task, among the keys of dic_classes.
+            function (func): The function to run.
+            *args: Arguments of function.
+            **kwargs: Named arguments of function.
+
+        Returns:
+            The result of function. Type may vary depending on function.
+        """
+        dic_metrics = self.dic_metrics[task_class]
+        time_submitted = time.perf_counter()
+        with self._condition:
+            dic_metrics["submitted"] += 1
+            if dic_metrics["queued"] >= self.dic_classes[task_class]["max_queued"]:
+                dic_metrics["rejected"] += 1
+                raise ExecutionQueueFull("The queue of the " + task_class + " tasks is full")
+            ticket = (self.dic_classes[task_class]["priority"], next(self._counter), task_class)
+            self._l_waiting.append(ticket)
+            dic_metrics["queued"] += 1
+            dic_metrics["max_queued_observed"] = max(
+                dic_metrics["max_queued_observed"], dic_metrics["queued"]
+            )
+            while self.return_next_ticket() != ticket:
+                self._condition.wait()
+            self._l_waiting.remove(ticket)
+            dic_metrics["queued"] -= 1
+            dic_metrics["running"] += 1
+
+        time_start = time.perf_counter()
+        failed = False
+        try:
+            if self.threadpool is not None:
+                return self.threadpool.apply(function, args, kwargs)
+            return function(*args, **kwargs)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            with self._condition:
+                dic_metrics["running"] -= 1
+                dic_metrics["failed" if failed else "completed"] += 1
+                dic_metrics["wait_seconds"] += time_start - time_submitted
+                dic_metrics["run_seconds"] += time.perf_counter() - time_start
+                self._condition.notify_all()
+
+    def return_metrics(self):
+        """This function returns the metrics of each task class.
+
+        Returns:
+            (dict): The metrics, indexed by task class.
+        """
+        with self._condition:
+            return {task_class: dict(dic) for task_class, dic in self.dic_metrics.items()}
+
+    def return_metrics_lines(self):
+        """This function returns the metrics of each task class in the Prometheus text format.
+
+        Returns:
+            (list(str)): The lines of the metrics.
+        """
+        dic_metrics = self.return_metrics()
+        l_lines = []
+        for key, type_metric in [
+            ("running", "gauge"),
+            ("queued", "gauge"),
+            ("max_queued_observed", "gauge"),
+            ("submitted", "counter"),
+            ("completed", "counter"),
+            ("failed", "counter"),
+            ("rejected", "counter"),
+            ("wait_seconds", "counter"),
+            ("run_seconds", "counter"),
+        ]:
+            metric = "lbae_execution_" + key + ("_total" if type_metric == "counter" else "")
+            l_lines.append("# TYPE " + metric + " " + type_metric)
+            for task_class, dic in dic_metrics.items():
+                l_lines.append(metric + '{class="' + task_class + '"} ' + str(dic[key]))
+        return l_lines
+
+
+# ==================================================================================================
+# --- Functions
+# ==================================================================================================
+
+# Execution pool shared by the whole process, created on first use
+_execution_pool = None
+_lock_execution_pool = threading.Lock()
+
+
+def return_execution_pool():
+    """This function returns the execution pool of the process, creating it on first use. The
+    number of threads can be set with the environment variable LBAE_EXECUTION_THREADS.
+
+    Returns:
+        (ExecutionPool): The execution pool.
+    """
+    global _execution_pool
+    with _lock_execution_pool:
+        # The threads of a pool created before a fork (e.g. in a long callback process) are lost
+        if _execution_pool is None or _execution_pool.pid != os.getpid():
+            n_threads = os.environ.get("LBAE_EXECUTION_THREADS", None)
+            _execution_pool = ExecutionPool(int(n_threads) if n_threads is not None else None)
+    return _execution_pool
@@ -0,0 +1,416 @@
+# Copyright (c) 2022, Colas Droin. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
+
+""" This class is used to export data (e.g. the spectra of the selected regions, or lipid images)
+as files, in the background, instead of building them synchronously in a callback. Each export is
+a job, fed by a generator yielding the data as chunks of columns, and written in one of the
+following formats:
+- csv: text file, which can be downloaded while being written.
+- npz: compressed numpy archive, with one array per column.
+- parquet: compressed columnar file, only if pyarrow is installed.
+
+The writing is run on the background class of the execution pool (see modules/execution.py), such
+that a large export never freezes the other requests. The progress of a job can be queried at
+/export/<job_id>/status, and the file is streamed (in chunks) from /export/<job_id>/download. The
+metadata of each job is written in a manifest file next to the exported file, such that these
+routes can be served by any worker of the server, and not only by the one running the job.
+"""
+
+# ==================================================================================================
+# --- Imports
+# ==================================================================================================
+
+# Standard modules
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+import flask
+import numpy as np
+import pandas as pd
+
+# Parquet is only available if pyarrow is installed
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# LBAE imports
+from modules.execution import return_execution_pool
+
+# ==================================================================================================
+# --- Functions
+# ==================================================================================================
+
+
+def generate_spectra_table(slice_index, l_spectra, ll_idx_labels, l_labels_all_lipids):
+    """This generator yields the spectra of the selected regions as chunks of columns, one chunk per
+    region, each peak being labelled with the annotated lipid (if any).
+
+    Args:
+        slice_index (int): Index of the slice the spectra come from.
+        l_spectra (list(np.ndarray)): Spectra of the selected regions, with m/z values on the first
+            row and intensities on the second row.
+        ll_idx_labels (list(np.ndarray)): For each spectrum, the index of the annotation of each
+            peak, -1 if not annotated.
+        l_labels_all_lipids (list(str)): Labels of the annotations of the slice.
+
+    Yields:
+        (float, dict): The progress of the export, and a chunk of columns.
+    """
+    array_labels = np.array(list(l_labels_all_lipids) + [""], dtype=object)
+    for idx_spectrum, (spectrum, l_idx_labels) in enumerate(zip(l_spectra, ll_idx_labels)):
+        spectrum = np.asarray(spectrum, dtype=np.float32)
+        array_idx_labels = np.asarray(l_idx_labels, dtype=np.int64)
+        yield (idx_spectrum + 1) / len(l_spectra), {
+            "slice": np.full(spectrum.shape[1], slice_index, dtype=np.int16),
+            "selection": np.full(spectrum.shape[1], idx_spectrum + 1, dtype=np.int16),
+            "mz": spectrum[0, :],
+            "intensity": spectrum[1, :],
+            # -1 indexes the empty label appended at the end
+            "lipid": array_labels[array_idx_labels].astype(str),
+        }
+
+
+def generate_lipid_images_table(data, slice_index, l_lipid_names):
+    """This generator yields the (colormapped) images of the requested lipids as chunks of columns,
+    one chunk per lipid, keeping only the non-transparent pixels.
+
+    Args:
+        data (MaldiData): The object used to access the MALDI data.
+        slice_index (int): Index of the slice.
+        l_lipid_names (list(str)): Names of the lipids.
+
+    Yields:
+        (float, dict): The progress of the export, and a chunk of columns.
+    """
+    for idx_lipid, lipid_name in enumerate(l_lipid_names):
+        array_image = data.get_lipid_plasma_array(slice_index)[f"{slice_index}_{lipid_name}"]
+        array_y, array_x = np.nonzero(array_image[:, :, 3])
+        yield (idx_lipid + 1) / len(l_lipid_names), {
+            "slice": np.full(len(array_y), slice_index, dtype=np.int16),
+            "lipid": np.full(len(array_y), lipid_name),
+            "y": array_y.astype(np.int16),
+            "x": array_x.astype(np.int16),
+            "r": array_image[array_y, array_x, 0],
+            "g": array_image[array_y, array_x, 1],
+            "b": array_image[array_y, array_x, 2],
+            "a": array_image[array_y, array_x, 3],
+        }
+
+
+# ==================================================================================================
+# --- Class
+# ==================================================================================================
+
+
+class ExportService:
+    """Class used to write exports in the background, and serve them through streaming routes.
+
+    Attributes:
+        path_exports (str): Path of the folder containing the exported files.
+        max_age (int): Time (in seconds) after which a finished export is deleted.
+        dic_mimetypes (dict): Mimetype of each available format.
+        _lock (threading.Lock): Lock protecting the writing of the manifests of the jobs run by the
+            current process.
+
+    Methods:
+        __init__(path_exports, max_age=3600): Initialize the ExportService class.
+        return_formats(): Return the available formats.
+        return_manifest_path(job_id): Return the path of the manifest of a job.
+        write_manifest(dic_job): Write the manifest of a job.
+        load_job(job_id): Load a job from its manifest.
+        purge_expired(): Delete the expired exports.
+        submit(session_id, name, format_export, generate_function, **generate_function_args):
+            Submit an export job and return its id.
+        run_job(dic_job, generate_function, generate_function_args): Run an export job.
+        write_export(dic_job, generate_function, generate_function_args): Write an export file.
+        return_status(job_id, session_id=None): Return the status of a job.
+        return_stream(job_id, chunk_size=2**16): Yield the chunks of an exported file.
+        register_routes(server): Register the status and download routes.
+    """
+
+    def __init__(self, path_exports, max_age=3600):
+        """Initialize the class ExportService.
+
+        Args:
+            path_exports (str): Path of the folder containing the exported files.
+            max_age (int, optional): Time (in seconds) after which a finished export is deleted.
+                Defaults to 3600.
+        """
+        self.path_exports = path_exports
+        self.max_age = max_age
+        self.dic_mimetypes = {"csv": "text/csv", "npz": "application/octet-stream"}
+        if pyarrow is not None:
+            self.dic_mimetypes["parquet"] = "application/vnd.apache.parquet"
+        self._lock = threading.Lock()
+        os.makedirs(self.path_exports, exist_ok=True)
+
+    # ==============================================================================================
+    # --- Methods
+    # ==============================================================================================
+
+    def return_formats(self):
+        """This function returns the available export formats.
+
+        Returns:
+            (list(str)): The available formats.
+        """
+        return list(self.dic_mimetypes.keys())
+
+    def return_manifest_path(self, job_id):
+        """This function returns the path of the manifest of a job.
+
+        Args:
+            job_id (str): Id of the job.
+
+        Returns:
+            (str): The path of the manifest.
+        """
+        return os.path.join(self.path_exports, job_id + ".json")
+
+    def write_manifest(self, dic_job):
+        """This function writes the manifest of a job, i.e. a json file containing its metadata,
+        next to the exported file. The manifest is replaced atomically, such that the other workers
+        never read a partially written file.
+
+        Args:
+            dic_job (dict): The job, i.e. a dictionnary with its id, session id, name, format,
+                status (queued, running, done or failed), progress, path, size and error.
+        """
+        path_manifest = self.return_manifest_path(dic_job["id"])
+        with self._lock:
+            path_temp = path_manifest + "." + uuid.uuid4().hex + ".tmp"
+            with open(path_temp, "w") as handle:
+                json.dump(dic_job, handle)
+            os.replace(path_temp, path_manifest)
+
+    def load_job(self, job_id):
+        """This function loads a job from its manifest, whichever the worker running it.
+
+        Args:
+            job_id (str): Id of the job.
+
+        Returns:
+            (dict): The job, or None if it doesn't exist.
+        """
+        # The id is used in a path, so it must be one of the ids returned by submit()
+        if not re.fullmatch("[0-9a-f]{32}", job_id):
+            return None
+        try:
+            with open(self.return_manifest_path(job_id), "r") as handle:
+                return json.load(handle)
+        except (OSError, ValueError):
+            return None
+
+    def purge_expired(self):
+        """This function deletes the exports finished for more than max_age seconds, along with
+        their manifests."""
+        time_now = time.time()
+        for file_name in os.listdir(self.path_exports):
+            if not file_name.endswith(".json"):
+                continue
+            dic_job = self.load_job(file_name[: -len(".json")])
+            if dic_job is not None and dic_job["time_finished"] is not None:
+                if time_now - dic_job["time_finished"] > self.max_age:
+                    # Another worker may be purging the same job
+                    for path in [dic_job["path"], self.return_manifest_path(dic_job["id"])]:
+                        try:
+                            os.remove(path)
+                        except FileNotFoundError:
+                            pass
+
+    def submit(self, session_id, name, format_export, generate_function, **generate_function_args):
+        """This function submits an export job, which is run in a background thread.
+
+        Args:
+            session_id (str): Id of the session requesting the export.
+            name (str): Name of the exported file, without extension.
+            format_export (str): Format of the export, among return_formats().
+            generate_function (func): Generator yielding the progress of the export along with the
+                exported data, as chunks of columns (dictionnaries of arrays of same length).
+            **generate_function_args: Arguments of generate_function.
+
+        Returns:
+            (str): The id of the job.
+        """
+        if format_export not in self.dic_mimetypes:
+            raise ValueError("The export format " + format_export + " is not available")
+        job_id = uuid.uuid4().hex
+        self.purge_expired()
+        dic_job = {
+            "id": job_id,
+            "session_id": session_id,
+            "name": name,
+            "format": format_export,
+            "status": "queued",
+            "progress": 0.0,
+            "path": os.path.join(self.path_exports, job_id + "." + format_export),
+            "size": 0,
+            "error": None,
+            "time_created": time.time(),
+            "time_finished": None,
+        }
+        self.write_manifest(dic_job)
+        threading.Thread(
+            target=self.run_job,
+            args=(dic_job, generate_function, generate_function_args),
+            daemon=True,
+        ).start()
+        logging.info("Export " + job_id + " (" + name + "." + format_export + ") submitted")
+        return job_id
+
+    def run_job(self, dic_job, generate_function, generate_function_args):
+        """This function runs an export job, the writing being done on the background class of the
+        execution pool.
+
+        Args:
+            dic_job (dict): The job.
+            generate_function (func): Generator yielding the exported data.
+            generate_function_args (dict): Arguments of generate_function.
+        """
+        job_id = dic_job["id"]
+        try:
+            return_execution_pool().run(
+                "background", self.write_export, dic_job, generate_function, generate_function_args
+            )
+            dic_job["status"] = "done"
+            dic_job["progress"] = 1.0
+            logging.info("Export " + job_id + " done")
+        except Exception as e:
+            dic_job["status"] = "failed"
+            dic_job["error"] = type(e).__name__ + ": " + str(e)
+            logging.warning("Export " + job_id + " failed: " + dic_job["error"])
+        finally:
+            dic_job["time_finished"] = time.time()
+            self.write_manifest(dic_job)
+
+    def write_export(self, dic_job, generate_function, generate_function_args):
+        """This function writes an export file, chunk by chunk for the csv and parquet formats.
+
+        Args:
+            dic_job (dict): The job.
+            generate_function (func): Generator yielding the exported data.
+            generate_function_args (dict): Arguments of generate_function.
+        """
+        dic_job["status"] = "running"
+        self.write_manifest(dic_job)
+        dic_l_columns = {}
+        writer_parquet = None
+        with open(dic_job["path"], "wb") as handle:
+            for progress, dic_columns in generate_function(**generate_function_args):
+                if dic_job["format"] == "csv":
+                    df = pd.DataFrame(dic_columns)
+                    handle.write(df.to_csv(header=handle.tell() == 0, index=False).encode("utf-8"))
+                    handle.flush()
+                elif dic_job["format"] == "parquet":
+                    table = pyarrow.Table.from_pydict(dic_columns)
+                    if writer_parquet is None:
+                        writer_parquet = pyarrow.parquet.ParquetWriter(
+                            handle, table.schema, compression="zstd"
+                        )
+                    writer_parquet.write_table(table)
+                else:
+                    for key, array in dic_columns.items():
+                        dic_l_columns.setdefault(key, []).append(array)
+                dic_job["progress"] = float(progress)
+                dic_job["size"] = handle.tell()
+                self.write_manifest(dic_job)
+
+            if writer_parquet is not None:
+                writer_parquet.close()
+            elif dic_job["format"] == "npz":
+                np.savez_compressed(
+                    handle,
+                    **{key: np.concatenate(l_arrays) for key, l_arrays in dic_l_columns.items()},
+                )
+            dic_job["size"] = handle.tell()
+
+    def return_status(self, job_id, session_id=None):
+        """This function returns the status of a job.
+
+        Args:
+            job_id (str): Id of the job.
+            session_id (str, optional): If provided, the job must belong to this session. Defaults
+                to None.
+
+        Returns:
+            (dict): The status, progress, size and error of the job, or None if it doesn't exist.
+        """
+        dic_job = self.load_job(job_id)
+        if dic_job is None or (session_id is not None and dic_job["session_id"] != session_id):
+            return None
+        return {
+            key: dic_job[key]
+            for key in ["id", "name", "format", "status", "progress", "size", "error"]
+        }
+
+    def return_stream(self, job_id, chunk_size=2**16):
+        """This generator yields the content of an exported file, chunk by chunk. A csv file is
+        streamed while being written, the other formats once the file is complete.
+
+        Args:
+            job_id (str): Id of the job.
+            chunk_size (int, optional): Size of the chunks, in bytes. Defaults to 2**16.
+
+        Yields:
+            (bytes): A chunk of the file.
+        """
+        # The job is read from its manifest, as it may be run by another worker
+        dic_job = self.load_job(job_id)
+        while dic_job is not None and (
+            dic_job["status"] in ["queued", "running"]
+            and (dic_job["format"] != "csv" or not os.path.exists(dic_job["path"]))
+        ):
+            time.sleep(0.2)
+            dic_job = self.load_job(job_id)
+        if dic_job is None or dic_job["status"] == "failed":
+            return
+
+        with open(dic_job["path"], "rb") as handle:
+            while True:
+                # The status must be read before the file, to not miss the last chunk
+                dic_job = self.load_job(job_id)
+                finished = dic_job is None or dic_job["status"] not in ["queued", "running"]
+                chunk = handle.read(chunk_size)
+                if chunk:
+                    yield chunk
+                elif finished:
+                    break
+                else:
+                    time.sleep(0.2)
+
+    def register_routes(self, server):
+        """This function registers the routes used to query the status of the jobs and download the
+        exported files.
+
+        Args:
+            server (flask.Flask): The server of the app.
+        """
+
+        @server.route("/export/<job_id>/status")
+        def export_status(job_id):
+            dic_status = self.return_status(job_id, flask.request.args.get("session_id", None))
+            if dic_status is None:
+                flask.abort(404)
+            return flask.jsonify(dic_status)
+
+        @server.route("/export/<job_id>/download")
+        def export_download(job_id):
+            dic_status = self.return_status(job_id, flask.request.args.get("session_id", None))
+            if dic_status is None or dic_status["status"] == "failed":
+                flask.abort(404)
+            return flask.Response(
+                flask.stream_with_context(self.return_stream(job_id)),
+                mimetype=self.dic_mimetypes[dic_status["format"]],
+                headers={
+                    "Content-Disposition": "attachment; filename="
+                    + dic_status["name"]
+                    + "."
+                    + dic_status["format"]
+                },
+            )
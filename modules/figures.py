@@ -18,15 +18,17 @@ import plotly.express as px
 from skimage import io
 from scipy.ndimage.interpolation import map_coordinates
 import pandas as pd
-from scipy.interpolate import griddata
 from modules.tools.external_lib.clustergram import Clustergram
 import plotly.figure_factory as ff
 from scipy.cluster.hierarchy import linkage
 import copy
+import os
+from collections import OrderedDict
 from plotly.subplots import make_subplots
 
 # LBAE imports
 from modules.tools.image import convert_image_to_base64
+from modules.tools.contours import convert_contours_to_path
 from modules.tools.atlas import project_image, slice_to_atlas_transform
 from modules.tools.volume import (
     filter_voxels,
@@ -38,11 +40,15 @@ from modules.tools.volume import (
 from config import dic_colors, l_colors
 from modules.tools.spectra import (
     compute_image_using_index_and_image_lookup,
-    compute_index_boundaries,
-    compute_avg_intensity_per_lipid,
-    global_lipid_index_store,
     compute_thread_safe_function,
 )
+from modules.tools.interpolation import (
+    compute_grid_domains,
+    compute_linear_interpolation_weights,
+    interpolate_on_grid,
+)
+from modules.region_expression import RegionLipidExpression
+from modules.spectrum_pyramid import SpectrumPyramid
 
 
 # ==================================================================================================
@@ -63,6 +69,15 @@ class Figures:
         _scRNAseq (ScRNAseq): Used to manipulate the objects coming from the scRNAseq dataset.
         dic_normalization_factors (dict): Dictionnary of normalization factors across slices for
             MAIA.
+        spectrum_pyramid (SpectrumPyramid): Multi-resolution average spectra, used to plot the
+            spectra with a bounded number of points.
+        _region_expression (RegionLipidExpression): Precomputed table of average lipid expression
+            per slice and per brain region, used to build the clustergrams.
+        _interpolation_weights (tuple): Sparse matrix of linear interpolation weights from the
+            scRNAseq spots to the regular grid, along with the mask of nodes outside of the convex
+            hull and the shape of the grid. Loaded from the shelve database on first use.
+        _dic_interpolated_grids (OrderedDict): Least-recently-used cache of interpolated grids,
+            indexed by (brain_1, type of data, index of the lipid or gene).
 
     Methods:
         __init__(): Initialize the Figures class.
@@ -70,6 +85,8 @@ class Figures:
             from the maldi_data acquisition (TIC) or the corresponding image from the atlas.
         compute_figure_basic_image(): Computes a figure representing slices from the TIC or the
             corresponding image from the atlas.
+        compute_atlas_contours_shape(): Computes a Plotly shape representing the atlas annotations
+            contours of a slice, as a vector path.
         compute_figure_slices_3D(): Computes a figure representing all slices from the maldi data in
             3D.
         get_surface(): Computes a Plotly Surface representing the requested slice in 3D.
@@ -87,14 +104,14 @@ class Figures:
             requested lipids in the requested slice.
         compute_rgb_image_per_lipid_selection(): Similar to compute_heatmap_per_lipid_selection, but
             computes an RGB image instead of a heatmap.
-        compute_spectrum_low_res(): Returns the full (low-resolution) spectrum of the requested
-            slice.
+        compute_spectrum_low_res(): Returns the full spectrum of the requested slice, decimated to
+            a screen width's worth of points.
         compute_heatmap_per_lipizones_selection(): Computes a heatmap of the sum of expression of the
             requested lipizones in the requested slice.
         compute_rgb_image_per_lipizones_selection(): Similar to compute_heatmap_per_lipizones_selection, but
             computes an RGB image instead of a heatmap.
-        compute_spectrum_high_res(): Returns the full (high-resolution) spectrum of the requested
-            slice between the two provided m/z boundaries.
+        compute_spectrum_high_res(): Returns the spectrum of the requested slice between the two
+            provided m/z boundaries, at the finest resolution fitting in the plot.
         return_empty_spectrum(): Returns an empty spectrum.
         return_heatmap_lipid(): Either generate a Plotly Figure containing an empty go.Heatmap,
             or complete the figure passed as argument with a proper layout that matches the theme of
@@ -115,11 +132,21 @@ class Figures:
         compute_clustergram_figure(): Computes a Plotly Clustergram figure, allowing to cluster and
             compare the expression of all the MAIA-transformed lipids in the dataset in the selected
             regions.
+        update_region_expression(): Updates the precomputed table of average lipid expression per
+            region.
+        is_region_expression_computed(): Checks whether the average lipid expression per region
+            has been computed for the requested slices.
         compute_scatter_3D(): cmputes a figure representing, in a 3D scatter plot, the spots
             acquired using spatial scRNAseq experiments.
         compute_barplots_enrichment(): Computes two figures representing, in barplots, the lipid
             expression in the spots acquired using spatial scRNAseq experiments, as well as how it
             can be explained by an elastic net regression using gene expression as explaing factors.
+        compute_interpolation_weights(): Computes the sparse matrix of weights used to linearly
+            interpolate the scRNAseq data on a regular grid.
+        return_interpolation_weights(): Returns the (shelved) interpolation weights for the
+            scRNAseq data.
+        return_interpolated_grid(): Returns the interpolated grid of expression of a given lipid or
+            gene, using the precomputed interpolation weights.
         compute_heatmap_lipid_genes(): Computes a heatmap representing the expression of a
         given lipid in the MALDI data and the expressions of the selected genes.
         shelve_arrays_basic_figures(): Shelves in the database all the arrays of basic images
@@ -130,7 +157,20 @@ class Figures:
             used in a 3D representation of the brain.
     """
 
-    __slots__ = ["_data", "_atlas", "_scRNAseq", "_storage", "dic_normalization_factors"]
+    __slots__ = [
+        "_data",
+        "_atlas",
+        "_scRNAseq",
+        "_storage",
+        "dic_normalization_factors",
+        "spectrum_pyramid",
+        "_region_expression",
+        "_interpolation_weights",
+        "_dic_interpolated_grids",
+    ]
+
+    # Maximum number of interpolated grids kept in memory
+    n_max_interpolated_grids = 16
 
     # ==============================================================================================
     # --- Constructor
@@ -157,6 +197,13 @@ class Figures:
         # attribute to access the shelve database
         self._storage = storage
 
+        # Multi-resolution average spectra, used to plot the spectra with a bounded number of points
+        self.spectrum_pyramid = SpectrumPyramid(maldi_data, storage)
+
+        # Interpolation weights for the scRNAseq data are loaded on first use
+        self._interpolation_weights = None
+        self._dic_interpolated_grids = OrderedDict()
+
         # Dic of normalization factors across slices for MAIA normalized lipids
         self.dic_normalization_factors = self._storage.return_shelved_object(
             "figures/lipid_selection",
@@ -249,6 +296,17 @@ class Figures:
         if not self._storage.check_shelved_object("figures/3D_page", "arrays_annotation_computed"):
             self.shelve_all_arrays_annotation()
 
+        # Check that the average lipid expression per region has been computed for all slices, if
+        # not, compute the missing entries
+        self._region_expression = RegionLipidExpression(
+            self._data,
+            self._atlas,
+            path_tensor=os.path.join(
+                os.path.dirname(self._storage.path_db), "region_lipid_expression.npz"
+            ),
+        )
+        self._region_expression.update()
+
         logging.info("Figures object instantiated" + logmem())
 
     # ==============================================================================================
@@ -357,11 +415,9 @@ class Figures:
             # Get image at specified index
             array_image = array_images[index_image]
 
-        # Add the contours if requested
-        if plot_atlas_contours:
+        # Only the contours alone are displayed as an image, otherwise they're added as a shape
+        if only_contours:
             array_image_atlas = self._atlas.list_projected_atlas_borders_arrays[index_image]
-        else:
-            array_image_atlas = None
 
         # Create figure
         fig = go.Figure()
@@ -371,13 +427,15 @@ class Figures:
             fig.add_trace(
                 go.Image(
                     visible=True,
-                    source=convert_image_to_base64(
-                        array_image, overlay=array_image_atlas, transparent_zeros=True
-                    ),
+                    source=convert_image_to_base64(array_image, transparent_zeros=True),
                     hoverinfo="none",
                 )
             )
 
+            # Add the contours if requested
+            if plot_atlas_contours:
+                fig.add_shape(self.compute_atlas_contours_shape(index_image))
+
             # Add the labels only if it's not a simple annotation illustration
             # fig.update_xaxes(
             #     title_text=self._atlas.bg_atlas.space.axis_labels[0][1], title_standoff=0
@@ -421,6 +479,32 @@ class Figures:
 
         return fig
 
+    def compute_atlas_contours_shape(self, index_image, tolerance=1.0, color="orange", width=0.5):
+        """This function computes a Plotly shape representing the atlas annotations contours of the
+        requested slice, as a single vector path whose coordinates match the ones of the slice
+        image. This is much lighter than blending a raster of the contours with the slice image.
+
+        Args:
+            index_image (int): Index of the requested slice.
+            tolerance (float, optional): Maximum distance (in pixels) between the simplified
+                contours and the original annotation boundaries. Defaults to 1.0.
+            color (str, optional): Color of the contours. Defaults to "orange".
+            width (float, optional): Width of the contours, in pixels of the screen. Defaults to
+                0.5.
+
+        Returns:
+            (dict): The Plotly shape, to be added with go.Figure.add_shape().
+        """
+        return dict(
+            type="path",
+            path=convert_contours_to_path(
+                self._atlas.get_projected_atlas_contours(index_image, tolerance=tolerance)
+            ),
+            line=dict(color=color, width=width),
+            layer="above",
+            editable=False,
+        )
+
     def compute_figure_slices_3D(self, reduce_resolution_factor=20, brain="brain_1"):
         """This function computes and returns a figure representing the slices from the maldi data
         in 3D.
@@ -1554,7 +1638,9 @@ class Figures:
 
 
     def compute_spectrum_low_res(self, slice_index, annotations=None):
-        """This function returns the full (low-resolution) spectrum of the requested slice.
+        """This function returns the full (low-resolution) spectrum of the requested slice,
+        decimated such that it contains about a screen width's worth of points (see
+        modules/spectrum_pyramid.py).
 
         Args:
             slice_index (int): The slice index of the requested slice.
@@ -1565,10 +1651,11 @@ class Figures:
             (go.Figure): A Plotly Figure representing the low-resolution spectrum.
         """
 
-        # Define figure data
+        # Define figure data, decimated to about a screen width's worth of points
+        x, y = self.spectrum_pyramid.return_spectrum(slice_index)
         data = go.Scattergl(
-            x=self._data.get_array_avg_spectrum_downsampled(slice_index)[0, :],
-            y=self._data.get_array_avg_spectrum_downsampled(slice_index)[1, :],
+            x=x,
+            y=y,
             visible=True,
             line_color=dic_colors["blue"],
             fill="tozeroy",
@@ -1624,7 +1711,8 @@ class Figures:
     ):
         """This function returns the high-resolution spectrum of the requested slice between the two
         provided m/z boundaries lb and hb. If boundaries are not provided, it returns an empty
-        spectrum.
+        spectrum. When plotting, the spectrum is decimated (preserving the peaks) if there are more
+        than a screen width's worth of points between the boundaries.
 
         Args:
             slice_index (int): The slice index of the requested slice.
@@ -1655,34 +1743,16 @@ class Figures:
             x = ([],)
             y = ([],)
 
-        # If boundaries are provided, get their index
+        # If boundaries are provided, get the spectrum between them at the finest resolution
+        # fitting in the plot
         else:
-            index_lb, index_hb = compute_thread_safe_function(
-                compute_index_boundaries,
-                cache_flask,
-                self._data,
+            x, y = self.spectrum_pyramid.return_spectrum(
                 slice_index,
                 lb,
                 hb,
-                array_spectra_avg=self._data.get_array_avg_spectrum(
-                    slice_index, standardization=standardization
-                ),
-                lookup_table=self._data.get_array_lookup_mz_avg(slice_index),
-            )
-
-            def return_x_y(array):
-                x = np.copy(array[0, index_lb:index_hb])
-                y = np.copy(array[1, index_lb:index_hb])
-                return x, y
-
-            # Get x, y in a thread safe fashion
-            # No need to clean memory as it's really small
-            x, y = compute_thread_safe_function(
-                return_x_y,
-                cache_flask,
-                self._data,
-                slice_index,
-                self._data.get_array_avg_spectrum(slice_index, standardization=standardization),
+                standardization=standardization,
+                max_points=None if plot else np.inf,
+                cache_flask=cache_flask,
             )
 
         # In case download without plotting
@@ -2168,10 +2238,9 @@ class Figures:
                 hierarchy.
         """
 
-        # Build treemaps from list of children and parents
-        fig = px.treemap(
-            names=self._atlas.l_nodes, parents=self._atlas.l_parents, maxdepth=maxdepth
-        )
+        # Build treemaps from list of children and parents of the hierarchy index
+        l_nodes, l_parents = self._atlas.hierarchy.return_treemap_inputs()
+        fig = px.treemap(names=l_nodes, parents=l_parents, maxdepth=maxdepth)
 
         # Improve layout
         fig.update_layout(
@@ -2763,90 +2832,13 @@ class Figures:
         """
         logging.info("Starting computing clustergram figure")
 
-        # Memoize result as it's called everytime a filtering is done
-        @cache_flask.memoize()
-        def return_df_avg_lipids(l_selected_regions):
-            dic_avg_lipids = {}
-            l_slices = self._data.get_slice_list(indices="brain_1" if brain_1 else "brain_2")
-            for slice_index in l_slices:
-                # Display progress every 10 slices
-                if slice_index % 10 == 0:
-                    set_progress(
-                        (
-                            int(slice_index / len(l_slices) * 100),
-                            "Loading slice n°" + str(slice_index),
-                        )
-                    )
-
-                l_spectra = []
-                for region in l_selected_regions:
-                    long_region = self._atlas.dic_acronym_name[region]
-                    if slice_index - 1 in self._atlas.dic_existing_masks:
-                        if region in self._atlas.dic_existing_masks[slice_index - 1]:
-                            grah_scattergl_data = self._atlas.get_projected_mask_and_spectrum(
-                                slice_index - 1, long_region, MAIA_correction=True
-                            )[1]
-                            l_spectra.append(grah_scattergl_data)
-                        else:
-                            l_spectra.append(None)
-                    else:
-                        raise Exception(
-                            "The masks have not been precomputed. Please precompute them before"
-                            " running this function."
-                        )
-                ll_idx_labels = global_lipid_index_store(self._data, slice_index - 1, l_spectra)
-                logging.info("Computing dictionnary for averaging slice " + str(slice_index))
-
-                # Compute average expression for each lipid and each selection
-                set_lipids_idx = set()
-                ll_lipids_idx = []
-                ll_avg_intensity = []
-                n_sel = len(l_spectra)
-                for spectrum, l_idx_labels in zip(l_spectra, ll_idx_labels):
-                    if spectrum is not None:
-                        array_intensity_with_lipids = np.array(spectrum, dtype=np.float32)[1, :]
-                        array_idx_labels = np.array(l_idx_labels, dtype=np.int32)
-
-                        l_lipids_idx, l_avg_intensity = compute_avg_intensity_per_lipid(
-                            array_intensity_with_lipids, array_idx_labels
-                        )
-                        set_lipids_idx.update(l_lipids_idx)
-                    else:
-                        l_lipids_idx = None
-                        l_avg_intensity = None
-
-                    ll_lipids_idx.append(l_lipids_idx)
-                    ll_avg_intensity.append(l_avg_intensity)
-
-                for i, (l_lipids, l_avg_intensity) in enumerate(
-                    zip(ll_lipids_idx, ll_avg_intensity)
-                ):
-                    if l_lipids is not None:
-                        for lipid, intensity in zip(l_lipids, l_avg_intensity):
-                            if lipid not in dic_avg_lipids:
-                                dic_avg_lipids[lipid] = []
-                                for j in range(n_sel):
-                                    dic_avg_lipids[lipid].append([])
-                            dic_avg_lipids[lipid][i].append(intensity)
-
-            logging.info("Averaging all lipid values across slices")
-
-            # Average intensity per slice
-            for lipid in dic_avg_lipids:
-                for i in range(n_sel):
-                    if len(dic_avg_lipids[lipid][i]) > 0:
-                        dic_avg_lipids[lipid][i] = np.mean(dic_avg_lipids[lipid][i])
-                    else:
-                        dic_avg_lipids[lipid][i] = 0
-
-            df_avg_intensity_lipids = pd.DataFrame.from_dict(
-                dic_avg_lipids,
-                orient="index",
-                columns=[l_selected_regions[i] for i in range(n_sel)],
-            )
-            return df_avg_intensity_lipids
-
-        df_avg_intensity_lipids = return_df_avg_lipids(l_selected_regions)
+        # Compute any missing (slice, region) entry, then slice the precomputed table
+        l_slices = self._data.get_slice_list(indices="brain_1" if brain_1 else "brain_2")
+        set_progress((10, "Loading precomputed expression table"))
+        self._region_expression.update(l_slice_indices=l_slices, set_progress=set_progress)
+        df_avg_intensity_lipids = self._region_expression.compute_df_avg_lipids(
+            l_selected_regions, l_slices
+        )
         logging.info("Averaging done for all slices")
         set_progress((90, "Loading data"))
 
@@ -2902,6 +2894,36 @@ class Figures:
     # --- Methods used in scRNAseq page
     # ==============================================================================================
 
+    def update_region_expression(self, l_slice_indices=None, force_update=False):
+        """This function updates the precomputed table of average lipid expression per region.
+
+        Args:
+            l_slice_indices (list(int), optional): List of slice indices (starting at 1) to update.
+                If None, all slices are updated. Defaults to None.
+            force_update (bool, optional): If True, the entries of the requested slices are
+                recomputed even if they already exist. Defaults to False.
+        """
+        if force_update:
+            self._region_expression.invalidate(
+                l_slice_indices
+                if l_slice_indices is not None
+                else self._data.get_slice_list(indices="all")
+            )
+        self._region_expression.update(l_slice_indices=l_slice_indices)
+
+    def is_region_expression_computed(self, l_slice_indices=None):
+        """This function checks whether the average lipid expression per region has been computed
+        for all the existing masks of the requested slices.
+
+        Args:
+            l_slice_indices (list(int), optional): List of slice indices (starting at 1) to check.
+                If None, all slices are checked. Defaults to None.
+
+        Returns:
+            (bool): True if no entry is missing.
+        """
+        return len(self._region_expression.return_missing_pairs(l_slice_indices)) == 0
+
     def compute_scatter_3D(self):
         """This functions computes a figure representing, in a 3D scatter plot, the spots acquired
         using spatial scRNAseq experiments.
@@ -3124,6 +3146,68 @@ class Figures:
 
         return fig_lipids, fig_genes, names, x
 
+    def compute_interpolation_weights(self):
+        """This function computes the sparse matrix of weights used to linearly interpolate the
+        expression values of the scRNAseq spots on a regular grid. Since the coordinates of the
+        spots never change, the triangulation only needs to be done once.
+
+        Returns:
+            (scipy.sparse.csr_matrix, np.ndarray, tuple): The sparse matrix of interpolation weights,
+                a flat boolean array indicating which grid nodes are outside of the convex hull of
+                the spots, and the shape of the grid.
+        """
+        x = self._scRNAseq.xmol
+        y = -self._scRNAseq.ymol
+        z = self._scRNAseq.zmol
+        return compute_linear_interpolation_weights(
+            np.vstack((x, y, z)).T, compute_grid_domains(x, y, z)
+        )
+
+    def return_interpolation_weights(self):
+        """This function returns the interpolation weights for the scRNAseq data, loading them from
+        the shelve database (or computing them) on first call.
+
+        Returns:
+            (scipy.sparse.csr_matrix, np.ndarray, tuple): See compute_interpolation_weights().
+        """
+        if self._interpolation_weights is None:
+            self._interpolation_weights = self._storage.return_shelved_object(
+                "figures/scRNAseq_page",
+                "interpolation_weights",
+                force_update=False,
+                compute_function=self.compute_interpolation_weights,
+            )
+        return self._interpolation_weights
+
+    def return_interpolated_grid(self, brain_1, type_data, idx):
+        """This function returns the grid of interpolated expression of a given lipid or gene, using
+        the precomputed interpolation weights. The most recently used grids are kept in memory.
+
+        Args:
+            brain_1 (bool): If True, the data from the first brain is used. Else, from the 2nd
+                brain.
+            type_data (str): Either "lipids" or "genes".
+            idx (int): Index of the lipid or gene in the corresponding expression array.
+
+        Returns:
+            (np.ndarray): A three-dimensional array of interpolated expression, with NaN values
+                outside of the convex hull of the spots.
+        """
+        key = (brain_1, type_data, idx)
+        if key in self._dic_interpolated_grids:
+            self._dic_interpolated_grids.move_to_end(key)
+            return self._dic_interpolated_grids[key]
+
+        suffix = "_brain_1" if brain_1 else "_brain_2"
+        array_expression = getattr(self._scRNAseq, "array_exp_" + type_data + suffix)
+        weights, array_outside, grid_shape = self.return_interpolation_weights()
+        grid = interpolate_on_grid(weights, array_outside, grid_shape, array_expression[:, idx])
+
+        self._dic_interpolated_grids[key] = grid
+        if len(self._dic_interpolated_grids) > self.n_max_interpolated_grids:
+            self._dic_interpolated_grids.popitem(last=False)
+        return grid
+
     def compute_heatmap_lipid_genes(
         self,
         lipid=None,
@@ -3186,11 +3270,6 @@ class Figures:
             lipid = lipids[0]
             l_genes = genes[:3]
 
-        # Get coordinates
-        x = self._scRNAseq.xmol
-        y = -self._scRNAseq.ymol
-        z = self._scRNAseq.zmol
-
         # Get idx lipid and genes
         if lipid is not None:
             idx_lipid = list(name_lipids).index(lipid)
@@ -3202,45 +3281,25 @@ class Figures:
         ]
         l_idx_genes = [idx_gene for idx_gene in l_idx_genes_with_None if idx_gene is not None]
 
-        # Build grids on which the data will be interpolated
-        x_domain = np.arange(np.min(x), np.max(x), 0.5)
-        y_domain = np.arange(np.min(y), np.max(y), 0.1)
-        z_domain = np.arange(np.min(z), np.max(z), 0.1)
-        x_grid, y_grid, z_grid = np.meshgrid(x_domain, y_domain, z_domain, indexing="ij")
-
         if set_progress is not None:
             set_progress((15, "Preparing interpolation"))
 
-        # Build data from interpolation since sampling is irregular
+        # Build data from interpolation since sampling is irregular, using precomputed weights
         if idx_lipid is not None:
-            grid_lipid = griddata(
-                np.vstack((x, y, z)).T,
-                array_lipids[:, idx_lipid],
-                (x_grid, y_grid, z_grid),
-                method="linear",
-            )
+            grid_lipid = self.return_interpolated_grid(brain_1, "lipids", idx_lipid)
         else:
             grid_lipid = None
 
         if len(l_idx_genes) == 1:
-            grid_genes = griddata(
-                np.vstack((x, y, z)).T,
-                array_genes[:, l_idx_genes[0]],
-                (x_grid, y_grid, z_grid),
-                method="linear",
-            )
+            grid_genes = self.return_interpolated_grid(brain_1, "genes", l_idx_genes[0])
         elif len(l_idx_genes) > 1:
+            grid_shape = self.return_interpolation_weights()[2]
             grid_genes = np.moveaxis(
                 np.stack(
                     [
-                        griddata(
-                            np.vstack((x, y, z)).T,
-                            array_genes[:, idx_genes],
-                            (x_grid, y_grid, z_grid),
-                            method="linear",
-                        )
+                        self.return_interpolated_grid(brain_1, "genes", idx_genes)
                         if idx_genes is not None
-                        else np.zeros_like(x_grid)
+                        else np.zeros(grid_shape)
                         for idx_genes in l_idx_genes_with_None
                     ]
                 ),
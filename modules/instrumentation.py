@@ -0,0 +1,374 @@
+# Copyright (c) 2022, Colas Droin. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
+
+""" This class is used to instrument the callbacks of the app. Every callback and long callback
+registered on the app is wrapped to record its wall time, CPU time, RSS increase and the number of
+hits and misses of the Flask cache it triggered, while the size of the serialized responses is
+recorded on the server side. Everything is aggregated into histograms, exposed in the Prometheus
+text format at a local /metrics endpoint."""
+
+# ==================================================================================================
+# --- Imports
+# ==================================================================================================
+
+# Standard modules
+import bisect
+import contextvars
+import functools
+import logging
+import os
+import threading
+import time
+import flask
+import psutil
+
+# ==================================================================================================
+# --- Classes
+# ==================================================================================================
+
+
+class Histogram:
+    """Class used to aggregate observations into cumulative buckets, following the Prometheus
+    conventions.
+
+    Attributes:
+        l_bounds (list(float)): Upper bounds of the buckets (the last, implicit, bucket is +Inf).
+        l_counts (list(int)): Number of observations per bucket (not cumulated).
+        count (int): Total number of observations.
+        sum (float): Sum of all observations.
+
+    Methods:
+        __init__(l_bounds): Initialize the Histogram class.
+        observe(value): Add an observation.
+        return_cumulated_counts(): Return the cumulated number of observations per bucket.
+    """
+
+    __slots__ = ["l_bounds", "l_counts", "count", "sum"]
+
+    def __init__(self, l_bounds):
+        """Initialize the class Histogram.
+
+        Args:
+            l_bounds (list(float)): Sorted upper bounds of the buckets.
+        """
+        self.l_bounds = l_bounds
+        self.l_counts = [0] * (len(l_bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        """Add an observation to the histogram.
+
+        Args:
+            value (float): The observed value.
+        """
+        self.l_counts[bisect.bisect_left(self.l_bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def return_cumulated_counts(self):
+        """Return the cumulated number of observations per bucket.
+
+        Returns:
+            (list(tuple)): A list of (upper bound as a string, cumulated count) tuples, the last
+                upper bound being "+Inf".
+        """
+        l_cumulated = []
+        total = 0
+        for bound, count in zip(self.l_bounds + [float("inf")], self.l_counts):
+            total += count
+            l_cumulated.append(("+Inf" if bound == float("inf") else repr(bound), total))
+        return l_cumulated
+
+
+class Instrumentation:
+    """Class used to wrap the callbacks of the app, record their metrics, and expose them in the
+    Prometheus text format.
+
+    Attributes:
+        dic_histograms (dict): Dictionnary of Histogram objects, indexed by (metric name, label).
+        dic_counters (dict): Dictionnary of counters, indexed by (metric name, label).
+        cache_long_callback (diskcache.Cache): Cache shared with the processes running the long
+            callbacks, used to send their metrics back to the server process.
+        pid (int): Identifier of the server process.
+        l_collectors (list(func)): Functions returning additional metrics (e.g. the state of the
+            execution queues), as lists of lines in the Prometheus text format.
+        _current_record (contextvars.ContextVar): Record of the callback being executed in the
+            current thread or greenlet, used to attribute the cache accesses.
+        _lock (threading.Lock): Lock used to update the metrics.
+
+    Methods:
+        __init__(cache_long_callback=None): Initialize the Instrumentation class.
+        instrument_app(app, cache_flask=None): Wrap all the callbacks registered from now on, the
+            Flask cache, and register the routes of the server.
+        instrument_cache(server, cache_flask): Wrap the Flask cache to count hits and misses.
+        wrap_callback(function, type_callback): Wrap a callback function to record its metrics.
+        register_collector(collector): Register a function returning additional metrics.
+        record(dic_record): Aggregate the metrics of a callback execution.
+        collect_long_callback_records(): Aggregate the metrics sent by the long callback processes.
+        return_metrics(): Return all the metrics in the Prometheus text format.
+    """
+
+    # Buckets of the histograms
+    l_bounds_seconds = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+    l_bounds_megabytes = [-100, -10, -1, 0, 1, 10, 50, 100, 250, 500, 1000]
+    l_bounds_bytes = [1e3, 1e4, 1e5, 5e5, 1e6, 5e6, 1e7, 5e7]
+
+    # Prefix of the long callback records in the shared cache
+    prefix_records = "instrumentation-records"
+
+    def __init__(self, cache_long_callback=None):
+        """Initialize the class Instrumentation.
+
+        Args:
+            cache_long_callback (diskcache.Cache, optional): Cache shared with the processes running
+                the long callbacks. If None, the metrics of the long callbacks are lost. Defaults
+                to None.
+        """
+        self.dic_histograms = {}
+        self.dic_counters = {}
+        self.cache_long_callback = cache_long_callback
+        self.pid = os.getpid()
+        self.l_collectors = []
+        self._current_record = contextvars.ContextVar("current_record", default=None)
+        self._lock = threading.Lock()
+
+    # ==============================================================================================
+    # --- Methods
+    # ==============================================================================================
+
+    def instrument_app(self, app, cache_flask=None):
+        """This function wraps app.callback and app.long_callback such that all the callbacks
+        registered from now on are instrumented. It also wraps the Flask cache to count hits and
+        misses, and registers the hooks and routes on the server. It must therefore be called
+        before the pages are imported.
+
+        Args:
+            app (dash.Dash): The app.
+            cache_flask (flask_caching.Cache, optional): Cache of the Flask database. Defaults to
+                None.
+        """
+        callback = app.callback
+        long_callback = app.long_callback
+
+        @functools.wraps(callback)
+        def instrumented_callback(*args, **kwargs):
+            decorator = callback(*args, **kwargs)
+            return lambda function: decorator(self.wrap_callback(function, "callback"))
+
+        @functools.wraps(long_callback)
+        def instrumented_long_callback(*args, **kwargs):
+            decorator = long_callback(*args, **kwargs)
+            return lambda function: decorator(self.wrap_callback(function, "long_callback"))
+
+        app.callback = instrumented_callback
+        app.long_callback = instrumented_long_callback
+
+        if cache_flask is not None:
+            self.instrument_cache(app.server, cache_flask)
+
+        # Record the size of the serialized callback responses
+        @app.server.after_request
+        def record_response_size(response):
+            if flask.request.path.endswith("/_dash-update-component"):
+                try:
+                    output = flask.request.get_json(silent=True)["output"]
+                except (TypeError, KeyError):
+                    output = "unknown"
+                size = response.content_length
+                if size is None and not response.direct_passthrough:
+                    size = len(response.get_data())
+                if size is not None:
+                    with self._lock:
+                        self._observe("lbae_callback_response_bytes", output, size)
+            return response
+
+        # Expose the metrics, only to local clients
+        @app.server.route("/metrics")
+        def metrics():
+            if flask.request.remote_addr not in ["127.0.0.1", "::1"]:
+                flask.abort(403)
+            return flask.Response(self.return_metrics(), mimetype="text/plain; version=0.0.4")
+
+    def instrument_cache(self, server, cache_flask):
+        """This function wraps the get method of the Flask cache backend to count the hits and
+        misses, attributed to the callback being executed. Accesses to the locks used for the
+        memory-mapped data are ignored.
+
+        Args:
+            server (flask.Flask): The server of the app.
+            cache_flask (flask_caching.Cache): Cache of the Flask database.
+        """
+        with server.app_context():
+            backend = cache_flask.cache
+        get = backend.get
+
+        @functools.wraps(get)
+        def instrumented_get(key, *args, **kwargs):
+            value = get(key, *args, **kwargs)
+            dic_record = self._current_record.get()
+            if dic_record is not None and not str(key).startswith("locked-"):
+                if value is None:
+                    dic_record["cache_misses"] += 1
+                else:
+                    dic_record["cache_hits"] += 1
+            return value
+
+        backend.get = instrumented_get
+
+    def wrap_callback(self, function, type_callback):
+        """This function wraps a callback function to record its metrics.
+
+        Args:
+            function (func): The callback function.
+            type_callback (str): Either "callback" or "long_callback".
+
+        Returns:
+            (func): The wrapped function.
+        """
+        name = function.__module__ + "." + function.__name__
+        process = psutil.Process()
+
+        @functools.wraps(function)
+        def instrumented_function(*args, **kwargs):
+            dic_record = {
+                "name": name,
+                "type": type_callback,
+                "cache_hits": 0,
+                "cache_misses": 0,
+                "error": False,
+            }
+            token = self._current_record.set(dic_record)
+            rss_start = process.memory_info().rss
+            cpu_start = time.thread_time()
+            time_start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            except Exception as e:
+                # PreventUpdate is not an error
+                dic_record["error"] = type(e).__name__ != "PreventUpdate"
+                raise
+            finally:
+                dic_record["wall_time"] = time.perf_counter() - time_start
+                dic_record["cpu_time"] = time.thread_time() - cpu_start
+                dic_record["rss_increase"] = (process.memory_info().rss - rss_start) / 1024**2
+                self._current_record.reset(token)
+                self.record(dic_record)
+
+        return instrumented_function
+
+    def register_collector(self, collector):
+        """Register a function returning additional metrics, called each time the metrics are
+        exposed.
+
+        Args:
+            collector (func): Function taking no argument and returning a list of lines in the
+                Prometheus text format.
+        """
+        self.l_collectors.append(collector)
+
+    def record(self, dic_record):
+        """This function aggregates the metrics of a callback execution. If called from a long
+        callback process, the record is sent to the server process through the shared cache.
+
+        Args:
+            dic_record (dict): The metrics of the callback execution.
+        """
+        if os.getpid() != self.pid:
+            if self.cache_long_callback is not None:
+                self.cache_long_callback.push(dic_record, prefix=self.prefix_records, expire=3600)
+            return
+
+        name = dic_record["name"]
+        with self._lock:
+            self._observe("lbae_callback_duration_seconds", name, dic_record["wall_time"])
+            self._observe("lbae_callback_cpu_seconds", name, dic_record["cpu_time"])
+            self._observe("lbae_callback_rss_increase_megabytes", name, dic_record["rss_increase"])
+            self._increment("lbae_callback_calls_total", name)
+            self._increment("lbae_callback_cache_hits_total", name, dic_record["cache_hits"])
+            self._increment("lbae_callback_cache_misses_total", name, dic_record["cache_misses"])
+            if dic_record["error"]:
+                self._increment("lbae_callback_errors_total", name)
+
+    def collect_long_callback_records(self):
+        """This function aggregates the records sent by the long callback processes through the
+        shared cache."""
+        if self.cache_long_callback is None:
+            return
+        while True:
+            _, dic_record = self.cache_long_callback.pull(prefix=self.prefix_records)
+            if dic_record is None:
+                break
+            self.record(dic_record)
+
+    def _observe(self, metric, label, value):
+        """Add an observation to a histogram, creating it if needed. Must be called with the lock.
+
+        Args:
+            metric (str): Name of the metric.
+            label (str): Label of the histogram (e.g. callback name).
+            value (float): The observed value.
+        """
+        key = (metric, label)
+        if key not in self.dic_histograms:
+            if metric.endswith("_seconds"):
+                l_bounds = self.l_bounds_seconds
+            elif metric.endswith("_megabytes"):
+                l_bounds = self.l_bounds_megabytes
+            else:
+                l_bounds = self.l_bounds_bytes
+            self.dic_histograms[key] = Histogram(l_bounds)
+        self.dic_histograms[key].observe(value)
+
+    def _increment(self, metric, label, value=1):
+        """Increment a counter. Must be called with the lock.
+
+        Args:
+            metric (str): Name of the metric.
+            label (str): Label of the counter (e.g. callback name).
+            value (int, optional): Increment. Defaults to 1.
+        """
+        key = (metric, label)
+        self.dic_counters[key] = self.dic_counters.get(key, 0) + value
+
+    def return_metrics(self):
+        """This function returns all the metrics in the Prometheus text format.
+
+        Returns:
+            (str): The metrics.
+        """
+        try:
+            self.collect_long_callback_records()
+        except Exception:
+            logging.warning("Metrics of the long callbacks could not be collected")
+
+        l_lines = []
+        with self._lock:
+            for metric in sorted(set(key[0] for key in self.dic_histograms)):
+                l_lines.append("# TYPE " + metric + " histogram")
+                # Response sizes are labelled by output, as recorded on the server side
+                label_name = "output" if metric.endswith("response_bytes") else "callback"
+                for (metric_key, label), histogram in sorted(self.dic_histograms.items()):
+                    if metric_key != metric:
+                        continue
+                    label_string = label_name + '="' + label.replace('"', '\\"') + '"'
+                    for bound, count in histogram.return_cumulated_counts():
+                        l_lines.append(
+                            metric
+                            + "_bucket{"
+                            + label_string
+                            + ',le="'
+                            + bound
+                            + '"} '
+                            + str(count)
+                        )
+                    l_lines.append(metric + "_sum{" + label_string + "} " + repr(histogram.sum))
+                    l_lines.append(metric + "_count{" + label_string + "} " + str(histogram.count))
+            for metric in sorted(set(key[0] for key in self.dic_counters)):
+                l_lines.append("# TYPE " + metric + " counter")
+                for (metric_key, label), count in sorted(self.dic_counters.items()):
+                    if metric_key == metric:
+                        l_lines.append(metric + '{callback="' + label + '"} ' + str(count))
+        for collector in self.l_collectors:
+            l_lines.extend(collector())
+        return "\n".join(l_lines) + "\n"
@@ -9,6 +9,7 @@ launch."""
 # ==================================================================================================
 
 # Standard modules
+import functools
 import logging
 import shelve
 import sys
@@ -25,7 +26,11 @@ from modules.tools.spectra import (
     compute_spectrum_per_row_selection,
     convert_array_to_fine_grained,
     strip_zeros,
+    return_number_of_threads,
 )
+from modules.tools.compilation import compile_kernels
+from modules.planner import PrecomputePlanner
+from modules.tools.misc import file_lock
 
 # ==================================================================================================
 # --- Class
@@ -40,6 +45,8 @@ class Launch:
         atlas (Atlas): Used to manipulate the objects coming from the Allen Brain Atlas.
         figures (Figures): Used to build the figures of the app.
         storage (Storage): Used to access the shelve database.
+        spatial_index (SpectralTileIndex): Used to compute the spectra of the selections of the
+            region analysis page from the precomputed spectra of tiles of pixels.
         l_atlas_objects_at_init (list): List of atlas objects normally computed at app startup
             if not already in shelve database.
         l_figures_objects_at_init (list): List of figures objects normally computed at app
@@ -52,10 +59,15 @@ class Launch:
             shelve database.
 
     Methods:
-        __init__(data, atlas, figures, storage): Initialize the Launch class.
+        __init__(data, atlas, figures, storage, spatial_index=None): Initialize the Launch class.
         check_missing_db_entries(): Check if all the entries in l_db_entries are in the shelve db.
         compute_and_fill_entries(l_missing_entries): Precompute all the entries in l_missing_entries
             and fill them in the shelve database.
+        run_compiled_functions(): Simulate user actions to compile the numba functions.
+        compile_functions(): Compile the numba functions from the on-disk cache, falling back to
+            run_compiled_functions() if needed.
+        return_planner(): Return a planner registering the precomputed artifacts along with their
+            inputs and dependencies.
         launch(force_exit_if_first_launch=True): Launch the checks and precomputations at app
             startup.
     """
@@ -64,7 +76,7 @@ class Launch:
     # --- Constructor
     # ==============================================================================================
 
-    def __init__(self, data, atlas, figures, storage):
+    def __init__(self, data, atlas, figures, storage, spatial_index=None):
         """Initialize the class Launch.
 
         Args:
@@ -73,12 +85,16 @@ class Launch:
                 Atlas.
             figures (Figures): Figures object, used to build the figures of the app.
             storage (Storage): Storage object, used to access the shelve database.
+            spatial_index (SpectralTileIndex, optional): SpectralTileIndex object, whose tile
+                indices are built with the other precomputed artifacts. If None, the indices are
+                built on demand. Defaults to None.
         """
 
         # App main objects
         self.data = data
         self.atlas = atlas
         self.figures = figures
+        self.spatial_index = spatial_index
 
         # Database path
         self.storage = storage
@@ -87,13 +103,10 @@ class Launch:
         # initialization of Atlas and Figures objects. The computations described are the ones done
         # at startup.
         self.l_atlas_objects_at_init = [
-            # Computed in Atlas.__init__() as an argument of Atlas. Corresponds to the object
-            # returned by Atlas.compute_dic_acronym_children_id()
-            "atlas/atlas_objects/dic_acronym_children_id",
-            #
-            # Computed in Atlas.__init__() as an argument of Atlas. Corresponds to the object
-            # returned by Atlas.compute_hierarchy_list()
-            "atlas/atlas_objects/hierarchy",
+            # Computed in Atlas.__init__(), through Atlas.load_hierarchy(). Corresponds to the
+            # object returned by AtlasHierarchy.compute_hierarchy_index(), suffixed by its version
+            # key
+            "atlas/atlas_objects/hierarchy_index_" + self.atlas.hierarchy.version,
             #
             # Computed in Atlas.__init__() as an argument of Atlas. Corresponds to the object
             # returned by Atlas.compute_array_projection(True, True)
@@ -117,14 +130,19 @@ class Launch:
             "atlas/atlas_objects/dic_existing_masks",
             #
             # Computed when needed, as a property of Atlas. Corresponds to the object returned by
-            # Atlas.compute_list_projected_atlas_borders_figures(). In practice, this function is
-            # called at startup, when calling Figures.compute_dic_fig_contours() in
-            # Figures.__init()__, through the computation of compute_figure_basic_image (with
+            # Atlas.compute_list_projected_atlas_contours(). In practice, this function is called
+            # at startup, when shelving the figures of Figures.compute_figure_basic_image() (with
             # plot_atlas_contours set to True).
+            "atlas/atlas_objects/list_projected_atlas_contours",
+            #
+            # Computed when needed, as a property of Atlas. Corresponds to the object returned by
+            # Atlas.compute_list_projected_atlas_borders_figures(), which rasterizes the contours
+            # above. In practice, this function is called at startup, through the computation of
+            # Figures.compute_figure_basic_image() (with only_contours set to True).
             "atlas/atlas_objects/list_projected_atlas_borders_arrays",
             #
             # Computed at startup through calling
-            # Atlas.compute_list_projected_atlas_borders_figures() (see comment just above).
+            # Atlas.compute_list_projected_atlas_contours() (see comment just above).
             # Corresponds to the object returned by atlas.prepare_and_compute_array_images_atlas().
             "atlas/atlas_objects/array_images_atlas_True",
             #
@@ -237,6 +255,14 @@ class Launch:
             "atlas/atlas_objects/mask_and_spectrum_",
             "atlas/atlas_objects/dic_processed_temp",
             "launch/first_launch",
+            "launch/kernel_signatures",
+            "launch/planner_manifest",
+            "figures/region_analysis/tile_indices/",
+            "figures/spectra/pyramids/",
+            "figures/scRNAseq_page/interpolation_weights",
+            # Replaced by (possibly older versions of) the hierarchy index
+            "atlas/atlas_objects/dic_acronym_children_id",
+            "atlas/atlas_objects/hierarchy",
         ]
 
     # ==============================================================================================
@@ -248,17 +274,19 @@ class Launch:
         It then returns a list containing the missing entries.
         """
 
-        # Get database
-        db = shelve.open(self.storage.path_db)
+        # Get database keys, with the database locked as other workers might be using it
+        with self.storage.lock, file_lock(self.storage.path_lock):
+            with shelve.open(self.storage.path_db) as db:
+                set_keys = set(db.keys())
 
         # Build a set of missing entries
-        l_missing_entries = list(set(self.l_db_entries) - set(db.keys()))
+        l_missing_entries = list(set(self.l_db_entries) - set_keys)
 
         if len(l_missing_entries) > 0:
             logging.info("Missing entries found in the shelve database:" + str(l_missing_entries))
 
         # Find out if there are entries in the databse and not in the list of entries to check
-        l_unexpected_entries = list(set(db.keys()) - set(self.l_db_entries))
+        l_unexpected_entries = list(set_keys - set(self.l_db_entries))
 
         # Remove entries that are not in the initial list but are in the database, i.e all 2D lipid
         # slices, all brain regions, all figures in the load_slice page, and all atlas masks.
@@ -274,9 +302,6 @@ class Launch:
                 + str(l_unexpected_entries)
             )
 
-        # Close database
-        db.close()
-
         return l_missing_entries
 
     def compute_and_fill_entries(self, l_missing_entries):
@@ -321,6 +346,187 @@ class Launch:
         # Close database
         db.close()
 
+    def return_planner(self, n_workers=4):
+        """This function returns a planner in which the main precomputed artifacts of the app are
+        registered, along with the input files, code and parameters they depend on. Running the
+        planner recomputes only the artifacts which are stale, e.g. the masks and spectra of a
+        single slice whose data has been updated.
+
+        Args:
+            n_workers (int, optional): Maximum number of artifacts computed in parallel. Defaults to
+                4.
+
+        Returns:
+            (PrecomputePlanner): The planner.
+        """
+        planner = PrecomputePlanner(self.storage, n_workers=n_workers)
+
+        # Hierarchy of the brain structures
+        planner.register(
+            "atlas/hierarchy",
+            lambda: self.atlas.load_hierarchy(force_update=True),
+            l_code=[self.atlas.hierarchy.compute_hierarchy_index],
+            params={"version": self.atlas.hierarchy.version},
+            check_function=lambda: self.storage.check_shelved_object(
+                "atlas/atlas_objects", "hierarchy_index_" + self.atlas.hierarchy.version
+            ),
+        )
+
+        # Treemaps figure, derived from the hierarchy
+        planner.register(
+            "figures/treemaps",
+            lambda: self.storage.return_shelved_object(
+                "figures/atlas_page/3D",
+                "treemaps",
+                force_update=True,
+                compute_function=self.figures.compute_treemaps_figure,
+            ),
+            l_code=[self.figures.compute_treemaps_figure],
+            l_dependencies=["atlas/hierarchy"],
+            parallel=True,
+            check_function=lambda: self.storage.check_shelved_object(
+                "figures/atlas_page/3D", "treemaps"
+            ),
+        )
+
+        # Contours of the atlas annotations, and their rasterized version
+        def compute_contours():
+            self.atlas._list_projected_atlas_contours = self.storage.return_shelved_object(
+                "atlas/atlas_objects",
+                "list_projected_atlas_contours",
+                force_update=True,
+                compute_function=self.atlas.compute_list_projected_atlas_contours,
+            )
+
+        planner.register(
+            "atlas/contours",
+            compute_contours,
+            l_code=[self.atlas.compute_list_projected_atlas_contours],
+            check_function=lambda: self.storage.check_shelved_object(
+                "atlas/atlas_objects", "list_projected_atlas_contours"
+            ),
+        )
+        planner.register(
+            "atlas/borders",
+            lambda: self.storage.return_shelved_object(
+                "atlas/atlas_objects",
+                "list_projected_atlas_borders_arrays",
+                force_update=True,
+                compute_function=self.atlas.compute_list_projected_atlas_borders_figures,
+            ),
+            l_code=[self.atlas.compute_list_projected_atlas_borders_figures],
+            l_dependencies=["atlas/contours"],
+            parallel=True,
+            check_function=lambda: self.storage.check_shelved_object(
+                "atlas/atlas_objects", "list_projected_atlas_borders_arrays"
+            ),
+        )
+
+        # 3D scatter plot of the scRNAseq spots
+        planner.register(
+            "figures/scatter3D",
+            lambda: self.storage.return_shelved_object(
+                "figures/scRNAseq_page",
+                "scatter3D",
+                force_update=True,
+                compute_function=self.figures.compute_scatter_3D,
+            ),
+            l_code=[self.figures.compute_scatter_3D],
+            parallel=True,
+            check_function=lambda: self.storage.check_shelved_object(
+                "figures/scRNAseq_page", "scatter3D"
+            ),
+        )
+
+        # Lipid options of the dropdowns
+        planner.register(
+            "annotations/lipid_options",
+            lambda: self.storage.dump_shelved_object(
+                "annotations", "lipid_options", self.data.return_lipid_options()
+            ),
+            l_code=[self.data.return_lipid_options],
+            check_function=lambda: self.storage.check_shelved_object(
+                "annotations", "lipid_options"
+            ),
+        )
+
+        # Masks and spectra, and the resulting lipid expression per region, slice by slice. Masks
+        # are not computed in parallel as they all update the same dictionnary of existing masks.
+        for slice_index in self.data.get_slice_list(indices="all"):
+            planner.register(
+                "atlas/masks_and_spectra_" + str(slice_index),
+                lambda slice_index=slice_index: self.atlas.save_all_projected_masks_and_spectra(
+                    force_update=True, l_slice_indices=[slice_index - 1]
+                ),
+                l_inputs=self.data.get_slice_files(slice_index),
+                l_code=[
+                    self.atlas.save_all_projected_masks_and_spectra,
+                    self.atlas.compute_spectrum_data,
+                    self.atlas.get_atlas_mask,
+                ],
+                params={"resolution": self.atlas.resolution},
+                l_dependencies=["atlas/hierarchy"],
+                check_function=lambda slice_index=slice_index: (
+                    slice_index - 1 in self.atlas.dic_existing_masks
+                ),
+            )
+            planner.register(
+                "figures/region_expression_" + str(slice_index),
+                lambda slice_index=slice_index: self.figures.update_region_expression(
+                    l_slice_indices=[slice_index], force_update=True
+                ),
+                l_code=[self.figures.update_region_expression],
+                l_dependencies=["atlas/masks_and_spectra_" + str(slice_index)],
+                check_function=lambda slice_index=slice_index: (
+                    self.figures.is_region_expression_computed([slice_index])
+                ),
+            )
+
+            # Multi-resolution average spectra, used to plot the spectra at any zoom level
+            spectrum_pyramid = self.figures.spectrum_pyramid
+            for standardization in [False, True]:
+                planner.register(
+                    "figures/pyramid_" + str(slice_index) + "_" + str(standardization),
+                    functools.partial(
+                        spectrum_pyramid.load_pyramid, slice_index, standardization, True
+                    ),
+                    l_inputs=[
+                        path
+                        for path in self.data.get_slice_files(slice_index)
+                        if "array_avg_spectrum" in path
+                    ],
+                    l_code=[spectrum_pyramid.compute_pyramid],
+                    params={
+                        "max_points": spectrum_pyramid.max_points,
+                        "reduction_factor": spectrum_pyramid.reduction_factor,
+                    },
+                    parallel=True,
+                    check_function=functools.partial(
+                        spectrum_pyramid.check_pyramid, slice_index, standardization
+                    ),
+                )
+
+            # Tile index of the region analysis page, built here rather than in the short-lived
+            # processes of the long callbacks, which only load it
+            if self.spatial_index is not None:
+                planner.register(
+                    "figures/tile_index_" + str(slice_index),
+                    lambda slice_index=slice_index: self.spatial_index.build_tile_index(
+                        slice_index, force_update=True
+                    ),
+                    l_inputs=self.data.get_slice_files(slice_index),
+                    l_code=[self.spatial_index.compute_tile_index],
+                    params={
+                        "tile_size": self.spatial_index.tile_size,
+                        "resolution": self.spatial_index.resolution,
+                    },
+                    check_function=lambda slice_index=slice_index: (
+                        self.spatial_index.check_tile_index(slice_index)
+                    ),
+                )
+
+        return planner
+
     def run_compiled_functions(self):
         """This function runs once the slowest numba functions, whose compilation can take a little
         bit of time, so that the app is as fast as it can be after startup. Basically, it simulates
@@ -348,6 +554,7 @@ class Launch:
                 self.data.get_array_corrective_factors(slice_index).astype(np.float32),
                 zeros_extend=False,
                 apply_correction=False,
+                n_threads=return_number_of_threads(),
             )
             grah_scattergl_data = convert_array_to_fine_grained(
                 grah_scattergl_data,
@@ -394,6 +601,18 @@ class Launch:
         self.data.clean_memory(slice_index=1)
         logging.info("Compiled functions executed.")
 
+    def compile_functions(self):
+        """This function compiles all the numba functions with the signatures registered in the
+        shelve database, which loads them from the on-disk cache. If some functions have never been
+        registered, or have been modified since, run_compiled_functions() is used instead to
+        compile them with real data, and the signatures are registered for the next launch.
+
+        Returns:
+            (dict): For each compiled function, the number of signatures loaded from cache and
+                compiled from scratch.
+        """
+        return compile_kernels(self.storage, self.run_compiled_functions)
+
     def launch(self, force_exit_if_first_launch=True):
         """This function is used at the execution of the app. It will take care of checking/cleaning
         the database entries, run compiled functions once, and precompute all the objects that can
@@ -411,8 +630,11 @@ class Launch:
         # Compute missing entries
         self.compute_and_fill_entries(l_missing_entries)
 
-        # Run compiled functions
-        self.run_compiled_functions()
+        # Recompute the entries whose inputs have changed since they were computed
+        self.return_planner().run()
+
+        # Compile numba functions, from the on-disk cache if possible
+        self.compile_functions()
 
         # Check if the app has been run before, and potentially force exit if not
         if not self.storage.check_shelved_object("launch", "first_launch"):
@@ -20,6 +20,7 @@ import lzma
 
 # LBAE imports
 from modules.tools.misc import logmem
+from modules.tools.spectra_compression import CompressedSpectra
 
 
 # ==================================================================================================
@@ -76,6 +77,12 @@ class MaldiData:
             - array_corrective_factors: three-dimensional, it contains the MAIA corrective factor
                 used for lipid (first dimension) and each pixel (second and third dimension).
         _path_data (str): path were the data files are stored.
+        _dic_compressed_spectra (dictionnary): a dictionnary containing, for the slices whose
+            spectral data has been compressed, the CompressedSpectra object used instead of the
+            array_spectra memory map to read ranges of peaks or of pixels. The memory map is kept
+            for the functions which need the whole spectral data.
+        _prefetcher (SlicePrefetcher): the object to which the accesses to the slices are reported,
+            to read ahead the files of their neighbours. None if no prefetching is done.
         _df_annotations (pd.dataframe): a dataframe containing for each slice and each annotated
             peak the name of the lipid in between the two annotated peak boundaries. Columns are
             'slice', 'name', 'structure', 'cation', 'theoretical m/z', 'min', 'max', 'num_pixels',
@@ -94,6 +101,8 @@ class MaldiData:
         get_annotations_MAIA_transformed_lipids(brain_1=True): Getter for the MAIA transformed
             lipid annotation, contained in a pandas dataframe.
         get_slice_number(): Getter for the number of slice present in the dataset.
+        get_slice_files(slice_index): Getter for the list of files containing the data of the
+            acquisition indexed by slice_index.
         get_slice_list(indices="all"): Getter for the list of slice indices in the dataset.
         get_image_shape(slice_index): Getter for image_shape, which indicates the shape of the image
             corresponding to the acquisition indexed by slice_index.
@@ -115,6 +124,8 @@ class MaldiData:
             acquired slice.
         get_array_spectra(slice_index): Getter for array_spectra, which is a (memmaped) numpy array
             containing the spectral data of slice indexed by slice_index.
+        get_array_spectra_rows(slice_index, row_1, row_2): Getter for the spectral data of a range
+            of rows of pixels, along with the corresponding lookup table.
         get_array_mz(slice_index): Getter for array_mz, which corresponds to the first row of
             array_spectra, i.e. the m/z values of the spectral data.
         get_array_intensity(slice_index): Getter for array_intensity, which corresponds to the
@@ -147,6 +158,10 @@ class MaldiData:
             data of slice indexed by slice_index.
         is_brain_1(self, slice_index): Returns True if the slice indexed by slice_index is from
             brain 1, False otherwise.
+        record_access(slice_index): Reports an access to the heavyweight arrays of a slice to the
+            prefetcher.
+        return_memmap(slice_index, array_name): Returns a new memory map to one of the heavyweight
+            arrays of a slice.
         clean_memory(slice_index=None, array=None, cache=None): Cleans the memory (reset the
             memory-mapped arrays) of the app.
         compute_l_labels(slice_index): Computes and returns the labels of the lipids in the dataset
@@ -172,6 +187,8 @@ class MaldiData:
         "_np_lipizones_sections_arrays",
         "_slices_n",
         "_path_data",
+        "_dic_compressed_spectra",
+        "_prefetcher",
     ]
 
     # ==============================================================================================
@@ -184,12 +201,28 @@ class MaldiData:
         path_lipids="data/lipids/",
         path_lipizones="data/lipizones/",
         sample_data=False,
+        shared_arrays=None,
+        use_compressed_spectra=True,
+        memory_limit_compressed_spectra=2**28,
+        prefetcher=None,
     ):
         """Initialize the class MaldiData.
 
         Args:
             path_data (str): Path used to load the files containing the MALDI data.
             path_annotations (str): Path used to load the files containing the annotations.
+            shared_arrays (SharedArrayStore, optional): If provided and enabled, the lightweight
+                arrays are attached from this store, such that they are shared between the workers
+                of the server. Defaults to None.
+            use_compressed_spectra (bool, optional): If True, the spectral data of the slices for
+                which a compressed version has been written (see
+                modules/tools/spectra_compression.py) is read from it instead of the memory maps.
+                Defaults to True.
+            memory_limit_compressed_spectra (int, optional): Maximum size of the decoded chunks of
+                compressed spectral data kept in memory, per slice, in bytes. Defaults to 256MB.
+            prefetcher (SlicePrefetcher, optional): If provided, the accesses to the heavyweight
+                arrays are reported to it, such that the files of the neighbouring slices are read
+                ahead. Defaults to None.
         """
 
         logging.info("Initializing MaldiData object" + logmem())
@@ -198,12 +231,22 @@ class MaldiData:
         self._sample_data = sample_data
 
         # Load the dictionnary containing small-size data for all slices
-        if self._sample_data:
-            with lzma.open(path_data + "light_arrays.pickle", "rb") as handle:
-                self._dic_lightweight = pickle.load(handle)
+        def load_lightweight():
+            if self._sample_data:
+                with lzma.open(path_data + "light_arrays.pickle", "rb") as handle:
+                    return pickle.load(handle)
+            else:
+                with open(path_data + "light_arrays.pickle", "rb") as handle:
+                    return pickle.load(handle)
+
+        if shared_arrays is not None and shared_arrays.enabled:
+            self._dic_lightweight = shared_arrays.return_shared_object(
+                "maldi_data/dic_lightweight",
+                load_lightweight,
+                version=str(os.path.getmtime(path_data + "light_arrays.pickle")),
+            )
         else:
-            with open(path_data + "light_arrays.pickle", "rb") as handle:
-                self._dic_lightweight = pickle.load(handle)
+            self._dic_lightweight = load_lightweight()
 
         # Simple variable to get the number of slices
         self._n_slices = len(self._dic_lightweight)
@@ -215,6 +258,31 @@ class MaldiData:
             [slice_idx for slice_idx, val in self._dic_lightweight.items() if not val["is_brain_1"]]
         )
 
+        # Save path_data for cleaning memmap in case
+        self._path_data = path_data
+
+        # Report the accesses to the slices for the files of their neighbours to be read ahead
+        self._prefetcher = prefetcher if not self._sample_data else None
+        if self._prefetcher is not None:
+            self._prefetcher.set_slices(self._l_slices)
+
+        # Use the compressed spectral data of the slices for which it has been written
+        self._dic_compressed_spectra = {}
+        if not self._sample_data and use_compressed_spectra:
+            for slice_index in self._l_slices:
+                path = path_data + "array_spectra_" + str(slice_index)
+                if CompressedSpectra.exists(path):
+                    self._dic_compressed_spectra[slice_index] = CompressedSpectra(
+                        path, memory_limit=memory_limit_compressed_spectra
+                    )
+            if len(self._dic_compressed_spectra) > 0:
+                logging.info(
+                    "Using compressed spectra for "
+                    + str(len(self._dic_compressed_spectra))
+                    + " slices"
+                    + logmem()
+                )
+
         # Set the accesser to the mmap files
         self._dic_memmap = {}
         if not self._sample_data:
@@ -228,16 +296,10 @@ class MaldiData:
                     "array_cumulated_lookup_mz_image",
                     "array_corrective_factors",
                 ]:
-                    self._dic_memmap[slice_index][array_name] = np.memmap(
-                        path_data + array_name + "_" + str(slice_index) + ".mmap",
-                        dtype="float32" if array_name != "array_lookup_mz" else "int32",
-                        mode="r",
-                        shape=self._dic_lightweight[slice_index][array_name + "_shape"],
+                    self._dic_memmap[slice_index][array_name] = self.return_memmap(
+                        slice_index, array_name
                     )
 
-        # Save path_data for cleaning memmap in case
-        self._path_data = path_data
-
         # Load lipids for brain 2
         logging.info("Loading lipids" + logmem())
         green = []
@@ -450,6 +512,28 @@ class MaldiData:
         """
         return self._n_slices
 
+    def get_slice_files(self, slice_index):
+        """Getter for the list of files containing the data of the acquisition indexed by
+        slice_index.
+
+        Args:
+            slice_index (int): Index of the requested slice.
+
+        Returns:
+            (list(str)): The list of paths of the memory-mapped arrays of the slice.
+        """
+        return [
+            self._path_data + array_name + "_" + str(slice_index) + ".mmap"
+            for array_name in [
+                "array_spectra",
+                "array_avg_spectrum",
+                "array_avg_spectrum_after_standardization",
+                "array_lookup_mz",
+                "array_cumulated_lookup_mz_image",
+                "array_corrective_factors",
+            ]
+        ]
+
     def get_slice_list(self, indices="all"):
         """Getter for the list of slice indices.
 
@@ -560,6 +644,7 @@ class MaldiData:
         if self._sample_data:
             return self._dic_lightweight[slice_index]["array_corrective_factors"]
         else:
+            self.record_access(slice_index)
             return self._dic_memmap[slice_index]["array_corrective_factors"]
 
     def get_array_spectra(self, slice_index):
@@ -570,13 +655,40 @@ class MaldiData:
             slice_index (int): Index of the slice for which the spectral data is requested.
 
         Returns:
-            (np.ndarray (mmaped if not sampled dataset)): Spectral data of the requested slice.
+            (np.ndarray (mmaped if not sampled dataset)): Spectral data of the requested slice. The
+                memory map is returned even if the spectral data has been compressed, such that
+                the whole slice is never decoded in memory: only the pages read by the caller are
+                loaded.
         """
         if self._sample_data:
             return self._dic_lightweight[slice_index]["array_spectra"]
         else:
+            self.record_access(slice_index)
             return self._dic_memmap[slice_index]["array_spectra"]
 
+    def get_array_spectra_rows(self, slice_index, row_1, row_2):
+        """Getter for the spectral data of a range of rows of pixels of the slice indexed by
+        slice_index, along with the lookup table mapping each pixel to its spectrum in the returned
+        array. With the memory maps, the whole arrays are returned, while with compressed spectral
+        data, only the chunks containing the requested rows are decoded.
+
+        Args:
+            slice_index (int): Index of the slice for which the spectral data is requested.
+            row_1 (int): Index of the first row of pixels.
+            row_2 (int): Index of the last row of pixels (included).
+
+        Returns:
+            (np.ndarray): Spectral data containing (at least) the spectra of the requested rows.
+            (np.ndarray): The corresponding array_lookup_pixels.
+        """
+        if self._sample_data or slice_index not in self._dic_compressed_spectra:
+            return self.get_array_spectra(slice_index), self.get_array_lookup_pixels(slice_index)
+        self.record_access(slice_index)
+        width = self.get_image_shape(slice_index)[1]
+        return self._dic_compressed_spectra[slice_index].return_pixel_range(
+            self.get_array_lookup_pixels(slice_index), row_1 * width, (row_2 + 1) * width - 1
+        )
+
     def get_array_mz(self, slice_index):
         """Getter for array_mz, which corresponds to the first row of array_spectra, i.e. the m/z
         values of the spectral data.
@@ -621,6 +733,8 @@ class MaldiData:
             (np.ndarray (mmaped if not sampled dataset)): The requested average spectrum.
         """
 
+        if not self._sample_data:
+            self.record_access(slice_index)
         if not standardization:
             if self._sample_data:
                 return self._dic_lightweight[slice_index]["array_avg_spectrum"]
@@ -647,6 +761,7 @@ class MaldiData:
         if self._sample_data:
             return self._dic_lightweight[slice_index]["array_lookup_mz"]
         else:
+            self.record_access(slice_index)
             return self._dic_memmap[slice_index]["array_lookup_mz"]
 
     def get_array_cumulated_lookup_mz_image(self, slice_index):
@@ -662,6 +777,7 @@ class MaldiData:
         if self._sample_data:
             return self._dic_lightweight[slice_index]["array_cumulated_lookup_mz_image"]
         else:
+            self.record_access(slice_index)
             return self._dic_memmap[slice_index]["array_cumulated_lookup_mz_image"]
 
     def get_partial_array_spectra(self, slice_index, lb=None, hb=None, index=None):
@@ -678,25 +794,29 @@ class MaldiData:
             (np.ndarray (mmaped if not sampled dataset)): Spectral data of the requested slice.
         """
 
-        # As there are many possibilities, define new dic depending if sampled data or not
+        # As there are many possibilities, define the array to read depending if sampled data or not
         if self._sample_data:
-            dic = self._dic_lightweight[slice_index]
+            array_spectra = self._dic_lightweight[slice_index]["array_spectra"]
         else:
-            dic = self._dic_memmap[slice_index]
+            self.record_access(slice_index)
+            # Read the requested peaks from the compressed spectral data, if it exists
+            array_spectra = self._dic_compressed_spectra.get(
+                slice_index, self._dic_memmap[slice_index]["array_spectra"]
+            )
 
         if lb is None and hb is None and index is None:
             # Previously called array_spectra_high_res.
-            return dic["array_spectra"]
+            return self.get_array_spectra(slice_index)
         elif lb is not None and hb is not None:
-            return dic["array_spectra"][:, lb:hb]
+            return array_spectra[:, lb:hb]
         elif index is not None:
-            return dic["array_spectra"][:, index]
+            return array_spectra[:, index]
 
         # If not specific index has been provided, it returns a range
         if index is None:
             # Start with most likely case
             if hb is not None and lb is not None:
-                return dic["array_spectra"][:, lb:hb]
+                return array_spectra[:, lb:hb]
 
             # Second most likely case : full slice
             elif lb is None and hb is None:
@@ -704,9 +824,9 @@ class MaldiData:
 
             # Most likely the remaining cases won't be used
             elif lb is None:
-                return dic["array_spectra"][:, :hb]
+                return array_spectra[:, :hb]
             else:
-                return dic["array_spectra"][:, lb:]
+                return array_spectra[:, lb:]
 
         # Else, it returns the required index
         else:
@@ -716,7 +836,7 @@ class MaldiData:
                     + " when calling array_spectra. "
                     + "Only the index request will be satisfied."
                 )
-            return dic["array_spectra"][:, index]
+            return array_spectra[:, index]
 
     def get_partial_array_mz(self, slice_index, lb=None, hb=None, index=None):
         """Getter for partial_array_mz, which corresponds to the first row of partial_array_spectra,
@@ -733,25 +853,29 @@ class MaldiData:
                 requested slice between lb and hb.
         """
 
-        # As there are many possibilities, define new dic depending if sampled data or not
+        # As there are many possibilities, define the array to read depending if sampled data or not
         if self._sample_data:
-            dic = self._dic_lightweight[slice_index]
+            array_spectra = self._dic_lightweight[slice_index]["array_spectra"]
         else:
-            dic = self._dic_memmap[slice_index]
+            self.record_access(slice_index)
+            # Read the requested peaks from the compressed spectral data, if it exists
+            array_spectra = self._dic_compressed_spectra.get(
+                slice_index, self._dic_memmap[slice_index]["array_spectra"]
+            )
 
         if lb is None and hb is None and index is None:
             # Previously called array_spectra_high_res
-            return dic["array_spectra"][0, :]
+            return self.get_array_mz(slice_index)
         elif lb is not None and hb is not None:
-            return dic["array_spectra"][0, lb:hb]
+            return array_spectra[0, lb:hb]
         elif index is not None:
-            return dic["array_spectra"][0, index]
+            return array_spectra[0, index]
 
         # If not specific index has been provided, it returns a range
         if index is None:
             # Start with most likely case
             if hb is not None and lb is not None:
-                return dic["array_spectra"][0, lb:hb]
+                return array_spectra[0, lb:hb]
 
             # Second most likely case : full slice
             elif lb is None and hb is None:
@@ -759,10 +883,10 @@ class MaldiData:
 
             # Most likely the remaining cases won't be used
             elif lb is None:
-                return dic["array_spectra"][0, :hb]
+                return array_spectra[0, :hb]
 
             else:
-                return dic["array_spectra"][0, lb:]
+                return array_spectra[0, lb:]
 
         # Else, it returns the required index
         else:
@@ -772,7 +896,7 @@ class MaldiData:
                     + " when calling array_spectra. "
                     + "Only the index request will be satisfied."
                 )
-            return dic["array_spectra"][0, index]
+            return array_spectra[0, index]
 
     def get_partial_array_intensity(self, slice_index, lb=None, hb=None, index=None):
         """Getter for partial_array_intensity, which corresponds to the second row of
@@ -788,25 +912,29 @@ class MaldiData:
             (np.ndarray, mmaped if not sampled dataset): Intensity values of the spectral data of the
                 requested slice between lb and hb.
         """
-        # As there are many possibilities, define new dic depending if sampled data or not
+        # As there are many possibilities, define the array to read depending if sampled data or not
         if self._sample_data:
-            dic = self._dic_lightweight[slice_index]
+            array_spectra = self._dic_lightweight[slice_index]["array_spectra"]
         else:
-            dic = self._dic_memmap[slice_index]
+            self.record_access(slice_index)
+            # Read the requested peaks from the compressed spectral data, if it exists
+            array_spectra = self._dic_compressed_spectra.get(
+                slice_index, self._dic_memmap[slice_index]["array_spectra"]
+            )
 
         if lb is None and hb is None and index is None:
             # Previously called array_spectra_high_res
-            return dic["array_spectra"][1, :]
+            return self.get_array_intensity(slice_index)
         elif lb is not None and hb is not None:
-            return dic["array_spectra"][1, lb:hb]
+            return array_spectra[1, lb:hb]
         elif index is not None:
-            return dic["array_spectra"][1, index]
+            return array_spectra[1, index]
 
         # If not specific index has been provided, it returns a range
         if index is None:
             # Start with most likely case
             if hb is not None and lb is not None:
-                return dic["array_spectra"][1, lb:hb]
+                return array_spectra[1, lb:hb]
 
             # Second most likely case : full slice
             elif lb is None and hb is None:
@@ -814,10 +942,10 @@ class MaldiData:
 
             # Most likely the remaining cases won't be used
             elif lb is None:
-                return dic["array_spectra"][1, :hb]
+                return array_spectra[1, :hb]
 
             else:
-                return dic["array_spectra"][1, lb:]
+                return array_spectra[1, lb:]
 
         # Else, it returns the required index
         else:
@@ -827,7 +955,7 @@ class MaldiData:
                     + " when calling array_spectra. "
                     + "Only the index request will be satisfied."
                 )
-            return dic["array_spectra"][1, index]
+            return array_spectra[1, index]
 
     def get_partial_array_avg_spectrum(self, slice_index, lb=None, hb=None, standardization=True):
         """Getter for partial_array_avg_spectrum, which corresponds to the average spectrum of the
@@ -847,6 +975,7 @@ class MaldiData:
         if self._sample_data:
             dic = self._dic_lightweight[slice_index]
         else:
+            self.record_access(slice_index)
             dic = self._dic_memmap[slice_index]
 
         # Start with most likely case
@@ -919,6 +1048,32 @@ class MaldiData:
         """
         return self._dic_lightweight[slice_index]["is_brain_1"]
 
+    def record_access(self, slice_index):
+        """Reports an access to the heavyweight arrays of a slice to the prefetcher, if any.
+
+        Args:
+            slice_index (int): Index of the accessed slice.
+        """
+        if self._prefetcher is not None:
+            self._prefetcher.record_access(slice_index)
+
+    def return_memmap(self, slice_index, array_name):
+        """Returns a new numpy memory map to one of the heavyweight arrays of a slice.
+
+        Args:
+            slice_index (int): Index of the slice.
+            array_name (str): Name of the array.
+
+        Returns:
+            (np.memmap): The memory map of the requested array.
+        """
+        return np.memmap(
+            self._path_data + array_name + "_" + str(slice_index) + ".mmap",
+            dtype="float32" if array_name != "array_lookup_mz" else "int32",
+            mode="r",
+            shape=self._dic_lightweight[slice_index][array_name + "_shape"],
+        )
+
     def clean_memory(self, slice_index=None, array=None, cache=None):
         """Cleans the memory (reset the memory-mapped arrays) of the app. slice_index and array
         allow for a more fine-grained cleaning. If "cache" is provided, it will be used to lock the
@@ -962,42 +1117,26 @@ class MaldiData:
             if slice_index is None:
                 for index in self._l_slices:
                     for array_name in l_array_names:
-                        self._dic_memmap[index][array_name] = np.memmap(
-                            self._path_data + array_name + "_" + str(index) + ".mmap",
-                            dtype="float32" if array_name != "array_lookup_mz" else "int32",
-                            mode="r",
-                            shape=self._dic_lightweight[index][array_name + "_shape"],
+                        self._dic_memmap[index][array_name] = self.return_memmap(
+                            index, array_name
                         )
 
             # Else clean all memmaps of a given slice index
             else:
                 for array_name in l_array_names:
-                    self._dic_memmap[slice_index][array_name] = np.memmap(
-                        self._path_data + array_name + "_" + str(slice_index) + ".mmap",
-                        dtype="float32" if array_name != "array_lookup_mz" else "int32",
-                        mode="r",
-                        shape=self._dic_lightweight[slice_index][array_name + "_shape"],
+                    self._dic_memmap[slice_index][array_name] = self.return_memmap(
+                        slice_index, array_name
                     )
         # Case an array name has been provided
         else:
             # Clean all memmaps corresponding to the current array if no slice_index have been given
             if slice_index is None:
                 for index in self._l_slices:
-                    self._dic_memmap[index][array] = np.memmap(
-                        self._path_data + array + "_" + str(index) + ".mmap",
-                        dtype="float32" if array != "array_lookup_mz" else "int32",
-                        mode="r",
-                        shape=self._dic_lightweight[index][array + "_shape"],
-                    )
+                    self._dic_memmap[index][array] = self.return_memmap(index, array)
 
             # Else clean the memap of the given slice index
             else:
-                self._dic_memmap[slice_index][array] = np.memmap(
-                    self._path_data + array + "_" + str(slice_index) + ".mmap",
-                    dtype="float32" if array != "array_lookup_mz" else "int32",
-                    mode="r",
-                    shape=self._dic_lightweight[slice_index][array + "_shape"],
-                )
+                self._dic_memmap[slice_index][array] = self.return_memmap(slice_index, array)
 
         # Release memory
         if cache is not None:
@@ -0,0 +1,343 @@
+# Copyright (c) 2022, Colas Droin. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
+
+""" This class is used to account for the memory held by the main objects of the app (data, atlas,
+figures, etc.). For each owning object, the memory is split between heap-allocated numpy arrays,
+memory-mapped arrays (mapped size and actually resident size, read from /proc/self/smaps),
+dataframes, and other python objects. Snapshots are kept over time, such that growing owners can be
+flagged. The report is exposed through an admin route of the server, and can also be printed from
+the command line:
+
+`python -m modules.memory`
+"""
+
+# ==================================================================================================
+# --- Imports
+# ==================================================================================================
+
+# Standard modules
+import collections
+import logging
+import os
+import sys
+import time
+import types
+import numpy as np
+import pandas as pd
+import psutil
+from pympler import asizeof
+
+# LBAE imports
+from modules.startup import LazyComponent
+
+# ==================================================================================================
+# --- Functions
+# ==================================================================================================
+
+
+def return_mapped_files_usage():
+    """This function parses /proc/self/smaps to get, for each memory-mapped file, the size of the
+    mapping and the size actually resident in memory.
+
+    Returns:
+        (dict): A dictionnary associating each file path to a dictionnary with the mapped and
+            resident sizes (in bytes). Empty if /proc/self/smaps is not available (e.g. not Linux).
+    """
+    dic_usage = {}
+    if not os.path.exists("/proc/self/smaps"):
+        return dic_usage
+
+    path = None
+    with open("/proc/self/smaps") as handle:
+        for line in handle:
+            l_fields = line.split()
+            if len(l_fields) == 0:
+                continue
+            # Header lines start with an address range
+            if "-" in l_fields[0] and not l_fields[0].endswith(":"):
+                path = l_fields[5] if len(l_fields) > 5 and l_fields[5].startswith("/") else None
+                if path is not None and path not in dic_usage:
+                    dic_usage[path] = {"mapped": 0, "resident": 0}
+            elif path is not None and l_fields[0] == "Size:":
+                dic_usage[path]["mapped"] += int(l_fields[1]) * 1024
+            elif path is not None and l_fields[0] == "Rss:":
+                dic_usage[path]["resident"] += int(l_fields[1]) * 1024
+    return dic_usage
+
+
+# ==================================================================================================
+# --- Class
+# ==================================================================================================
+
+
+class MemoryAccountant:
+    """Class used to account for the memory held by the main objects of the app, and track it over
+    time.
+
+    Attributes:
+        dic_owners (dict): Dictionnary of owning objects, indexed by name.
+        deque_snapshots (collections.deque): Last snapshots taken, the first snapshot ever taken
+            being kept separately as a baseline.
+        baseline (dict): First snapshot taken.
+        growth_threshold (float): Relative growth (compared to the previous snapshot) above which an
+            owner is flagged.
+        growth_min_bytes (int): Absolute growth below which an owner is never flagged.
+        max_depth (int): Maximum depth of the exploration of the attributes of each owner.
+
+    Methods:
+        __init__(dic_owners=None, n_snapshots=100, growth_threshold=0.1,
+            growth_min_bytes=50*1024**2, max_depth=8): Initialize the MemoryAccountant class.
+        register(name, owner): Register an owning object.
+        account_owner(owner, dic_mapped_files, set_visited): Account for the memory held by one
+            owner.
+        take_snapshot(): Account for the memory held by all the owners, and flag growth.
+        return_report(): Return the last snapshot, the baseline and the growth flags.
+        format_report(): Return the last snapshot as a human-readable table.
+    """
+
+    # Categories of memory reported for each owner
+    l_categories = ["heap", "mapped", "resident_mapped", "dataframe", "other"]
+
+    def __init__(
+        self,
+        dic_owners=None,
+        n_snapshots=100,
+        growth_threshold=0.1,
+        growth_min_bytes=50 * 1024**2,
+        max_depth=8,
+    ):
+        """Initialize the class MemoryAccountant.
+
+        Args:
+            dic_owners (dict, optional): Dictionnary of owning objects, indexed by name. Defaults to
+                None.
+            n_snapshots (int, optional): Number of snapshots kept in memory. Defaults to 100.
+            growth_threshold (float, optional): Relative growth above which an owner is flagged.
+                Defaults to 0.1.
+            growth_min_bytes (int, optional): Absolute growth below which an owner is never
+                flagged. Defaults to 50MB.
+            max_depth (int, optional): Maximum depth of the exploration of the attributes of each
+                owner. Defaults to 8.
+        """
+        self.dic_owners = dict(dic_owners) if dic_owners is not None else {}
+        self.deque_snapshots = collections.deque(maxlen=n_snapshots)
+        self.baseline = None
+        self.growth_threshold = growth_threshold
+        self.growth_min_bytes = growth_min_bytes
+        self.max_depth = max_depth
+
+    # ==============================================================================================
+    # --- Methods
+    # ==============================================================================================
+
+    def register(self, name, owner):
+        """Register an owning object.
+
+        Args:
+            name (str): Name of the owner.
+            owner (object): The owning object (possibly a LazyComponent).
+        """
+        self.dic_owners[name] = owner
+
+    def account_owner(self, owner, dic_mapped_files, set_visited):
+        """This function explores recursively the attributes of an owner to account for the memory
+        it holds. Objects already visited (e.g. when shared with another owner) are not counted
+        twice, and other owners are not explored.
+
+        Args:
+            owner (object): The owning object.
+            dic_mapped_files (dict): Usage of the memory-mapped files, as returned by
+                return_mapped_files_usage().
+            set_visited (set): Identifiers of the objects already visited. Updated inplace.
+
+        Returns:
+            (dict): The number of bytes per category, along with the number of arrays and mapped
+                files.
+        """
+        dic_account = {category: 0 for category in self.l_categories}
+        dic_account["n_arrays"] = 0
+        set_mapped_files = set()
+        set_owners = set(
+            id(x.resolve() if isinstance(x, LazyComponent) and x.is_ready() else x)
+            for x in self.dic_owners.values()
+        )
+
+        stack = [(owner, 0)]
+        while len(stack) > 0:
+            obj, depth = stack.pop()
+            if id(obj) in set_visited or (depth > 0 and id(obj) in set_owners):
+                continue
+            set_visited.add(id(obj))
+
+            if isinstance(obj, np.memmap) or (
+                isinstance(obj, np.ndarray) and isinstance(obj.base, np.memmap)
+            ):
+                # Account for each mapped file only once
+                filename = getattr(obj, "filename", None)
+                if filename is None and isinstance(obj.base, np.memmap):
+                    filename = obj.base.filename
+                if filename is not None and filename not in set_mapped_files:
+                    set_mapped_files.add(filename)
+                    dic_usage = dic_mapped_files.get(os.path.realpath(filename), None)
+                    if dic_usage is not None:
+                        dic_account["mapped"] += dic_usage["mapped"]
+                        dic_account["resident_mapped"] += dic_usage["resident"]
+                    else:
+                        dic_account["mapped"] += obj.nbytes
+                dic_account["n_arrays"] += 1
+            elif isinstance(obj, np.ndarray):
+                # Views are accounted through their base
+                base = obj
+                while isinstance(base.base, np.ndarray):
+                    base = base.base
+                if base is obj or id(base) not in set_visited:
+                    set_visited.add(id(base))
+                    dic_account["heap"] += base.nbytes
+                    dic_account["n_arrays"] += 1
+                if obj.dtype == object:
+                    stack.extend((x, depth + 1) for x in obj.ravel())
+            elif isinstance(obj, (pd.DataFrame, pd.Series)):
+                dic_account["dataframe"] += int(obj.memory_usage(deep=True).sum())
+            elif isinstance(obj, (types.ModuleType, types.FunctionType, types.MethodType, type)):
+                continue
+            elif depth >= self.max_depth:
+                dic_account["other"] += asizeof.asizeof(obj)
+            elif isinstance(obj, dict):
+                dic_account["other"] += sys.getsizeof(obj)
+                stack.extend((x, depth + 1) for x in obj.keys())
+                stack.extend((x, depth + 1) for x in obj.values())
+            elif isinstance(obj, (list, tuple, set, frozenset, collections.deque)):
+                dic_account["other"] += sys.getsizeof(obj)
+                stack.extend((x, depth + 1) for x in obj)
+            elif isinstance(obj, (str, bytes, int, float, complex, bool, type(None))):
+                dic_account["other"] += sys.getsizeof(obj)
+            else:
+                # Generic object: explore its attributes
+                l_attributes = list(getattr(obj, "__dict__", {}).values())
+                for cls in type(obj).__mro__:
+                    for slot in getattr(cls, "__slots__", []):
+                        if hasattr(obj, slot) and not isinstance(
+                            getattr(type(obj), slot, None), property
+                        ):
+                            l_attributes.append(getattr(obj, slot))
+                if len(l_attributes) == 0:
+                    dic_account["other"] += asizeof.asizeof(obj)
+                else:
+                    dic_account["other"] += sys.getsizeof(obj)
+                    stack.extend((x, depth + 1) for x in l_attributes)
+
+        dic_account["n_mapped_files"] = len(set_mapped_files)
+        return dic_account
+
+    def take_snapshot(self):
+        """This function accounts for the memory held by all the owners (owners which have not been
+        initialized yet are skipped), and flags the owners whose memory has grown since the
+        previous snapshot.
+
+        Returns:
+            (dict): The snapshot, with the time, the process RSS, the account of each owner, and the
+                list of flagged owners.
+        """
+        time_start = time.time()
+        dic_mapped_files = return_mapped_files_usage()
+        set_visited = set()
+        dic_accounts = {}
+        for name, owner in self.dic_owners.items():
+            if isinstance(owner, LazyComponent):
+                if not owner.is_ready():
+                    continue
+                owner = owner.resolve()
+            dic_accounts[name] = self.account_owner(owner, dic_mapped_files, set_visited)
+
+        # Flag owners whose held memory (mapped memory excluded) has grown
+        l_flagged = []
+        if len(self.deque_snapshots) > 0:
+            dic_previous = self.deque_snapshots[-1]["owners"]
+            for name, dic_account in dic_accounts.items():
+                if name not in dic_previous:
+                    continue
+                l_held = ["heap", "resident_mapped", "dataframe", "other"]
+                previous = sum(dic_previous[name][x] for x in l_held)
+                current = sum(dic_account[x] for x in l_held)
+                if (
+                    current - previous > self.growth_min_bytes
+                    and current > previous * (1 + self.growth_threshold)
+                ):
+                    l_flagged.append(name)
+                    logging.warning(
+                        "Memory held by "
+                        + name
+                        + " has grown from "
+                        + str(round(previous / 1024**2))
+                        + "MB to "
+                        + str(round(current / 1024**2))
+                        + "MB"
+                    )
+
+        snapshot = {
+            "time": time_start,
+            "duration": round(time.time() - time_start, 3),
+            "process_rss": psutil.Process().memory_info().rss,
+            "owners": dic_accounts,
+            "flagged": l_flagged,
+        }
+        if self.baseline is None:
+            self.baseline = snapshot
+        self.deque_snapshots.append(snapshot)
+        return snapshot
+
+    def return_report(self):
+        """This function returns the last snapshot (taking one if needed), along with the baseline
+        and the history of the process RSS.
+
+        Returns:
+            (dict): The report.
+        """
+        if len(self.deque_snapshots) == 0:
+            self.take_snapshot()
+        return {
+            "last": self.deque_snapshots[-1],
+            "baseline": self.baseline,
+            "history": [
+                {"time": x["time"], "process_rss": x["process_rss"], "flagged": x["flagged"]}
+                for x in self.deque_snapshots
+            ],
+        }
+
+    def format_report(self):
+        """This function returns the last snapshot (taking one if needed) as a human-readable
+        table, with sizes in MB.
+
+        Returns:
+            (str): The table.
+        """
+        snapshot = self.return_report()["last"]
+        l_lines = [
+            "{:<12}".format("owner")
+            + "".join("{:>17}".format(category) for category in self.l_categories)
+            + "{:>10}".format("arrays")
+        ]
+        for name, dic_account in snapshot["owners"].items():
+            l_lines.append(
+                "{:<12}".format(name)
+                + "".join(
+                    "{:>17.1f}".format(dic_account[category] / 1024**2)
+                    for category in self.l_categories
+                )
+                + "{:>10}".format(dic_account["n_arrays"])
+                + (" (growing)" if name in snapshot["flagged"] else "")
+            )
+        l_lines.append("Process RSS: {:.1f}MB".format(snapshot["process_rss"] / 1024**2))
+        return "\n".join(l_lines)
+
+
+# ==================================================================================================
+# --- Command line report
+# ==================================================================================================
+
+if __name__ == "__main__":
+    import app
+
+    # Wait for all the main objects to be initialized
+    app.startup.initialize_all(raise_exception=True)
+    print(app.memory_accountant.format_report())
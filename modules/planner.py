@@ -0,0 +1,271 @@
+# Copyright (c) 2022, Colas Droin. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
+
+""" This class is used to plan and run the precomputations of the app incrementally. Each stored
+artifact (i.e. one or several entries of the shelve database) is registered along with the input
+files, the code and the parameters it is derived from, and the artifacts it depends on. A manifest
+of these fingerprints is kept in the shelve database, such that only the artifacts whose inputs have
+changed since they were computed (or whose dependencies have been recomputed) are computed again."""
+
+# ==================================================================================================
+# --- Imports
+# ==================================================================================================
+
+# Standard modules
+import hashlib
+import inspect
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# LBAE imports
+from modules.tools.misc import logmem
+
+# ==================================================================================================
+# --- Class
+# ==================================================================================================
+
+
+class PrecomputePlanner:
+    """Class used to register the precomputed artifacts of the app with their dependencies, and to
+    recompute only the stale ones, in dependency order, in parallel when allowed.
+
+    Attributes:
+        storage (Storage): Used to access the shelve database.
+        n_workers (int): Maximum number of artifacts computed in parallel.
+        dic_artifacts (dict): Dictionnary of registered artifacts, indexed by name. Each artifact is
+            a dictionnary with the keys "compute_function", "l_inputs", "l_code", "params",
+            "l_dependencies", "parallel" and "check_function".
+        dic_manifest (dict): Dictionnary associating the name of each artifact to the fingerprint it
+            had when it was last computed. It is stored in the shelve database.
+
+    Methods:
+        __init__(storage, n_workers=4): Initialize the PrecomputePlanner class.
+        register(name, compute_function, ...): Register an artifact.
+        compute_fingerprint(name, dic_fingerprints): Compute the current fingerprint of an
+            artifact.
+        return_sorted_artifacts(): Return the artifacts sorted in dependency order.
+        plan(): Return the list of stale artifacts, in dependency order.
+        run(): Recompute the stale artifacts and update the manifest.
+        invalidate(l_names): Force the recomputation of the given artifacts at the next run.
+    """
+
+    # ==============================================================================================
+    # --- Constructor
+    # ==============================================================================================
+
+    def __init__(self, storage, n_workers=4):
+        """Initialize the class PrecomputePlanner.
+
+        Args:
+            storage (Storage): Used to access the shelve database.
+            n_workers (int, optional): Maximum number of artifacts computed in parallel. Defaults to
+                4.
+        """
+        self.storage = storage
+        self.n_workers = n_workers
+        self.dic_artifacts = {}
+        if self.storage.check_shelved_object("launch", "planner_manifest"):
+            self.dic_manifest = self.storage.load_shelved_object("launch", "planner_manifest")
+        else:
+            self.dic_manifest = {}
+
+    # ==============================================================================================
+    # --- Methods
+    # ==============================================================================================
+
+    def register(
+        self,
+        name,
+        compute_function,
+        l_inputs=[],
+        l_code=[],
+        params=None,
+        l_dependencies=[],
+        parallel=False,
+        check_function=None,
+    ):
+        """This function registers an artifact.
+
+        Args:
+            name (str): Unique name of the artifact.
+            compute_function (func): Function taking no argument, computing the artifact and storing
+                it (e.g. in the shelve database).
+            l_inputs (list(str), optional): List of paths of the files the artifact is derived from.
+                Defaults to [].
+            l_code (list(func), optional): List of functions used to compute the artifact. Their
+                source code is hashed such that the artifact is recomputed when they change.
+                Defaults to [].
+            params (object, optional): Parameters used to compute the artifact. Their
+                representation is hashed. Defaults to None.
+            l_dependencies (list(str), optional): Names of the artifacts this artifact depends on.
+                Defaults to [].
+            parallel (bool, optional): If True, the artifact can be computed in parallel with other
+                artifacts having the same flag. Defaults to False.
+            check_function (func, optional): Function taking no argument and returning True if the
+                artifact already exists. It is used to adopt existing artifacts which are not yet
+                in the manifest, instead of recomputing them. Defaults to None.
+        """
+        self.dic_artifacts[name] = {
+            "compute_function": compute_function,
+            "l_inputs": l_inputs,
+            "l_code": l_code,
+            "params": params,
+            "l_dependencies": l_dependencies,
+            "parallel": parallel,
+            "check_function": check_function,
+        }
+
+    def compute_fingerprint(self, name, dic_fingerprints):
+        """This function computes the current fingerprint of an artifact, from the size and
+        modification time of its input files, the source code of its functions, its parameters, and
+        the fingerprints of its dependencies.
+
+        Args:
+            name (str): Name of the artifact.
+            dic_fingerprints (dict): Current fingerprints of the dependencies of the artifact.
+
+        Returns:
+            (str): The fingerprint of the artifact.
+        """
+        artifact = self.dic_artifacts[name]
+        hash_object = hashlib.md5()
+        for path in artifact["l_inputs"]:
+            if os.path.exists(path):
+                stat = os.stat(path)
+                hash_object.update((path + str(stat.st_size) + str(stat.st_mtime_ns)).encode())
+            else:
+                hash_object.update((path + "missing").encode())
+        for function in artifact["l_code"]:
+            hash_object.update(inspect.getsource(function).encode())
+        hash_object.update(repr(artifact["params"]).encode())
+        for dependency in artifact["l_dependencies"]:
+            hash_object.update((dependency + dic_fingerprints[dependency]).encode())
+        return hash_object.hexdigest()
+
+    def return_sorted_artifacts(self):
+        """This function sorts the artifacts in dependency order, grouped by level: the artifacts of
+        a given level only depend on artifacts of the previous levels.
+
+        Returns:
+            (list(list(str))): The list of levels, each level being a list of artifact names.
+        """
+        dic_level = {}
+
+        def return_level(name, l_visited):
+            if name in dic_level:
+                return dic_level[name]
+            if name in l_visited:
+                raise ValueError("Cyclic dependency found for artifact " + name)
+            level = 0
+            for dependency in self.dic_artifacts[name]["l_dependencies"]:
+                if dependency not in self.dic_artifacts:
+                    raise ValueError(
+                        "Artifact " + dependency + " (dependency of " + name + ") is not registered"
+                    )
+                level = max(level, return_level(dependency, l_visited + [name]) + 1)
+            dic_level[name] = level
+            return level
+
+        for name in self.dic_artifacts:
+            return_level(name, [])
+
+        ll_levels = [[] for _ in range(max(dic_level.values(), default=-1) + 1)]
+        for name, level in dic_level.items():
+            ll_levels[level].append(name)
+        return ll_levels
+
+    def plan(self):
+        """This function computes the list of stale artifacts, i.e. artifacts which have never been
+        computed, or whose fingerprint has changed since they were last computed. Existing
+        artifacts missing from the manifest are adopted (their current fingerprint is recorded)
+        rather than recomputed.
+
+        Returns:
+            (list(list(str)), dict): The stale artifacts, grouped by dependency level, and the
+                current fingerprints of all artifacts.
+        """
+        dic_fingerprints = {}
+        ll_stale = []
+        for l_names in self.return_sorted_artifacts():
+            l_stale = []
+            for name in l_names:
+                fingerprint = self.compute_fingerprint(name, dic_fingerprints)
+                dic_fingerprints[name] = fingerprint
+                check_function = self.dic_artifacts[name]["check_function"]
+                if name not in self.dic_manifest:
+                    if check_function is not None and check_function():
+                        logging.info("Adopting existing artifact " + name)
+                        self.dic_manifest[name] = fingerprint
+                    else:
+                        l_stale.append(name)
+                elif self.dic_manifest[name] != fingerprint:
+                    l_stale.append(name)
+            ll_stale.append(l_stale)
+        return ll_stale, dic_fingerprints
+
+    def _compute_artifact(self, name, fingerprint):
+        """This function computes an artifact and records its fingerprint in the manifest.
+
+        Args:
+            name (str): Name of the artifact.
+            fingerprint (str): Fingerprint of the artifact.
+        """
+        time_start = time.time()
+        logging.info("Computing stale artifact " + name + logmem())
+        self.dic_artifacts[name]["compute_function"]()
+        self.dic_manifest[name] = fingerprint
+        logging.info(
+            "Artifact " + name + " computed in " + str(round(time.time() - time_start, 2)) + "s"
+        )
+
+    def run(self):
+        """This function recomputes all the stale artifacts, level by level. Within a level,
+        artifacts flagged as parallel are computed in a thread pool, while the others are computed
+        sequentially. The manifest is saved in the shelve database after each level, such that an
+        interrupted run can be resumed.
+
+        Returns:
+            (list(str)): The list of artifacts that have been recomputed.
+        """
+        ll_stale, dic_fingerprints = self.plan()
+        n_stale = sum(len(l_stale) for l_stale in ll_stale)
+        logging.info(str(n_stale) + " stale artifacts to compute" + logmem())
+
+        l_computed = []
+        for l_stale in ll_stale:
+            l_parallel = [name for name in l_stale if self.dic_artifacts[name]["parallel"]]
+            l_sequential = [name for name in l_stale if not self.dic_artifacts[name]["parallel"]]
+
+            if len(l_parallel) > 0:
+                with ThreadPoolExecutor(max_workers=self.n_workers) as executor:
+                    l_futures = [
+                        executor.submit(self._compute_artifact, name, dic_fingerprints[name])
+                        for name in l_parallel
+                    ]
+                    for future in l_futures:
+                        future.result()
+            for name in l_sequential:
+                self._compute_artifact(name, dic_fingerprints[name])
+
+            l_computed.extend(l_stale)
+            if len(l_stale) > 0:
+                self.storage.dump_shelved_object("launch", "planner_manifest", self.dic_manifest)
+
+        # Also save the manifest if artifacts have been adopted
+        self.storage.dump_shelved_object("launch", "planner_manifest", self.dic_manifest)
+        return l_computed
+
+    def invalidate(self, l_names):
+        """This function removes the given artifacts from the manifest, such that they are
+        recomputed at the next run (regardless of their check function).
+
+        Args:
+            l_names (list(str)): Names of the artifacts to invalidate.
+        """
+        for name in l_names:
+            self.dic_manifest.pop(name, None)
+            # Invalidated artifacts must not be adopted
+            self.dic_artifacts[name]["check_function"] = None
+        self.storage.dump_shelved_object("launch", "planner_manifest", self.dic_manifest)
@@ -0,0 +1,361 @@
+# Copyright (c) 2022, Colas Droin. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
+
+""" This class is used to warm the page cache with the memory-mapped files of the slices that are
+likely to be accessed next. MaldiData reports each access to the heavyweight arrays of a slice, and
+the files of the neighbouring slices (mostly in the direction in which the user is moving through
+the slices, e.g. with the slider) are then read ahead in the background, with the
+posix_fadvise(WILLNEED) hint. As the hint is given on the files rather than on the mappings, the
+warmed pages remain useful after MaldiData.clean_memory() has recreated the memory maps.
+
+The residency of the files of each slice in the page cache (obtained with mincore) is exposed with
+the other metrics of the app, at /metrics, separately for the memory maps and the compressed
+spectral files.
+"""
+
+# ==================================================================================================
+# --- Imports
+# ==================================================================================================
+
+# Standard modules
+import ctypes
+import ctypes.util
+import logging
+import mmap
+import os
+import queue
+import threading
+import time
+import numpy as np
+
+# LBAE imports
+from modules.execution import return_execution_pool, ExecutionQueueFull
+
+# Load the C library to call mincore, which is not exposed by the standard library
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    _libc.mmap.restype = ctypes.c_void_p
+    _libc.mmap.argtypes = [
+        ctypes.c_void_p,
+        ctypes.c_size_t,
+        ctypes.c_int,
+        ctypes.c_int,
+        ctypes.c_int,
+        ctypes.c_long,
+    ]
+    _libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+    _libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.POINTER(ctypes.c_ubyte)]
+except (OSError, AttributeError):
+    _libc = None
+
+# ==================================================================================================
+# --- Functions
+# ==================================================================================================
+
+
+def return_file_residency(path):
+    """This function returns the number of bytes of a file that are resident in the page cache.
+
+    Args:
+        path (str): Path of the file.
+
+    Returns:
+        (int): The resident size, in bytes, or None if it can't be obtained (e.g. not Linux).
+    """
+    if _libc is None or not os.path.exists(path):
+        return None
+    size = os.path.getsize(path)
+    if size == 0:
+        return 0
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        address = _libc.mmap(None, size, mmap.PROT_READ, mmap.MAP_SHARED, fd, 0)
+        if address is None or address == ctypes.c_void_p(-1).value:
+            return None
+        try:
+            n_pages = (size + mmap.PAGESIZE - 1) // mmap.PAGESIZE
+            array_vec = (ctypes.c_ubyte * n_pages)()
+            if _libc.mincore(address, size, array_vec) != 0:
+                return None
+            n_resident = int(np.count_nonzero(np.frombuffer(array_vec, dtype=np.uint8) & 1))
+            return min(size, n_resident * mmap.PAGESIZE)
+        finally:
+            _libc.munmap(address, size)
+    finally:
+        os.close(fd)
+
+
+# ==================================================================================================
+# --- Class
+# ==================================================================================================
+
+
+class SlicePrefetcher:
+    """Class used to track the accesses to the slices, and read ahead the files of the slices likely
+    to be accessed next.
+
+    Attributes:
+        path_data (str): Path of the folder containing the memory-mapped files.
+        l_array_names (list(str)): Names of the arrays whose files are read ahead.
+        n_ahead (int): Number of slices read ahead in the direction of the navigation.
+        n_behind (int): Number of slices read ahead in the opposite direction.
+        min_interval (float): Minimum time (in seconds) between two warmings of the same slice.
+        max_bytes_per_file (int): If not None, only the beginning of each file is read ahead.
+        l_slices (list(int)): Indices of the slices of the dataset.
+        dic_accesses (dict): Number of accesses of each slice.
+        dic_statistics (dict): Number of warmings, of bytes read ahead, and of warmings skipped.
+        _last_slice (int): Index of the last slice accessed.
+        _dic_last_warming (dict): Time of the last warming of each slice.
+        _set_pending (set): Slices waiting to be warmed.
+        _queue (queue.Queue): Queue of the slices waiting to be warmed.
+        _pid (int): Identifier of the process in which the worker thread has been started.
+        _lock (threading.Lock): Lock protecting the access statistics.
+
+    Methods:
+        __init__(path_data, l_array_names=None, n_ahead=2, n_behind=1, min_interval=60,
+            max_bytes_per_file=None): Initialize the SlicePrefetcher class.
+        set_slices(l_slices): Set the indices of the slices of the dataset.
+        return_slice_files(slice_index, extension=None): Return the files of a slice.
+        record_access(slice_index): Record an access to a slice and schedule the warming of its
+            neighbours.
+        run_worker(): Warm the scheduled slices, in a background thread.
+        warm_slice(slice_index): Read ahead the files of a slice.
+        return_residency(slice_index, extension=None): Return the page cache residency of the
+            files of a slice.
+        return_metrics_lines(): Return the accesses and residency in the Prometheus text format.
+    """
+
+    def __init__(
+        self,
+        path_data,
+        l_array_names=None,
+        n_ahead=2,
+        n_behind=1,
+        min_interval=60,
+        max_bytes_per_file=None,
+    ):
+        """Initialize the class SlicePrefetcher.
+
+        Args:
+            path_data (str): Path of the folder containing the memory-mapped files.
+            l_array_names (list(str), optional): Names of the arrays whose files are read ahead.
+                Defaults to None, corresponding to all the memory-mapped arrays of MaldiData.
+            n_ahead (int, optional): Number of slices read ahead in the direction of the
+                navigation. Defaults to 2.
+            n_behind (int, optional): Number of slices read ahead in the opposite direction.
+                Defaults to 1.
+            min_interval (float, optional): Minimum time (in seconds) between two warmings of the
+                same slice. Defaults to 60.
+            max_bytes_per_file (int, optional): If not None, only the beginning of each file is
+                read ahead. Defaults to None.
+        """
+        self.path_data = path_data
+        if l_array_names is None:
+            l_array_names = [
+                "array_spectra",
+                "array_avg_spectrum",
+                "array_avg_spectrum_after_standardization",
+                "array_lookup_mz",
+                "array_cumulated_lookup_mz_image",
+                "array_corrective_factors",
+            ]
+        self.l_array_names = l_array_names
+        self.n_ahead = n_ahead
+        self.n_behind = n_behind
+        self.min_interval = min_interval
+        self.max_bytes_per_file = max_bytes_per_file
+        self.l_slices = []
+        self.dic_accesses = {}
+        self.dic_statistics = {"warmings": 0, "warmed_bytes": 0, "skipped": 0}
+        self._last_slice = None
+        self._dic_last_warming = {}
+        self._set_pending = set()
+        self._queue = queue.Queue()
+        self._pid = None
+        self._lock = threading.Lock()
+
+    # ==============================================================================================
+    # --- Methods
+    # ==============================================================================================
+
+    def set_slices(self, l_slices):
+        """This function sets the indices of the slices of the dataset, among which the neighbours
+        of an accessed slice are taken.
+
+        Args:
+            l_slices (list(int)): Indices of the slices.
+        """
+        self.l_slices = sorted(l_slices)
+
+    def return_slice_files(self, slice_index, extension=None):
+        """This function returns the existing files of a slice, i.e. the memory maps and, for the
+        spectral data, the compressed file if it has been written. Both files of the spectral data
+        are returned, as MaldiData still reads the whole spectra from the memory map, and only the
+        partial spectra from the compressed file.
+
+        Args:
+            slice_index (int): Index of the slice.
+            extension (str, optional): If not None, only the files with this extension (i.e.
+                ".mmap" or ".lbs") are returned. Defaults to None.
+
+        Returns:
+            (list(str)): The paths of the files.
+        """
+        l_paths = []
+        for array_name in self.l_array_names:
+            path = self.path_data + array_name + "_" + str(slice_index)
+            l_extensions = [".mmap", ".lbs"] if array_name == "array_spectra" else [".mmap"]
+            for extension_file in l_extensions:
+                if extension is not None and extension_file != extension:
+                    continue
+                if os.path.exists(path + extension_file):
+                    l_paths.append(path + extension_file)
+        return l_paths
+
+    def record_access(self, slice_index):
+        """This function records an access to a slice, and schedules the warming of the slice and
+        of its neighbours, from the closest in the direction of the navigation to the farthest.
+
+        Args:
+            slice_index (int): Index of the slice.
+        """
+        with self._lock:
+            self.dic_accesses[slice_index] = self.dic_accesses.get(slice_index, 0) + 1
+            direction = -1 if self._last_slice is not None and slice_index < self._last_slice else 1
+            self._last_slice = slice_index
+            if slice_index not in self.l_slices:
+                return
+            position = self.l_slices.index(slice_index)
+            l_positions = [position]
+            for distance in range(1, max(self.n_ahead, self.n_behind) + 1):
+                if distance <= self.n_ahead:
+                    l_positions.append(position + direction * distance)
+                if distance <= self.n_behind:
+                    l_positions.append(position - direction * distance)
+
+            time_now = time.time()
+            for position in l_positions:
+                if position < 0 or position >= len(self.l_slices):
+                    continue
+                index = self.l_slices[position]
+                if (
+                    index in self._set_pending
+                    or time_now - self._dic_last_warming.get(index, -np.inf) < self.min_interval
+                ):
+                    continue
+                self._set_pending.add(index)
+                self._queue.put(index)
+
+            # Start the worker in the current process (it's lost in a forked process)
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                threading.Thread(target=self.run_worker, daemon=True).start()
+
+    def run_worker(self):
+        """This function warms the scheduled slices, one at a time. It runs in a background thread,
+        the warming itself being done in the background class of the execution pool, such that it
+        never holds the event loop."""
+        while True:
+            slice_index = self._queue.get()
+            try:
+                return_execution_pool().run("background", self.warm_slice, slice_index)
+            except ExecutionQueueFull:
+                with self._lock:
+                    self.dic_statistics["skipped"] += 1
+            except Exception as e:
+                logging.warning("Slice " + str(slice_index) + " could not be warmed: " + str(e))
+            finally:
+                with self._lock:
+                    self._set_pending.discard(slice_index)
+
+    def warm_slice(self, slice_index):
+        """This function reads ahead the files of a slice, i.e. asks the kernel to load them in the
+        page cache asynchronously.
+
+        Args:
+            slice_index (int): Index of the slice.
+
+        Returns:
+            (int): The number of bytes requested.
+        """
+        if not hasattr(os, "posix_fadvise"):
+            return 0
+        n_bytes = 0
+        for path in self.return_slice_files(slice_index):
+            size = os.path.getsize(path)
+            if self.max_bytes_per_file is not None:
+                size = min(size, self.max_bytes_per_file)
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, size, os.POSIX_FADV_WILLNEED)
+            finally:
+                os.close(fd)
+            n_bytes += size
+        with self._lock:
+            self._dic_last_warming[slice_index] = time.time()
+            self.dic_statistics["warmings"] += 1
+            self.dic_statistics["warmed_bytes"] += n_bytes
+        logging.info("Slice " + str(slice_index) + " warmed (" + str(n_bytes // 1024**2) + "MB)")
+        return n_bytes
+
+    def return_residency(self, slice_index, extension=None):
+        """This function returns the page cache residency of the files of a slice.
+
+        Args:
+            slice_index (int): Index of the slice.
+            extension (str, optional): If not None, only the files with this extension (i.e.
+                ".mmap" or ".lbs") are taken into account. Defaults to None.
+
+        Returns:
+            (tuple(int)): The resident size and the total size of the files, in bytes. The resident
+                size is None if it can't be obtained.
+        """
+        resident_bytes = 0
+        size_bytes = 0
+        for path in self.return_slice_files(slice_index, extension=extension):
+            resident = return_file_residency(path)
+            if resident is None or resident_bytes is None:
+                resident_bytes = None
+            else:
+                resident_bytes += resident
+            size_bytes += os.path.getsize(path)
+        return resident_bytes, size_bytes
+
+    def return_metrics_lines(self):
+        """This function returns the accesses to the slices and the residency of their files in the
+        Prometheus text format. The residency is given separately for the memory maps and for the
+        compressed spectral files.
+
+        Returns:
+            (list(str)): The lines of the metrics.
+        """
+        with self._lock:
+            dic_accesses = dict(self.dic_accesses)
+            dic_statistics = dict(self.dic_statistics)
+        l_lines = []
+        for key in ["warmings", "warmed_bytes", "skipped"]:
+            metric = "lbae_prefetch_" + key + "_total"
+            l_lines.append("# TYPE " + metric + " counter")
+            l_lines.append(metric + " " + str(dic_statistics[key]))
+        l_lines.append("# TYPE lbae_prefetch_accesses_total counter")
+        for slice_index in sorted(dic_accesses):
+            l_lines.append(
+                'lbae_prefetch_accesses_total{slice="'
+                + str(slice_index)
+                + '"} '
+                + str(dic_accesses[slice_index])
+            )
+        l_lines_resident = ["# TYPE lbae_prefetch_resident_bytes gauge"]
+        l_lines_size = ["# TYPE lbae_prefetch_size_bytes gauge"]
+        for slice_index in self.l_slices:
+            for extension in [".mmap", ".lbs"]:
+                if len(self.return_slice_files(slice_index, extension=extension)) == 0:
+                    continue
+                resident_bytes, size_bytes = self.return_residency(slice_index, extension=extension)
+                label = '{slice="' + str(slice_index) + '",format="' + extension[1:] + '"} '
+                if resident_bytes is not None:
+                    l_lines_resident.append(
+                        "lbae_prefetch_resident_bytes" + label + str(resident_bytes)
+                    )
+                l_lines_size.append("lbae_prefetch_size_bytes" + label + str(size_bytes))
+        return l_lines + l_lines_resident + l_lines_size
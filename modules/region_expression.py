@@ -0,0 +1,401 @@
+# Copyright (c) 2022, Colas Droin. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
+
+""" This class is used to precompute and query the average expression of each lipid, in each brain
+region, for each slice. The result is stored as a compact columnar file, such that clustergrams can
+be obtained by slicing it instead of reloading all masks and spectra from the shelve database."""
+
+# ==================================================================================================
+# --- Imports
+# ==================================================================================================
+
+# Standard modules
+import logging
+import os
+import uuid
+import numpy as np
+import pandas as pd
+
+# LBAE imports
+from modules.tools.spectra import compute_avg_intensity_per_lipid, global_lipid_index_store
+from modules.tools.misc import logmem, file_lock
+
+# ==================================================================================================
+# --- Class
+# ==================================================================================================
+
+
+class RegionLipidExpression:
+    """Class used to build, incrementally update and query a sparse (slice x region x lipid) tensor
+    of average lipid expression. Only the non-empty entries of the tensor are recorded, in a long
+    (columnar) format, i.e. one column per axis and one column for the values. A second table keeps
+    track of the (slice, region) pairs that have already been processed, so that only missing pairs
+    are computed when the tensor is updated.
+
+    Attributes:
+        data (MaldiData): Used to manipulate the raw MALDI data.
+        atlas (Atlas): Used to access the precomputed masks and spectra.
+        path_tensor (str): Path of the npz file in which the tensor is stored.
+        l_regions (list(str)): List of region acronyms, defining the region axis of the tensor.
+        array_slice (np.ndarray): Slice index (starting at 1) of each non-empty entry.
+        array_region (np.ndarray): Region index (in l_regions) of each non-empty entry.
+        array_lipid (np.ndarray): Lipid index of each non-empty entry.
+        array_value (np.ndarray): Average lipid expression of each non-empty entry.
+        set_computed (set(tuple)): Set of (slice_index, region acronym) pairs already processed.
+
+    Methods:
+        __init__(maldi_data, atlas, path_tensor): Initialize the RegionLipidExpression class.
+        read_tensor(): Read the tensor from disk, if it exists.
+        load(): Load the tensor from disk, if it exists.
+        merge_tensor(l_slice_indices_invalidated=None): Add the entries saved by another process.
+        save(l_slice_indices_invalidated=None): Merge the entries saved by other processes and
+            save the tensor on disk.
+        return_missing_pairs(l_slice_indices=None): Return the (slice, region) pairs that have not
+            been processed yet.
+        is_complete(): Return True if all existing (slice, region) pairs have been processed.
+        update(l_slice_indices=None, set_progress=None): Compute the missing entries of the tensor.
+        invalidate(l_slice_indices): Remove all entries of the tensor for the given slices.
+        compute_df_avg_lipids(l_selected_regions, l_slices): Return the dataframe of average lipid
+            expression per region, averaged across the requested slices.
+    """
+
+    __slots__ = [
+        "data",
+        "atlas",
+        "path_tensor",
+        "l_regions",
+        "_dic_region_index",
+        "array_slice",
+        "array_region",
+        "array_lipid",
+        "array_value",
+        "set_computed",
+    ]
+
+    # ==============================================================================================
+    # --- Constructor
+    # ==============================================================================================
+
+    def __init__(self, maldi_data, atlas, path_tensor="data/app_data/region_lipid_expression.npz"):
+        """Initialize the class RegionLipidExpression.
+
+        Args:
+            maldi_data (MaldiData): MaldiData object, used to manipulate the raw MALDI data.
+            atlas (Atlas): Atlas object, used to access the precomputed masks and spectra.
+            path_tensor (str, optional): Path of the npz file in which the tensor is stored.
+                Defaults to "data/app_data/region_lipid_expression.npz".
+        """
+        logging.info("Initializing RegionLipidExpression object" + logmem())
+
+        self.data = maldi_data
+        self.atlas = atlas
+        self.path_tensor = path_tensor
+
+        # Region axis is the (sorted) list of all acronyms
+        self.l_regions = sorted(self.atlas.dic_acronym_name.keys())
+        self._dic_region_index = {region: idx for idx, region in enumerate(self.l_regions)}
+
+        # Start from an empty tensor, and fill it from disk if possible
+        self.array_slice = np.zeros((0,), dtype=np.int16)
+        self.array_region = np.zeros((0,), dtype=np.int32)
+        self.array_lipid = np.zeros((0,), dtype=np.int32)
+        self.array_value = np.zeros((0,), dtype=np.float32)
+        self.set_computed = set([])
+        self.load()
+
+        logging.info("RegionLipidExpression object instantiated" + logmem())
+
+    # ==============================================================================================
+    # --- Methods
+    # ==============================================================================================
+
+    def read_tensor(self):
+        """This function reads the tensor from disk. The region axis is remapped onto the current
+        list of regions, in case the hierarchy has changed since the file was written.
+
+        Returns:
+            (tuple): The arrays of slice indices, region indices, lipid indices and values of the
+                non-empty entries, and the set of (slice_index, region acronym) pairs already
+                processed, or None if the file doesn't exist.
+        """
+        if not os.path.exists(self.path_tensor):
+            return None
+
+        with np.load(self.path_tensor, allow_pickle=False) as handle:
+            l_regions_file = handle["array_regions"].tolist()
+            array_region_file = handle["array_region"]
+            array_computed_slice = handle["array_computed_slice"]
+            array_computed_region = handle["array_computed_region"]
+
+            # Remap region indices onto the current region axis, dropping unknown regions
+            array_remap = np.array(
+                [self._dic_region_index.get(region, -1) for region in l_regions_file],
+                dtype=np.int32,
+            )
+            array_region = (
+                array_remap[array_region_file]
+                if len(array_region_file) > 0
+                else np.zeros((0,), dtype=np.int32)
+            )
+            array_kept = array_region >= 0
+            array_slice = handle["array_slice"][array_kept]
+            array_region = array_region[array_kept]
+            array_lipid = handle["array_lipid"][array_kept]
+            array_value = handle["array_value"][array_kept]
+
+        set_computed = set(
+            (int(slice_index), l_regions_file[idx_region])
+            for slice_index, idx_region in zip(array_computed_slice, array_computed_region)
+            if l_regions_file[idx_region] in self._dic_region_index
+        )
+        return array_slice, array_region, array_lipid, array_value, set_computed
+
+    def load(self):
+        """This function loads the tensor from disk, if it exists."""
+        t_tensor = self.read_tensor()
+        if t_tensor is None:
+            logging.info("No region x lipid expression tensor found at " + self.path_tensor)
+            return
+
+        (
+            self.array_slice,
+            self.array_region,
+            self.array_lipid,
+            self.array_value,
+            self.set_computed,
+        ) = t_tensor
+        logging.info(
+            "Region x lipid expression tensor loaded with "
+            + str(len(self.array_value))
+            + " entries"
+            + logmem()
+        )
+
+    def merge_tensor(self, l_slice_indices_invalidated=None):
+        """This function adds to the tensor the (slice, region) pairs that have been processed and
+        saved by another process (e.g. another worker, or a long callback) since the tensor was
+        loaded. Must be called with the lock of the file held.
+
+        Args:
+            l_slice_indices_invalidated (list(int), optional): List of slice indices (starting at 1)
+                whose entries on disk must not be merged, as they have been invalidated. Defaults to
+                None.
+        """
+        t_tensor = self.read_tensor()
+        if t_tensor is None:
+            return
+        array_slice, array_region, array_lipid, array_value, set_computed = t_tensor
+        if l_slice_indices_invalidated is None:
+            l_slice_indices_invalidated = []
+        set_new = set(
+            x
+            for x in set_computed - self.set_computed
+            if x[0] not in l_slice_indices_invalidated
+        )
+        if len(set_new) == 0:
+            return
+
+        # Encode the (slice, region) pairs as integers to select the new entries at once
+        n_regions = len(self.l_regions)
+        array_new = np.array(
+            [x[0] * n_regions + self._dic_region_index[x[1]] for x in set_new], dtype=np.int64
+        )
+        array_kept = np.isin(array_slice.astype(np.int64) * n_regions + array_region, array_new)
+        self.array_slice = np.concatenate((self.array_slice, array_slice[array_kept]))
+        self.array_region = np.concatenate((self.array_region, array_region[array_kept]))
+        self.array_lipid = np.concatenate((self.array_lipid, array_lipid[array_kept]))
+        self.array_value = np.concatenate((self.array_value, array_value[array_kept]))
+        self.set_computed |= set_new
+        logging.info(
+            str(len(set_new)) + " (slice, region) pairs saved by another process have been merged"
+        )
+
+    def save(self, l_slice_indices_invalidated=None):
+        """This function saves the tensor on disk. As several processes may update the tensor, the
+        file is locked while the entries saved by the other processes are merged in and the tensor
+        is written. The file is first written under a temporary name, unique to the writer, and
+        then moved, such that a partially written file is never read.
+
+        Args:
+            l_slice_indices_invalidated (list(int), optional): List of slice indices (starting at 1)
+                whose entries on disk must be discarded rather than merged. Defaults to None.
+        """
+        os.makedirs(os.path.dirname(self.path_tensor) or ".", exist_ok=True)
+        path_temp = (
+            self.path_tensor + "." + str(os.getpid()) + "." + uuid.uuid4().hex + ".tmp.npz"
+        )
+        with file_lock(self.path_tensor + ".lock"):
+            self.merge_tensor(l_slice_indices_invalidated)
+            l_computed = sorted(self.set_computed)
+            try:
+                np.savez_compressed(
+                    path_temp,
+                    array_regions=np.array(self.l_regions, dtype=str),
+                    array_slice=self.array_slice,
+                    array_region=self.array_region,
+                    array_lipid=self.array_lipid,
+                    array_value=self.array_value,
+                    array_computed_slice=np.array([x[0] for x in l_computed], dtype=np.int16),
+                    array_computed_region=np.array(
+                        [self._dic_region_index[x[1]] for x in l_computed], dtype=np.int32
+                    ),
+                )
+                os.replace(path_temp, self.path_tensor)
+            finally:
+                if os.path.exists(path_temp):
+                    os.remove(path_temp)
+
+    def return_missing_pairs(self, l_slice_indices=None):
+        """This function returns the (slice, region) pairs for which a mask exists in the atlas, but
+        which have not been processed yet.
+
+        Args:
+            l_slice_indices (list(int), optional): List of slice indices (starting at 1) to inspect.
+                If None, all slices are inspected. Defaults to None.
+
+        Returns:
+            (list(tuple)): A list of (slice_index, region acronym) pairs.
+        """
+        if l_slice_indices is None:
+            l_slice_indices = self.data.get_slice_list(indices="all")
+
+        l_missing_pairs = []
+        for slice_index in l_slice_indices:
+            # Masks are indexed from 0 in the atlas
+            for region in sorted(self.atlas.dic_existing_masks.get(slice_index - 1, [])):
+                if region in self._dic_region_index and (slice_index, region) not in self.set_computed:
+                    l_missing_pairs.append((slice_index, region))
+        return l_missing_pairs
+
+    def is_complete(self):
+        """This function checks whether all existing (slice, region) pairs have been processed.
+
+        Returns:
+            (bool): True if the tensor does not need to be updated.
+        """
+        return len(self.return_missing_pairs()) == 0
+
+    def update(self, l_slice_indices=None, set_progress=None):
+        """This function computes the entries of the tensor for all the (slice, region) pairs that
+        have not been processed yet, and saves the tensor on disk after each slice.
+
+        Args:
+            l_slice_indices (list(int), optional): List of slice indices (starting at 1) to update.
+                If None, all slices are updated. Defaults to None.
+            set_progress: Used as part of the Plotly long callbacks, to indicate the progress of the
+                computation in the corresponding progress bar. Defaults to None.
+        """
+        l_missing_pairs = self.return_missing_pairs(l_slice_indices)
+        if len(l_missing_pairs) == 0:
+            return
+
+        logging.info(
+            "Computing " + str(len(l_missing_pairs)) + " missing region x lipid entries" + logmem()
+        )
+
+        # Group missing pairs per slice, as lipid labels are defined per slice
+        dic_missing_regions = {}
+        for slice_index, region in l_missing_pairs:
+            dic_missing_regions.setdefault(slice_index, []).append(region)
+
+        for idx, (slice_index, l_regions) in enumerate(sorted(dic_missing_regions.items())):
+            if set_progress is not None:
+                set_progress(
+                    (
+                        int(idx / len(dic_missing_regions) * 100),
+                        "Processing slice n°" + str(slice_index),
+                    )
+                )
+
+            # Load the MAIA-corrected average spectrum of each region
+            l_spectra = [
+                self.atlas.get_projected_mask_and_spectrum(
+                    slice_index - 1, self.atlas.dic_acronym_name[region], MAIA_correction=True
+                )[1]
+                for region in l_regions
+            ]
+
+            # Average the intensity of the peaks of each lipid
+            ll_idx_labels = global_lipid_index_store(self.data, slice_index - 1, l_spectra)
+            l_slice, l_region, l_lipid, l_value = [], [], [], []
+            for region, spectrum, l_idx_labels in zip(l_regions, l_spectra, ll_idx_labels):
+                if spectrum is not None:
+                    l_lipids_idx, l_avg_intensity = compute_avg_intensity_per_lipid(
+                        np.array(spectrum, dtype=np.float32)[1, :],
+                        np.array(l_idx_labels, dtype=np.int32),
+                    )
+                    l_slice.extend([slice_index] * len(l_lipids_idx))
+                    l_region.extend([self._dic_region_index[region]] * len(l_lipids_idx))
+                    l_lipid.extend(l_lipids_idx)
+                    l_value.extend(l_avg_intensity)
+                self.set_computed.add((slice_index, region))
+
+            # Append the new entries to the columns
+            self.array_slice = np.concatenate(
+                (self.array_slice, np.array(l_slice, dtype=np.int16))
+            )
+            self.array_region = np.concatenate(
+                (self.array_region, np.array(l_region, dtype=np.int32))
+            )
+            self.array_lipid = np.concatenate(
+                (self.array_lipid, np.array(l_lipid, dtype=np.int32))
+            )
+            self.array_value = np.concatenate(
+                (self.array_value, np.array(l_value, dtype=np.float32))
+            )
+
+            # Save after every slice so that the computation can be resumed
+            self.save()
+
+        logging.info("Region x lipid expression tensor updated" + logmem())
+
+    def invalidate(self, l_slice_indices):
+        """This function removes all the entries of the tensor for the given slices, e.g. after the
+        data or the annotations of these slices have changed. The entries will be recomputed at the
+        next update.
+
+        Args:
+            l_slice_indices (list(int)): List of slice indices (starting at 1) to invalidate.
+        """
+        array_kept = ~np.isin(self.array_slice, l_slice_indices)
+        self.array_slice = self.array_slice[array_kept]
+        self.array_region = self.array_region[array_kept]
+        self.array_lipid = self.array_lipid[array_kept]
+        self.array_value = self.array_value[array_kept]
+        self.set_computed = set(x for x in self.set_computed if x[0] not in l_slice_indices)
+        self.save(l_slice_indices_invalidated=l_slice_indices)
+
+    def compute_df_avg_lipids(self, l_selected_regions, l_slices):
+        """This function slices the tensor to return the average expression of each lipid in each
+        selected region, averaged across the requested slices. For a given region, the average is
+        only computed over the slices in which the lipid has been detected in this region, and is
+        set to 0 if the lipid has never been detected in this region.
+
+        Args:
+            l_selected_regions (list(str)): List of region acronyms.
+            l_slices (list(int)): List of slice indices (starting at 1) to average over.
+
+        Returns:
+            (pd.DataFrame): A dataframe whose index contains the lipid indices, and whose columns
+                correspond to the selected regions.
+        """
+        l_idx_regions = [self._dic_region_index[region] for region in l_selected_regions]
+        array_kept = np.isin(self.array_region, l_idx_regions) & np.isin(
+            self.array_slice, l_slices
+        )
+        df = pd.DataFrame(
+            {
+                "lipid": self.array_lipid[array_kept],
+                "region": self.array_region[array_kept],
+                "value": self.array_value[array_kept],
+            }
+        )
+
+        # Average across slices, and reorder the columns as requested
+        df_avg_intensity_lipids = df.pivot_table(
+            index="lipid", columns="region", values="value", aggfunc="mean"
+        ).reindex(columns=l_idx_regions)
+        df_avg_intensity_lipids = df_avg_intensity_lipids.fillna(0)
+        df_avg_intensity_lipids.columns = list(l_selected_regions)
+        df_avg_intensity_lipids.index.name = None
+        return df_avg_intensity_lipids
@@ -1,7 +1,7 @@
 # Copyright (c) 2022, Colas Droin. All rights reserved.
 # Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
 
-""" This class is used to compare the data coming from acquisitions (MALDI), and the molecular atlas 
+""" This class is used to compare the data coming from acquisitions (MALDI), and the molecular atlas
 data (scRNAseq). See https://molecularatlas.org/ for more information."""
 
 # ==================================================================================================
@@ -11,6 +11,9 @@ data (scRNAseq). See https://molecularatlas.org/ for more information."""
 # Standard modules
 import numpy as np
 import logging
+import os
+import threading
+import psutil
 
 # LBAE imports
 from modules.tools.misc import logmem
@@ -23,15 +26,19 @@ from modules.tools.misc import logmem
 
 class ScRNAseq:
     """Class used to compare the data coming from acquisitions (MALDI), and the molecular atlas
-    data (scRNAseq).
+    data (scRNAseq). The data is loaded lazily: nothing is read from disk when the object is
+    instantiated, and each array is only materialized (as a read-only memory-map) the first time it
+    is accessed. The normalized gene expression arrays are computed once and stored on disk, such
+    that they can be memory-mapped as well. All materialized arrays can be released at any time
+    with evict(), and are automatically released when the system is under memory pressure.
 
         Attributes:
             array_exp_lipids_brain_1 (np.ndarray): Matrix of lipids expression for brain 1, whose
                 rows correspond to acquired spots and columns to lipids.
             array_exp_lipids_brain_2 (np.ndarray): Same as for array_exp_lipids_brain_1, but with
                 the data from brain 2.
-            array_exp_genes_brain_1 (np.ndarray): Matrix of genes expression for brain 1, whose rows
-                correspond to acquired spots and columns to genes.
+            array_exp_genes_brain_1 (np.ndarray): Matrix of (normalized) genes expression for brain
+                1, whose rows correspond to acquired spots and columns to genes.
             array_exp_genes_brain_2 (np.ndarray): Same as for array_exp_genes_brain_1, but with
                 the data from brain 2.
             l_name_lipids_brain_1 (list(str)): List of lipids names for brain 1.
@@ -53,70 +60,219 @@ class ScRNAseq:
             ymol (np.ndarray): Array of y coordinates of the acquired spots.
             zmol (np.ndarray): Array of z coordinates of the acquired spots.
 
+            path_scRNAseq (str): Path of the scRNAseq data.
+            path_normalized (str): Path of the folder in which the normalized gene expression arrays
+                are stored.
+            percentile (int): The percentile used to normalize the gene expression values.
+            memory_threshold (float): Percentage of used system memory above which the materialized
+                arrays are evicted.
+            _dic_data (dict): Dictionnary of materialized arrays and lists, indexed by attribute
+                name.
+            _lock (threading.Lock): Lock used to materialize the data from a single thread at a
+                time.
+
         Methods:
-            __init__(path_scRNAseq="data/scRNAseq/"): Initialize the scRNAseq class.
+            __init__(path_scRNAseq="data/scRNAseq/", percentile=75, memory_threshold=90):
+                Initialize the scRNAseq class.
+            normalize_gene_expression_values(): Compute and store on disk the normalized gene
+                expression arrays, if needed.
+            return_data(): Return the requested array or list, materializing it if needed.
+            evict(): Release all the materialized arrays and lists.
+            evict_if_memory_pressure(): Release all the materialized arrays and lists if the system
+                is under memory pressure.
+            is_materialized(): Return True if the requested array or list is currently in memory.
     """
 
+    # Name of the file and post-processing of each lazily loaded attribute. Brain 1 corresponds to
+    # the "True" suffix in the files, brain 2 to the "False" suffix.
+    dic_attributes = {
+        "array_exp_lipids_brain_1": ("array_exp_lipids_True.npy", "array"),
+        "l_name_lipids_brain_1": ("array_name_lipids_True.npy", "list"),
+        "array_exp_genes_brain_1": ("array_exp_genes_True.npy", "normalized"),
+        "l_genes_brain_1": ("array_name_genes_True.npy", "list"),
+        "array_coef_brain_1": ("array_coef_True.npy", "array"),
+        "l_score_brain_1": ("array_score_True.npy", "list"),
+        "array_exp_lipids_brain_2": ("array_exp_lipids_False.npy", "array"),
+        "l_name_lipids_brain_2": ("array_name_lipids_False.npy", "list"),
+        "array_exp_genes_brain_2": ("array_exp_genes_False.npy", "normalized"),
+        "l_genes_brain_2": ("array_name_genes_False.npy", "list"),
+        "array_coef_brain_2": ("array_coef_False.npy", "array"),
+        "l_score_brain_2": ("array_score_False.npy", "list"),
+        "xmol": ("array_coordinates.npy", "coordinate_0"),
+        "ymol": ("array_coordinates.npy", "coordinate_1"),
+        "zmol": ("array_coordinates.npy", "coordinate_2"),
+    }
+
     # ==============================================================================================
     # --- Constructor
     # ==============================================================================================
 
-    def __init__(self, path_scRNAseq="data/scRNAseq/"):
-        """Initialize the class ScRNAseq.
+    def __init__(self, path_scRNAseq="data/scRNAseq/", percentile=75, memory_threshold=90):
+        """Initialize the class ScRNAseq. No data is read at this stage.
 
         Args:
             path_scRNAseq (str): Path of the scRNAseq data.
+            percentile (int, optional): The percentile used to normalize the gene expression values.
+                Defaults to 75.
+            memory_threshold (float, optional): Percentage of used system memory above which the
+                materialized arrays are evicted before new data is loaded. Defaults to 90.
         """
 
         logging.info("Initializing ScRNAseq object" + logmem())
 
-        # Load the array of lipids and genes and corresponding names for brain 1
-        self.array_exp_lipids_brain_1 = np.load(path_scRNAseq + "array_exp_lipids_True.npy")
-        self.l_name_lipids_brain_1 = np.load(path_scRNAseq + "array_name_lipids_True.npy").tolist()
-        self.array_exp_genes_brain_1 = np.load(path_scRNAseq + "array_exp_genes_True.npy")
-        self.l_genes_brain_1 = np.load(path_scRNAseq + "array_name_genes_True.npy").tolist()
-        self.array_coef_brain_1 = np.load(path_scRNAseq + "array_coef_True.npy")
-        self.l_score_brain_1 = np.load(path_scRNAseq + "array_score_True.npy").tolist()
+        self.path_scRNAseq = path_scRNAseq
+        self.path_normalized = path_scRNAseq + "normalized/"
+        self.percentile = percentile
+        self.memory_threshold = memory_threshold
+        self._dic_data = {}
+        self._lock = threading.Lock()
 
-        # Same for brain 2
-        self.array_exp_lipids_brain_2 = np.load(path_scRNAseq + "array_exp_lipids_False.npy")
-        self.l_name_lipids_brain_2 = np.load(path_scRNAseq + "array_name_lipids_False.npy").tolist()
-        self.array_exp_genes_brain_2 = np.load(path_scRNAseq + "array_exp_genes_False.npy")
-        self.l_genes_brain_2 = np.load(path_scRNAseq + "array_name_genes_False.npy").tolist()
-        self.array_coef_brain_2 = np.load(path_scRNAseq + "array_coef_False.npy")
-        self.l_score_brain_2 = np.load(path_scRNAseq + "array_score_False.npy").tolist()
+        logging.info("ScRNAseq object instantiated (data will be loaded on first access)" + logmem())
 
-        # Load the array of coordinates
-        self.xmol, self.ymol, self.zmol = np.load(path_scRNAseq + "array_coordinates.npy")
+    # ==============================================================================================
+    # --- Lazy attributes
+    # ==============================================================================================
 
-        # Normalize gene expression values
-        self.normalize_gene_expression_values()
+    def __getattr__(self, name):
+        """Materialize the lazily loaded attributes on first access. This method is only called
+        when the attribute could not be found through the usual mechanism.
 
-        logging.info("ScRNAseq object instantiated" + logmem())
+        Args:
+            name (str): Name of the requested attribute.
+
+        Returns:
+            (np.ndarray or list): The requested array or list.
+        """
+        if name in ScRNAseq.dic_attributes:
+            return self.return_data(name)
+        raise AttributeError("'ScRNAseq' object has no attribute '" + name + "'")
 
     # ==============================================================================================
     # --- Methods
     # ==============================================================================================
 
-    def normalize_gene_expression_values(self, percentile=75):
-        """Normalize inplace the gene expression values according to the provided percentile."""
+    def normalize_gene_expression_values(self, brain_1, force_update=False):
+        """Normalize the gene expression values according to self.percentile, clip them above 255,
+        and store the result on disk, such that it can be memory-mapped. The computation is only
+        done if the normalized array doesn't exist yet, or is older than the raw data.
+
+        Args:
+            brain_1 (bool): If True, the data from the first brain is normalized. Else, from the 2nd
+                brain.
+            force_update (bool, optional): If True, the normalized array is recomputed even if it
+                already exists. Defaults to False.
+
+        Returns:
+            (str): The path of the normalized gene expression array.
+        """
+        path_raw = self.path_scRNAseq + "array_exp_genes_" + str(brain_1) + ".npy"
+        path_normalized = (
+            self.path_normalized
+            + "array_exp_genes_"
+            + str(brain_1)
+            + "_"
+            + str(self.percentile)
+            + ".npy"
+        )
+        if (
+            not force_update
+            and os.path.exists(path_normalized)
+            and os.path.getmtime(path_normalized) >= os.path.getmtime(path_raw)
+        ):
+            return path_normalized
 
         logging.info("Normalizing gene expression values" + logmem())
 
         # Normalize the gene expression values
-        self.array_exp_genes_brain_1 = (
-            self.array_exp_genes_brain_1
-            / np.percentile(self.array_exp_genes_brain_1, percentile)
-            * 255
-        )
-        self.array_exp_genes_brain_2 = (
-            self.array_exp_genes_brain_2
-            / np.percentile(self.array_exp_genes_brain_2, percentile)
-            * 255
-        )
+        array_exp_genes = np.load(path_raw, mmap_mode="r")
+        array_exp_genes = array_exp_genes / np.percentile(array_exp_genes, self.percentile) * 255
 
         # Clip the gene expression values above 255
-        self.array_exp_genes_brain_1[self.array_exp_genes_brain_1 > 255] = 255
-        self.array_exp_genes_brain_2[self.array_exp_genes_brain_2 > 255] = 255
+        array_exp_genes[array_exp_genes > 255] = 255
+
+        # Write under a temporary name first to never expose a partially written file
+        if not os.path.exists(self.path_normalized):
+            os.makedirs(self.path_normalized)
+        path_temp = path_normalized[:-4] + "_temp.npy"
+        np.save(path_temp, array_exp_genes)
+        os.replace(path_temp, path_normalized)
 
         logging.info("Gene expression values normalized" + logmem())
+        return path_normalized
+
+    def return_data(self, name):
+        """Return the requested array or list, materializing it from disk if needed. Arrays are
+        memory-mapped in read-only mode, such that only the pages actually used are loaded in
+        memory.
+
+        Args:
+            name (str): Name of the requested attribute (see dic_attributes).
+
+        Returns:
+            (np.ndarray or list): The requested array or list.
+        """
+        # Fast path, without locking
+        data = self._dic_data.get(name)
+        if data is not None:
+            return data
+
+        with self._lock:
+            if name not in self._dic_data:
+                self.evict_if_memory_pressure(locked=True)
+                filename, type_data = ScRNAseq.dic_attributes[name]
+                logging.info("Materializing scRNAseq attribute " + name + logmem())
+                if type_data == "list":
+                    self._dic_data[name] = np.load(self.path_scRNAseq + filename).tolist()
+                elif type_data == "normalized":
+                    path_normalized = self.normalize_gene_expression_values(
+                        brain_1=name.endswith("brain_1")
+                    )
+                    self._dic_data[name] = np.load(path_normalized, mmap_mode="r")
+                elif type_data.startswith("coordinate"):
+                    array_coordinates = np.load(self.path_scRNAseq + filename, mmap_mode="r")
+                    self._dic_data[name] = array_coordinates[int(type_data.split("_")[1])]
+                else:
+                    self._dic_data[name] = np.load(self.path_scRNAseq + filename, mmap_mode="r")
+            return self._dic_data[name]
+
+    def evict(self, locked=False):
+        """Release all the materialized arrays and lists. They will be reloaded on next access.
+
+        Args:
+            locked (bool, optional): Must be True if the caller already holds self._lock. Defaults
+                to False.
+        """
+        if locked:
+            self._dic_data.clear()
+        else:
+            with self._lock:
+                self._dic_data.clear()
+        logging.info("ScRNAseq data evicted" + logmem())
+
+    def evict_if_memory_pressure(self, locked=False):
+        """Release all the materialized arrays and lists if the percentage of used system memory is
+        above self.memory_threshold.
+
+        Args:
+            locked (bool, optional): Must be True if the caller already holds self._lock. Defaults
+                to False.
+
+        Returns:
+            (bool): True if the data has been evicted.
+        """
+        if len(self._dic_data) > 0 and psutil.virtual_memory().percent > self.memory_threshold:
+            logging.warning("Memory pressure detected, evicting scRNAseq data")
+            self.evict(locked=locked)
+            return True
+        return False
+
+    def is_materialized(self, name):
+        """Return True if the requested array or list is currently in memory.
+
+        Args:
+            name (str): Name of the requested attribute (see dic_attributes).
+
+        Returns:
+            (bool): True if the attribute has already been materialized.
+        """
+        return name in self._dic_data
@@ -0,0 +1,231 @@
+# Copyright (c) 2022, Colas Droin. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
+
+""" This class is used to keep the results computed for a given user session (e.g. the spectra of
+the regions selected in the region analysis page) on the server, such that the callbacks displaying
+or exporting them can read them by reference, instead of recomputing them or having the browser
+post them back. The results are indexed by the session id recorded in the dcc.Store "session-id",
+expire after a given time without being accessed, and are evicted (least recently used first) once
+the memory budget of the store is exceeded.
+
+The store is private to each process: a callback served by another worker, or run after the result
+has expired or been evicted, must recompute the result from its inputs.
+"""
+
+# ==================================================================================================
+# --- Imports
+# ==================================================================================================
+
+# Standard modules
+import logging
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+import numpy as np
+
+# ==================================================================================================
+# --- Class
+# ==================================================================================================
+
+
+class SessionStore:
+    """Class used to keep the results of each user session in memory, with a time to live and a
+    global memory budget.
+
+    Attributes:
+        memory_limit (int): Maximum size of the store, in bytes.
+        default_ttl (int): Time (in seconds) after which a result that has not been accessed
+            expires.
+        _dic_entries (OrderedDict): Results, indexed by (session id, reference), as (value, size,
+            ttl, expiration) tuples, from the least to the most recently used.
+        _size (int): Size of the store, in bytes.
+        _dic_statistics (dict): Hits, misses, evictions and expirations of the store.
+        _lock (threading.Lock): Lock protecting the store.
+
+    Methods:
+        __init__(memory_limit=2**28, default_ttl=1800): Initialize the SessionStore class.
+        return_size(value): Estimate the memory used by a value.
+        remove_entry(key): Remove an entry from the store.
+        purge_expired(): Remove the expired entries.
+        set(session_id, value, reference=None, ttl=None): Record a result and return its reference.
+        get(session_id, reference): Return a result.
+        delete(session_id, reference=None): Delete a result, or all the results of a session.
+        return_statistics(): Return the statistics of the store.
+        return_metrics_lines(): Return the statistics in the Prometheus text format.
+    """
+
+    def __init__(self, memory_limit=2**28, default_ttl=1800):
+        """Initialize the class SessionStore.
+
+        Args:
+            memory_limit (int, optional): Maximum size of the store, in bytes. Defaults to 256MB.
+            default_ttl (int, optional): Time (in seconds) after which a result that has not been
+                accessed expires. Defaults to 1800.
+        """
+        self.memory_limit = memory_limit
+        self.default_ttl = default_ttl
+        self._dic_entries = OrderedDict()
+        self._size = 0
+        self._dic_statistics = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+        self._lock = threading.Lock()
+
+    # ==============================================================================================
+    # --- Methods
+    # ==============================================================================================
+
+    def return_size(self, value):
+        """This function estimates the memory used by a value, counting the buffers of the numpy
+        arrays it contains.
+
+        Args:
+            value (object): The value, possibly made of nested dictionnaries, lists and tuples.
+
+        Returns:
+            (int): The estimated size, in bytes.
+        """
+        if isinstance(value, np.ndarray):
+            return value.nbytes
+        elif isinstance(value, dict):
+            return sys.getsizeof(value) + sum(
+                self.return_size(key) + self.return_size(x) for key, x in value.items()
+            )
+        elif isinstance(value, (list, tuple)):
+            return sys.getsizeof(value) + sum(self.return_size(x) for x in value)
+        return sys.getsizeof(value)
+
+    def remove_entry(self, key):
+        """This function removes an entry from the store, if present. Must be called with the lock
+        held.
+
+        Args:
+            key (tuple): Key of the entry, as (session id, reference).
+        """
+        entry = self._dic_entries.pop(key, None)
+        if entry is not None:
+            self._size -= entry[1]
+
+    def purge_expired(self):
+        """This function removes the expired entries from the store. Must be called with the lock
+        held."""
+        time_now = time.time()
+        for key in [key for key, entry in self._dic_entries.items() if entry[3] <= time_now]:
+            self.remove_entry(key)
+            self._dic_statistics["expirations"] += 1
+
+    def set(self, session_id, value, reference=None, ttl=None):
+        """This function records a result of a session, evicting the least recently used results
+        (of any session) if the memory budget is exceeded.
+
+        Args:
+            session_id (str): Id of the session.
+            value (object): The result. It must not be modified once recorded.
+            reference (str, optional): Reference of the result, to overwrite an existing result.
+                Defaults to None, in which case a new reference is created.
+            ttl (int, optional): Time (in seconds) after which the result expires if it is not
+                accessed. Defaults to None, corresponding to default_ttl.
+
+        Returns:
+            (str): The reference of the result, to be stored in the browser.
+        """
+        if reference is None:
+            reference = uuid.uuid4().hex
+        ttl = ttl if ttl is not None else self.default_ttl
+        size = self.return_size(value)
+        key = (session_id, reference)
+        with self._lock:
+            self.remove_entry(key)
+            self.purge_expired()
+            if size > self.memory_limit:
+                logging.warning(
+                    "A result of "
+                    + str(round(size / 1024**2))
+                    + "MB can't fit in the session store"
+                )
+                return reference
+            while self._size + size > self.memory_limit:
+                self.remove_entry(next(iter(self._dic_entries)))
+                self._dic_statistics["evictions"] += 1
+            self._dic_entries[key] = (value, size, ttl, time.time() + ttl)
+            self._size += size
+        return reference
+
+    def get(self, session_id, reference):
+        """This function returns a result of a session, and postpones its expiration.
+
+        Args:
+            session_id (str): Id of the session.
+            reference (str): Reference of the result, as returned by set().
+
+        Returns:
+            (object): The result, or None if it doesn't exist (anymore) in this process.
+        """
+        key = (session_id, reference)
+        with self._lock:
+            entry = self._dic_entries.get(key, None)
+            if entry is not None and entry[3] <= time.time():
+                self.remove_entry(key)
+                self._dic_statistics["expirations"] += 1
+                entry = None
+            if entry is None:
+                self._dic_statistics["misses"] += 1
+                return None
+            self._dic_entries[key] = entry[:3] + (time.time() + entry[2],)
+            self._dic_entries.move_to_end(key)
+            self._dic_statistics["hits"] += 1
+            return entry[0]
+
+    def delete(self, session_id, reference=None):
+        """This function deletes a result of a session, or all the results of the session.
+
+        Args:
+            session_id (str): Id of the session.
+            reference (str, optional): Reference of the result. Defaults to None, in which case
+                all the results of the session are deleted.
+        """
+        with self._lock:
+            if reference is not None:
+                self.remove_entry((session_id, reference))
+            else:
+                for key in [key for key in self._dic_entries if key[0] == session_id]:
+                    self.remove_entry(key)
+
+    def return_statistics(self):
+        """This function returns the statistics of the store.
+
+        Returns:
+            (dict): The number of hits, misses, evictions, expirations, entries and sessions, along
+                with the size (in bytes) of the store and its limit.
+        """
+        with self._lock:
+            self.purge_expired()
+            dic_statistics = dict(self._dic_statistics)
+            dic_statistics["entries"] = len(self._dic_entries)
+            dic_statistics["sessions"] = len(set(key[0] for key in self._dic_entries))
+            dic_statistics["size_bytes"] = self._size
+            dic_statistics["size_limit_bytes"] = self.memory_limit
+        return dic_statistics
+
+    def return_metrics_lines(self):
+        """This function returns the statistics of the store in the Prometheus text format.
+
+        Returns:
+            (list(str)): The lines of the metrics.
+        """
+        dic_statistics = self.return_statistics()
+        l_lines = []
+        for key, type_metric in [
+            ("hits", "counter"),
+            ("misses", "counter"),
+            ("evictions", "counter"),
+            ("expirations", "counter"),
+            ("entries", "gauge"),
+            ("sessions", "gauge"),
+            ("size_bytes", "gauge"),
+            ("size_limit_bytes", "gauge"),
+        ]:
+            metric = "lbae_session_store_" + key + ("_total" if type_metric == "counter" else "")
+            l_lines.append("# TYPE " + metric + " " + type_metric)
+            l_lines.append(metric + " " + str(dic_statistics[key]))
+        return l_lines
@@ -0,0 +1,247 @@
+# Copyright (c) 2022, Colas Droin. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
+
+""" This class is used to share the large read-only arrays of the app (e.g. the lightweight arrays
+of MaldiData, or the warped coordinates and projection correspondence of Atlas) between several
+processes, such as the workers of gunicorn. Each object is built only once, by the first process
+requesting it, and dumped as numpy (.npy) files in a shared folder. All the processes then attach
+the arrays as read-only memory maps, such that their memory is shared through the page cache
+instead of being duplicated in each worker.
+
+Objects are made of numpy arrays, possibly nested in dictionnaries, lists and tuples, along with
+scalars. The structure of each object is recorded in a JSON manifest, written once all the arrays
+have been dumped, such that a partially dumped object is never attached. The shared folder must be
+cleared (see SharedArrayStore.clear()) whenever the precomputed data is recomputed.
+"""
+
+# ==================================================================================================
+# --- Imports
+# ==================================================================================================
+
+# Standard modules
+import json
+import logging
+import os
+import shutil
+import numpy as np
+
+# LBAE imports
+from modules.tools.misc import file_lock, logmem
+
+# ==================================================================================================
+# --- Class
+# ==================================================================================================
+
+
+class SharedArrayStore:
+    """Class used to build large read-only objects once, and attach them as read-only memory maps
+    in every process.
+
+    Attributes:
+        path_shared (str): Path of the folder containing the shared objects.
+        enabled (bool): If False, the objects are simply computed and returned, without being
+            shared.
+
+    Methods:
+        __init__(path_shared, enabled=True): Initialize the SharedArrayStore class.
+        return_path(name): Return the path of the folder of a shared object.
+        encode(object, l_arrays): Encode an object into a JSON-serializable structure.
+        decode(structure, path_object): Rebuild an object from its structure, attaching its arrays.
+        check_shared_object(name, version=None): Check if an object has been shared.
+        dump_shared_object(name, object, version=None): Dump an object in the shared folder.
+        load_shared_object(name): Attach a shared object.
+        return_shared_object(name, compute_function, version=None, **compute_function_args):
+            Return a shared object, computing and dumping it first if needed.
+        clear(): Delete all the shared objects.
+    """
+
+    def __init__(self, path_shared, enabled=True):
+        """Initialize the class SharedArrayStore.
+
+        Args:
+            path_shared (str): Path of the folder containing the shared objects.
+            enabled (bool, optional): If False, the objects are simply computed and returned,
+                without being shared. Defaults to True.
+        """
+        self.path_shared = path_shared
+        self.enabled = enabled
+        if self.enabled:
+            os.makedirs(self.path_shared, exist_ok=True)
+
+    # ==============================================================================================
+    # --- Methods
+    # ==============================================================================================
+
+    def return_path(self, name):
+        """This function returns the path of the folder in which a shared object is dumped.
+
+        Args:
+            name (str): Name of the object, e.g. "atlas/array_coordinates_warped_data".
+
+        Returns:
+            (str): Path of the folder of the object.
+        """
+        return os.path.join(self.path_shared, name.replace("/", "__"))
+
+    def encode(self, object, l_arrays):
+        """This function encodes an object into a JSON-serializable structure, in which the arrays
+        are replaced by their index in l_arrays.
+
+        Args:
+            object (object): The object to encode, made of numpy arrays, dictionnaries, lists,
+                tuples and scalars.
+            l_arrays (list(np.ndarray)): List of arrays of the object. Updated inplace.
+
+        Returns:
+            (dict): The structure of the object.
+        """
+        if isinstance(object, np.ndarray):
+            if object.dtype.hasobject:
+                raise TypeError("Arrays of python objects can't be shared")
+            l_arrays.append(object)
+            return {"type": "array", "index": len(l_arrays) - 1}
+        elif isinstance(object, np.generic):
+            return {"type": "scalar", "dtype": object.dtype.str, "value": object.item()}
+        elif isinstance(object, dict):
+            return {
+                "type": "dict",
+                "items": [
+                    [self.encode(key, l_arrays), self.encode(value, l_arrays)]
+                    for key, value in object.items()
+                ],
+            }
+        elif isinstance(object, (list, tuple)):
+            return {
+                "type": "list" if isinstance(object, list) else "tuple",
+                "items": [self.encode(x, l_arrays) for x in object],
+            }
+        elif object is None or isinstance(object, (bool, int, float, str)):
+            return {"type": "value", "value": object}
+        raise TypeError("Objects of type " + type(object).__name__ + " can't be shared")
+
+    def decode(self, structure, path_object):
+        """This function rebuilds an object from its structure, attaching its arrays as read-only
+        memory maps.
+
+        Args:
+            structure (dict): The structure of the object, as returned by encode().
+            path_object (str): Path of the folder of the object.
+
+        Returns:
+            (object): The object.
+        """
+        if structure["type"] == "array":
+            return np.load(
+                os.path.join(path_object, str(structure["index"]) + ".npy"), mmap_mode="r"
+            )
+        elif structure["type"] == "scalar":
+            return np.dtype(structure["dtype"]).type(structure["value"])
+        elif structure["type"] == "dict":
+            return {
+                self.decode(key, path_object): self.decode(value, path_object)
+                for key, value in structure["items"]
+            }
+        elif structure["type"] in ["list", "tuple"]:
+            l_items = [self.decode(x, path_object) for x in structure["items"]]
+            return l_items if structure["type"] == "list" else tuple(l_items)
+        return structure["value"]
+
+    def check_shared_object(self, name, version=None):
+        """This function checks if an object has been completely dumped in the shared folder, with
+        the provided version.
+
+        Args:
+            name (str): Name of the object.
+            version (str, optional): Version of the object, e.g. the modification time of the file
+                it is computed from. Defaults to None.
+
+        Returns:
+            (bool): True if the object can be attached.
+        """
+        try:
+            with open(os.path.join(self.return_path(name), "manifest.json")) as handle:
+                return json.load(handle)["version"] == version
+        except FileNotFoundError:
+            return False
+
+    def dump_shared_object(self, name, object, version=None):
+        """This function dumps an object in the shared folder. The arrays are first dumped in a
+        temporary folder, which is then renamed, such that other processes never see a partially
+        dumped object. This function must be called with the lock of the object held.
+
+        Args:
+            name (str): Name of the object.
+            object (object): The object to dump.
+            version (str, optional): Version of the object. Defaults to None.
+        """
+        path_object = self.return_path(name)
+        path_temporary = path_object + ".tmp" + str(os.getpid())
+        shutil.rmtree(path_temporary, ignore_errors=True)
+        os.makedirs(path_temporary)
+
+        l_arrays = []
+        structure = self.encode(object, l_arrays)
+        for index, array in enumerate(l_arrays):
+            np.save(os.path.join(path_temporary, str(index) + ".npy"), np.ascontiguousarray(array))
+        with open(os.path.join(path_temporary, "manifest.json"), "w") as handle:
+            json.dump({"version": version, "structure": structure}, handle)
+
+        # Processes which already attached an outdated version keep their (unlinked) memory maps
+        shutil.rmtree(path_object, ignore_errors=True)
+        os.rename(path_temporary, path_object)
+        logging.info(
+            name + " has been dumped in the shared folder as " + str(len(l_arrays)) + " arrays"
+        )
+
+    def load_shared_object(self, name):
+        """This function attaches a shared object, its arrays being read-only memory maps.
+
+        Args:
+            name (str): Name of the object.
+
+        Returns:
+            (object): The object.
+        """
+        path_object = self.return_path(name)
+        with open(os.path.join(path_object, "manifest.json")) as handle:
+            structure = json.load(handle)["structure"]
+        return self.decode(structure, path_object)
+
+    def return_shared_object(self, name, compute_function, version=None, **compute_function_args):
+        """This function returns a shared object. If it has not been shared yet, it is computed
+        (by a single process at a time, the others waiting for it) and dumped in the shared folder.
+        In all cases, the returned object is the one attached from the shared folder, such that the
+        process which computed it doesn't keep a private copy.
+
+        Args:
+            name (str): Name of the object.
+            compute_function (func): The function computing the object.
+            version (str, optional): Version of the object. If the version of the shared object is
+                different, the object is recomputed. Defaults to None.
+            **compute_function_args: Arguments of compute_function.
+
+        Returns:
+            (object): The object, its arrays being read-only memory maps if the store is enabled.
+        """
+        if not self.enabled:
+            return compute_function(**compute_function_args)
+
+        if not self.check_shared_object(name, version):
+            with file_lock(self.return_path(name) + ".lock"):
+                # The object might have been dumped by another process in the meantime
+                if not self.check_shared_object(name, version):
+                    logging.info(name + " is not shared yet. Computing it now." + logmem())
+                    self.dump_shared_object(
+                        name, compute_function(**compute_function_args), version=version
+                    )
+
+        logging.info("Attaching " + name + " from the shared folder" + logmem())
+        return self.load_shared_object(name)
+
+    def clear(self):
+        """This function deletes all the shared objects. It must be called when the data they are
+        computed from has changed, and while no other process is using the store."""
+        if os.path.exists(self.path_shared):
+            shutil.rmtree(self.path_shared)
+        if self.enabled:
+            os.makedirs(self.path_shared, exist_ok=True)
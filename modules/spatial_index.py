@@ -0,0 +1,434 @@
+# Copyright (c) 2022, Colas Droin. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
+
+""" This class is used to compute the summed spectrum of a large hand-drawn region without
+concatenating and sorting the spectra of all its pixels. Each slice is split into square tiles of
+pixels, and the summed spectrum of each tile, binned on the same 1e-4 m/z grid as
+reduce_resolution_sorted_array_spectra(), is precomputed and shelved. The spectrum of a region is
+then obtained by merging the precomputed spectra of the tiles fully covered by the region with the
+spectra of the remaining (boundary) pixels, such that the cost of a selection grows with its
+perimeter rather than with its area.
+
+The indices are built at launch by the precomputation planner (see Launch.return_planner()), and
+loaded from the shelve database the first time a slice is queried. If the index of a slice hasn't
+been shelved yet, it can be built in the background. Until then, compute_spectrum() returns None
+and the caller falls back to compute_spectrum_per_row_selection().
+The index only contains raw intensities: selections requiring the MAIA correction must also use
+compute_spectrum_per_row_selection().
+"""
+
+# ==================================================================================================
+# --- Imports
+# ==================================================================================================
+
+# Standard modules
+import logging
+import threading
+from collections import OrderedDict
+import numpy as np
+
+# LBAE imports
+from modules.execution import return_execution_pool
+from modules.tools.misc import logmem
+
+# ==================================================================================================
+# --- Functions
+# ==================================================================================================
+
+
+def compute_selection_mask(list_index_bound_rows, list_index_bound_column_per_row, image_shape):
+    """This function turns a selection of rows (bounds in list_index_bound_rows) and corresponding
+    columns (bounds in list_index_bound_column_per_row), as returned by sample_rows_from_path(),
+    into a boolean mask of the selected pixels.
+
+    Args:
+        list_index_bound_rows (list(tuple)): A list of lower and upper indices delimiting the range
+            of rows belonging to the current selection.
+        list_index_bound_column_per_row (list(list)): For each row (outer list), provides the index
+            of the columns delimiting the current selection (inner list), zero-padded.
+        image_shape (int, int): A tuple of integers, indicating the vertical and horizontal sizes of
+            the current slice.
+
+    Returns:
+        (np.ndarray): A boolean array of shape image_shape, True for the selected pixels.
+    """
+    array_mask = np.zeros(image_shape, dtype=bool)
+    for i, x in enumerate(range(list_index_bound_rows[0], list_index_bound_rows[1] + 1)):
+        if x < 0 or x >= image_shape[0]:
+            continue
+        for j in range(0, len(list_index_bound_column_per_row[i]) - 1, 2):
+            column_1 = list_index_bound_column_per_row[i][j]
+            column_2 = list_index_bound_column_per_row[i][j + 1]
+            # Skip zero padding
+            if column_1 == 0 and column_2 == 0:
+                continue
+            array_mask[x, max(0, column_1) : max(0, column_2 + 1)] = True
+    return array_mask
+
+
+def return_pixels_peaks(array_spectra, array_lookup_pixels, array_pixels):
+    """This function returns the concatenated peaks of a set of pixels.
+
+    Args:
+        array_spectra (np.ndarray): An array of shape (2,n) containing spectrum data (m/z and
+            intensity) for each pixel.
+        array_lookup_pixels (np.ndarray): An array of shape (m,2) containing the boundary indices of
+            each pixel in array_spectra.
+        array_pixels (np.ndarray): The indices of the pixels, sorted.
+
+    Returns:
+        (np.ndarray): The m/z values of the peaks.
+        (np.ndarray): The intensities of the peaks.
+    """
+    array_bounds = array_lookup_pixels[array_pixels]
+    array_bounds = array_bounds[array_bounds[:, 0] >= 0].astype(np.int64)
+    array_lengths = array_bounds[:, 1] - array_bounds[:, 0] + 1
+    n_peaks = int(np.sum(array_lengths))
+    if n_peaks == 0:
+        return np.empty(0, dtype=np.float32), np.empty(0, dtype=np.float32)
+
+    # Indices of all the peaks, pixel after pixel
+    array_shifts = array_bounds[:, 0] - (np.cumsum(array_lengths) - array_lengths)
+    array_indices = np.repeat(array_shifts, array_lengths) + np.arange(n_peaks)
+    return array_spectra[0, array_indices], array_spectra[1, array_indices]
+
+
+def return_ranges(array_values, array_offsets, array_ranges):
+    """This function concatenates several ranges of an array, delimited by offsets.
+
+    Args:
+        array_values (np.ndarray): The array.
+        array_offsets (np.ndarray): The offsets of the ranges, followed by the size of the array.
+        array_ranges (np.ndarray): The indices of the ranges to concatenate.
+
+    Returns:
+        (np.ndarray): The concatenated ranges.
+    """
+    array_starts = array_offsets[array_ranges]
+    array_lengths = array_offsets[array_ranges + 1] - array_starts
+    n_values = int(np.sum(array_lengths))
+    array_shifts = array_starts - (np.cumsum(array_lengths) - array_lengths)
+    return array_values[np.repeat(array_shifts, array_lengths) + np.arange(n_values)]
+
+
+def reduce_binned_peaks(array_bins, array_intensities):
+    """This function sums the intensities of the peaks falling in the same m/z bin.
+
+    Args:
+        array_bins (np.ndarray): The m/z bin of each peak.
+        array_intensities (np.ndarray): The intensity of each peak.
+
+    Returns:
+        (np.ndarray): The sorted unique bins.
+        (np.ndarray): The summed intensity of each bin (float64).
+    """
+    if array_bins.shape[0] == 0:
+        return array_bins, np.empty(0, dtype=np.float64)
+
+    # The input is mostly made of sorted runs, which the stable sort (timsort) merges cheaply
+    array_order = np.argsort(array_bins, kind="stable")
+    array_bins = array_bins[array_order]
+    array_starts = np.concatenate(([0], np.flatnonzero(np.diff(array_bins)) + 1))
+    array_sums = np.add.reduceat(array_intensities[array_order].astype(np.float64), array_starts)
+    return array_bins[array_starts], array_sums
+
+
+# ==================================================================================================
+# --- Class
+# ==================================================================================================
+
+
+class SpectralTileIndex:
+    """Class used to precompute the summed spectra of square tiles of pixels, and use them to
+    compute the summed spectrum of large selections.
+
+    Attributes:
+        tile_size (int): Size (in pixels) of the side of the tiles.
+        resolution (float): Size of the m/z bins, identical to the one used by
+            compute_spectrum_per_row_selection().
+        max_slices_loaded (int): Maximum number of slice indices kept in memory.
+        _data (MaldiData): Used to access the spectral data.
+        _storage (Storage): Used to access the shelve database.
+        _dic_indices (OrderedDict): Indices loaded in memory, from the least to the most recently
+            used.
+        _set_building (set): Slices whose index is being built.
+        _lock (threading.Lock): Lock protecting the loaded indices.
+
+    Methods:
+        __init__(maldi_data, storage, tile_size=16, resolution=1e-4, max_slices_loaded=4):
+            Initialize the SpectralTileIndex class.
+        return_tile_index_name(slice_index): Return the name of the shelved index of a slice.
+        check_tile_index(slice_index): Check if the index of a slice has been shelved.
+        compute_tile_index(slice_index): Compute the summed spectrum of each tile of a slice.
+        build_tile_index(slice_index, force_update=False): Build and shelve the index of a slice.
+        return_tile_index(slice_index, build_missing=True): Return the index of a slice, or None if
+            it's not built yet.
+        compute_spectrum(slice_index, list_index_bound_rows, list_index_bound_column_per_row,
+            build_missing=True): Compute the summed spectrum of a selection.
+    """
+
+    def __init__(self, maldi_data, storage, tile_size=16, resolution=1e-4, max_slices_loaded=4):
+        """Initialize the class SpectralTileIndex.
+
+        Args:
+            maldi_data (MaldiData): MaldiData object, used to access the spectral data.
+            storage (Storage): Used to access the shelve database.
+            tile_size (int, optional): Size (in pixels) of the side of the tiles. Defaults to 16.
+            resolution (float, optional): Size of the m/z bins. Defaults to 1e-4.
+            max_slices_loaded (int, optional): Maximum number of slice indices kept in memory.
+                Defaults to 4.
+        """
+        self._data = maldi_data
+        self._storage = storage
+        self.tile_size = tile_size
+        self.resolution = resolution
+        self.max_slices_loaded = max_slices_loaded
+        self._dic_indices = OrderedDict()
+        self._set_building = set()
+        self._lock = threading.Lock()
+
+    # ==============================================================================================
+    # --- Methods
+    # ==============================================================================================
+
+    def return_tile_index_name(self, slice_index):
+        """This function returns the name of the shelved index of a slice.
+
+        Args:
+            slice_index (int): Index of the slice.
+
+        Returns:
+            (str): The name of the index in the folder figures/region_analysis/tile_indices of the
+                shelve database.
+        """
+        return "tile_index_" + str(slice_index) + "_" + str(self.tile_size)
+
+    def check_tile_index(self, slice_index):
+        """This function checks if the index of a slice has been shelved.
+
+        Args:
+            slice_index (int): Index of the slice.
+
+        Returns:
+            (bool): True if the index is in the shelve database.
+        """
+        return self._storage.check_shelved_object(
+            "figures/region_analysis/tile_indices", self.return_tile_index_name(slice_index)
+        )
+
+    def compute_tile_index(self, slice_index):
+        """This function computes the summed spectrum of each tile of a slice, binned on the m/z
+        grid.
+
+        Args:
+            slice_index (int): Index of the slice.
+
+        Returns:
+            (dict): The m/z bins and summed intensities of all the tiles, concatenated tile after
+                tile (tiles being ordered row by row), along with the offsets of each tile.
+        """
+        logging.info("Computing tile index for slice " + str(slice_index) + logmem())
+        height, width = self._data.get_image_shape(slice_index)
+        n_tiles_rows = -(-height // self.tile_size)
+        n_tiles_columns = -(-width // self.tile_size)
+        l_bins = []
+        l_intensities = []
+        array_offsets = np.zeros(n_tiles_rows * n_tiles_columns + 1, dtype=np.int64)
+        for idx_tile_row in range(n_tiles_rows):
+            row_1 = idx_tile_row * self.tile_size
+            row_2 = min(height, row_1 + self.tile_size) - 1
+            array_spectra, array_lookup_pixels = self._data.get_array_spectra_rows(
+                slice_index, row_1, row_2
+            )
+            for idx_tile_column in range(n_tiles_columns):
+                column_1 = idx_tile_column * self.tile_size
+                column_2 = min(width, column_1 + self.tile_size) - 1
+                array_pixels = (
+                    np.arange(row_1, row_2 + 1)[:, None] * width
+                    + np.arange(column_1, column_2 + 1)[None, :]
+                ).ravel()
+                array_mz, array_intensity = return_pixels_peaks(
+                    array_spectra, array_lookup_pixels, array_pixels
+                )
+                array_bins, array_sums = reduce_binned_peaks(
+                    np.floor(array_mz.astype(np.float64) / self.resolution).astype(np.int64),
+                    array_intensity,
+                )
+                idx_tile = idx_tile_row * n_tiles_columns + idx_tile_column
+                array_offsets[idx_tile + 1] = array_offsets[idx_tile] + array_bins.shape[0]
+                l_bins.append(array_bins.astype(np.int32))
+                l_intensities.append(array_sums.astype(np.float32))
+
+        logging.info(
+            "Tile index computed with " + str(array_offsets[-1]) + " binned peaks" + logmem()
+        )
+        return {
+            "tile_size": self.tile_size,
+            "resolution": self.resolution,
+            "array_offsets": array_offsets,
+            "array_bins": np.concatenate(l_bins),
+            "array_intensities": np.concatenate(l_intensities),
+        }
+
+    def build_tile_index(self, slice_index, force_update=False):
+        """This function builds the index of a slice (or loads it if it has already been shelved),
+        and keeps it in memory.
+
+        Args:
+            slice_index (int): Index of the slice.
+            force_update (bool, optional): If True, the index is recomputed even if it has already
+                been shelved. Defaults to False.
+        """
+        try:
+            dic_index = self._storage.return_shelved_object(
+                "figures/region_analysis/tile_indices",
+                self.return_tile_index_name(slice_index),
+                force_update=force_update,
+                compute_function=self.compute_tile_index,
+                ignore_arguments_naming=True,
+                slice_index=slice_index,
+            )
+            with self._lock:
+                self._dic_indices[slice_index] = dic_index
+                while len(self._dic_indices) > self.max_slices_loaded:
+                    self._dic_indices.popitem(last=False)
+        finally:
+            with self._lock:
+                self._set_building.discard(slice_index)
+
+    def return_tile_index(self, slice_index, build_missing=True):
+        """This function returns the index of a slice. If it's not in memory, it is loaded from the
+        shelve database if it has already been shelved. Else, it can be built in the background,
+        with the lowest priority of the execution pool.
+
+        Args:
+            slice_index (int): Index of the slice.
+            build_missing (bool, optional): If True, the index is built in the background if it
+                hasn't been shelved yet. It must be False in short-lived processes (e.g. the jobs
+                of the long callbacks), which would be terminated during the build. Defaults to
+                True.
+
+        Returns:
+            (dict): The index of the slice, or None if it's not available yet.
+        """
+        with self._lock:
+            if slice_index in self._dic_indices:
+                self._dic_indices.move_to_end(slice_index)
+                return self._dic_indices[slice_index]
+            if slice_index in self._set_building:
+                return None
+
+        # Load the index synchronously if it has already been shelved
+        if self.check_tile_index(slice_index):
+            self.build_tile_index(slice_index)
+            with self._lock:
+                return self._dic_indices.get(slice_index, None)
+
+        if not build_missing:
+            return None
+        with self._lock:
+            if slice_index in self._set_building:
+                return None
+            self._set_building.add(slice_index)
+
+        def build():
+            try:
+                return_execution_pool().run("background", self.build_tile_index, slice_index)
+            except Exception as e:
+                logging.warning("Tile index of slice " + str(slice_index) + " not built: " + str(e))
+                with self._lock:
+                    self._set_building.discard(slice_index)
+
+        threading.Thread(target=build, daemon=True).start()
+        return None
+
+    def compute_spectrum(
+        self,
+        slice_index,
+        list_index_bound_rows,
+        list_index_bound_column_per_row,
+        build_missing=True,
+    ):
+        """This function computes the summed spectrum of a selection, merging the precomputed
+        spectra of the tiles fully covered by the selection with the spectra of the other selected
+        pixels. The result has the same format as compute_spectrum_per_row_selection() (without
+        correction nor zero-padding).
+
+        Args:
+            slice_index (int): Index of the slice.
+            list_index_bound_rows (list(tuple)): A list of lower and upper indices delimiting the
+                range of rows belonging to the current selection.
+            list_index_bound_column_per_row (list(list)): For each row (outer list), provides the
+                index of the columns delimiting the current selection (inner list).
+            build_missing (bool, optional): If True, the index of the slice is built in the
+                background if it hasn't been shelved yet. Defaults to True.
+
+        Returns:
+            (np.ndarray): Spectrum summed over the selection, containing m/z values in the first
+                row, and intensities in the second row. None if the index of the slice is not
+                available yet.
+        """
+        dic_index = self.return_tile_index(slice_index, build_missing=build_missing)
+        if dic_index is None:
+            return None
+        image_shape = self._data.get_image_shape(slice_index)
+        height, width = image_shape
+        array_mask = compute_selection_mask(
+            list_index_bound_rows, list_index_bound_column_per_row, image_shape
+        )
+
+        # Count the selected pixels of each tile, and compare with the size of the tile
+        n_tiles_rows = -(-height // self.tile_size)
+        n_tiles_columns = -(-width // self.tile_size)
+        shape_padded = (n_tiles_rows * self.tile_size, n_tiles_columns * self.tile_size)
+        shape_tiles = (n_tiles_rows, self.tile_size, n_tiles_columns, self.tile_size)
+        array_mask_padded = np.zeros(shape_padded, dtype=bool)
+        array_mask_padded[:height, :width] = array_mask
+        array_valid_padded = np.zeros(shape_padded, dtype=bool)
+        array_valid_padded[:height, :width] = True
+        array_counts = array_mask_padded.reshape(shape_tiles).sum(axis=(1, 3))
+        array_sizes = array_valid_padded.reshape(shape_tiles).sum(axis=(1, 3))
+        array_full = (array_counts == array_sizes) & (array_counts > 0)
+
+        # Summed spectra of the fully covered tiles
+        array_full_tiles = np.flatnonzero(array_full.ravel())
+        array_bins_tiles = return_ranges(
+            dic_index["array_bins"], dic_index["array_offsets"], array_full_tiles
+        )
+        array_intensities_tiles = return_ranges(
+            dic_index["array_intensities"], dic_index["array_offsets"], array_full_tiles
+        )
+
+        # Peaks of the selected pixels in the other tiles
+        array_full_pixels = np.repeat(np.repeat(array_full, self.tile_size, 0), self.tile_size, 1)
+        array_boundary = np.flatnonzero((array_mask & ~array_full_pixels[:height, :width]).ravel())
+        if array_boundary.shape[0] > 0:
+            array_spectra, array_lookup_pixels = self._data.get_array_spectra_rows(
+                slice_index, array_boundary[0] // width, array_boundary[-1] // width
+            )
+            array_mz, array_intensity = return_pixels_peaks(
+                array_spectra, array_lookup_pixels, array_boundary
+            )
+        else:
+            array_mz, array_intensity = np.empty(0, dtype=np.float32), np.empty(0, np.float32)
+
+        logging.info(
+            "Merging "
+            + str(array_full_tiles.shape[0])
+            + " tiles with "
+            + str(array_boundary.shape[0])
+            + " boundary pixels"
+        )
+        array_bins, array_sums = reduce_binned_peaks(
+            np.concatenate(
+                (
+                    array_bins_tiles.astype(np.int64),
+                    np.floor(array_mz.astype(np.float64) / self.resolution).astype(np.int64),
+                )
+            ),
+            np.concatenate((array_intensities_tiles, array_intensity)),
+        )
+        array_spectra_selection = np.empty((2, array_bins.shape[0]), dtype=np.float32)
+        array_spectra_selection[0] = array_bins * self.resolution
+        array_spectra_selection[1] = array_sums
+        return array_spectra_selection
@@ -0,0 +1,294 @@
+# Copyright (c) 2022, Colas Droin. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
+
+""" This class is used to display the average spectrum of a slice at any zoom level with a bounded
+number of points. For each slice, a pyramid of decimated versions of the average spectrum (raw and
+MAIA-standardized) is precomputed and shelved, each level keeping the minimum and maximum peaks of
+bins of increasing width (see decimate_spectrum_min_max() in modules/tools/spectra.py). A query for
+a given m/z window is answered with the finest level (possibly the full resolution spectrum) having
+less than a screen width's worth of points in the window.
+
+The pyramids are precomputed at launch by the precomputation planner (see Launch.return_planner()).
+If a pyramid is missing nonetheless, it is computed in the background class of the execution pool,
+such that it never holds the event loop.
+"""
+
+# ==================================================================================================
+# --- Imports
+# ==================================================================================================
+
+# Standard modules
+import logging
+import numpy as np
+
+# LBAE imports
+from modules.tools.misc import logmem
+from modules.tools.spectra import compute_thread_safe_function, decimate_spectrum_min_max
+
+# ==================================================================================================
+# --- Functions
+# ==================================================================================================
+
+
+def return_spectrum_window(array_spectra_avg, lb, hb, max_points=None):
+    """This function returns the peaks of a spectrum between two m/z boundaries, along with the
+    peaks just outside the boundaries, such that the plotted spectrum reaches the boundaries.
+
+    Args:
+        array_spectra_avg (np.ndarray): An array of shape (2,n) containing spectrum data (m/z and
+            intensity), sorted by m/z.
+        lb (float): The lower m/z boundary. If None, the spectrum is not cropped on the left.
+        hb (float): The higher m/z boundary. If None, the spectrum is not cropped on the right.
+        max_points (int, optional): If the window contains more peaks, None is returned. Defaults to
+            None.
+
+    Returns:
+        (tuple(np.ndarray)): The m/z values and intensities of the window (copied), or None if the
+            window contains more than max_points peaks.
+    """
+    index_lb = 0 if lb is None else max(0, np.searchsorted(array_spectra_avg[0, :], lb) - 1)
+    index_hb = array_spectra_avg.shape[1]
+    if hb is not None:
+        index_hb = min(index_hb, np.searchsorted(array_spectra_avg[0, :], hb, side="right") + 1)
+    if max_points is not None and index_hb - index_lb > max_points:
+        return None
+    return (
+        np.array(array_spectra_avg[0, index_lb:index_hb]),
+        np.array(array_spectra_avg[1, index_lb:index_hb]),
+    )
+
+
+# ==================================================================================================
+# --- Class
+# ==================================================================================================
+
+
+class SpectrumPyramid:
+    """Class used to precompute and query multi-resolution versions of the average spectrum of each
+    slice.
+
+    Attributes:
+        max_points (int): Maximum number of points returned for a window, i.e. about twice the
+            width of the spectrum plots, in pixels.
+        reduction_factor (int): Factor by which the bins widen from one level to the next.
+        _data (MaldiData): Used to access the average spectra.
+        _storage (Storage): Used to access the shelve database.
+        _dic_pyramids (dict): Pyramids already loaded, indexed by (slice_index, standardization).
+
+    Methods:
+        __init__(maldi_data, storage, max_points=2000, reduction_factor=4): Initialize the
+            SpectrumPyramid class.
+        return_pyramid_name(slice_index, standardization=False): Return the name of the shelved
+            pyramid of a slice.
+        check_pyramid(slice_index, standardization=False): Check if the pyramid of a slice has
+            been shelved.
+        compute_pyramid(slice_index, standardization=False): Compute the decimated levels of the
+            average spectrum of a slice.
+        load_pyramid(slice_index, standardization=False, force_update=False): Load the decimated
+            levels from the shelve database, computing and shelving them if needed.
+        return_pyramid(slice_index, standardization=False, cache_flask=None): Return the
+            decimated levels, loading them in the execution pool if needed.
+        return_spectrum(slice_index, lb=None, hb=None, standardization=False, max_points=None,
+            cache_flask=None): Return the spectrum of a slice in a m/z window, with a bounded number
+            of points.
+    """
+
+    def __init__(self, maldi_data, storage, max_points=2000, reduction_factor=4):
+        """Initialize the class SpectrumPyramid.
+
+        Args:
+            maldi_data (MaldiData): MaldiData object, used to access the average spectra.
+            storage (Storage): Used to access the shelve database.
+            max_points (int, optional): Maximum number of points returned for a window. Defaults to
+                2000.
+            reduction_factor (int, optional): Factor by which the bins widen from one level to the
+                next. Defaults to 4.
+        """
+        self._data = maldi_data
+        self._storage = storage
+        self.max_points = max_points
+        self.reduction_factor = reduction_factor
+        self._dic_pyramids = {}
+
+    # ==============================================================================================
+    # --- Methods
+    # ==============================================================================================
+
+    def return_pyramid_name(self, slice_index, standardization=False):
+        """This function returns the name of the shelved pyramid of a slice.
+
+        Args:
+            slice_index (int): Index of the slice.
+            standardization (bool, optional): If True, the name of the pyramid of the
+                MAIA-standardized average spectrum is returned. Defaults to False.
+
+        Returns:
+            (str): The name of the pyramid in the folder figures/spectra/pyramids of the shelve
+                database.
+        """
+        return "pyramid_" + str(slice_index) + "_" + str(standardization)
+
+    def check_pyramid(self, slice_index, standardization=False):
+        """This function checks if the pyramid of a slice has been shelved.
+
+        Args:
+            slice_index (int): Index of the slice.
+            standardization (bool, optional): If True, the pyramid of the MAIA-standardized average
+                spectrum is checked. Defaults to False.
+
+        Returns:
+            (bool): True if the pyramid is in the shelve database.
+        """
+        return self._storage.check_shelved_object(
+            "figures/spectra/pyramids", self.return_pyramid_name(slice_index, standardization)
+        )
+
+    def compute_pyramid(self, slice_index, standardization=False):
+        """This function computes the decimated levels of the average spectrum of a slice, from the
+        finest to the coarsest. The full resolution spectrum is not part of the pyramid, as it is
+        already stored as a memory-mapped array.
+
+        Args:
+            slice_index (int): Index of the slice.
+            standardization (bool, optional): If True, the MAIA-standardized average spectrum is
+                used. Defaults to False.
+
+        Returns:
+            (list(np.ndarray)): The decimated spectra, each level having about reduction_factor
+                times less points than the previous one, the coarsest one having less than
+                max_points points.
+        """
+        logging.info(
+            "Computing spectrum pyramid for slice "
+            + str(slice_index)
+            + (" (standardized)" if standardization else "")
+            + logmem()
+        )
+        array_level = np.array(
+            self._data.get_array_avg_spectrum(slice_index, standardization=standardization)
+        )
+        l_levels = []
+        while array_level.shape[1] > self.max_points:
+            # Each bin keeps up to two peaks
+            mz_range = max(float(array_level[0, -1] - array_level[0, 0]), 1e-9)
+            bin_width = mz_range * 2 * self.reduction_factor / array_level.shape[1]
+            array_level = decimate_spectrum_min_max(array_level, bin_width)
+            l_levels.append(array_level)
+
+        logging.info(
+            "Spectrum pyramid computed with sizes "
+            + str([array_level.shape[1] for array_level in l_levels])
+            + logmem()
+        )
+        return l_levels
+
+    def load_pyramid(self, slice_index, standardization=False, force_update=False):
+        """This function loads the decimated levels of the average spectrum of a slice from the
+        shelve database, computing and shelving them if needed, and keeps them in memory.
+
+        Args:
+            slice_index (int): Index of the slice.
+            standardization (bool, optional): If True, the levels of the MAIA-standardized average
+                spectrum are loaded. Defaults to False.
+            force_update (bool, optional): If True, the levels are recomputed even if they have
+                already been shelved. Defaults to False.
+
+        Returns:
+            (list(np.ndarray)): The decimated spectra, from the finest to the coarsest.
+        """
+        l_levels = self._storage.return_shelved_object(
+            "figures/spectra/pyramids",
+            self.return_pyramid_name(slice_index, standardization),
+            force_update=force_update,
+            compute_function=self.compute_pyramid,
+            ignore_arguments_naming=True,
+            slice_index=slice_index,
+            standardization=standardization,
+        )
+        self._dic_pyramids[(slice_index, standardization)] = l_levels
+        return l_levels
+
+    def return_pyramid(self, slice_index, standardization=False, cache_flask=None):
+        """This function returns the decimated levels of the average spectrum of a slice. On first
+        use, they are loaded from the shelve database (or computed and shelved if they haven't been
+        precomputed) in the background class of the execution pool.
+
+        Args:
+            slice_index (int): Index of the slice.
+            standardization (bool, optional): If True, the levels of the MAIA-standardized average
+                spectrum are returned. Defaults to False.
+            cache_flask (flask_caching.Cache, optional): Cache of the Flask database. If set to
+                None, the reading of memory-mapped data will not be multithreads-safe. Defaults to
+                None.
+
+        Returns:
+            (list(np.ndarray)): The decimated spectra, from the finest to the coarsest.
+        """
+        key = (slice_index, standardization)
+        if key not in self._dic_pyramids:
+            l_levels = compute_thread_safe_function(
+                self.load_pyramid,
+                cache_flask,
+                self._data,
+                slice_index,
+                slice_index,
+                standardization,
+                task_class="background",
+            )
+            # The levels are not kept in memory if the computation failed
+            return l_levels if l_levels is not None else []
+        return self._dic_pyramids[key]
+
+    def return_spectrum(
+        self,
+        slice_index,
+        lb=None,
+        hb=None,
+        standardization=False,
+        max_points=None,
+        cache_flask=None,
+    ):
+        """This function returns the average spectrum of a slice between two m/z boundaries, at the
+        finest resolution having at most max_points points in the window.
+
+        Args:
+            slice_index (int): Index of the slice.
+            lb (float, optional): The lower m/z boundary. Defaults to None (no boundary).
+            hb (float, optional): The higher m/z boundary. Defaults to None (no boundary).
+            standardization (bool, optional): If True, the MAIA-standardized average spectrum is
+                returned. Defaults to False.
+            max_points (int, optional): Maximum number of points returned. Defaults to None,
+                corresponding to self.max_points.
+            cache_flask (flask_caching.Cache, optional): Cache of the Flask database. If set to
+                None, the reading of memory-mapped data will not be multithreads-safe. Defaults to
+                None.
+
+        Returns:
+            (tuple(np.ndarray)): The m/z values and intensities of the spectrum in the window.
+        """
+        max_points = max_points if max_points is not None else self.max_points
+
+        # Use the full resolution spectrum if the window is small enough
+        window = compute_thread_safe_function(
+            return_spectrum_window,
+            cache_flask,
+            self._data,
+            slice_index,
+            self._data.get_array_avg_spectrum(slice_index, standardization=standardization),
+            lb,
+            hb,
+            max_points=max_points,
+            task_class=None,
+        )
+        if window is not None:
+            return window
+
+        # Otherwise, use the finest decimated level small enough
+        l_levels = self.return_pyramid(slice_index, standardization, cache_flask=cache_flask)
+        if len(l_levels) == 0:
+            return np.array([]), np.array([])
+        for array_level in l_levels[:-1]:
+            window = return_spectrum_window(array_level, lb, hb, max_points=max_points)
+            if window is not None:
+                return window
+        return return_spectrum_window(l_levels[-1], lb, hb)
@@ -0,0 +1,340 @@
+# Copyright (c) 2022, Colas Droin. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
+
+""" This class is used to orchestrate the initialization of the global objects of the app (data,
+atlas, figures, etc.). Each global object is registered with a factory function and exposed through
+a lazy proxy, such that it is only built on first access, or in a background thread while the
+server is already answering requests. The time and memory taken by each component is recorded to
+profile the startup of the app."""
+
+# ==================================================================================================
+# --- Imports
+# ==================================================================================================
+
+# Standard modules
+import logging
+import threading
+import time
+from contextlib import contextmanager
+import psutil
+
+# LBAE imports
+from modules.tools.misc import logmem
+
+# ==================================================================================================
+# --- Classes
+# ==================================================================================================
+
+
+class LazyComponent:
+    """Class used as a transparent proxy for a global object of the app. The actual object is built
+    (only once, in a thread-safe way) the first time one of its attributes is accessed, or when
+    resolve() is called explicitly, e.g. from a background thread.
+
+    Attributes:
+        _name (str): Name of the component, used for profiling and logging.
+        _factory (function): Function taking no argument and returning the actual object.
+        _startup (Startup): Startup object used to profile the initialization.
+        _instance (object): The actual object, once built.
+        _exception (Exception): The exception raised by the factory, if any.
+        _ready (threading.Event): Event set once the object has been built (or has failed).
+        _lock (threading.Lock): Lock used to build the object from a single thread.
+
+    Methods:
+        __init__(name, factory, startup): Initialize the LazyComponent class.
+        resolve(): Build the actual object if needed, and return it.
+        is_ready(): Return True if the actual object has been built.
+        has_failed(): Return True if the factory raised an exception.
+        wait(timeout=None): Block until the actual object has been built.
+    """
+
+    __slots__ = ["_name", "_factory", "_startup", "_instance", "_exception", "_ready", "_lock"]
+
+    def __init__(self, name, factory, startup):
+        """Initialize the class LazyComponent.
+
+        Args:
+            name (str): Name of the component, used for profiling and logging.
+            factory (function): Function taking no argument and returning the actual object.
+            startup (Startup): Startup object used to profile the initialization.
+        """
+        object.__setattr__(self, "_name", name)
+        object.__setattr__(self, "_factory", factory)
+        object.__setattr__(self, "_startup", startup)
+        object.__setattr__(self, "_instance", None)
+        object.__setattr__(self, "_exception", None)
+        object.__setattr__(self, "_ready", threading.Event())
+        object.__setattr__(self, "_lock", threading.Lock())
+
+    def resolve(self):
+        """This function builds the actual object if it hasn't been built yet, and returns it. If
+        the factory failed, the corresponding exception is raised again.
+
+        Returns:
+            (object): The actual object.
+        """
+        if not self._ready.is_set():
+            with self._lock:
+                if not self._ready.is_set():
+                    try:
+                        with self._startup.record(self._name):
+                            object.__setattr__(self, "_instance", self._factory())
+                    except Exception as e:
+                        object.__setattr__(self, "_exception", e)
+                        raise
+                    finally:
+                        self._ready.set()
+        if self._exception is not None:
+            raise RuntimeError(
+                "Component " + self._name + " failed to initialize"
+            ) from self._exception
+        return self._instance
+
+    def is_ready(self):
+        """This function checks whether the actual object has been successfully built.
+
+        Returns:
+            (bool): True if the actual object is available.
+        """
+        return self._ready.is_set() and self._exception is None
+
+    def has_failed(self):
+        """This function checks whether the factory of the actual object raised an exception.
+
+        Returns:
+            (bool): True if the actual object can't be built.
+        """
+        return self._ready.is_set() and self._exception is not None
+
+    def wait(self, timeout=None):
+        """This function blocks until the actual object has been built (or has failed).
+
+        Args:
+            timeout (float, optional): Maximum number of seconds to wait. Defaults to None.
+
+        Returns:
+            (bool): True if the actual object is available.
+        """
+        self._ready.wait(timeout)
+        return self.is_ready()
+
+    def __getattr__(self, attr):
+        """Forward attribute access to the actual object, building it if needed."""
+        return getattr(self.resolve(), attr)
+
+    def __setattr__(self, attr, value):
+        """Forward attribute assignment to the actual object, building it if needed."""
+        setattr(self.resolve(), attr, value)
+
+    def __repr__(self):
+        """Describe the proxy without building the actual object."""
+        return (
+            "<LazyComponent "
+            + self._name
+            + (" (ready)" if self.is_ready() else " (not initialized)")
+            + ">"
+        )
+
+
+class Startup:
+    """Class used to register the global objects of the app, initialize them lazily or in a
+    background thread, and record the time and memory taken by each of them.
+
+    Attributes:
+        dic_components (dict): Dictionnary of registered LazyComponent, indexed by name, in
+            registration order.
+        l_records (list(dict)): List of profiling records, one per initialized component, with the
+            name, start time, duration (in seconds) and RSS increase (in MB) of the initialization.
+            Note that RSS increases are only indicative when components are initialized while the
+            server is answering requests.
+        time_start (float): Time at which the Startup object was created.
+        dic_failure (dict): Name of the component whose initialization failed, along with the
+            corresponding error, or None if no component failed.
+        _thread (threading.Thread): Thread used to initialize the components in the background.
+        _lock (threading.Lock): Lock used to write the profiling records.
+
+    Methods:
+        __init__(): Initialize the Startup class.
+        record(name): Context manager used to profile the initialization of a component.
+        register(name, factory): Register a component and return its lazy proxy.
+        initialize_all(raise_exception=False): Initialize all the registered components, in
+            registration order.
+        start(background=True): Initialize all the registered components, in the current thread or
+            in a background thread.
+        is_ready(): Return True if all the registered components have been initialized.
+        has_failed(): Return True if the initialization of a component failed.
+        return_failure(): Return the component whose initialization failed, and the error.
+        return_report(): Return a dictionnary summarizing the state and profile of the startup.
+        log_report(): Log the profile of the startup.
+    """
+
+    def __init__(self):
+        """Initialize the class Startup."""
+        self.dic_components = {}
+        self.l_records = []
+        self.time_start = time.time()
+        self.dic_failure = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def record(self, name):
+        """Context manager used to profile the time and memory taken by a block of code.
+
+        Args:
+            name (str): Name of the profiled component.
+        """
+        process = psutil.Process()
+        rss_start = process.memory_info().rss
+        time_start = time.time()
+        logging.info("Initializing component " + name + logmem())
+        try:
+            yield
+        finally:
+            dic_record = {
+                "name": name,
+                "start": round(time_start - self.time_start, 3),
+                "duration": round(time.time() - time_start, 3),
+                "rss_increase_mb": round((process.memory_info().rss - rss_start) / 1024**2, 1),
+                "thread": threading.current_thread().name,
+            }
+            with self._lock:
+                self.l_records.append(dic_record)
+            logging.info(
+                "Component "
+                + name
+                + " initialized in "
+                + str(dic_record["duration"])
+                + "s"
+                + logmem()
+            )
+
+    def register(self, name, factory):
+        """Register a component and return its lazy proxy. The factory can access other registered
+        components through their proxies, which will initialize them if needed.
+
+        Args:
+            name (str): Name of the component.
+            factory (function): Function taking no argument and returning the actual object.
+
+        Returns:
+            (LazyComponent): The lazy proxy of the component.
+        """
+        component = LazyComponent(name, factory, self)
+        self.dic_components[name] = component
+        return component
+
+    def initialize_all(self, raise_exception=False):
+        """Initialize all the registered components, in registration order.
+
+        Args:
+            raise_exception (bool, optional): If True, the exception raised by a failing component
+                is propagated. Else, it is only logged and recorded in self.dic_failure (e.g. in a
+                background thread). Defaults to False.
+        """
+        for name, component in self.dic_components.items():
+            try:
+                component.resolve()
+            except Exception as e:
+                logging.exception("Component " + name + " could not be initialized")
+                # The root cause is more informative than the error of a dependent component
+                error = e.__cause__ if e.__cause__ is not None else e
+                self.dic_failure = {"component": name, "error": repr(error)}
+                if raise_exception:
+                    raise
+                return
+        self.log_report()
+
+    def start(self, background=True):
+        """Initialize all the registered components.
+
+        Args:
+            background (bool, optional): If True, the components are initialized in a daemon
+                thread, and this function returns immediately. Else, they are initialized in the
+                current thread. Defaults to True.
+        """
+        if not background:
+            self.initialize_all(raise_exception=True)
+            return
+        if self._thread is None:
+            # If the threads have been replaced by greenlets (gevent workers), use a native thread,
+            # such that the initialization doesn't block the event loop of the worker
+            thread_class = threading.Thread
+            try:
+                import gevent.monkey
+
+                if gevent.monkey.is_module_patched("threading"):
+                    thread_class = gevent.monkey.get_original("threading", "Thread")
+            except ImportError:
+                pass
+
+            self._thread = thread_class(
+                target=self.initialize_all, name="lbae-startup", daemon=True
+            )
+            self._thread.start()
+
+    def is_ready(self):
+        """This function checks whether all the registered components have been initialized.
+
+        Returns:
+            (bool): True if all the components are available.
+        """
+        return all(component.is_ready() for component in self.dic_components.values())
+
+    def has_failed(self):
+        """This function checks whether the initialization of a registered component failed, in
+        which case the app will never be ready.
+
+        Returns:
+            (bool): True if a component failed to initialize.
+        """
+        return self.return_failure() is not None
+
+    def return_failure(self):
+        """This function returns the component whose initialization failed, along with the
+        corresponding error. Components which failed when accessed outside of initialize_all()
+        (e.g. lazily, from a request) are also reported.
+
+        Returns:
+            (dict): A dictionnary with the name of the component and the error, or None if no
+                component failed.
+        """
+        if self.dic_failure is not None:
+            return self.dic_failure
+        for name, component in self.dic_components.items():
+            if component.has_failed():
+                return {"component": name, "error": repr(component._exception)}
+        return None
+
+    def return_report(self):
+        """This function returns a summary of the state and profile of the startup.
+
+        Returns:
+            (dict): A dictionnary with the global readiness, the failure (if any), the uptime, the
+                readiness of each component, and the profiling records.
+        """
+        with self._lock:
+            l_records = list(self.l_records)
+        return {
+            "ready": self.is_ready(),
+            "failed": self.has_failed(),
+            "failure": self.return_failure(),
+            "uptime": round(time.time() - self.time_start, 3),
+            "components": {
+                name: component.is_ready() for name, component in self.dic_components.items()
+            },
+            "records": l_records,
+        }
+
+    def log_report(self):
+        """Log the profile of the startup, one line per component."""
+        for dic_record in self.return_report()["records"]:
+            logging.info(
+                "Startup profile - "
+                + dic_record["name"]
+                + ": "
+                + str(dic_record["duration"])
+                + "s, "
+                + str(dic_record["rss_increase_mb"])
+                + "MB"
+            )
@@ -11,10 +11,11 @@
 import logging
 import shelve
 import os
+import threading
 from pympler import asizeof
 
 # LBAE imports
-from modules.tools.misc import logmem
+from modules.tools.misc import file_lock, logmem
 
 # ==================================================================================================
 # --- Class
@@ -25,6 +26,10 @@ class Storage:
 
     Attributes:
         path_db (str): Path of the shelve database.
+        lock (threading.RLock): Lock used to access the shelve database from a single thread at a
+            time, as shelve doesn't support concurrent writes.
+        path_lock (str): Path of the lock file used to access the shelve database from a single
+            process at a time, when the app is served by several workers.
 
     Methods:
         __init__(path_db="data/whole_dataset/"): Initializes the class Storage.
@@ -54,6 +59,8 @@ class Storage:
         self.path_db = path_db
         if not os.path.exists(self.path_db):
             os.makedirs(self.path_db)
+        self.lock = threading.RLock()
+        self.path_lock = self.path_db + ".lock"
         # self.list_shelve_objects_size()
 
     def dump_shelved_object(self, data_folder, file_name, object):
@@ -70,7 +77,7 @@ class Storage:
         complete_file_name = data_folder + "/" + file_name
 
         # Dump in db
-        with shelve.open(self.path_db) as db:
+        with self.lock, file_lock(self.path_lock), shelve.open(self.path_db) as db:
             db[complete_file_name] = object
 
     def load_shelved_object(self, data_folder, file_name):
@@ -86,7 +93,7 @@ class Storage:
         complete_file_name = data_folder + "/" + file_name
 
         # Load from in db
-        with shelve.open(self.path_db) as db:
+        with self.lock, file_lock(self.path_lock), shelve.open(self.path_db) as db:
             return db[complete_file_name]
 
     def check_shelved_object(self, data_folder, file_name):
@@ -102,7 +109,7 @@ class Storage:
         complete_file_name = data_folder + "/" + file_name
 
         # Load from in db
-        with shelve.open(self.path_db) as db:
+        with self.lock, file_lock(self.path_lock), shelve.open(self.path_db) as db:
             if complete_file_name in db:
                 return True
             else:
@@ -148,33 +155,25 @@ class Storage:
                 complete_file_name += "_" + str(value)
 
         # Load the shelve
-        db = shelve.open(db_path)
-        # Check if the object is in the folder already and return it
-        if complete_file_name in db and not force_update:
-            logging.info("Returning " + complete_file_name + " from shelve file." + logmem())
-            object = db[complete_file_name]
-        else:
-            logging.info(
-                complete_file_name
-                + " could not be found or force_update is True. "
-                + "Computing the object and shelving it now."
-            )
-
-            # Close shelve to prevent nesting issues with compute function
-            db.close()
-
-            # Execute compute_function
-            object = compute_function(**compute_function_args)
-
-            # Reopen shelve
-            db = shelve.open(db_path)
-
-            # Save the result in a pickle file
+        with self.lock, file_lock(self.path_lock), shelve.open(db_path) as db:
+            # Check if the object is in the folder already and return it
+            if complete_file_name in db and not force_update:
+                logging.info("Returning " + complete_file_name + " from shelve file." + logmem())
+                return db[complete_file_name]
+
+        logging.info(
+            complete_file_name
+            + " could not be found or force_update is True. "
+            + "Computing the object and shelving it now."
+        )
+
+        # Execute compute_function, with the shelve closed (and unlocked) to prevent nesting issues
+        object = compute_function(**compute_function_args)
+
+        # Reopen shelve and save the result in a pickle file
+        with self.lock, file_lock(self.path_lock), shelve.open(db_path) as db:
             db[complete_file_name] = object
-            logging.info(complete_file_name + " being returned now from computation.")
-
-        # Close shelve for good this time
-        db.close()
+        logging.info(complete_file_name + " being returned now from computation.")
         return object
 
     def empty_shelve(self):
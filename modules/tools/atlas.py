@@ -19,7 +19,7 @@ from numba import njit
 # ==================================================================================================
 
 
-@njit
+@njit(cache=True)
 def project_image(slice_index, original_image, array_projection_correspondence):
     """This function is used to project the original maldi acquisition (low-resolution, possibly
     tilted, and) into a warped and higher resolution, indexed with the Allen Mouse Brain Common
@@ -56,7 +56,7 @@ def project_image(slice_index, original_image, array_projection_correspondence):
     return new_image
 
 
-@njit
+@njit(cache=True)
 def project_atlas_mask(stack_mask, slice_coordinates_rescaled, shape_atlas):
     """This function projects a mask array_annotation (obtained from the atlas, sliced from a
     3-dimensional object) on our two-dimensional, high-resolution warped data, for a given slice.
@@ -94,7 +94,7 @@ def project_atlas_mask(stack_mask, slice_coordinates_rescaled, shape_atlas):
     return projected_mask
 
 
-@njit
+@njit(cache=True)
 def get_array_rows_from_atlas_mask(mask, mask_remapped, array_projection_correspondence_sliced):
     """This function is similar to spectra.sample_rows_from_path(), in that it returns the lower and
     upper indexes of the rows belonging to the current mask (instead of path), as well as the
@@ -171,7 +171,7 @@ def get_array_rows_from_atlas_mask(mask, mask_remapped, array_projection_corresp
     return np.array([xmin, xmax], dtype=np.int32), array_index_bound_column_per_row
 
 
-@njit
+@njit(cache=True)
 def solve_plane_equation(
     array_coordinates_high_res_slice,
     point_1=(50, 51),
@@ -233,7 +233,7 @@ def solve_plane_equation(
     return a_atlas, u_atlas, v_atlas
 
 
-@njit
+@njit(cache=True)
 def slice_to_atlas_transform(a, u, v, lambd, mu):
     """This function returns a 3D coordinate (in the ccfv3) from a 2D slice coordinate, using the
     parameters obtained from the inversion made in solve_plane_equation().
@@ -256,7 +256,7 @@ def slice_to_atlas_transform(a, u, v, lambd, mu):
     return x_atlas, y_atlas, z_atlas
 
 
-@njit
+@njit(cache=True)
 def fill_array_projection(
     slice_index,
     array_projection,
@@ -478,7 +478,7 @@ def fill_array_projection(
     return array_projection, array_projection_correspondence
 
 
-@njit
+@njit(cache=True)
 def compute_simplified_atlas_annotation(atlas_annotation):
     """This function is used to map the array of annotations (which can initially be very large
     integers) to an array of annotations of similar size, but with annotations ranging from 0 to the
@@ -502,7 +502,7 @@ def compute_simplified_atlas_annotation(atlas_annotation):
     return simplified_atlas_annotation
 
 
-@njit
+@njit(cache=True)
 def compute_array_images_atlas(
     array_coordinates_warped_data,
     simplified_atlas_annotation,
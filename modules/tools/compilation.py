@@ -0,0 +1,212 @@
+# Copyright (c) 2022, Colas Droin. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
+
+""" In this module, functions used to manage the compilation of the numba kernels of the app are
+defined. All kernels are decorated with @njit(cache=True), such that the compiled machine code is
+stored on disk (in __pycache__, or in the folder defined by the NUMBA_CACHE_DIR environment
+variable). The signatures with which each kernel has been compiled are registered in the shelve
+database, along with a hash of the kernel source code, such that all kernels can be compiled (i.e.
+loaded from the disk cache) at startup without having to simulate user actions with real data.
+"""
+
+# ==================================================================================================
+# --- Imports
+# ==================================================================================================
+
+# Standard modules
+import hashlib
+import inspect
+import logging
+import time
+
+# LBAE imports
+from modules.tools import atlas, lookup_tables, spectra, volume
+from modules.tools.misc import logmem
+
+# ==================================================================================================
+# --- Functions
+# ==================================================================================================
+
+# Modules whose kernels are registered
+l_kernel_modules = [spectra, atlas, volume, lookup_tables]
+
+
+def return_kernels(l_modules=l_kernel_modules):
+    """This function returns all the numba kernels defined in the provided modules.
+
+    Args:
+        l_modules (list(module), optional): List of modules to inspect. Defaults to
+            l_kernel_modules.
+
+    Returns:
+        (dict): A dictionnary associating the qualified name of each kernel to its numba
+            dispatcher.
+    """
+    dic_kernels = {}
+    for module in l_modules:
+        for name, obj in vars(module).items():
+            # Numba dispatchers wrap the original python function in py_func
+            if hasattr(obj, "py_func") and hasattr(obj, "signatures"):
+                if obj.py_func.__module__ == module.__name__:
+                    dic_kernels[module.__name__ + "." + name] = obj
+    return dic_kernels
+
+
+def compute_kernel_hash(dispatcher):
+    """This function computes a hash of the source code of a kernel, used to check that the
+    registered signatures still correspond to the current version of the code.
+
+    Args:
+        dispatcher (numba.core.registry.CPUDispatcher): The kernel.
+
+    Returns:
+        (str): The md5 hash of the kernel source code.
+    """
+    return hashlib.md5(inspect.getsource(dispatcher.py_func).encode()).hexdigest()
+
+
+def register_kernel_signatures(storage, l_modules=l_kernel_modules):
+    """This function registers in the shelve database the signatures with which each kernel has
+    been compiled so far, along with the hash of its source code. It must be called after the
+    kernels have been compiled, e.g. after simulating user actions. The kernels which have not been
+    compiled (e.g. because the warmup doesn't use them) are registered with an empty list of
+    signatures, such that they are not considered as missing at the next startup.
+
+    Args:
+        storage (Storage): Used to access the shelve database.
+        l_modules (list(module), optional): List of modules whose kernels are registered. Defaults
+            to l_kernel_modules.
+
+    Returns:
+        (dict): The registry, associating the qualified name of each kernel to a dictionnary
+            containing the hash of its source code and the list of its signatures.
+    """
+    dic_registry = {}
+    if storage.check_shelved_object("launch", "kernel_signatures"):
+        dic_registry = storage.load_shelved_object("launch", "kernel_signatures")
+
+    for name, dispatcher in return_kernels(l_modules).items():
+        kernel_hash = compute_kernel_hash(dispatcher)
+
+        # Merge with the signatures already registered for the same version of the code
+        l_signatures = []
+        if name in dic_registry and dic_registry[name]["hash"] == kernel_hash:
+            l_signatures = dic_registry[name]["signatures"]
+        for signature in dispatcher.signatures:
+            if signature not in l_signatures:
+                l_signatures.append(signature)
+        dic_registry[name] = {"hash": kernel_hash, "signatures": l_signatures}
+
+    storage.dump_shelved_object("launch", "kernel_signatures", dic_registry)
+    logging.info("Signatures of " + str(len(dic_registry)) + " kernels have been registered")
+    return dic_registry
+
+
+def compile_registered_kernels(storage, l_modules=l_kernel_modules):
+    """This function compiles all the kernels with the signatures registered in the shelve
+    database. Thanks to the on-disk cache, this basically amounts to loading the compiled machine
+    code from disk, unless the cache has been invalidated.
+
+    Args:
+        storage (Storage): Used to access the shelve database.
+        l_modules (list(module), optional): List of modules whose kernels are compiled. Defaults to
+            l_kernel_modules.
+
+    Returns:
+        (list(str)): The list of kernels that could not be compiled from the registry, because
+            their source code has changed since they were registered, or because a registered
+            signature failed to compile. All the kernels are returned if no registry exists yet.
+            The kernels missing from an existing registry (e.g. newly added) are compiled on first
+            use, and are not returned.
+    """
+    dic_kernels = return_kernels(l_modules)
+    if not storage.check_shelved_object("launch", "kernel_signatures"):
+        return list(dic_kernels.keys())
+    dic_registry = storage.load_shelved_object("launch", "kernel_signatures")
+
+    l_stale_kernels = []
+    for name, dispatcher in dic_kernels.items():
+        if name not in dic_registry:
+            continue
+        if dic_registry[name]["hash"] != compute_kernel_hash(dispatcher):
+            l_stale_kernels.append(name)
+            continue
+        for signature in dic_registry[name]["signatures"]:
+            try:
+                dispatcher.compile(signature)
+            except Exception:
+                logging.warning("Kernel " + name + " could not be compiled for " + str(signature))
+                l_stale_kernels.append(name)
+                break
+    return l_stale_kernels
+
+
+def return_compilation_report(l_modules=l_kernel_modules):
+    """This function returns, for each kernel, the number of signatures that have been loaded from
+    the on-disk cache, and the number of signatures that have been freshly compiled.
+
+    Args:
+        l_modules (list(module), optional): List of modules whose kernels are inspected. Defaults to
+            l_kernel_modules.
+
+    Returns:
+        (dict): A dictionnary associating the qualified name of each compiled kernel to a
+            dictionnary with the number of cache hits and cache misses.
+    """
+    dic_report = {}
+    for name, dispatcher in return_kernels(l_modules).items():
+        if len(dispatcher.signatures) == 0:
+            continue
+        stats = dispatcher.stats
+        dic_report[name] = {
+            "cache_hits": sum(stats.cache_hits.values()),
+            "cache_misses": sum(stats.cache_misses.values()),
+        }
+    return dic_report
+
+
+def compile_kernels(storage, warmup_function, l_modules=l_kernel_modules):
+    """This function compiles all the kernels at startup. Registered signatures are compiled
+    directly (loading them from the disk cache). If there's no registry yet, or if some kernels have
+    changed since they were registered (or fail to compile), the provided warmup function
+    (simulating user actions) is run instead, and the signatures are registered again. A report of
+    the kernels loaded from cache versus freshly compiled is logged.
+
+    Args:
+        storage (Storage): Used to access the shelve database.
+        warmup_function (function): Function taking no argument, executing all the kernels with
+            real data.
+        l_modules (list(module), optional): List of modules whose kernels are compiled. Defaults to
+            l_kernel_modules.
+
+    Returns:
+        (dict): The compilation report, as returned by return_compilation_report().
+    """
+    time_start = time.time()
+    l_stale_kernels = compile_registered_kernels(storage, l_modules)
+    if len(l_stale_kernels) > 0:
+        logging.info(
+            "Kernels unregistered, modified or failing to compile: "
+            + ", ".join(l_stale_kernels)
+            + ". Running warmup instead."
+        )
+        warmup_function()
+        register_kernel_signatures(storage, l_modules)
+
+    dic_report = return_compilation_report(l_modules)
+    n_hits = sum(x["cache_hits"] for x in dic_report.values())
+    n_misses = sum(x["cache_misses"] for x in dic_report.values())
+    for name, dic_stats in dic_report.items():
+        if dic_stats["cache_misses"] > 0:
+            logging.info("Kernel " + name + " has been compiled from scratch")
+    logging.info(
+        "Kernels compiled in "
+        + str(round(time.time() - time_start, 2))
+        + "s: "
+        + str(n_hits)
+        + " signatures loaded from cache, "
+        + str(n_misses)
+        + " compiled from scratch"
+        + logmem()
+    )
+    return dic_report
@@ -0,0 +1,129 @@
+# Copyright (c) 2022, Colas Droin. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
+
+""" In this module, functions used to extract the boundaries of the atlas annotations projected on
+the slices as vector polylines, and to turn them into Plotly shapes or raster overlays, are defined.
+"""
+
+# ==================================================================================================
+# --- Imports
+# ==================================================================================================
+
+# Standard modules
+import logging
+import numpy as np
+from scipy.ndimage import find_objects
+from skimage.measure import find_contours, approximate_polygon
+from skimage.draw import line_aa
+
+# ==================================================================================================
+# --- Functions
+# ==================================================================================================
+
+
+def compute_slice_contours(array_annotation, l_tolerances=(0.5, 1.0, 2.0), border=10):
+    """This function extracts the boundaries of the structures of a slice of (simplified)
+    annotations, as polylines simplified with the Douglas-Peucker algorithm, for several tolerances.
+    Boundaries shared by two structures are traced once per structure.
+
+    Args:
+        array_annotation (np.ndarray): A two-dimensional array of structure ids, zero being used
+            for the pixels outside of the annotations.
+        l_tolerances (tuple(float), optional): Maximum distance (in pixels) between the simplified
+            polylines and the original boundaries, one set of polylines being computed per
+            tolerance. Defaults to (0.5, 1.0, 2.0).
+        border (int, optional): Width (in pixels) of the frame of the image on which the boundaries
+            are ignored, as it usually contains registration artifacts. Defaults to 10.
+
+    Returns:
+        (dict): A dictionnary associating each tolerance to a list of polylines, each polyline being
+            an array of shape (n,2) containing the (row, column) coordinates of its vertices.
+    """
+    image_shape = array_annotation.shape
+    if border > 0:
+        array_annotation = array_annotation[border:-border, border:-border]
+
+    # Map the structures ids to consecutive integers, keeping zero for the background
+    array_unique, array_labels = np.unique(array_annotation, return_inverse=True)
+    array_labels = array_labels.reshape(array_annotation.shape)
+    if array_unique[0] != 0:
+        array_labels += 1
+
+    dic_contours = {tolerance: [] for tolerance in l_tolerances}
+    for label, (slice_rows, slice_cols) in enumerate(find_objects(array_labels), start=1):
+        # Crop around the structure, with a margin to close the boundaries
+        row_1, row_2 = max(slice_rows.start - 1, 0), min(slice_rows.stop + 1, array_labels.shape[0])
+        col_1, col_2 = max(slice_cols.start - 1, 0), min(slice_cols.stop + 1, array_labels.shape[1])
+        array_mask = np.asarray(array_labels[row_1:row_2, col_1:col_2] == label, dtype=np.float32)
+
+        for array_contour in find_contours(array_mask, 0.5):
+            if array_contour.shape[0] < 3:
+                continue
+            array_contour += (row_1 + border, col_1 + border)
+            for tolerance in l_tolerances:
+                dic_contours[tolerance].append(
+                    approximate_polygon(array_contour, tolerance).astype(np.float32)
+                )
+
+    logging.info(
+        "Contours computed for a slice of shape "
+        + str(image_shape)
+        + " with "
+        + str(len(dic_contours[l_tolerances[0]]))
+        + " polylines"
+    )
+    return dic_contours
+
+
+def compute_contours_raster(l_contours, image_shape, color=(255, 165, 0), opacity=1.0):
+    """This function draws a list of polylines as antialiased lines of one pixel width, on a
+    transparent RGBA image, such that it can be blended with the slice images.
+
+    Args:
+        l_contours (list(np.ndarray)): A list of polylines, each being an array of shape (n,2)
+            containing the (row, column) coordinates of its vertices.
+        image_shape (int, int): A tuple of integers, indicating the vertical and horizontal sizes of
+            the image.
+        color (tuple(int), optional): RGB color of the lines. Defaults to orange.
+        opacity (float, optional): Opacity of the lines, between 0 and 1. Defaults to 1.0.
+
+    Returns:
+        (np.ndarray): An RGBA image of shape (image_shape[0], image_shape[1], 4), of type uint8.
+    """
+    array_alpha = np.zeros(image_shape, dtype=np.float64)
+    for array_contour in l_contours:
+        array_vertices = np.round(array_contour).astype(np.int64)
+        for (row_1, col_1), (row_2, col_2) in zip(array_vertices[:-1], array_vertices[1:]):
+            rr, cc, val = line_aa(row_1, col_1, row_2, col_2)
+            array_in = (rr >= 0) & (rr < image_shape[0]) & (cc >= 0) & (cc < image_shape[1])
+            np.maximum.at(array_alpha, (rr[array_in], cc[array_in]), val[array_in])
+
+    array_image = np.zeros((image_shape[0], image_shape[1], 4), dtype=np.uint8)
+    array_image[array_alpha > 0, :3] = color
+    array_image[:, :, 3] = np.round(array_alpha * 255 * opacity).astype(np.uint8)
+    return array_image
+
+
+def convert_contours_to_path(l_contours, decimals=1):
+    """This function converts a list of polylines into a single SVG path, which can be added to a
+    Plotly figure as a shape (whose coordinates match the ones of a go.Image trace).
+
+    Args:
+        l_contours (list(np.ndarray)): A list of polylines, each being an array of shape (n,2)
+            containing the (row, column) coordinates of its vertices.
+        decimals (int, optional): Number of decimals kept for the coordinates. Defaults to 1.
+
+    Returns:
+        (str): The SVG path.
+    """
+    l_paths = []
+    for array_contour in l_contours:
+        array_vertices = np.round(array_contour, decimals)
+        path = "M" + "L".join(
+            ("{:g},{:g}".format(col, row) for row, col in array_vertices.tolist())
+        )
+        # Close the polylines which are not cut by the frame of the image
+        if np.array_equal(array_vertices[0], array_vertices[-1]):
+            path += "Z"
+        l_paths.append(path)
+    return "".join(l_paths)
@@ -0,0 +1,136 @@
+# Copyright (c) 2022, Colas Droin. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
+
+""" In this module, functions used to interpolate irregularly sampled data (e.g. scRNAseq spots) on
+a regular grid are defined. The (linear) interpolation weights only depend on the coordinates of the
+samples, and can therefore be precomputed once and applied to any vector of values as a sparse
+matrix-vector product.
+"""
+
+# ==================================================================================================
+# --- Imports
+# ==================================================================================================
+
+# Standard modules
+import logging
+import numpy as np
+from scipy.spatial import Delaunay
+from scipy.sparse import csr_matrix
+
+# LBAE imports
+from modules.tools.misc import logmem
+
+# ==================================================================================================
+# --- Functions
+# ==================================================================================================
+
+
+def compute_grid_domains(x, y, z, step_x=0.5, step_y=0.1, step_z=0.1):
+    """This function computes the domains of the regular grid on which the data sampled at the
+    coordinates (x, y, z) will be interpolated.
+
+    Args:
+        x (np.ndarray): A flat array of x coordinates.
+        y (np.ndarray): A flat array of y coordinates.
+        z (np.ndarray): A flat array of z coordinates.
+        step_x (float, optional): Step of the grid along the x axis. Defaults to 0.5.
+        step_y (float, optional): Step of the grid along the y axis. Defaults to 0.1.
+        step_z (float, optional): Step of the grid along the z axis. Defaults to 0.1.
+
+    Returns:
+        (np.ndarray, np.ndarray, np.ndarray): The domains of the grid along each axis.
+    """
+    x_domain = np.arange(np.min(x), np.max(x), step_x)
+    y_domain = np.arange(np.min(y), np.max(y), step_y)
+    z_domain = np.arange(np.min(z), np.max(z), step_z)
+    return x_domain, y_domain, z_domain
+
+
+def compute_linear_interpolation_weights(array_points, l_domains, chunk_size=1000000):
+    """This function triangulates the sampled points (Delaunay) and computes, for each node of the
+    regular grid defined by l_domains, the barycentric coordinates of the node in the simplex that
+    contains it. The result is a sparse matrix such that, for any vector of values v sampled at
+    array_points, weights @ v gives the same result as scipy.interpolate.griddata with
+    method="linear".
+
+    Args:
+        array_points (np.ndarray): A two-dimensional array of shape (n_points, n_dims) containing
+            the coordinates of the sampled points.
+        l_domains (list(np.ndarray)): The domain of the grid along each dimension. The grid is built
+            with the "ij" indexing.
+        chunk_size (int, optional): Number of grid nodes processed at once, to bound the memory
+            used during the computation. Defaults to 1000000.
+
+    Returns:
+        (scipy.sparse.csr_matrix, np.ndarray, tuple): The sparse matrix of interpolation weights, of
+            shape (n_nodes, n_points), a flat boolean array indicating which grid nodes are outside
+            of the convex hull of the sampled points, and the shape of the grid.
+    """
+    logging.info("Computing Delaunay triangulation for interpolation" + logmem())
+    triangulation = Delaunay(array_points)
+    n_dims = array_points.shape[1]
+    grid_shape = tuple(len(domain) for domain in l_domains)
+    n_nodes = int(np.prod(grid_shape))
+
+    # Each node is interpolated from the n_dims + 1 vertices of its simplex
+    array_indices = np.zeros((n_nodes, n_dims + 1), dtype=np.int32)
+    array_weights = np.zeros((n_nodes, n_dims + 1), dtype=np.float32)
+    array_outside = np.zeros((n_nodes,), dtype=bool)
+    for start in range(0, n_nodes, chunk_size):
+        stop = min(start + chunk_size, n_nodes)
+
+        # Build the coordinates of the current chunk of grid nodes, in "ij" order
+        array_nodes = np.column_stack(
+            [
+                domain[idx]
+                for domain, idx in zip(l_domains, np.unravel_index(np.arange(start, stop), grid_shape))
+            ]
+        )
+        array_simplex = triangulation.find_simplex(array_nodes)
+        array_inside = array_simplex >= 0
+
+        # Barycentric coordinates of the nodes inside the convex hull
+        array_transform = triangulation.transform[array_simplex[array_inside]]
+        array_bary = np.einsum(
+            "ijk,ik->ij",
+            array_transform[:, :n_dims, :],
+            array_nodes[array_inside] - array_transform[:, n_dims, :],
+        )
+        array_weights[start:stop][array_inside] = np.column_stack(
+            (array_bary, 1 - array_bary.sum(axis=1))
+        )
+        array_indices[start:stop][array_inside] = triangulation.simplices[
+            array_simplex[array_inside]
+        ]
+        array_outside[start:stop] = ~array_inside
+
+    weights = csr_matrix(
+        (
+            array_weights.ravel(),
+            (np.repeat(np.arange(n_nodes), n_dims + 1), array_indices.ravel()),
+        ),
+        shape=(n_nodes, array_points.shape[0]),
+    )
+    logging.info("Interpolation weights computed" + logmem())
+    return weights, array_outside, grid_shape
+
+
+def interpolate_on_grid(weights, array_outside, grid_shape, array_values):
+    """This function applies precomputed interpolation weights to a vector of values sampled at the
+    triangulated points, and returns the corresponding grid.
+
+    Args:
+        weights (scipy.sparse.csr_matrix): The sparse matrix of interpolation weights, as returned
+            by compute_linear_interpolation_weights().
+        array_outside (np.ndarray): A flat boolean array indicating which grid nodes are outside of
+            the convex hull of the sampled points.
+        grid_shape (tuple): The shape of the grid.
+        array_values (np.ndarray): A flat array of values sampled at the triangulated points.
+
+    Returns:
+        (np.ndarray): The interpolated grid, with NaN values outside of the convex hull (as in
+            scipy.interpolate.griddata).
+    """
+    array_grid = weights @ np.asarray(array_values, dtype=np.float64)
+    array_grid[array_outside] = np.nan
+    return array_grid.reshape(grid_shape)
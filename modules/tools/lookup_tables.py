@@ -23,7 +23,7 @@ DIVIDER_LOOKUP = 1
 # ==================================================================================================
 
 
-@njit
+@njit(cache=True)
 def build_index_lookup_table(
     array_spectra, array_pixel_indexes, divider_lookup, size_spectrum=2000
 ):
@@ -87,7 +87,7 @@ def build_index_lookup_table(
 
 
 # Lookup table to
-@njit
+@njit(cache=True)
 def build_cumulated_image_lookup_table(
     array_spectra, array_pixel_indexes, img_shape, divider_lookup, size_spectrum=2000
 ):
@@ -150,7 +150,7 @@ def build_cumulated_image_lookup_table(
     return image_lookup_table
 
 
-@njit
+@njit(cache=True)
 def build_index_lookup_table_averaged_spectrum(array_mz, size_spectrum=2000):
     """This function builds a lookup table identical to the one defined in
     build_index_lookup_table(), except that this one maps mz values to indexes in the averaged
@@ -8,8 +8,10 @@
 # ==================================================================================================
 
 # Standard modules
+import fcntl
 import os
 import shutil
+from contextlib import contextmanager
 import psutil
 
 # ==================================================================================================
@@ -45,3 +47,24 @@ def delete_all_files_in_folder(input_folder):
                 shutil.rmtree(file_path)
         except Exception as e:
             print("Failed to delete %s. Reason: %s" % (file_path, e))
+
+
+@contextmanager
+def file_lock(path_lock, shared=False):
+    """This function returns a context manager holding an advisory lock (fcntl) on a lock file, such
+    that a resource can be accessed by several processes (e.g. gunicorn workers) in turn.
+
+    Args:
+        path_lock (str): Path of the lock file, created if needed.
+        shared (bool, optional): If True, a shared lock is acquired (several processes can hold it
+            at the same time), else an exclusive lock. Defaults to False.
+
+    Yields:
+        None
+    """
+    with open(path_lock, "a") as handle:
+        fcntl.flock(handle, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(handle, fcntl.LOCK_UN)
@@ -10,18 +10,59 @@ lipid annotation, for of a given slice) are defined.
 # ==================================================================================================
 
 # Standard modules
+import importlib
+import os
 import time
 import numpy as np
-from numba import njit
+import numba
+from numba import njit, prange
 import logging
 from typing import Tuple
 
+# LBAE imports
+from modules.execution import return_execution_pool, ExecutionQueueFull
+
+
+def check_threadsafe_threading_layer():
+    """This function checks if a threading layer of numba supporting concurrent launches of
+    parallel kernels (i.e. tbb or omp) is available. The parallel kernels are launched from several
+    threads of the execution pool, which the fallback layer (workqueue) doesn't support.
+
+    Returns:
+        (bool): True if a threadsafe threading layer is available.
+    """
+    for module in ["numba.np.ufunc.tbbpool", "numba.np.ufunc.omppool"]:
+        try:
+            importlib.import_module(module)
+            return True
+        except Exception:
+            continue
+    return False
+
+
+# Parallelize the kernels only if it's safe to do so, and never let numba pick the workqueue layer
+PARALLEL_KERNELS = check_threadsafe_threading_layer()
+if PARALLEL_KERNELS and "NUMBA_THREADING_LAYER" not in os.environ:
+    numba.config.THREADING_LAYER = "threadsafe"
+
+
+def return_number_of_threads():
+    """This function returns the number of threads the parallel kernels can use. It must be called
+    outside of the jitted functions, as a jitted function calling numba.get_num_threads() can't be
+    cached on disk.
+
+    Returns:
+        (int): The number of threads of numba, or 1 if the kernels are not parallelized.
+    """
+    return numba.get_num_threads() if PARALLEL_KERNELS else 1
+
+
 # ==================================================================================================
 # --- Functions for coordinates indices manipulation
 # ==================================================================================================
 
 
-@njit
+@njit(cache=True)
 def convert_spectrum_idx_to_coor(index, shape):
     """This function takes a pixel index and converts it into a tuple of integers representing the
     coordinates of the pixel in the current slice.
@@ -36,7 +77,7 @@ def convert_spectrum_idx_to_coor(index, shape):
     return int(index / shape[1]), int(index % shape[1])
 
 
-@njit
+@njit(cache=True)
 def convert_coor_to_spectrum_idx(coordinate, shape):
     """This function takes a tuple of integers representing the coordinates of the pixel in the
     current slice and converts it into an index in a flattened version of the image.
@@ -60,7 +101,7 @@ def convert_coor_to_spectrum_idx(coordinate, shape):
 # ==================================================================================================
 
 
-@njit
+@njit(cache=True, nogil=True)
 def compute_normalized_spectra(array_spectra, array_pixel_indexes):
     """This function takes an array of spectra and returns it normalized (per pixel). In pratice,
     each pixel spectrum is converted into a uncompressed version, and divided by the sum of all
@@ -131,7 +172,7 @@ def compute_normalized_spectra(array_spectra, array_pixel_indexes):
     return array_spectra_normalized
 
 
-@njit
+@njit(cache=True, nogil=True)
 def convert_array_to_fine_grained(array, resolution, lb=350, hb=1250):
     """This function converts an array to a fine-grained version, which is common to all pixels,
     allowing for easier computations. If several values of the compressed version map to the same
@@ -160,7 +201,7 @@ def convert_array_to_fine_grained(array, resolution, lb=350, hb=1250):
     return new_array
 
 
-@njit
+@njit(cache=True, nogil=True)
 def strip_zeros(array):
     """This function strips a (potentially sparse) array (e.g. one that has been converted with
     convert_array_to_fine_grained) from its columns having intensity zero.
@@ -186,7 +227,7 @@ def strip_zeros(array):
 # ==================================================================================================
 
 
-@njit
+@njit(cache=True, nogil=True)
 def compute_image_using_index_lookup(
     low_bound,
     high_bound,
@@ -267,7 +308,7 @@ def compute_image_using_index_lookup(
     return image
 
 
-@njit
+@njit(cache=True, nogil=True)
 def _fill_image(
     image,
     idx_pix,
@@ -358,7 +399,7 @@ def compute_image_using_index_and_image_lookup(
     )
 
 
-@njit
+@njit(cache=True, nogil=True)
 def _compute_image_using_index_and_image_lookup_partial(
     array_spectra,
     array_pixel_indexes,
@@ -418,7 +459,7 @@ def _compute_image_using_index_and_image_lookup_partial(
     return image
 
 
-@njit
+@njit(cache=True, nogil=True)
 def _correct_image(
     image,
     idx_pix,
@@ -539,7 +580,7 @@ def compute_normalized_image_per_lipid(
 # ==================================================================================================
 
 
-@njit
+@njit(cache=True)
 def compute_index_boundaries_nolookup(low_bound, high_bound, array_spectra_avg):
     """This function computes, from array_spectra_avg, the first existing indices corresponding to
     m/z values above the provided lower and higher bounds, without using any lookup. If high_bound
@@ -580,7 +621,7 @@ def compute_index_boundaries_nolookup(low_bound, high_bound, array_spectra_avg):
     return index_low_bound, index_high_bound
 
 
-@njit
+@njit(cache=True)
 def compute_index_boundaries(low_bound, high_bound, array_spectra_avg, lookup_table):
     """This function is very much similar to compute_index_boundaries_nolookup(), except that it
     uses lookup_table to find the low and high bounds indices faster. As in
@@ -622,7 +663,7 @@ def compute_index_boundaries(low_bound, high_bound, array_spectra_avg, lookup_ta
     )
 
 
-@njit
+@njit(cache=True)
 def _loop_compute_index_boundaries(
     array_to_sum_lb, array_to_sum_hb, low_bound, high_bound, lookup_table
 ):
@@ -648,12 +689,195 @@ def _loop_compute_index_boundaries(
     return index_low_bound, index_high_bound
 
 
+# ==================================================================================================
+# --- Functions to decimate averaged spectra
+# ==================================================================================================
+
+
+@njit(cache=True, nogil=True)
+def decimate_spectrum_min_max(array_spectra_avg, bin_width):
+    """This function decimates a spectrum by splitting the m/z axis into bins of equal width, and
+    keeping only, in each bin, the peaks of lowest and highest intensity (in their m/z order). As
+    opposed to a regular downsampling, the maxima (and the gaps between peaks) are preserved, such
+    that the decimated spectrum is visually identical to the original one at the corresponding
+    zoom level. Note that array_spectra_avg normally corresponds to the high-resolution spectrum
+    averaged across all pixels, but in can be any spectrum so long as it is sorted by m/z and not
+    subdivided in pixels.
+
+    Args:
+        array_spectra_avg (np.ndarray): An array of shape (2,n) containing spectrum data (m/z and
+            intensity), sorted by m/z.
+        bin_width (float): Width of the bins, in m/z.
+
+    Returns:
+        (np.ndarray): An array of shape (2,k), with k <= n, containing the decimated spectrum.
+    """
+    n = array_spectra_avg.shape[1]
+    array_decimated = np.empty((2, n), dtype=array_spectra_avg.dtype)
+    if n == 0:
+        return array_decimated
+
+    mz_start = array_spectra_avg[0, 0]
+    k = 0
+    i = 0
+    while i < n:
+        # Browse the peaks of the current bin
+        bin_index = int((array_spectra_avg[0, i] - mz_start) / bin_width)
+        idx_min = i
+        idx_max = i
+        j = i + 1
+        while j < n and int((array_spectra_avg[0, j] - mz_start) / bin_width) == bin_index:
+            if array_spectra_avg[1, j] < array_spectra_avg[1, idx_min]:
+                idx_min = j
+            if array_spectra_avg[1, j] > array_spectra_avg[1, idx_max]:
+                idx_max = j
+            j += 1
+
+        # Record the extrema of the bin in m/z order
+        if idx_min == idx_max:
+            array_decimated[:, k] = array_spectra_avg[:, idx_min]
+            k += 1
+        else:
+            array_decimated[:, k] = array_spectra_avg[:, min(idx_min, idx_max)]
+            array_decimated[:, k + 1] = array_spectra_avg[:, max(idx_min, idx_max)]
+            k += 2
+        i = j
+
+    return array_decimated[:, :k]
+
+
+# ==================================================================================================
+# --- Functions to merge sorted spectra
+# ==================================================================================================
+
+
+@njit(cache=True, nogil=True)
+def sift_down_heap(heap_mz, heap_run, size, index):
+    """This function restores the heap property of a binary min-heap of runs, ordered by the m/z
+    value of their current peak, ties being broken by the index of the run, from a given node.
+
+    Args:
+        heap_mz (np.ndarray): The m/z value of the current peak of each run in the heap.
+        heap_run (np.ndarray): The index of each run in the heap.
+        size (int): The number of runs in the heap.
+        index (int): The node from which the heap property must be restored.
+    """
+    while True:
+        smallest = index
+        for child in (2 * index + 1, 2 * index + 2):
+            if child < size and (
+                heap_mz[child] < heap_mz[smallest]
+                or (heap_mz[child] == heap_mz[smallest] and heap_run[child] < heap_run[smallest])
+            ):
+                smallest = child
+        if smallest == index:
+            return
+        heap_mz[index], heap_mz[smallest] = heap_mz[smallest], heap_mz[index]
+        heap_run[index], heap_run[smallest] = heap_run[smallest], heap_run[index]
+        index = smallest
+
+
+@njit(cache=True, nogil=True)
+def merge_sorted_runs(array_spectra, array_run_offsets, array_spectra_merged):
+    """This function merges contiguous runs of peaks, each sorted by m/z, with a heap-based k-way
+    merge. The merge is stable: peaks having the same m/z value are kept in the order of their runs.
+
+    Args:
+        array_spectra (np.ndarray): An array of shape (2,n) containing spectrum data (m/z and
+            intensity).
+        array_run_offsets (np.ndarray): The index of the first peak of each run in array_spectra,
+            followed by the index following the last peak of the last run.
+        array_spectra_merged (np.ndarray): An array of shape (2,n), in which the merged peaks are
+            written, between array_run_offsets[0] and array_run_offsets[-1].
+    """
+    n_runs = array_run_offsets.shape[0] - 1
+    heap_mz = np.empty(n_runs, dtype=array_spectra.dtype)
+    heap_run = np.empty(n_runs, dtype=np.int64)
+    array_positions = array_run_offsets[:-1].copy()
+
+    # Build the heap with the first peak of each non-empty run
+    size = 0
+    for idx_run in range(n_runs):
+        if array_run_offsets[idx_run + 1] > array_run_offsets[idx_run]:
+            heap_mz[size] = array_spectra[0, array_run_offsets[idx_run]]
+            heap_run[size] = idx_run
+            size += 1
+    for index in range(size // 2 - 1, -1, -1):
+        sift_down_heap(heap_mz, heap_run, size, index)
+
+    # Pop the smallest peak and replace it with the next peak of its run
+    idx_out = array_run_offsets[0]
+    while size > 0:
+        idx_run = heap_run[0]
+        position = array_positions[idx_run]
+        array_spectra_merged[0, idx_out] = array_spectra[0, position]
+        array_spectra_merged[1, idx_out] = array_spectra[1, position]
+        idx_out += 1
+        position += 1
+        array_positions[idx_run] = position
+        if position < array_run_offsets[idx_run + 1]:
+            heap_mz[0] = array_spectra[0, position]
+        else:
+            size -= 1
+            heap_mz[0] = heap_mz[size]
+            heap_run[0] = heap_run[size]
+        sift_down_heap(heap_mz, heap_run, size, 0)
+
+
+@njit(cache=True, nogil=True, parallel=PARALLEL_KERNELS)
+def merge_sorted_spectra(array_spectra, array_run_offsets, n_threads=1):
+    """This function sorts concatenated spectra by m/z, exploiting the fact that the spectrum of
+    each pixel is already sorted. The runs (e.g. pixels) are split into blocks of about the same
+    number of peaks, which are merged in parallel, before the blocks themselves are merged. The
+    result is identical to a stable sort of array_spectra by m/z, for a cost of O(n log(k)) instead
+    of O(n log(n)).
+
+    Args:
+        array_spectra (np.ndarray): An array of shape (2,n) containing the concatenated spectrum
+            data (m/z and intensity) of several pixels.
+        array_run_offsets (np.ndarray): The index of the first peak of each run sorted by m/z (e.g.
+            pixel spectrum) in array_spectra, followed by n.
+        n_threads (int, optional): Number of blocks merged in parallel, usually given by
+            return_number_of_threads(). Defaults to 1.
+
+    Returns:
+        (np.ndarray): An array of shape (2,n) containing the peaks of array_spectra sorted by m/z.
+    """
+    n_runs = array_run_offsets.shape[0] - 1
+    n_peaks = array_run_offsets[-1] - array_run_offsets[0]
+    n_blocks = max(1, min(n_threads, n_runs))
+    array_spectra_merged = np.empty((2, array_spectra.shape[1]), dtype=array_spectra.dtype)
+    if n_blocks == 1:
+        merge_sorted_runs(array_spectra, array_run_offsets, array_spectra_merged)
+        return array_spectra_merged
+
+    # Split the runs into blocks having about the same number of peaks
+    array_block_runs = np.searchsorted(
+        array_run_offsets, array_run_offsets[0] + np.arange(n_blocks + 1) * n_peaks // n_blocks
+    )
+    array_block_runs[0] = 0
+    array_block_runs[-1] = n_runs
+
+    # Merge the runs of each block, then the blocks
+    array_spectra_blocks = np.empty((2, array_spectra.shape[1]), dtype=array_spectra.dtype)
+    for idx_block in prange(n_blocks):
+        merge_sorted_runs(
+            array_spectra,
+            array_run_offsets[array_block_runs[idx_block] : array_block_runs[idx_block + 1] + 1],
+            array_spectra_blocks,
+        )
+    merge_sorted_runs(
+        array_spectra_blocks, array_run_offsets[array_block_runs], array_spectra_merged
+    )
+    return array_spectra_merged
+
+
 # ==================================================================================================
 # --- Functions to compute spectra averaged from a manual selection or a mask selection
 # ==================================================================================================
 
 
-@njit
+@njit(cache=True)
 def return_spectrum_per_pixel(idx_pix, array_spectra, array_pixel_indexes):
     """This function returns the spectrum of the pixel having index pixel_idx, using the lookup
     table array_pixel_indexes.
@@ -676,7 +900,7 @@ def return_spectrum_per_pixel(idx_pix, array_spectra, array_pixel_indexes):
     return array_spectra[:, idx_1 : idx_2 + 1]
 
 
-@njit
+@njit(cache=True, nogil=True)
 def add_zeros_to_spectrum(array_spectra, pad_individual_peaks=True, padding=10**-4):
     """This function adds zeros in-between the peaks of the spectra contained in array_spectra (e.g.
     to be able to plot them as scatterplotgl).
@@ -758,7 +982,7 @@ def add_zeros_to_spectrum(array_spectra, pad_individual_peaks=True, padding=10**
         return new_array_spectra, array_index_padding
 
 
-@njit
+@njit(cache=True)
 def compute_zeros_extended_spectrum_per_pixel(idx_pix, array_spectra, array_pixel_indexes):
     """This function computes a zero-extended version of the spectrum of pixel indexed by idx_pix.
 
@@ -778,7 +1002,7 @@ def compute_zeros_extended_spectrum_per_pixel(idx_pix, array_spectra, array_pixe
     return new_array_spectra
 
 
-@njit
+@njit(cache=True, nogil=True)
 def reduce_resolution_sorted_array_spectra(array_spectra, resolution=10**-3):
     """Recompute a sparce representation of the spectrum at a lower (fixed) resolution, summing over
         the redundant bins. Resolution should be <=10**-4 as it's about the maximum precision
@@ -809,7 +1033,7 @@ def reduce_resolution_sorted_array_spectra(array_spectra, resolution=10**-3):
 
 # * Caution, a very similar function is also in maldi_conversion.py, meaning that if a change is
 # * made here, it should probably be made there too
-@njit
+@njit(cache=True, nogil=True)
 def compute_standardization(array_spectra_pixel, idx_pixel, array_peaks, array_corrective_factors):
     """This function takes the spectrum data of a given pixel, along with the corresponding pixel
     index, and transforms the value of the lipids intensities annotated in 'array_peaks' according
@@ -876,7 +1100,7 @@ def compute_standardization(array_spectra_pixel, idx_pixel, array_peaks, array_c
     return array_spectra_pixel, n_peaks_transformed
 
 
-@njit
+@njit(cache=True, nogil=True)
 def compute_spectrum_per_row_selection(
     list_index_bound_rows,
     list_index_bound_column_per_row,
@@ -887,6 +1111,7 @@ def compute_spectrum_per_row_selection(
     array_corrective_factors,
     zeros_extend=True,
     apply_correction=False,
+    n_threads=1,
 ):
     """This function computes the average spectrum from a manual selection of rows of pixel (each
     containing a spectrum). The resulting average array can be zero-padded.
@@ -914,11 +1139,81 @@ def compute_spectrum_per_row_selection(
             belonging to array_peaks_transformed_lipids, for each pixel. This option makes the
             computation very slow, so it shouldn't be selected if the computations must be done on
             the fly. Defaults to False.
+        n_threads (int, optional): Number of threads used to sort the peaks, usually given by
+            return_number_of_threads(). Defaults to 1.
 
     Returns:
         (np.ndarray): Spectrum averaged from a manual selection of rows of pixel, containing m/z
             values in the first row, and intensities in the second row.
     """
+    # Get the peaks of the selection, sorted by m/z
+    array_spectra_selection = compute_sorted_spectra_per_row_selection(
+        list_index_bound_rows,
+        list_index_bound_column_per_row,
+        array_spectra,
+        array_pixel_indexes,
+        image_shape,
+        array_peaks_transformed_lipids,
+        array_corrective_factors,
+        apply_correction=apply_correction,
+        n_threads=n_threads,
+    )
+
+    # Sum the arrays (similar m/z values are added)
+    array_spectra_selection = reduce_resolution_sorted_array_spectra(
+        array_spectra_selection, resolution=10**-4
+    )
+
+    # Pad with zeros if asked
+    if zeros_extend:
+        array_spectra_selection, array_index_padding = add_zeros_to_spectrum(
+            array_spectra_selection
+        )
+    return array_spectra_selection
+
+
+@njit(cache=True, nogil=True)
+def compute_sorted_spectra_per_row_selection(
+    list_index_bound_rows,
+    list_index_bound_column_per_row,
+    array_spectra,
+    array_pixel_indexes,
+    image_shape,
+    array_peaks_transformed_lipids,
+    array_corrective_factors,
+    apply_correction=False,
+    n_threads=1,
+):
+    """This function concatenates the spectra of a manual selection of rows of pixel, and sorts the
+    resulting peaks by m/z.
+
+    Args:
+        list_index_bound_rows (list(tuple)): A list of lower and upper indices delimiting the range
+            of rows belonging to the current selection.
+        list_index_bound_column_per_row (list(list)): For each row (outer list), provides the index
+            of the columns delimiting the current selection (inner list).
+        array_spectra (np.ndarray): An array of shape (2,n) containing spectrum
+            data (m/z and intensity) for each pixel.
+        array_pixel_indexes (np.ndarray): An array of shape (m,2) containing the boundary indices of
+            each pixel in array_spectra.
+        image_shape (int, int): A tuple of integers, indicating the vertical and horizontal sizes of
+            the current slice.
+        array_peaks_transformed_lipids (np.ndarray): A numpy array containing the peak annotations
+            (min peak, max peak, number of pixels containing the peak, average value of the peak),
+            filtered for the lipids who have preliminarily been transformed. Sorted by min_mz.
+        array_corrective_factors (np.ndarray): A numpy array of shape (n_lipids, image_shape[0],
+            image_shape[1]) containing the corrective factors for the lipids we want to visualize,
+            for each pixel.
+        apply_correction (bool, optional): If True, MAIA transformation is applied to the lipids
+            belonging to array_peaks_transformed_lipids, for each pixel, and the peaks zeroed-out
+            by the transformation are removed. Defaults to False.
+        n_threads (int, optional): Number of threads used to sort the peaks, usually given by
+            return_number_of_threads(). Defaults to 1.
+
+    Returns:
+        (np.ndarray): The peaks of the selection, sorted by m/z, containing m/z values in the first
+            row, and intensities in the second row.
+    """
     # Get list of row indexes for the current selection
     ll_idx, size_array, ll_idx_pix = get_list_row_indexes(
         list_index_bound_rows, list_index_bound_column_per_row, array_pixel_indexes, image_shape
@@ -928,6 +1223,14 @@ def compute_spectrum_per_row_selection(
     array_spectra_selection = np.zeros((2, size_array), dtype=np.float32)
     pad = 0
 
+    # Record the boundaries of each pixel spectrum (sorted by m/z) in the selection
+    n_pixels = 0
+    for i in range(len(ll_idx_pix)):
+        for idx_pix_1, idx_pix_2 in zip(ll_idx_pix[i][0:-1:2], ll_idx_pix[i][1::2]):
+            n_pixels += idx_pix_2 + 1 - idx_pix_1
+    array_run_offsets = np.zeros(n_pixels + 1, dtype=np.int64)
+    n_runs = 0
+
     # Fill array line by line
     for i, x in enumerate(range(list_index_bound_rows[0], list_index_bound_rows[1] + 1)):
         for idx_1, idx_2, idx_pix_1, idx_pix_2 in zip(
@@ -938,6 +1241,8 @@ def compute_spectrum_per_row_selection(
                     idx_mz_1, idx_mz_2 = array_pixel_indexes[idx_pix]
                     # If the pixel is not empty
                     if idx_mz_2 - idx_mz_1 > 0:
+                        n_runs += 1
+                        array_run_offsets[n_runs] = pad + idx_mz_2 + 1 - idx_mz_1
                         array_spectra_pix_to_correct = array_spectra[
                             :, idx_mz_1 : idx_mz_2 + 1
                         ].copy()
@@ -955,20 +1260,197 @@ def compute_spectrum_per_row_selection(
                 array_spectra_selection[:, pad : pad + idx_2 + 1 - idx_1] = array_spectra[
                     :, idx_1 : idx_2 + 1
                 ]
+                for idx_pix in range(idx_pix_1, idx_pix_2 + 1):
+                    idx_mz_1, idx_mz_2 = array_pixel_indexes[idx_pix]
+                    if idx_mz_1 != -1:
+                        n_runs += 1
+                        array_run_offsets[n_runs] = pad + idx_mz_2 + 1 - idx_1
                 pad += idx_2 + 1 - idx_1
 
-    # Sort array
-    array_spectra_selection = array_spectra_selection[:, array_spectra_selection[0].argsort()]
+    # Sort array, merging the (already sorted) pixel spectra
+    array_run_offsets[n_runs] = pad
+    array_spectra_selection = merge_sorted_spectra(
+        array_spectra_selection[:, :pad], array_run_offsets[: n_runs + 1], n_threads=n_threads
+    )
 
     # Remove the values that have been zeroed-out
     if apply_correction:
         array_spectra_selection = strip_zeros(array_spectra_selection)
 
-    # Sum the arrays (similar m/z values are added)
-    array_spectra_selection = reduce_resolution_sorted_array_spectra(
-        array_spectra_selection, resolution=10**-4
+    return array_spectra_selection
+
+
+@njit(cache=True, nogil=True)
+def merge_binned_spectra(array_mz_1, array_intensity_1, array_mz_2, array_intensity_2):
+    """This function merges two binned spectra (e.g. as returned by reduce_resolution_sorted()),
+    summing the intensities of the bins present in both.
+
+    Args:
+        array_mz_1 (np.ndarray): The sorted unique m/z bins of the first spectrum.
+        array_intensity_1 (np.ndarray): The intensities of the first spectrum.
+        array_mz_2 (np.ndarray): The sorted unique m/z bins of the second spectrum.
+        array_intensity_2 (np.ndarray): The intensities of the second spectrum.
+
+    Returns:
+        (np.ndarray, np.ndarray): The sorted unique m/z bins and intensities of the merged spectrum.
+    """
+    array_mz = np.empty(array_mz_1.shape[0] + array_mz_2.shape[0], dtype=np.float64)
+    array_intensity = np.empty(array_mz.shape[0], dtype=np.float64)
+    i_1 = 0
+    i_2 = 0
+    i = 0
+    while i_1 < array_mz_1.shape[0] or i_2 < array_mz_2.shape[0]:
+        if i_2 == array_mz_2.shape[0] or (
+            i_1 < array_mz_1.shape[0] and array_mz_1[i_1] < array_mz_2[i_2]
+        ):
+            array_mz[i] = array_mz_1[i_1]
+            array_intensity[i] = array_intensity_1[i_1]
+            i_1 += 1
+        elif i_1 == array_mz_1.shape[0] or array_mz_2[i_2] < array_mz_1[i_1]:
+            array_mz[i] = array_mz_2[i_2]
+            array_intensity[i] = array_intensity_2[i_2]
+            i_2 += 1
+        else:
+            array_mz[i] = array_mz_1[i_1]
+            array_intensity[i] = array_intensity_1[i_1] + array_intensity_2[i_2]
+            i_1 += 1
+            i_2 += 1
+        i += 1
+    return array_mz[:i], array_intensity[:i]
+
+
+# Memory used per peak of a block of rows: the float32 concatenated and merged spectra, and the
+# float64 binned spectrum
+BYTES_PER_PEAK_SELECTION = 32
+
+
+def compute_spectrum_per_row_selection_bounded(
+    list_index_bound_rows,
+    list_index_bound_column_per_row,
+    array_spectra,
+    array_pixel_indexes,
+    image_shape,
+    array_peaks_transformed_lipids,
+    array_corrective_factors,
+    zeros_extend=True,
+    apply_correction=False,
+    memory_limit_bytes=2**28,
+    set_progress=None,
+    return_array_spectra_rows=None,
+):
+    """This function computes the same spectrum as compute_spectrum_per_row_selection(), but with a
+    bounded memory usage: the rows of the selection are processed by blocks whose peaks fit in
+    memory_limit_bytes, and the binned spectrum of each block is added to the binned spectrum of
+    the previous ones. A large selection is therefore slower to process, rather than allocating
+    memory proportionally to its number of peaks. If the whole selection fits in a single block,
+    the result is identical to the one of compute_spectrum_per_row_selection().
+
+    Args:
+        list_index_bound_rows (list(tuple)): A list of lower and upper indices delimiting the range
+            of rows belonging to the current selection.
+        list_index_bound_column_per_row (np.ndarray): For each row, provides the index of the
+            columns delimiting the current selection (zero-padded).
+        array_spectra (np.ndarray): An array of shape (2,n) containing spectrum data (m/z and
+            intensity) for each pixel. Not used if return_array_spectra_rows is provided.
+        array_pixel_indexes (np.ndarray): An array of shape (m,2) containing the boundary indices of
+            each pixel in array_spectra.
+        image_shape (int, int): A tuple of integers, indicating the vertical and horizontal sizes of
+            the current slice.
+        array_peaks_transformed_lipids (np.ndarray): A numpy array containing the peak annotations
+            (min peak, max peak, number of pixels containing the peak, average value of the peak),
+            filtered for the lipids who have preliminarily been transformed. Sorted by min_mz.
+        array_corrective_factors (np.ndarray): A numpy array of shape (n_lipids, image_shape[0],
+            image_shape[1]) containing the corrective factors for the lipids we want to visualize,
+            for each pixel.
+        zeros_extend (bool, optional): If True, the resulting spectrum will be zero-padded. Defaults
+            to True.
+        apply_correction (bool, optional): If True, MAIA transformation is applied to the lipids
+            belonging to array_peaks_transformed_lipids, for each pixel. Defaults to False.
+        memory_limit_bytes (int, optional): Maximum memory used to process a block of rows, in
+            bytes. Defaults to 256MB.
+        set_progress: Used as part of the Plotly long callbacks, to indicate the progress of the
+            computation in the corresponding progress bar. Defaults to None.
+        return_array_spectra_rows (func, optional): If provided, it is called with the first and
+            last rows of each block, and must return the corresponding spectral data and lookup
+            table (e.g. MaldiData.get_array_spectra_rows()), such that the spectral data doesn't
+            need to be fully loaded. Defaults to None.
+
+    Returns:
+        (np.ndarray): Spectrum averaged from a manual selection of rows of pixel, containing m/z
+            values in the first row, and intensities in the second row.
+    """
+    # Get the number of peaks of each row of the selection
+    ll_idx, size_array, ll_idx_pix = get_list_row_indexes(
+        list_index_bound_rows, list_index_bound_column_per_row, array_pixel_indexes, image_shape
+    )
+    l_n_peaks_per_row = [
+        sum(idx_2 + 1 - idx_1 for idx_1, idx_2 in zip(l_idx[0:-1:2], l_idx[1::2]))
+        for l_idx in ll_idx
+    ]
+
+    # Group consecutive rows into blocks fitting in memory (a row is never split)
+    n_peaks_max = max(1, memory_limit_bytes // BYTES_PER_PEAK_SELECTION)
+    l_blocks = []
+    idx_row_start = 0
+    n_peaks_block = 0
+    for idx_row, n_peaks in enumerate(l_n_peaks_per_row):
+        if n_peaks_block > 0 and n_peaks_block + n_peaks > n_peaks_max:
+            l_blocks.append((idx_row_start, idx_row - 1))
+            idx_row_start = idx_row
+            n_peaks_block = 0
+        n_peaks_block += n_peaks
+    l_blocks.append((idx_row_start, len(l_n_peaks_per_row) - 1))
+    logging.info(
+        "Computing the spectrum of "
+        + str(size_array)
+        + " peaks in "
+        + str(len(l_blocks))
+        + " blocks of rows"
     )
 
+    # Accumulate the binned spectrum of each block
+    n_threads = return_number_of_threads()
+    array_mz = np.empty(0, dtype=np.float64)
+    array_intensity = np.empty(0, dtype=np.float64)
+    for idx_block, (idx_row_1, idx_row_2) in enumerate(l_blocks):
+        row_1 = int(list_index_bound_rows[0]) + idx_row_1
+        row_2 = int(list_index_bound_rows[0]) + idx_row_2
+        if return_array_spectra_rows is not None:
+            array_spectra, array_pixel_indexes = return_array_spectra_rows(row_1, row_2)
+        array_spectra_block = compute_sorted_spectra_per_row_selection(
+            np.array([row_1, row_2], dtype=np.asarray(list_index_bound_rows).dtype),
+            list_index_bound_column_per_row[idx_row_1 : idx_row_2 + 1],
+            array_spectra,
+            array_pixel_indexes,
+            image_shape,
+            array_peaks_transformed_lipids,
+            array_corrective_factors,
+            apply_correction=apply_correction,
+            n_threads=n_threads,
+        )
+        array_mz_block, array_intensity_block = reduce_resolution_sorted(
+            array_spectra_block[0, :], array_spectra_block[1, :], 10**-4, max_intensity=False
+        )
+        del array_spectra_block
+        array_mz, array_intensity = merge_binned_spectra(
+            array_mz, array_intensity, array_mz_block, array_intensity_block
+        )
+        if set_progress is not None:
+            set_progress(
+                (
+                    int((idx_block + 1) / len(l_blocks) * 100),
+                    "Computing spectrum (block "
+                    + str(idx_block + 1)
+                    + "/"
+                    + str(len(l_blocks))
+                    + ")",
+                )
+            )
+
+    array_spectra_selection = np.empty((2, array_mz.shape[0]), dtype=np.float32)
+    array_spectra_selection[0, :] = array_mz
+    array_spectra_selection[1, :] = array_intensity
+
     # Pad with zeros if asked
     if zeros_extend:
         array_spectra_selection, array_index_padding = add_zeros_to_spectrum(
@@ -977,7 +1459,7 @@ def compute_spectrum_per_row_selection(
     return array_spectra_selection
 
 
-@njit
+@njit(cache=True)
 def get_list_row_indexes(
     list_index_bound_rows, list_index_bound_column_per_row, array_pixel_indexes, image_shape
 ):
@@ -1031,24 +1513,22 @@ def get_list_row_indexes(
             )
             idx_2 = array_pixel_indexes[idx_pix_2, 1]
 
-            # Case we started or finished with empty pixel
+            # Case we started or finished with empty pixel. The search remains within the current
+            # interval, such that the pixels between idx_pix_1 and idx_pix_2 are exactly the ones
+            # whose spectra lie between idx_1 and idx_2
             if idx_1 == -1 or idx_2 == -1:
                 # Move forward until a non-empty pixel is found for idx_1
-                j = 1
-                while idx_1 == -1:
-                    idx_1 = array_pixel_indexes[idx_pix_1 + j, 0]
-                    j += 1
-                idx_pix_1 = idx_pix_1 + j - 1
+                while idx_1 == -1 and idx_pix_1 < idx_pix_2:
+                    idx_pix_1 += 1
+                    idx_1 = array_pixel_indexes[idx_pix_1, 0]
 
                 # Move backward until a non-empty pixel is found for idx_2
-                j = 1
-                while idx_2 == -1:
-                    idx_2 = array_pixel_indexes[idx_pix_2 - j, 1]
-                    j += 1
-                idx_pix_2 = idx_pix_2 + j - 1
-
-            # Check that we still have idx_2>=idx_1
-            if idx_1 > idx_2:
+                while idx_2 == -1 and idx_pix_2 > idx_pix_1:
+                    idx_pix_2 -= 1
+                    idx_2 = array_pixel_indexes[idx_pix_2, 1]
+
+            # Check that the interval is not empty, and that we still have idx_2>=idx_1
+            if idx_1 == -1 or idx_2 == -1 or idx_1 > idx_2:
                 pass
             else:
                 size_array += idx_2 + 1 - idx_1
@@ -1061,7 +1541,7 @@ def get_list_row_indexes(
     return ll_idx, size_array, ll_idx_pix
 
 
-@njit
+@njit(cache=True)
 def sample_rows_from_path(path):
     """This function takes a path as input and returns the lower and upper indexes of the rows
     belonging to the current selection (i.e. indexed in the path), as well as the corresponding
@@ -1157,7 +1637,7 @@ def sample_rows_from_path(path):
     return np.array([x_min, x_max], dtype=np.int32), array_index_bound_column_per_row
 
 
-@njit
+@njit(cache=True)
 def return_index_labels(l_min, l_max, l_mz, zero_padding_extra=5 * 10**-5):
     """This function returns the corresponding lipid name indices from a list of m/z values. Note
     that the zero_padding_extra parameter is needed for both taking into account the zero-padding
@@ -1200,7 +1680,7 @@ def return_index_labels(l_min, l_max, l_mz, zero_padding_extra=5 * 10**-5):
     return array_indexes
 
 
-@njit
+@njit(cache=True)
 def return_idx_sup(l_idx_labels):
     """Returns the indices of the lipids that have an annotation
 
@@ -1213,7 +1693,7 @@ def return_idx_sup(l_idx_labels):
     return [i for i, x in enumerate(l_idx_labels) if x >= 0]
 
 
-@njit
+@njit(cache=True)
 def return_idx_inf(l_idx_labels):
     """Returns the indices of the lipids that do not have an annotation
 
@@ -1226,7 +1706,7 @@ def return_idx_inf(l_idx_labels):
     return [i for i, x in enumerate(l_idx_labels) if x < 0]
 
 
-@njit
+@njit(cache=True)
 def compute_avg_intensity_per_lipid(l_intensity_with_lipids, l_idx_labels):
     """This function computes the average intensity of each annotated lipid (summing over peaks
     coming from the same lipid) from a given spectrum.
@@ -1309,7 +1789,13 @@ def global_lipid_index_store(data, slice_index, l_spectra):
 
 
 def compute_thread_safe_function(
-    compute_function, cache, data, slice_index, *args_compute_function, **kwargs_compute_function
+    compute_function,
+    cache,
+    data,
+    slice_index,
+    *args_compute_function,
+    task_class="interactive",
+    **kwargs_compute_function
 ):
     """This function is a wrapper for safe multithreading and multiprocessing execution of
     compute_function. This is needed due to the regular cleansing of memory-mapped object.
@@ -1319,10 +1805,18 @@ def compute_thread_safe_function(
         cache (flask_caching.Cache): A caching object, used to check if the reading of memory-mapped
             data is safe
         *args_compute_function: Arguments of compute_function.
+        task_class (str, optional): Class of the task in the execution pool (see
+            modules/execution.py), i.e. "interactive", "heavy" or "background". If None,
+            compute_function is run directly in the calling thread (or greenlet), which is only
+            suitable for very fast functions. Defaults to "interactive".
         **kwargs_compute_function: Named arguments of compute_function.
 
     Returns:
         The result of compute_function. Type may vary depending on compute_function.
+
+    Raises:
+        ExecutionQueueFull: If the queue of the task class is full, i.e. the server is overloaded.
+            The data is unlocked before the exception is propagated to the caller.
     """
 
     logging.info(
@@ -1341,10 +1835,23 @@ def compute_thread_safe_function(
     else:
         logging.warning("No cache provided, the thread unsafe version of the function will be run")
 
-    # Run the actual function
+    # Run the actual function, off the event loop if a task class is provided
+    exception_queue_full = None
     try:
-        result = compute_function(*args_compute_function, **kwargs_compute_function)
-    except:
+        if task_class is None:
+            result = compute_function(*args_compute_function, **kwargs_compute_function)
+        else:
+            result = return_execution_pool().run(
+                task_class, compute_function, *args_compute_function, **kwargs_compute_function
+            )
+    except ExecutionQueueFull as e:
+        # The task hasn't been run at all, so the caller must not consider it as failed
+        logging.warning(
+            'The function "%s" was rejected by the execution pool' % str(compute_function)
+        )
+        exception_queue_full = e
+        result = None
+    except Exception:
         logging.warning('The function "%s" failed to run' % str(compute_function))
         result = None
 
@@ -1356,6 +1863,10 @@ def compute_thread_safe_function(
         # Clean the memory-mapped data
         data.clean_memory(slice_index=slice_index, cache=cache)
 
+    # Propagate the rejection of the task once the data has been unlocked
+    if exception_queue_full is not None:
+        raise exception_queue_full
+
     # Return result
     return result
 
@@ -1365,7 +1876,7 @@ def compute_thread_safe_function(
 # ==================================================================================================
 
 
-@njit
+@njit(cache=True, nogil=True)
 def reduce_resolution_sorted(
     mz: np.ndarray, intensity: np.ndarray, resolution: float, max_intensity=True
 ) -> Tuple[np.ndarray, np.ndarray]:
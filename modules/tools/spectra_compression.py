@@ -0,0 +1,508 @@
+# Copyright (c) 2022, Colas Droin. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
+
+""" This file contains the functions and the class used to store the spectral data of each slice
+(array_spectra) in a compressed format, and to read it back with the same access patterns as the
+uncompressed memory maps.
+
+The concatenated spectra are split into chunks of about chunk_size peaks, each chunk starting at
+the beginning of a pixel spectrum, such that each chunk can be decoded independently. In each
+chunk, the m/z values (sorted within each pixel) are delta-encoded on their binary representation,
+which is lossless, while the intensities are quantized with a configurable absolute error bound
+(or kept as is if no error bound is given). Both streams are byte-shuffled and compressed with
+zlib. The byte offsets and peak boundaries of the chunks are stored in a separate index file, such
+that any range of peaks (e.g. the spectra of a set of rows of pixels) can be read by decoding only
+the chunks it overlaps. The decoded chunks are kept in a least-recently-used cache with a memory
+budget.
+
+For a slice whose spectra are stored in path_data + "array_spectra_" + slice_index + ".mmap", the
+compressed data is stored in path_data + "array_spectra_" + slice_index + ".lbs", and the index in
+path_data + "array_spectra_" + slice_index + "_index.npz".
+"""
+
+# ==================================================================================================
+# --- Imports
+# ==================================================================================================
+
+# Standard modules
+import logging
+import os
+import pickle
+import threading
+import time
+import zlib
+from collections import OrderedDict
+import numpy as np
+
+# LBAE imports
+from modules.tools.misc import logmem
+
+# Codes of the intensity encodings, stored for each chunk in the index
+INTENSITY_FLOAT32 = 0
+INTENSITY_UINT16 = 1
+INTENSITY_INT32 = 2
+
+# ==================================================================================================
+# --- Functions to encode and decode chunks
+# ==================================================================================================
+
+
+def shuffle_bytes(array):
+    """This function groups the bytes of same significance of the elements of an array, which
+    makes slowly varying values much more compressible.
+
+    Args:
+        array (np.ndarray): A unidimensional array.
+
+    Returns:
+        (bytes): The shuffled bytes of the array.
+    """
+    return np.ascontiguousarray(array).view(np.uint8).reshape(-1, array.itemsize).T.tobytes()
+
+
+def unshuffle_bytes(buffer, dtype):
+    """This function reverts shuffle_bytes().
+
+    Args:
+        buffer (bytes): The shuffled bytes.
+        dtype (np.dtype): The type of the elements of the original array.
+
+    Returns:
+        (np.ndarray): The original unidimensional array.
+    """
+    itemsize = np.dtype(dtype).itemsize
+    array = np.frombuffer(buffer, dtype=np.uint8).reshape(itemsize, -1)
+    return np.ascontiguousarray(array.T).view(dtype).ravel()
+
+
+def encode_chunk(array_spectra_chunk, intensity_error=None, compression_level=6):
+    """This function encodes a chunk of concatenated pixel spectra.
+
+    Args:
+        array_spectra_chunk (np.ndarray): An array of shape (2,n) containing the spectrum data (m/z
+            and intensity) of consecutive pixels, starting at the beginning of a pixel spectrum.
+        intensity_error (float, optional): Maximum absolute error on the decoded intensities. If
+            None or 0, the intensities are stored losslessly. Defaults to None.
+        compression_level (int, optional): The zlib compression level. Defaults to 6.
+
+    Returns:
+        (bytes): The compressed m/z stream.
+        (bytes): The compressed intensity stream.
+        (int): The code of the intensity encoding.
+    """
+    # Positive floats have the same order as their binary representation, whose differences are
+    # small within a pixel spectrum
+    array_mz = np.ascontiguousarray(array_spectra_chunk[0], dtype=np.float32).view(np.int32)
+    array_delta_mz = np.diff(array_mz, prepend=np.int32(0)).astype(np.int32)
+    bytes_mz = zlib.compress(shuffle_bytes(array_delta_mz), compression_level)
+
+    # Quantize the intensities if an error bound is given and the quantized values fit in 32 bits
+    array_intensity = np.asarray(array_spectra_chunk[1], dtype=np.float32)
+    code = INTENSITY_FLOAT32
+    if intensity_error and array_intensity.shape[0] > 0:
+        array_quantized = np.rint(array_intensity / (2 * intensity_error))
+        if array_quantized.min() >= 0 and array_quantized.max() < 2**16:
+            array_intensity = array_quantized.astype(np.uint16)
+            code = INTENSITY_UINT16
+        elif np.abs(array_quantized).max() < 2**31:
+            array_intensity = array_quantized.astype(np.int32)
+            code = INTENSITY_INT32
+    bytes_intensity = zlib.compress(shuffle_bytes(array_intensity), compression_level)
+
+    return bytes_mz, bytes_intensity, code
+
+
+def decode_chunk(bytes_mz, bytes_intensity, code, intensity_error):
+    """This function decodes a chunk encoded with encode_chunk().
+
+    Args:
+        bytes_mz (bytes): The compressed m/z stream.
+        bytes_intensity (bytes): The compressed intensity stream.
+        code (int): The code of the intensity encoding.
+        intensity_error (float): The error bound used to quantize the intensities.
+
+    Returns:
+        (np.ndarray): An array of shape (2,n) containing the spectrum data of the chunk.
+    """
+    array_delta_mz = unshuffle_bytes(zlib.decompress(bytes_mz), np.int32)
+    array_spectra_chunk = np.empty((2, array_delta_mz.shape[0]), dtype=np.float32)
+    array_spectra_chunk[0] = np.cumsum(array_delta_mz, dtype=np.int64).astype(np.int32).view(
+        np.float32
+    )
+    if code == INTENSITY_FLOAT32:
+        array_spectra_chunk[1] = unshuffle_bytes(zlib.decompress(bytes_intensity), np.float32)
+    else:
+        dtype = np.uint16 if code == INTENSITY_UINT16 else np.int32
+        array_quantized = unshuffle_bytes(zlib.decompress(bytes_intensity), dtype)
+        array_spectra_chunk[1] = array_quantized * np.float32(2 * intensity_error)
+    return array_spectra_chunk
+
+
+def compute_chunk_boundaries(array_lookup_pixels, n_peaks, chunk_size):
+    """This function splits the concatenated spectra into chunks of about chunk_size peaks, each
+    chunk starting at the beginning of a pixel spectrum.
+
+    Args:
+        array_lookup_pixels (np.ndarray): An array of shape (m,2) containing the boundary indices
+            of each pixel in array_spectra (-1 for empty pixels).
+        n_peaks (int): Total number of peaks in array_spectra.
+        chunk_size (int): Targeted number of peaks per chunk.
+
+    Returns:
+        (np.ndarray): The index of the first peak of each chunk, followed by n_peaks.
+    """
+    array_starts = array_lookup_pixels[array_lookup_pixels[:, 0] >= 0, 0].astype(np.int64)
+    array_bins = array_starts // chunk_size
+    array_boundaries = array_starts[np.flatnonzero(np.diff(array_bins)) + 1]
+    return np.concatenate(([0], array_boundaries[array_boundaries > 0], [n_peaks])).astype(
+        np.int64
+    )
+
+
+# ==================================================================================================
+# --- Functions to write compressed spectra
+# ==================================================================================================
+
+
+def compress_array_spectra(
+    array_spectra,
+    array_lookup_pixels,
+    path,
+    chunk_size=2**18,
+    intensity_error=None,
+    compression_level=6,
+):
+    """This function writes the compressed version of the spectral data of a slice, along with its
+    index.
+
+    Args:
+        array_spectra (np.ndarray): An array of shape (2,n) containing spectrum data (m/z and
+            intensity) for each pixel. It can be a memory map.
+        array_lookup_pixels (np.ndarray): An array of shape (m,2) containing the boundary indices
+            of each pixel in array_spectra.
+        path (str): Path of the output files, without extension (e.g. path_data +
+            "array_spectra_1").
+        chunk_size (int, optional): Targeted number of peaks per chunk. Defaults to 2**18.
+        intensity_error (float, optional): Maximum absolute error on the decoded intensities. If
+            None or 0, the intensities are stored losslessly. Defaults to None.
+        compression_level (int, optional): The zlib compression level. Defaults to 6.
+
+    Returns:
+        (float): The compression ratio.
+    """
+    logging.info("Compressing spectra into " + path + ".lbs" + logmem())
+    n_peaks = array_spectra.shape[1]
+    array_boundaries = compute_chunk_boundaries(array_lookup_pixels, n_peaks, chunk_size)
+    n_chunks = array_boundaries.shape[0] - 1
+    array_offsets = np.zeros(n_chunks + 1, dtype=np.int64)
+    array_split = np.zeros(n_chunks, dtype=np.int64)
+    array_codes = np.zeros(n_chunks, dtype=np.int8)
+
+    # Write to a temporary file first so that readers never see a partial file
+    with open(path + ".lbs.tmp", "wb") as file:
+        for idx_chunk in range(n_chunks):
+            bytes_mz, bytes_intensity, array_codes[idx_chunk] = encode_chunk(
+                array_spectra[:, array_boundaries[idx_chunk] : array_boundaries[idx_chunk + 1]],
+                intensity_error,
+                compression_level,
+            )
+            file.write(bytes_mz)
+            file.write(bytes_intensity)
+            array_split[idx_chunk] = len(bytes_mz)
+            array_offsets[idx_chunk + 1] = (
+                array_offsets[idx_chunk] + len(bytes_mz) + len(bytes_intensity)
+            )
+    with open(path + "_index.npz.tmp", "wb") as file:
+        np.savez(
+            file,
+            array_boundaries=array_boundaries,
+            array_offsets=array_offsets,
+            array_split=array_split,
+            array_codes=array_codes,
+            intensity_error=np.float64(intensity_error if intensity_error else 0.0),
+        )
+    os.replace(path + ".lbs.tmp", path + ".lbs")
+    os.replace(path + "_index.npz.tmp", path + "_index.npz")
+
+    ratio = (n_peaks * 2 * 4) / max(1, int(array_offsets[-1]))
+    logging.info(
+        "Spectra compressed in "
+        + str(n_chunks)
+        + " chunks with a ratio of "
+        + str(round(ratio, 2))
+        + logmem()
+    )
+    return ratio
+
+
+def compress_slice_files(path_data, chunk_size=2**18, intensity_error=None, l_slices=None):
+    """This function writes the compressed version of the spectral data of the slices of a dataset,
+    from the uncompressed memory maps. The memory maps must be kept, as the functions needing the
+    whole spectral data of a slice (e.g. to compute lipid images) still read it from them.
+
+    Args:
+        path_data (str): Path of the folder containing the MALDI data (memory maps and lightweight
+            arrays).
+        chunk_size (int, optional): Targeted number of peaks per chunk. Defaults to 2**18.
+        intensity_error (float, optional): Maximum absolute error on the decoded intensities. If
+            None or 0, the intensities are stored losslessly. Defaults to None.
+        l_slices (list(int), optional): Indices of the slices to compress. Defaults to None,
+            corresponding to all the slices of the dataset.
+
+    Returns:
+        (dict): The compression ratio of each slice.
+    """
+    with open(path_data + "light_arrays.pickle", "rb") as handle:
+        dic_lightweight = pickle.load(handle)
+    if l_slices is None:
+        l_slices = sorted(dic_lightweight.keys())
+    dic_ratios = {}
+    for slice_index in l_slices:
+        array_spectra = np.memmap(
+            path_data + "array_spectra_" + str(slice_index) + ".mmap",
+            dtype="float32",
+            mode="r",
+            shape=dic_lightweight[slice_index]["array_spectra_shape"],
+        )
+        dic_ratios[slice_index] = compress_array_spectra(
+            array_spectra,
+            dic_lightweight[slice_index]["array_lookup_pixels"],
+            path_data + "array_spectra_" + str(slice_index),
+            chunk_size=chunk_size,
+            intensity_error=intensity_error,
+        )
+    return dic_ratios
+
+
+# ==================================================================================================
+# --- Class to read compressed spectra
+# ==================================================================================================
+
+
+class CompressedSpectra:
+    """Class used to read the compressed spectral data of a slice. It can be indexed as the (2,n)
+    array it replaces (e.g. [:, lb:hb], [:, index] or [0, :]), only the chunks overlapping the
+    requested peaks being read and decoded.
+
+    Attributes:
+        path (str): Path of the compressed files, without extension.
+        memory_limit (int): Maximum size of the decoded chunks kept in memory, in bytes.
+        shape (tuple(int)): Shape of the decompressed array, i.e. (2, n).
+        dtype (np.dtype): Type of the decompressed array, i.e. float32.
+        ndim (int): Number of dimensions of the decompressed array, i.e. 2.
+        intensity_error (float): Maximum absolute error on the decoded intensities (0 if lossless).
+        _array_boundaries (np.ndarray): Index of the first peak of each chunk, followed by n.
+        _array_offsets (np.ndarray): Byte offset of each chunk in the compressed file, followed by
+            the size of the file.
+        _array_split (np.ndarray): Size of the m/z stream of each chunk, in bytes.
+        _array_codes (np.ndarray): Code of the intensity encoding of each chunk.
+        _fd (int): File descriptor of the compressed file.
+        _dic_chunks (OrderedDict): Decoded chunks, from the least to the most recently used.
+        _size (int): Size of the decoded chunks kept in memory, in bytes.
+        _dic_statistics (dict): Hits, misses, bytes read and decoding time of the chunks.
+        _lock (threading.Lock): Lock protecting the decoded chunks.
+
+    Methods:
+        __init__(path, memory_limit=2**28): Initialize the CompressedSpectra class.
+        exists(path): Return True if compressed files exist for a given path.
+        return_chunk(idx_chunk, keep=True): Return a decoded chunk.
+        return_range(start, stop): Return the decoded spectra of a range of peaks.
+        return_pixel_range(array_lookup_pixels, idx_pix_1, idx_pix_2): Return the decoded spectra
+            of a range of pixels, along with the corresponding lookup table.
+        to_array(): Return the whole decoded array.
+        return_statistics(): Return the statistics of the decoded chunks cache.
+    """
+
+    def __init__(self, path, memory_limit=2**28):
+        """Initialize the class CompressedSpectra.
+
+        Args:
+            path (str): Path of the compressed files, without extension (e.g. path_data +
+                "array_spectra_1").
+            memory_limit (int, optional): Maximum size of the decoded chunks kept in memory, in
+                bytes. Defaults to 256MB.
+        """
+        self.path = path
+        self.memory_limit = memory_limit
+        with np.load(path + "_index.npz") as npzfile:
+            self._array_boundaries = npzfile["array_boundaries"]
+            self._array_offsets = npzfile["array_offsets"]
+            self._array_split = npzfile["array_split"]
+            self._array_codes = npzfile["array_codes"]
+            self.intensity_error = float(npzfile["intensity_error"])
+        self.shape = (2, int(self._array_boundaries[-1]))
+        self.dtype = np.dtype(np.float32)
+        self.ndim = 2
+        self._fd = os.open(path + ".lbs", os.O_RDONLY)
+        self._dic_chunks = OrderedDict()
+        self._size = 0
+        self._dic_statistics = {"hits": 0, "misses": 0, "bytes_read": 0, "decode_seconds": 0.0}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def exists(path):
+        """This function checks if the compressed files of a slice exist.
+
+        Args:
+            path (str): Path of the compressed files, without extension.
+
+        Returns:
+            (bool): True if both the compressed data and its index exist.
+        """
+        return os.path.exists(path + ".lbs") and os.path.exists(path + "_index.npz")
+
+    # ==============================================================================================
+    # --- Methods
+    # ==============================================================================================
+
+    def __len__(self):
+        """This function returns the length of the first dimension, as for a numpy array."""
+        return self.shape[0]
+
+    def return_chunk(self, idx_chunk, keep=True):
+        """This function returns a decoded chunk, reading and decoding it if it's not in memory.
+
+        Args:
+            idx_chunk (int): Index of the chunk.
+            keep (bool, optional): If True, the decoded chunk is kept in memory. Defaults to True.
+
+        Returns:
+            (np.ndarray): A read-only array of shape (2,k) containing the spectrum data of the
+                chunk.
+        """
+        with self._lock:
+            array_chunk = self._dic_chunks.get(idx_chunk, None)
+            if array_chunk is not None:
+                self._dic_chunks.move_to_end(idx_chunk)
+                self._dic_statistics["hits"] += 1
+                return array_chunk
+            self._dic_statistics["misses"] += 1
+
+        # Read and decode outside of the lock, pread being safe to use from several threads
+        time_start = time.perf_counter()
+        offset = int(self._array_offsets[idx_chunk])
+        size = int(self._array_offsets[idx_chunk + 1]) - offset
+        buffer = os.pread(self._fd, size, offset)
+        split = int(self._array_split[idx_chunk])
+        array_chunk = decode_chunk(
+            buffer[:split], buffer[split:], self._array_codes[idx_chunk], self.intensity_error
+        )
+        array_chunk.flags.writeable = False
+
+        with self._lock:
+            self._dic_statistics["bytes_read"] += size
+            self._dic_statistics["decode_seconds"] += time.perf_counter() - time_start
+            if keep and array_chunk.nbytes <= self.memory_limit:
+                if idx_chunk not in self._dic_chunks:
+                    self._size += array_chunk.nbytes
+                self._dic_chunks[idx_chunk] = array_chunk
+                while self._size > self.memory_limit:
+                    _, array_evicted = self._dic_chunks.popitem(last=False)
+                    self._size -= array_evicted.nbytes
+        return array_chunk
+
+    def return_range(self, start, stop):
+        """This function returns the decoded spectra of a range of peaks.
+
+        Args:
+            start (int): Index of the first peak.
+            stop (int): Index following the last peak.
+
+        Returns:
+            (np.ndarray): An array of shape (2, stop-start) containing the spectrum data of the
+                peaks. It's read-only if the range lies in a single chunk.
+        """
+        if stop <= start:
+            return np.empty((2, 0), dtype=np.float32)
+        idx_chunk_1 = int(np.searchsorted(self._array_boundaries, start, side="right")) - 1
+        idx_chunk_2 = int(np.searchsorted(self._array_boundaries, stop - 1, side="right")) - 1
+        l_arrays = []
+        for idx_chunk in range(idx_chunk_1, idx_chunk_2 + 1):
+            lb = max(start, int(self._array_boundaries[idx_chunk]))
+            hb = min(stop, int(self._array_boundaries[idx_chunk + 1]))
+            offset = int(self._array_boundaries[idx_chunk])
+            l_arrays.append(self.return_chunk(idx_chunk)[:, lb - offset : hb - offset])
+        if len(l_arrays) == 1:
+            return l_arrays[0]
+        return np.concatenate(l_arrays, axis=1)
+
+    def __getitem__(self, key):
+        """This function returns the decoded spectra as if the object was the (2,n) array it
+        replaces.
+
+        Args:
+            key (int, slice or tuple): The requested row(s) and column(s).
+
+        Returns:
+            (np.ndarray or float): The requested values.
+        """
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+        key_row, key_column = key
+        if isinstance(key_column, slice):
+            start, stop, step = key_column.indices(self.shape[1])
+            if step == 1:
+                return self.return_range(start, stop)[key_row]
+            return self.to_array()[key_row, key_column]
+        elif isinstance(key_column, (int, np.integer)):
+            index = int(key_column) + (self.shape[1] if key_column < 0 else 0)
+            if index < 0 or index >= self.shape[1]:
+                raise IndexError("Index " + str(key_column) + " is out of bounds")
+            return self.return_range(index, index + 1)[key_row, 0]
+        return self.to_array()[key]
+
+    def return_pixel_range(self, array_lookup_pixels, idx_pix_1, idx_pix_2):
+        """This function returns the decoded spectra of a range of pixels, along with a copy of the
+        lookup table in which the boundaries of these pixels refer to the returned array (and
+        those of the other pixels are set to -1).
+
+        Args:
+            array_lookup_pixels (np.ndarray): An array of shape (m,2) containing the boundary
+                indices of each pixel in the whole array_spectra.
+            idx_pix_1 (int): Index of the first pixel.
+            idx_pix_2 (int): Index of the last pixel (included).
+
+        Returns:
+            (np.ndarray): An array of shape (2,k) containing the spectra of the pixels.
+            (np.ndarray): The corresponding lookup table, of shape (m,2).
+        """
+        array_lookup_range = array_lookup_pixels[idx_pix_1 : idx_pix_2 + 1]
+        array_lookup_shifted = np.full_like(array_lookup_pixels, -1)
+        array_non_empty = np.flatnonzero(array_lookup_range[:, 0] >= 0)
+        if array_non_empty.shape[0] == 0:
+            return np.empty((2, 0), dtype=np.float32), array_lookup_shifted
+        start = int(array_lookup_range[array_non_empty[0], 0])
+        stop = int(array_lookup_range[array_non_empty[-1], 1]) + 1
+        array_lookup_shifted[idx_pix_1 : idx_pix_2 + 1] = np.where(
+            array_lookup_range >= 0, array_lookup_range - start, -1
+        )
+        return self.return_range(start, stop), array_lookup_shifted
+
+    def to_array(self):
+        """This function decodes the whole spectral data. The decoded chunks are not kept in
+        memory, to avoid evicting the working set.
+
+        Returns:
+            (np.ndarray): An array of shape (2,n) containing spectrum data (m/z and intensity) for
+                each pixel.
+        """
+        array_spectra = np.empty(self.shape, dtype=np.float32)
+        for idx_chunk in range(self._array_boundaries.shape[0] - 1):
+            lb, hb = self._array_boundaries[idx_chunk], self._array_boundaries[idx_chunk + 1]
+            array_spectra[:, lb:hb] = self.return_chunk(idx_chunk, keep=False)
+        return array_spectra
+
+    def return_statistics(self):
+        """This function returns the statistics of the decoded chunks cache.
+
+        Returns:
+            (dict): The number of hits and misses, the number of bytes read and the time spent
+                decoding, along with the number of chunks, the size (in bytes) of the decoded
+                chunks kept in memory and its limit.
+        """
+        with self._lock:
+            dic_statistics = dict(self._dic_statistics)
+            dic_statistics["chunks"] = len(self._dic_chunks)
+            dic_statistics["size_bytes"] = self._size
+            dic_statistics["size_limit_bytes"] = self.memory_limit
+        return dic_statistics
@@ -18,7 +18,7 @@ from numba import njit
 # ==================================================================================================
 
 
-@njit
+@njit(cache=True, nogil=True)
 def filter_voxels(
     array_data_stripped,
     coordinates_stripped,
@@ -92,7 +92,7 @@ def filter_voxels(
 
 
 # * This function could be optimized by turning keep_structure_id into a set
-@njit
+@njit(cache=True, nogil=True)
 def fill_array_borders(
     array_annotation,
     differentiate_borders=False,
@@ -187,7 +187,7 @@ def fill_array_borders(
 
 
 # Fill the 3D array of expression with the value from the slices
-@njit
+@njit(cache=True, nogil=True)
 def fill_array_slices(
     array_x,
     array_y,
@@ -236,7 +236,7 @@ def fill_array_slices(
     return array_slices
 
 
-@njit
+@njit(cache=True, nogil=True)
 def fill_array_interpolation(
     array_annotation,
     array_slices,
@@ -331,7 +331,7 @@ def fill_array_interpolation(
     return array_interpolated
 
 
-@njit
+@njit(cache=True)
 def crop_array(array_annotation, list_id_regions):
     """Given an array of annotations containing regions as ids, and a list of ids, this functions
     crops the parts of the array that do not contain the regions inside of the list.
@@ -22,12 +22,26 @@ from numba import njit
 import dash_mantine_components as dmc
 
 # LBAE imports
-from app import app, figures, data, storage, atlas, cache_flask
+from app import (
+    app,
+    figures,
+    data,
+    storage,
+    atlas,
+    cache_flask,
+    session_store,
+    export_service,
+    spatial_index,
+    SPECTRUM_MEMORY_LIMIT,
+)
 import config
+from modules.cache_backend import cache_group
+from modules.execution import ExecutionQueueFull
+from modules.export import generate_spectra_table
 from modules.tools.image import convert_image_to_base64
 from modules.tools.spectra import (
     sample_rows_from_path,
-    compute_spectrum_per_row_selection,
+    compute_spectrum_per_row_selection_bounded,
     convert_array_to_fine_grained,
     strip_zeros,
     add_zeros_to_spectrum,
@@ -130,6 +144,17 @@ def return_layout(basic_config, slice_index=1):
                         },
                         className="position-absolute",
                     ),
+                    dbc.Progress(
+                        id="page-3-progress-bar-spectra",
+                        color="#338297",
+                        className="d-none",
+                        style={
+                            "right": "1%",
+                            "top": "5.5em",
+                            "width": "13em",
+                            "position": "absolute",
+                        },
+                    ),
                     dmc.Group(
                         spacing=0,
                         style={
@@ -823,7 +848,14 @@ def return_layout(basic_config, slice_index=1):
                             dmc.Center(
                                 className="w-100",
                                 children=[
-                                    dcc.Download(id="page-3-download-data"),
+                                    # The exported file is downloaded through a hidden frame
+                                    html.Iframe(
+                                        id="page-3-iframe-export", style={"display": "none"}
+                                    ),
+                                    dcc.Store(id="page-3-dcc-store-export-job"),
+                                    dcc.Interval(
+                                        id="page-3-interval-export", interval=500, disabled=True
+                                    ),
                                 ],
                             ),
                         ],
@@ -1353,9 +1385,16 @@ expression in the selected regions as a png file."""
 
 
 # Global function to memoize/compute spectrum
-@cache_flask.memoize()
+@cache_group("region_spectra")
+@cache_flask.memoize(args_to_ignore=["set_progress"])
 def global_spectrum_store(
-    slice_index, l_shapes_and_masks, l_mask_name, relayoutData, as_enrichment, log_transform
+    slice_index,
+    l_shapes_and_masks,
+    l_mask_name,
+    relayoutData,
+    as_enrichment,
+    log_transform,
+    set_progress=None,
 ):
     """This function computes and returns the average spectra for the selected regions.
 
@@ -1371,6 +1410,9 @@ def global_spectrum_store(
         as_enrichment (bool): If True, the average spectrum in the selected region is normalized
             with respect to the average spectrum of the whole slice.
         log_transform (bool): If True, the average spectrum is computed from log-transformed data.
+        set_progress: Used as part of the Plotly long callbacks, to indicate the progress of the
+            computation in the corresponding progress bar. It's not part of the memoization key.
+            Defaults to None.
 
     Returns:
         (list(np.ndarray)): A list of numpy arrays, each corresponding to the spectral data of a
@@ -1385,8 +1427,10 @@ def global_spectrum_store(
     logging.info("Computing spectra now")
 
     # Loop over all user-draw regions and pre-existing masks
-    for shape in l_shapes_and_masks:
+    for idx_shape, shape in enumerate(l_shapes_and_masks):
         grah_scattergl_data = None
+        if set_progress is not None:
+            set_progress((int(100 * idx_shape / len(l_shapes_and_masks)), "Computing spectra..."))
         # Compute average spectrum from mask
         if shape[0] == "mask":
             idx_mask += 1
@@ -1448,22 +1492,50 @@ def global_spectrum_store(
                         np.array(path, dtype=np.int32)
                     )
 
+                    # Merge the precomputed spectra of the tiles covered by the selection
                     grah_scattergl_data = compute_thread_safe_function(
-                        compute_spectrum_per_row_selection,
+                        spatial_index.compute_spectrum,
                         cache_flask,
                         data,
                         slice_index,
                         list_index_bound_rows,
                         list_index_bound_column_per_row,
-                        data.get_array_spectra(slice_index),
-                        data.get_array_lookup_pixels(slice_index),
-                        data.get_image_shape(slice_index),
-                        data.get_array_peaks_transformed_lipids(slice_index),
-                        data.get_array_corrective_factors(slice_index).astype(np.float32),
-                        zeros_extend=False,
-                        apply_correction=False,
+                        # Long callback jobs run in a process which is terminated when the job
+                        # is done, so they can only use an index which has already been shelved
+                        build_missing=set_progress is None,
+                        task_class="heavy",
                     )
 
+                    # If the index of the slice is not available yet, sum all the selected peaks
+                    # by blocks of rows, loading only the spectra of the rows of the current block
+                    if grah_scattergl_data is None:
+                        grah_scattergl_data = compute_thread_safe_function(
+                            compute_spectrum_per_row_selection_bounded,
+                            cache_flask,
+                            data,
+                            slice_index,
+                            list_index_bound_rows,
+                            list_index_bound_column_per_row,
+                            None,
+                            data.get_array_lookup_pixels(slice_index),
+                            data.get_image_shape(slice_index),
+                            data.get_array_peaks_transformed_lipids(slice_index),
+                            data.get_array_corrective_factors(slice_index).astype(np.float32),
+                            zeros_extend=False,
+                            apply_correction=False,
+                            memory_limit_bytes=SPECTRUM_MEMORY_LIMIT,
+                            set_progress=return_shape_progress(
+                                set_progress, idx_shape, len(l_shapes_and_masks)
+                            ),
+                            return_array_spectra_rows=lambda row_1, row_2: (
+                                data.get_array_spectra_rows(slice_index, row_1, row_2)
+                            ),
+                            task_class="heavy",
+                        )
+
+            # The server is overloaded, the spectrum must not be memoized as missing
+            except ExecutionQueueFull:
+                raise
             except Exception as e:
                 logging.warning("Bug, the selected path does't exist")
                 logging.warning(e)
@@ -1497,6 +1569,7 @@ def global_spectrum_store(
                         10**-3,
                         lb=350,
                         hb=1250,
+                        task_class="heavy",
                     )[1, :]
                     + 1
                 )
@@ -1517,9 +1590,183 @@ def global_spectrum_store(
     return l_spectra
 
 
+def return_shape_progress(set_progress, idx_shape, n_shapes):
+    """This function returns a function reporting the progress of the computation of the spectrum
+    of one of the selected regions, as a fraction of the progress of the whole selection.
+
+    Args:
+        set_progress: Used as part of the Plotly long callbacks, to indicate the progress of the
+            computation in the corresponding progress bar. May be None.
+        idx_shape (int): Index of the region being computed.
+        n_shapes (int): Number of selected regions.
+
+    Returns:
+        (func): The function reporting the progress of the region, or None if set_progress is None.
+    """
+    if set_progress is None:
+        return None
+
+    def set_shape_progress(progress):
+        set_progress((int((100 * idx_shape + progress[0]) / n_shapes), progress[1]))
+
+    return set_shape_progress
+
+
+def return_session_spectra(
+    session_id, reference_spectra, slice_index, l_shapes_and_masks, l_mask_name, relayoutData
+):
+    """This function returns the spectra of the selected regions recorded for the current session,
+    along with their lipid labels. If they're not in the session store of the current process (e.g.
+    if they expired, or were recorded by another worker), they are recomputed from the current
+    selection, and recorded again under the same reference.
+
+    Args:
+        session_id (str): Id of the session.
+        reference_spectra (str): Reference of the spectra in the session store.
+        slice_index (int): Index of the selected slice.
+        l_shapes_and_masks (list): A list of either user-draw regions, or pre-existing masks.
+        l_mask_name (list(str)): Names of the masks present in l_shapes_and_masks.
+        relayoutData (dict): Relayout data containing the paths of the user-draw regions.
+
+    Returns:
+        (dict): A dictionnary containing the slice index, the list of spectra (l_spectra) and the
+            corresponding list of lipid labels (ll_idx_labels), or None if the spectra could not be
+            computed.
+    """
+    dic_spectra = session_store.get(session_id, reference_spectra)
+    if dic_spectra is None:
+        logging.info("Spectra not found in the session store, recomputing them now")
+        l_spectra = global_spectrum_store(
+            slice_index, l_shapes_and_masks, l_mask_name, relayoutData, False, False
+        )
+        if l_spectra is None:
+            return None
+        dic_spectra = {
+            "slice_index": slice_index,
+            "l_spectra": l_spectra,
+            "ll_idx_labels": global_lipid_index_store(data, slice_index, l_spectra),
+        }
+        session_store.set(session_id, dic_spectra, reference=reference_spectra)
+    return dic_spectra
+
+
+def compute_spectrum_traces(slice_index, spectrum, l_idx_labels):
+    """This function splits a spectrum into its annotated and not-annotated peaks, padded with
+    zeros, along with the label of each annotated peak. It is used both to plot and to export the
+    spectra of the selected regions.
+
+    Args:
+        slice_index (int): Index of the selected slice.
+        spectrum (np.ndarray): Spectrum of a selected region, with m/z values on the first row and
+            intensities on the second row.
+        l_idx_labels (np.ndarray): Index of the lipid annotation of each peak, -1 if not annotated.
+
+    Returns:
+        (tuple): The m/z values, intensities and labels of the annotated peaks, followed by the m/z
+            values and intensities of the not-annotated peaks.
+    """
+    # Compute (again) the numpy array of the spectrum
+    grah_scattergl_data = np.array(spectrum, dtype=np.float32)
+
+    # Two different functions so that's there's a unique output for each numba function
+    l_idx_kept = return_idx_sup(l_idx_labels)
+    l_idx_unkept = return_idx_inf(l_idx_labels)
+
+    # Pad annotated trace with zeros
+    (
+        grah_scattergl_data_padded_annotated,
+        array_index_padding,
+    ) = add_zeros_to_spectrum(
+        grah_scattergl_data[:, l_idx_kept],
+        pad_individual_peaks=True,
+        padding=10**-4,
+    )
+    l_mz_with_lipids = grah_scattergl_data_padded_annotated[0, :]
+    l_intensity_with_lipids = grah_scattergl_data_padded_annotated[1, :]
+    l_idx_labels_kept = l_idx_labels[l_idx_kept]
+
+    # @njit # We need to wait for the support of np.insert, still relatively fast anyway
+    def pad_l_idx_labels(l_idx_labels_kept, array_index_padding):
+        pad = 0
+        # The initial condition in the loop is only evaluated once so no problem with
+        # insertion afterwards
+        for i in range(len(l_idx_labels_kept)):
+            # Array_index_padding[i] will be 0 or 2 (peaks are padded with 2 zeros, one
+            # on each side)
+            for j in range(array_index_padding[i]):
+                # i+1 instead of i plus insert on the right of the element i
+                l_idx_labels_kept = np.insert(l_idx_labels_kept, i + 1 + pad, -1)
+                pad += 1
+        return l_idx_labels_kept
+
+    l_idx_labels_kept = list(pad_l_idx_labels(l_idx_labels_kept, array_index_padding))
+
+    # Rebuild lipid name from structure, cation, etc.
+    l_labels_all_lipids = data.compute_l_labels(slice_index)
+    l_labels = [l_labels_all_lipids[idx] if idx != -1 else "" for idx in l_idx_labels_kept]
+
+    # Pad not annotated traces peaks with zeros
+    grah_scattergl_data_padded, array_index_padding = add_zeros_to_spectrum(
+        grah_scattergl_data[:, l_idx_unkept],
+        pad_individual_peaks=True,
+        padding=10**-4,
+    )
+    l_mz_without_lipids = grah_scattergl_data_padded[0, :]
+    l_intensity_without_lipids = grah_scattergl_data_padded[1, :]
+
+    return (
+        l_mz_with_lipids,
+        l_intensity_with_lipids,
+        l_labels,
+        l_mz_without_lipids,
+        l_intensity_without_lipids,
+    )
+
+
+@app.long_callback(
+    output=Output("page-3-dcc-store-spectra-computed", "data"),
+    inputs=[
+        Input("page-3-button-compute-spectra", "n_clicks"),
+        State("main-slider", "data"),
+        State("page-3-dropdown-brain-regions", "value"),
+        State("dcc-store-shapes-and-masks", "data"),
+        State("page-3-graph-heatmap-per-sel", "relayoutData"),
+    ],
+    running=[
+        (Output("page-3-progress-bar-spectra", "className"), "", "d-none"),
+        (Output("page-3-button-compute-spectra", "loading"), True, False),
+    ],
+    progress=[
+        Output("page-3-progress-bar-spectra", "value"),
+        Output("page-3-progress-bar-spectra", "label"),
+    ],
+    prevent_initial_call=True,
+)
+def page_3_compute_spectra(
+    set_progress, clicked_compute, slice_index, l_mask_name, l_shapes_and_masks, relayoutData
+):
+    """This long callback is used to compute the average spectrum of the selected region(s) when
+    clicking on the compute spectra button, displaying the progress of the computation. The spectra
+    are memoized, such that page_3_record_spectra() then records them in the session store."""
+    if clicked_compute is None or len(l_shapes_and_masks) == 0:
+        return dash.no_update
+    set_progress((0, "Computing spectra..."))
+    global_spectrum_store(
+        slice_index,
+        l_shapes_and_masks,
+        l_mask_name,
+        relayoutData,
+        False,
+        False,
+        set_progress=set_progress,
+    )
+    set_progress((100, "Done"))
+    return clicked_compute
+
+
 @app.callback(
     Output("dcc-store-list-mz-spectra", "data"),
-    Input("page-3-button-compute-spectra", "n_clicks"),
+    Input("page-3-dcc-store-spectra-computed", "data"),
     Input("page-3-dcc-store-path-heatmap", "data"),
     Input("page-3-reset-button", "n_clicks"),
     Input("url", "pathname"),
@@ -1542,7 +1789,7 @@ def page_3_record_spectra(
     session_id,
 ):
     """This callback is used to compute and record the average spectrum of the selected
-    region(s)."""
+    region(s) in the session store. Only the reference of the record is sent to the browser."""
 
     # Deactivated switches
     as_enrichment = False
@@ -1559,10 +1806,12 @@ def page_3_record_spectra(
 
     # Delete everything when clicking reset
     elif id_input == "page-3-reset-button" or id_input == "url":
+        session_store.delete(session_id)
         return []
 
-    # If the user clicked on the button after drawing a region and/or selecting a structure
-    elif id_input == "page-3-button-compute-spectra" and len(l_shapes_and_masks) > 0:
+    # If the spectra of the selected region(s) have been computed, after the user clicked on the
+    # button
+    elif id_input == "page-3-dcc-store-spectra-computed" and len(l_shapes_and_masks) > 0:
         logging.info("Starting to compute spectrum")
 
         l_spectra = global_spectrum_store(
@@ -1571,12 +1820,21 @@ def page_3_record_spectra(
 
         if l_spectra is not None:
             if l_spectra != []:
-                logging.info("Spectra computed, returning it now")
-                # Return a dummy variable to indicate that the spectrum has been computed and
-                # trigger the callback
-                return "ok"
+                logging.info("Spectra computed, recording it now")
+                # Only the last selection of the session is kept
+                session_store.delete(session_id)
+                # Return the reference of the spectra to trigger the plotting callbacks
+                return session_store.set(
+                    session_id,
+                    {
+                        "slice_index": slice_index,
+                        "l_spectra": l_spectra,
+                        "ll_idx_labels": global_lipid_index_store(data, slice_index, l_spectra),
+                    },
+                )
         logging.warning("A bug appeared during spectrum computation")
 
+    session_store.delete(session_id)
     return []
 
 
@@ -1588,21 +1846,20 @@ def page_3_record_spectra(
     State("page-3-dropdown-brain-regions", "value"),
     State("dcc-store-shapes-and-masks", "data"),
     State("page-3-graph-heatmap-per-sel", "relayoutData"),
+    State("session-id", "data"),
     prevent_intial_call=True,
 )
 def page_3_plot_spectrum(
     cliked_reset,
-    l_spectra,
+    reference_spectra,
     slice_index,
     l_mask_name,
     l_shapes_and_masks,
     relayoutData,
+    session_id,
 ):
-    """This callback is used to plot the spectra of the selected region(s)."""
-
-    # Deactivated switches
-    as_enrichment = False
-    log_transform = False
+    """This callback is used to plot the spectra of the selected region(s), read from the session
+    store."""
 
     # Find out which input triggered the function
     id_input = dash.callback_context.triggered[0]["prop_id"].split(".")[0]
@@ -1613,70 +1870,35 @@ def page_3_plot_spectrum(
         return dash.no_update
 
     # Delete everything when clicking reset
-    elif id_input == "page-3-reset-button" or l_spectra is None or l_spectra == []:
+    elif id_input == "page-3-reset-button" or reference_spectra is None or reference_spectra == []:
         return figures.return_empty_spectrum()
 
-    # Do nothing if l_spectra is None or []
+    # Do nothing if no spectra have been recorded
     elif id_input == "dcc-store-list-mz-spectra":
-        if len(l_spectra) > 0 or l_spectra == "ok":
+        dic_spectra = return_session_spectra(
+            session_id,
+            reference_spectra,
+            slice_index,
+            l_shapes_and_masks,
+            l_mask_name,
+            relayoutData,
+        )
+        if dic_spectra is not None:
             logging.info("Starting spectra plotting now")
             fig_mz = go.Figure()
-
-            # Compute the average spectra
-            l_spectra = global_spectrum_store(
-                slice_index,
-                l_shapes_and_masks,
-                l_mask_name,
-                relayoutData,
-                as_enrichment,
-                log_transform,
-            )
-            ll_idx_labels = global_lipid_index_store(data, slice_index, l_spectra)
-            for idx_spectra, (spectrum, l_idx_labels) in enumerate(zip(l_spectra, ll_idx_labels)):
+            for idx_spectra, (spectrum, l_idx_labels) in enumerate(
+                zip(dic_spectra["l_spectra"], dic_spectra["ll_idx_labels"])
+            ):
                 # Find color of the current spectrum
                 col = config.l_colors[idx_spectra % 4]
 
-                # Compute (again) the numpy array of the spectrum
-                grah_scattergl_data = np.array(spectrum, dtype=np.float32)
-
-                # Two different functions so that's there's a unique output for each numba function
-                l_idx_kept = return_idx_sup(l_idx_labels)
-                l_idx_unkept = return_idx_inf(l_idx_labels)
-
-                # Pad annotated trace with zeros
                 (
-                    grah_scattergl_data_padded_annotated,
-                    array_index_padding,
-                ) = add_zeros_to_spectrum(
-                    grah_scattergl_data[:, l_idx_kept],
-                    pad_individual_peaks=True,
-                    padding=10**-4,
-                )
-                l_mz_with_lipids = grah_scattergl_data_padded_annotated[0, :]
-                l_intensity_with_lipids = grah_scattergl_data_padded_annotated[1, :]
-                l_idx_labels_kept = l_idx_labels[l_idx_kept]
-
-                # @njit # We need to wait for the support of np.insert, still relatively fast anyway
-                def pad_l_idx_labels(l_idx_labels_kept, array_index_padding):
-                    pad = 0
-                    # The initial condition in the loop is only evaluated once so no problem with
-                    # insertion afterwards
-                    for i in range(len(l_idx_labels_kept)):
-                        # Array_index_padding[i] will be 0 or 2 (peaks are padded with 2 zeros, one
-                        # on each side)
-                        for j in range(array_index_padding[i]):
-                            # i+1 instead of i plus insert on the right of the element i
-                            l_idx_labels_kept = np.insert(l_idx_labels_kept, i + 1 + pad, -1)
-                            pad += 1
-                    return l_idx_labels_kept
-
-                l_idx_labels_kept = list(pad_l_idx_labels(l_idx_labels_kept, array_index_padding))
-
-                # Rebuild lipid name from structure, cation, etc.
-                l_labels_all_lipids = data.compute_l_labels(slice_index)
-                l_labels = [
-                    l_labels_all_lipids[idx] if idx != -1 else "" for idx in l_idx_labels_kept
-                ]
+                    l_mz_with_lipids,
+                    l_intensity_with_lipids,
+                    l_labels,
+                    l_mz_without_lipids,
+                    l_intensity_without_lipids,
+                ) = compute_spectrum_traces(dic_spectra["slice_index"], spectrum, l_idx_labels)
 
                 # Add annotated trace to plot
                 fig_mz.add_trace(
@@ -1693,15 +1915,6 @@ def page_3_plot_spectrum(
                     )
                 )
 
-                # Pad not annotated traces peaks with zeros
-                grah_scattergl_data_padded, array_index_padding = add_zeros_to_spectrum(
-                    grah_scattergl_data[:, l_idx_unkept],
-                    pad_individual_peaks=True,
-                    padding=10**-4,
-                )
-                l_mz_without_lipids = grah_scattergl_data_padded[0, :]
-                l_intensity_without_lipids = grah_scattergl_data_padded[1, :]
-
                 # Add not-annotated trace to plot.
                 fig_mz.add_trace(
                     go.Scattergl(
@@ -1757,18 +1970,14 @@ def page_3_draw_heatmap_per_lipid_selection(
     sort_switch,
     percentile,
     slice_index,
-    l_spectra,
+    reference_spectra,
     l_mask_name,
     l_shapes_and_masks,
     relayoutData,
     session_id,
 ):
     """This callback is used to plot the heatmap representing the differential lipid expression in
-    the different regions of the current selection."""
-
-    # Deactivated switches
-    as_enrichment = False
-    log_transform = False
+    the different regions of the current selection, from the spectra read from the session store."""
 
     # Find out which input triggered the function
     id_input = dash.callback_context.triggered[0]["prop_id"].split(".")[0]
@@ -1792,18 +2001,21 @@ def page_3_draw_heatmap_per_lipid_selection(
     ):
         scale_switch = False
         # Load figure
-        if l_spectra == "ok":
+        dic_spectra = None
+        if isinstance(reference_spectra, str):
             logging.info("Starting computing heatmap now")
-            # Get the actual values for l_spectra and ll_idx_labels and not just the dummy fillings
-            l_spectra = global_spectrum_store(
+            # Get the actual values for l_spectra and ll_idx_labels from their reference
+            dic_spectra = return_session_spectra(
+                session_id,
+                reference_spectra,
                 slice_index,
                 l_shapes_and_masks,
                 l_mask_name,
                 relayoutData,
-                as_enrichment,
-                log_transform,
             )
-            ll_idx_labels = global_lipid_index_store(data, slice_index, l_spectra)
+        if dic_spectra is not None:
+            l_spectra = dic_spectra["l_spectra"]
+            ll_idx_labels = dic_spectra["ll_idx_labels"]
             if len(l_spectra) > 0:
                 if len(ll_idx_labels) != len(l_spectra):
                     print(
@@ -1902,64 +2114,91 @@ def page_3_draw_heatmap_per_lipid_selection(
 
 
 @app.callback(
-    Output("page-3-download-data", "data"),
+    Output("page-3-dcc-store-export-job", "data"),
+    Output("page-3-iframe-export", "src"),
     Input("page-3-download-data-button", "n_clicks"),
-    State("page-3-graph-spectrum-per-pixel", "figure"),
+    State("dcc-store-list-mz-spectra", "data"),
+    State("main-slider", "data"),
+    State("page-3-dropdown-brain-regions", "value"),
+    State("dcc-store-shapes-and-masks", "data"),
+    State("page-3-graph-heatmap-per-sel", "relayoutData"),
+    State("session-id", "data"),
     prevent_initial_call=True,
 )
-def page_3_download(n_clicks, fig_mz):
+def page_3_download(
+    n_clicks,
+    reference_spectra,
+    slice_index,
+    l_mask_name,
+    l_shapes_and_masks,
+    relayoutData,
+    session_id,
+):
     """This callback is used to download the spectra of the selected regions when clicking the
-    corresponding button."""
+    corresponding button. The spectra are read from the session store and exported in the
+    background, the hidden frame downloading the file from the streaming route of the export."""
 
     # Check that there's spectral data to download in the first place
-    if fig_mz is not None:
-        fig_mz = go.Figure(data=fig_mz)
-        if len(fig_mz.data) > 1:
-            # Excel writer for download
-            def to_excel(bytes_io):
-                xlsx_writer = pd.ExcelWriter(bytes_io, engine="xlsxwriter")
-                for i, data in enumerate(fig_mz.data):
-                    if i % 2 == 0:
-                        df = pd.DataFrame.from_dict(
-                            {
-                                "m/z": data["x"],
-                                "Intensity": data["y"],
-                                "Lipid": data["text"],
-                            }
-                        )
-                        df.to_excel(
-                            xlsx_writer,
-                            index=False,
-                            sheet_name="Annotated spectrum sel " + str(i // 2 + 1),
-                        )
-                    else:
-                        df = pd.DataFrame.from_dict({"m/z": data["x"], "Intensity": data["y"]})
-                        df.to_excel(
-                            xlsx_writer,
-                            index=False,
-                            sheet_name="Remaining spectrum sel " + str(i // 2 + 1),
-                        )
-                xlsx_writer.save()
+    if isinstance(reference_spectra, str):
+        dic_spectra = return_session_spectra(
+            session_id,
+            reference_spectra,
+            slice_index,
+            l_shapes_and_masks,
+            l_mask_name,
+            relayoutData,
+        )
+        if dic_spectra is not None and len(dic_spectra["l_spectra"]) > 0:
+            # Parquet is more compact, but can only be downloaded once complete
+            format_export = "parquet" if "parquet" in export_service.return_formats() else "csv"
+            job_id = export_service.submit(
+                session_id,
+                "my_region_selection_data",
+                format_export,
+                generate_spectra_table,
+                slice_index=dic_spectra["slice_index"],
+                l_spectra=dic_spectra["l_spectra"],
+                ll_idx_labels=dic_spectra["ll_idx_labels"],
+                l_labels_all_lipids=data.compute_l_labels(dic_spectra["slice_index"]),
+            )
+            return job_id, "/export/" + job_id + "/download?session_id=" + session_id
 
-            return dcc.send_data_frame(to_excel, "my_region_selection_data.xlsx")
+    return dash.no_update, dash.no_update
 
-    return dash.no_update
+
+@app.callback(
+    Output("page-3-download-data-button", "children"),
+    Output("page-3-download-data-button", "loading"),
+    Output("page-3-interval-export", "disabled"),
+    Input("page-3-dcc-store-export-job", "data"),
+    Input("page-3-interval-export", "n_intervals"),
+    State("session-id", "data"),
+    prevent_initial_call=True,
+)
+def page_3_export_progress(job_id, n_intervals, session_id):
+    """This callback is used to display the progress of the export of the spectra in the download
+    button, until the export is complete."""
+    dic_status = export_service.return_status(job_id, session_id) if job_id is not None else None
+    if dic_status is None or dic_status["status"] in ["done", "failed"]:
+        if dic_status is not None and dic_status["status"] == "failed":
+            logging.warning("The export of the spectra failed: " + str(dic_status["error"]))
+        return "Download spectrum data", False, True
+    return "Exporting... " + str(int(100 * dic_status["progress"])) + "%", True, False
 
 
 @app.callback(
     Output("page-3-download-data-button", "disabled"),
     Output("page-3-download-plot-button", "disabled"),
     Output("page-3-download-heatmap-button", "disabled"),
-    Input("page-3-graph-spectrum-per-pixel", "figure"),
+    Input("dcc-store-list-mz-spectra", "data"),
 )
-def page_3_reset_download(fig_mz):
-    """This callback is used to deactivate the download buttons if no region has been drawn."""
-
-    # Check the presence of spectral data in the corresponding figure
-    if fig_mz is not None:
-        fig_mz = go.Figure(data=fig_mz)
-        if len(fig_mz.data) > 1:
-            return False, False, False
+def page_3_reset_download(reference_spectra):
+    """This callback is used to deactivate the download buttons if no spectra have been recorded
+    for the selected regions."""
+
+    # Check the presence of a reference to recorded spectra
+    if isinstance(reference_spectra, str):
+        return False, False, False
     return True, True, True
 
 